@@ -5,6 +5,13 @@ from .extensions import db, redis_client
 from .models.base import Base
 from .api.routes import api_blueprint
 from .services.rate_limit_service import init_rate_limiter
+from .services.quota_service import init_quotas
+from .services.circuit_breaker_service import init_circuit_breakers
+from .services.provider_stats_service import init_provider_stats
+from .services.response_cache_service import init_response_cache
+from .services.single_flight_service import init_single_flight
+from .services.image_cache_service import init_image_cache
+from .services.uptime_service import init_uptime_prober
 import logging
 from .providers.provider_manager import ProviderManager
 
@@ -19,6 +26,12 @@ def create_app(config_class=Config):
     db.init_app(app)
     redis_client.init_app(app)
     init_rate_limiter(app)
+    init_quotas(app)
+    init_circuit_breakers(app)
+    init_provider_stats(app)
+    init_response_cache(app)
+    init_single_flight(app)
+    init_image_cache(app)
 
     # Enable CORS for all routes under /v1, allowing any origin.
     # This makes testing on different URLs (localhost, staging, production, etc.) easier.
@@ -27,6 +40,7 @@ def create_app(config_class=Config):
     provider_manager = ProviderManager()
     provider_manager.register_providers(app)
     app.provider_manager = provider_manager
+    init_uptime_prober(app)
 
     app.register_blueprint(api_blueprint, url_prefix='/v1')
 
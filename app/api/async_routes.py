@@ -0,0 +1,182 @@
+# app/api/async_routes.py
+
+import asyncio
+import logging
+from flask import request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from .controllers import (
+    prepare_chat_completion, upstream_unavailable_response, record_failed_attempts, list_models,
+    record_cache_hit, cache_stream_callback
+)
+from ..providers.provider_manager import UPSTREAM_REJECTIONS
+from ..services.api_key_service import validate_api_key_header
+from ..services.quota_service import reserve_quota, settle_quota, release_quota
+from ..services.rate_limit_service import check_rate_limit
+from ..services.response_cache_service import get_cached_completion, replay_stream, store_completion
+from ..services.single_flight_service import arun_once
+from ..services.usage_service import record_request, record_failed_request
+from ..utils.streaming import agenerate_stream
+from ..utils.token_counter import count_tokens
+from ..utils.deadline import is_timeout_error
+
+log = logging.getLogger(__name__)
+
+# Async handlers for the ASGI entry point (asgi.py). They mirror the Flask
+# routes in routes.py and reuse the same controllers; only the provider call
+# and the streaming loop are async. Blocking steps (database, Redis, token
+# counting) run in the default thread pool inside a Flask context.
+
+def _admit_chat_completion(flask_app, data, headers):
+    """
+    Runs the blocking admission steps of a chat completion (API key check,
+    rate limit, validation, token limits) inside a Flask request context.
+
+    Returns (call, None, rate limit headers) when the request may proceed,
+    otherwise (error body, status code, rate limit headers).
+    """
+    with flask_app.test_request_context("/v1/chat/completions", method="POST", headers=headers):
+        if not validate_api_key_header(request):
+            return {"error": "Invalid or missing API key"}, 401, {}
+        rejection, rate_limit_headers = check_rate_limit(request, "text")
+        if rejection:
+            return (*rejection, rate_limit_headers)
+        result = prepare_chat_completion(data, request)
+        if "error" in result:
+            return result, result["status_code"], rate_limit_headers
+        return result, None, rate_limit_headers
+
+def _record_attempts(flask_app, call, attempts):
+    """Records the failed failover attempts; returns the model id that served the request."""
+    with flask_app.app_context():
+        return record_failed_attempts(call["user_id"], call["api_key"], attempts)
+
+def _record_completion(flask_app, call, served_model_id, response):
+    """Counts the completion tokens and records usage for a non-streaming response."""
+    with flask_app.app_context():
+        completion_tokens = count_tokens(
+            [{"role": "assistant", "content": response["choices"][0]["message"]["content"]}],
+            served_model_id,
+            flask_app
+        )
+        record_request(call["user_id"], call["api_key"], served_model_id, call["prompt_tokens"], completion_tokens, response)
+        settle_quota(call["quota"], served_model_id, call["prompt_tokens"], completion_tokens)
+        store_completion(call["cache"], served_model_id, response, completion_tokens)
+
+def _serve_from_cache(flask_app, call):
+    """Looks the request up in the response cache; on a hit records usage and returns (entry, body)."""
+    entry = get_cached_completion(call["cache"])
+    if not entry:
+        return None, None
+    with flask_app.app_context():
+        return entry, record_cache_hit(call, entry)
+
+def _record_failure(flask_app, call, attempts):
+    release_quota(call["quota"])
+    with flask_app.app_context():
+        if attempts:
+            record_failed_attempts(call["user_id"], call["api_key"], attempts)
+        else:
+            record_failed_request(call["user_id"], call["api_key"], call["model_id"])
+
+async def chat_completions(request):
+    """Handles chat completion requests, adding the X-RateLimit-* headers to every response."""
+    request.state.rate_limit_headers = {}
+    response = await _chat_completions(request)
+    response.headers.update(request.state.rate_limit_headers)
+    return response
+
+async def _chat_completions(request):
+    flask_app = request.app.state.flask_app
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Request body must be valid JSON", "status_code": 400}, status_code=400)
+
+    call, status, request.state.rate_limit_headers = await asyncio.to_thread(
+        _admit_chat_completion, flask_app, data, dict(request.headers)
+    )
+    if status is not None:
+        return JSONResponse(call, status_code=status)
+
+    entry, body = await asyncio.to_thread(_serve_from_cache, flask_app, call)
+    if entry:
+        if call["is_stream"]:
+            return StreamingResponse(replay_stream(entry), media_type="text/event-stream", headers={"X-Cache": "HIT"})
+        return JSONResponse(body, status_code=200, headers={"X-Cache": "HIT"})
+
+    rejection = await asyncio.to_thread(reserve_quota, call)
+    if rejection:
+        body, status, headers = rejection
+        return JSONResponse(body, status_code=status, headers=headers)
+
+    provider_manager = flask_app.provider_manager
+    model_id = call["model_id"]
+    deadline = call["deadline"]
+    attempts = []
+    try:
+        if call["is_stream"]:
+            response_stream = await arun_once(call["flight"], lambda: provider_manager.achat_completion(
+                model_id=model_id,
+                messages=call["messages"],
+                stream=True,
+                deadline=deadline,
+                attempts=attempts,
+                candidates=call["candidates"],
+                hedge=call["hedge"],
+                **call["data_for_provider"]
+            ), attempts, stream=True, deadline=deadline)
+            served_model_id = await asyncio.to_thread(_record_attempts, flask_app, call, attempts)
+            return StreamingResponse(
+                agenerate_stream(
+                    response_stream, call["user_id"], call["api_key"], served_model_id, flask_app,
+                    call["prompt_tokens"], deadline=deadline,
+                    on_complete=cache_stream_callback(call, served_model_id),
+                    quota=call["quota"]
+                ),
+                media_type="text/event-stream"
+            )
+
+        response = await arun_once(call["flight"], lambda: provider_manager.achat_completion(
+            model_id=model_id,
+            messages=call["messages"],
+            stream=False,
+            deadline=deadline,
+            attempts=attempts,
+            candidates=call["candidates"],
+            **call["data_for_provider"],
+            app=flask_app
+        ), attempts, deadline=deadline)
+        served_model_id = await asyncio.to_thread(_record_attempts, flask_app, call, attempts)
+        await asyncio.to_thread(_record_completion, flask_app, call, served_model_id, response)
+        return JSONResponse(response, status_code=200)
+    except Exception as e:
+        await asyncio.to_thread(_record_failure, flask_app, call, attempts)
+        if isinstance(e, UPSTREAM_REJECTIONS):
+            body, status, headers = upstream_unavailable_response(e)
+            return JSONResponse(body, status_code=status, headers=headers)
+        if is_timeout_error(e):
+            log.warning(f"Provider timeout for {model_id} after {deadline.elapsed():.1f}s: {e}")
+            return JSONResponse(
+                {"error": f"Upstream provider timed out after {deadline.elapsed():.0f}s.", "status_code": 504},
+                status_code=504
+            )
+        log.error(f"Provider error: {e}")
+        return JSONResponse({"error": str(e), "status_code": 500}, status_code=500)
+
+async def models_list(request):
+    """Lists available models."""
+    with request.app.state.flask_app.app_context():
+        result = list_models()
+    return JSONResponse(result, status_code=result.get("status_code", 200))
+
+async def health_check(request):
+    return JSONResponse({"status": "OK"}, status_code=200)
+
+def build_routes():
+    """Routes served natively by the ASGI app; everything else falls through to Flask."""
+    return [
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/v1/models", models_list, methods=["GET", "POST"]),
+        Route("/health", health_check, methods=["GET"]),
+    ]
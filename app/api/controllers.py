@@ -1,20 +1,84 @@
 # app/api/controllers.py
 
-from flask import jsonify, current_app
+from flask import Response, jsonify, current_app
 from marshmallow import ValidationError
 import logging
-from ..providers.provider_manager import ProviderManager
+import time
+from ..providers.provider_manager import ProviderManager, UPSTREAM_REJECTIONS
 from .schemas import ChatCompletionRequestSchema, ModelListResponseSchema, ImageGenerationRequestSchema
-from ..services.api_key_service import get_api_key_from_request, create_new_api_key, get_api_key_record
+from ..services.api_key_service import get_api_key_from_request, create_new_api_key, get_api_key_record, get_api_key_settings
 from ..services.usage_service import record_request, record_failed_request
+from ..services.quota_service import reserve_quota, settle_quota, release_quota
+from ..services.provider_stats_service import get_stats, score
+from ..services.upstream_budget_service import get_budget_stats
+from ..services.response_cache_service import (
+    cache_policy, cached_response_body, get_cached_completion, replay_stream, store_completion, store_stream
+)
+from ..services.single_flight_service import flight_key, run_once
+from ..services.image_cache_service import image_cache_policy, get_cached_images, store_images, image_response
+from ..services.blob_store_service import json_response, signing_enabled
+from ..services.uptime_service import get_uptime, get_window_stats, probe_models
 from ..utils.token_counter import count_tokens
 from ..config import Config
 from ..utils.streaming import generate_stream
+from ..utils.deadline import Deadline, is_timeout_error
 
 log = logging.getLogger(__name__)
 
-def handle_chat_completion(data, request):
-    """Handles a chat completion request."""
+def _resolve_stream_coalescing(request, api_key):
+    """
+    Decides whether SSE frames should be coalesced for this stream.
+
+    The X-Stream-Coalesce header takes precedence ("off", "on" or a max delay
+    in milliseconds), then the per-key "sse_coalesce" setting, then the global
+    SSE_COALESCE_ENABLED flag. Returns None when coalescing is disabled.
+    """
+    max_delay_ms = Config.SSE_COALESCE_MAX_DELAY_MS
+    enabled = get_api_key_settings(api_key).get("sse_coalesce", Config.SSE_COALESCE_ENABLED)
+
+    header = (request.headers.get("X-Stream-Coalesce") or "").strip().lower()
+    if header in ("off", "false", "0"):
+        enabled = False
+    elif header in ("on", "true"):
+        enabled = True
+    elif header.isdigit():
+        enabled = True
+        max_delay_ms = min(int(header), 1000)
+
+    if not enabled:
+        return None
+    return {"max_bytes": Config.SSE_COALESCE_MAX_BYTES, "max_delay": max_delay_ms / 1000.0}
+
+def upstream_unavailable_response(error):
+    """503 (body, status, headers) for a call rejected by an open circuit breaker, a full bulkhead or a used-up upstream rate limit."""
+    log.warning(str(error))
+    return (
+        {"error": str(error), "status_code": 503},
+        503,
+        {"Retry-After": str(error.retry_after)}
+    )
+
+def _token_limit_error(model_id, prompt_tokens, max_tokens):
+    """Why a request of `prompt_tokens` asking for `max_tokens` (None if unset) exceeds `model_id`'s limits, or None."""
+    model_config = Config.get_model_config(model_id)
+    allowed_input_tokens = model_config.get("max_input_tokens")
+    allowed_output_tokens = model_config.get("max_output_tokens")
+    if prompt_tokens > allowed_input_tokens:
+        return f"Input tokens ({prompt_tokens}) exceed the model's allowed limit of {allowed_input_tokens} per request."
+    if max_tokens is not None and max_tokens > allowed_output_tokens:
+        return (f"Requested max output tokens ({max_tokens}) exceed the model's allowed limit of "
+                f"{allowed_output_tokens} per request.")
+    return None
+
+def prepare_chat_completion(data, request):
+    """
+    Validates a chat completion request and resolves everything needed to call
+    the provider (steps 1-4 below).
+
+    Returns an error dict with a "status_code" when the request is rejected,
+    otherwise a dict describing the provider call. Shared by the WSGI handler
+    below and the async handlers in async_routes.py.
+    """
     # 1. Validate the request data
     schema = ChatCompletionRequestSchema()
     try:
@@ -22,6 +86,9 @@ def handle_chat_completion(data, request):
     except ValidationError as err:
         return {"error": err.messages, "status_code": 400}
 
+    # The request's time budget starts now and bounds every upstream call.
+    deadline = Deadline.for_model(validated_data['model'], request.headers.get("X-Request-Timeout"))
+
     # 2. Get the API key and user
     api_key_record = get_api_key_from_request(request)
     if not api_key_record:
@@ -30,10 +97,12 @@ def handle_chat_completion(data, request):
     api_key = api_key_record.api_key
     user_id = api_key_record.user_id
 
-    # 3. Select a provider
+    # 3. Find the candidates. A canonical group name (or an alias in a group)
+    # may be served by several providers, tried in candidates() order.
     model_id = validated_data['model']
-    provider = current_app.provider_manager.select_provider(model_id)
-    if not provider:
+    candidates = current_app.provider_manager.candidates(model_id)
+    if not candidates:
+        log.warning(f"No provider found for model ID: {model_id}")
         record_failed_request(user_id, api_key, model_id)
         return {"error": f"Model '{model_id}' not supported or provider unavailable.", "status_code": 400}
 
@@ -49,61 +118,162 @@ def handle_chat_completion(data, request):
         data_for_provider["modalities"] = validated_data.get("modalities")
         data_for_provider["audio"] = validated_data.get("audio")
 
-    # 4. Check token limits using model-specific configuration
+    # 4. Check token limits using model-specific configuration. Candidates
+    # whose limits the request exceeds are left out; the request is rejected
+    # (with the first candidate's limits) only when none of them is left.
     messages = validated_data['messages']
     prompt_tokens = count_tokens(messages, model_id, current_app)
-    model_config = Config.get_model_config(model_id)
-    allowed_input_tokens = model_config.get("max_input_tokens")
-    allowed_output_tokens = model_config.get("max_output_tokens")
-
-    # Validate the prompt (input) tokens
-    if prompt_tokens > allowed_input_tokens:
+    fitting = []
+    limit_error = None
+    for candidate in candidates:
+        error = _token_limit_error(candidate, prompt_tokens, validated_data.get("max_tokens"))
+        if error is None:
+            fitting.append(candidate)
+        elif limit_error is None:
+            limit_error = error
+    if not fitting:
         record_failed_request(user_id, api_key, model_id)
-        return {
-            "error": f"Input tokens ({prompt_tokens}) exceed the model's allowed limit of {allowed_input_tokens} per request.",
-            "status_code": 400
-        }
+        return {"error": limit_error, "status_code": 400}
+    candidates = fitting
+    provider = current_app.provider_manager.select_provider(candidates[0])
 
-    # Validate the requested max output tokens, if supplied.
-    # If not supplied, default to the allowed maximum.
-    requested_max_tokens = validated_data.get("max_tokens", allowed_output_tokens)
-    if requested_max_tokens > allowed_output_tokens:
-        record_failed_request(user_id, api_key, model_id)
-        return {
-            "error": f"Requested max output tokens ({requested_max_tokens}) exceed the model's allowed limit of {allowed_output_tokens} per request.",
-            "status_code": 400
-        }
-    # Overwrite the value in the payload for consistency with provider calls.
+    # If max_tokens is not supplied, default to the first candidate's allowed
+    # maximum, and overwrite the value in the payload for consistency with
+    # provider calls.
+    requested_max_tokens = validated_data.get("max_tokens",
+                                              Config.get_model_config(candidates[0]).get("max_output_tokens"))
     validated_data["max_tokens"] = requested_max_tokens
 
-    # 5. Call the provider
+    return {
+        "user_id": user_id,
+        "api_key": api_key,
+        "model_id": model_id,
+        "provider": provider,
+        "candidates": candidates,
+        "messages": messages,
+        "is_stream": is_stream,
+        "data_for_provider": data_for_provider,
+        "prompt_tokens": prompt_tokens,
+        "max_tokens": requested_max_tokens,
+        "deadline": deadline,
+        "hedge": is_stream and get_api_key_settings(api_key).get("hedge", Config.HEDGE_ENABLED),
+        "cache": cache_policy(validated_data, api_key, request.headers),
+        "flight": flight_key(validated_data, api_key),
+    }
+
+def record_cache_hit(call, entry):
+    """Records usage for a request answered from the response cache and returns the response body."""
+    body = cached_response_body(entry, call["prompt_tokens"])
+    record_request(call["user_id"], call["api_key"], entry["model_id"], call["prompt_tokens"],
+                   entry["completion_tokens"], body, cached=True)
+    return body
+
+def cache_stream_callback(call, served_model_id):
+    """on_complete callback for generate_stream() that caches the finished stream, or None."""
+    if not call["cache"]:
+        return None
+    return lambda text, completion_tokens: store_stream(call["cache"], served_model_id, text, completion_tokens)
+
+def record_failed_attempts(user_id, api_key, attempts):
+    """
+    Records usage for the failover attempts that did not serve the request
+    and returns the model id of the one that did (None if all failed).
+    """
+    served = attempts[-1]["model_id"] if attempts and attempts[-1]["error"] is None else None
+    for attempt in attempts:
+        if attempt["error"] is not None:
+            record_failed_request(user_id, api_key, attempt["model_id"])
+    return served
+
+def handle_chat_completion(data, request):
+    """Handles a chat completion request."""
+    call = prepare_chat_completion(data, request)
+    if "error" in call:
+        return call
+
+    user_id = call["user_id"]
+    api_key = call["api_key"]
+    model_id = call["model_id"]
+    messages = call["messages"]
+    is_stream = call["is_stream"]
+    data_for_provider = call["data_for_provider"]
+    prompt_tokens = call["prompt_tokens"]
+    deadline = call["deadline"]
+
+    # Identical deterministic requests are answered from the response cache
+    # (replayed as SSE when streaming) without calling the provider.
+    entry = get_cached_completion(call["cache"])
+    if entry:
+        body = record_cache_hit(call, entry)
+        if is_stream:
+            return Response(replay_stream(entry), mimetype='text/event-stream', headers={"X-Cache": "HIT"})
+        return body, 200, {"X-Cache": "HIT"}
+
+    # Reserve the request's tokens and cost against the key's quotas before
+    # anything is spent upstream.
+    rejection = reserve_quota(call)
+    if rejection:
+        return rejection
+
+    # 5. Call the provider (through the manager, which applies the circuit
+    # breakers and fails over within the model's group). Each attempt is
+    # recorded in usage under the provider model that handled it. Identical
+    # requests already in flight share that call (single flight).
+    provider_manager = current_app.provider_manager
+    attempts = []
     try:
         if is_stream:
-            response_generator = provider.chat_completion(
+            response_generator = run_once(call["flight"], lambda: provider_manager.chat_completion(
                 model_id=model_id,
                 messages=messages,
                 stream=is_stream,
+                deadline=deadline,
+                attempts=attempts,
+                candidates=call["candidates"],
+                hedge=call["hedge"],
                 **data_for_provider
+            ), attempts, stream=True, deadline=deadline)
+            served_model_id = record_failed_attempts(user_id, api_key, attempts)
+            return generate_stream(
+                response_generator, user_id, api_key, served_model_id, current_app._get_current_object(), messages,
+                coalesce=_resolve_stream_coalescing(request, api_key),
+                deadline=deadline,
+                on_complete=cache_stream_callback(call, served_model_id),
+                quota=call["quota"]
             )
-            return generate_stream(response_generator, user_id, api_key, model_id, current_app._get_current_object(), messages)
         else:
-            response = provider.chat_completion(
+            response = run_once(call["flight"], lambda: provider_manager.chat_completion(
                 model_id=model_id,
                 messages=messages,
                 stream=is_stream,
+                deadline=deadline,
+                attempts=attempts,
+                candidates=call["candidates"],
                 **data_for_provider,
                 app=current_app
-            )
+            ), attempts, deadline=deadline)
+            served_model_id = record_failed_attempts(user_id, api_key, attempts)
             completion_tokens = count_tokens(
                 [{"role": "assistant", "content": response["choices"][0]["message"]["content"]}],
-                model_id,
+                served_model_id,
                 current_app
             )
-            record_request(user_id, api_key, model_id, prompt_tokens, completion_tokens, response)
+            record_request(user_id, api_key, served_model_id, prompt_tokens, completion_tokens, response)
+            settle_quota(call["quota"], served_model_id, prompt_tokens, completion_tokens)
+            store_completion(call["cache"], served_model_id, response, completion_tokens)
             return response, 200
     except Exception as e:
+        release_quota(call["quota"])
+        if attempts:
+            record_failed_attempts(user_id, api_key, attempts)
+        else:
+            record_failed_request(user_id, api_key, model_id)
+        if isinstance(e, UPSTREAM_REJECTIONS):
+            return upstream_unavailable_response(e)
+        if is_timeout_error(e):
+            log.warning(f"Provider timeout for {model_id} after {deadline.elapsed():.1f}s: {e}")
+            return {"error": f"Upstream provider timed out after {deadline.elapsed():.0f}s.", "status_code": 504}
         log.error(f"Provider error: {e}")
-        record_failed_request(user_id, api_key, model_id)
         return {"error": str(e), "status_code": 500}
 
 def handle_image_generation(data, request):
@@ -125,23 +295,49 @@ def handle_image_generation(data, request):
 
     # 3. Determine which provider to use based on the model
     model_id = validated_data.get('model', 'Provider-5/flux-pro')
+    deadline = Deadline.for_model(model_id, request.headers.get("X-Request-Timeout"))
     
     # Get the appropriate provider directly using the model ID
     provider = current_app.provider_manager.select_provider(model_id)
     if not provider:
         return {"error": f"Image generation provider for model '{model_id}' not available", "status_code": 503}
 
+    # Repeated (model, prompt, size, seed) requests are answered from the
+    # image cache without calling the provider.
+    prompt = validated_data['prompt']
+    size = validated_data.get('size', "1024x1024")
+    n = validated_data.get('n', 1)
+    response_format = validated_data.get('response_format', "url")
+    if response_format == "url" and not signing_enabled():
+        return {"error": 'response_format "url" is not available on this server (BLOB_SIGNING_SECRET is not set); '
+                         'use "b64_json"', "status_code": 400}
+    seed = validated_data.get('seed')
+    cache = image_cache_policy(model_id, prompt, size, seed, api_key, request.headers)
+    images = get_cached_images(cache, n)
+    if images:
+        return json_response(image_response(images, n, response_format), headers={"X-Cache": "HIT"})
+
     # 4. Call the provider's image_generation method
+    extra = {"seed": seed} if seed is not None else {}
     try:
-        response = provider.image_generation(
-            prompt=validated_data['prompt'],
-            size=validated_data.get('size', "1024x1024"),
-            n=validated_data.get('n', 1),
-            response_format=validated_data.get('response_format', "url"),
-            model=model_id
+        response = current_app.provider_manager.image_generation(
+            model_id,
+            prompt=prompt,
+            size=size,
+            n=n,
+            response_format=response_format,
+            deadline=deadline,
+            **extra
         )
-        return response, 200
+        store_images(cache, response)
+        # "b64_json" images are encoded from disk as the body is sent
+        return json_response(response)
     except Exception as e:
+        if isinstance(e, UPSTREAM_REJECTIONS):
+            return upstream_unavailable_response(e)
+        if is_timeout_error(e):
+            log.warning(f"Image generation timeout for {model_id}: {e}")
+            return {"error": f"Upstream provider timed out after {deadline.elapsed():.0f}s.", "status_code": 504}
         log.error(f"Image generation error: {e}")
         return {"error": str(e), "status_code": 500}
     
@@ -172,6 +368,88 @@ def list_models():
         log.error(f"Error listing models: {e}")
         return {"error": "Failed to retrieve model list", "status_code": 500}
 
+def get_provider_stats():
+    """
+    Returns the load balancing weights, per model group each member's recent
+    performance and score (lower is preferred), and the rate-limit budgets
+    the upstreams last announced.
+    """
+    groups = {}
+    for group_name, members in Config.MODEL_GROUPS.items():
+        stats = get_stats(members)
+        groups[group_name] = sorted(
+            [{"model_id": m, **stats[m], "score": round(score(stats[m]), 3)} for m in members],
+            key=lambda entry: entry["score"]
+        )
+    return {
+        "load_balancing_enabled": Config.LOAD_BALANCING_ENABLED,
+        "weights": {
+            "ttfb": Config.PROVIDER_SCORE_WEIGHT_TTFB,
+            "tps": Config.PROVIDER_SCORE_WEIGHT_TPS,
+            "errors": Config.PROVIDER_SCORE_WEIGHT_ERRORS,
+            "reference_tokens": Config.PROVIDER_SCORE_REFERENCE_TOKENS,
+            "error_penalty": Config.PROVIDER_SCORE_ERROR_PENALTY,
+            "alpha": Config.PROVIDER_STATS_ALPHA,
+        },
+        "groups": groups,
+        "rate_limit_budgets": get_budget_stats(),
+    }
+
+def get_model_uptime(model_id):
+    """
+    Returns (body, status) for /v1/uptime/<model id> from the last background
+    probe: 200 when the model is up, 503 when it is down or not probed yet.
+    A group name reports each of its members and is up while any of them is.
+    """
+    provider_manager = current_app.provider_manager
+    if model_id in Config.MODEL_GROUPS:
+        members = [m for m in Config.MODEL_GROUPS[model_id] if provider_manager.resolve(m)]
+    elif provider_manager.resolve(model_id):
+        members = [model_id]
+    else:
+        members = []
+    if not members:
+        return {"error": f"Model '{model_id}' not supported.", "status_code": 404}, 404
+    uptime = get_uptime(members)
+    if model_id not in Config.MODEL_GROUPS:
+        body = {"model": model_id, **uptime[model_id]}
+    else:
+        statuses = {entry["status"] for entry in uptime.values()}
+        body = {
+            "model": model_id,
+            "status": "up" if "up" in statuses else "down" if "down" in statuses else "unknown",
+            "members": [{"model": m, **uptime[m]} for m in members],
+        }
+    return body, 200 if body["status"] == "up" else 503
+
+def get_status():
+    """
+    Status page data for every probed model: its current status and, over
+    the last hour, day and week, the share of probes that succeeded and the
+    time to first chunk percentiles. Model groups are up while any member is.
+    """
+    model_ids = probe_models(current_app.provider_manager)
+    uptime = get_uptime(model_ids)
+    windows = get_window_stats(model_ids)
+    models = {
+        m: {
+            "status": uptime[m]["status"],
+            "checked_at": uptime[m].get("checked_at"),
+            "windows": windows[m],
+        }
+        for m in model_ids
+    }
+    groups = {}
+    for group_name, members in Config.MODEL_GROUPS.items():
+        probed = [m for m in members if m in models]
+        if probed:
+            statuses = {models[m]["status"] for m in probed}
+            groups[group_name] = {
+                "status": "up" if "up" in statuses else "down" if "down" in statuses else "unknown",
+                "members": probed,
+            }
+    return {"generated_at": int(time.time()), "models": models, "groups": groups}
+
 def create_api_key(data):
     """
     Creates a new API key for a user.
@@ -1,14 +1,22 @@
-from flask import Blueprint, request, jsonify, Response, current_app
+from flask import Blueprint, request, jsonify, Response, current_app, send_file
 from .controllers import (
     handle_chat_completion,
     handle_image_generation,
     list_models,
     create_api_key,
     get_usage,
+    get_provider_stats,
+    get_model_uptime,
+    get_status,
 )
 from ..services.rate_limit_service import rate_limit
 from ..services.api_key_service import validate_api_key_header
+from ..services.metrics_service import get_metrics
+from ..services.blob_store_service import blob_mimetype, blob_path, verify
+from ..config import Config
 from functools import wraps
+import hmac
+import time
 
 api_blueprint = Blueprint('api', __name__)
 
@@ -21,6 +29,17 @@ def requires_api_key(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def requires_system_secret(f):
+    """Decorator restricting internal/admin routes to callers holding SYSTEM_SECRET."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Header only: query strings end up in access logs and proxies.
+        provided_secret = request.headers.get('X-System-Secret') or ''
+        if not Config.SYSTEM_SECRET or not hmac.compare_digest(provided_secret.encode(), Config.SYSTEM_SECRET.encode()):
+            return jsonify({"error": "Unauthorized", "status_code": 401}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
 @api_blueprint.route('/chat/completions', methods=['POST'])
 @requires_api_key
 @rate_limit()  # Apply rate limiting with default "text" type
@@ -31,8 +50,9 @@ def chat_completions():
     if isinstance(result, Response):
         return result
     if isinstance(result, tuple):
-        response_data, status = result
-        return jsonify(response_data), status
+        # (body, status) or (body, status, headers)
+        response_data, status, *headers = result
+        return jsonify(response_data), status, *headers
     else:
         return jsonify(result), result.get("status_code", 200)
     
@@ -43,12 +63,31 @@ def image_generations():
     """Handles image generation requests."""
     data = request.get_json()
     result = handle_image_generation(data, request)
+    if isinstance(result, Response):
+        return result
     if isinstance(result, tuple):
-        response_data, status = result
-        return jsonify(response_data), status
+        response_data, status, *headers = result
+        return jsonify(response_data), status, *headers
     else:
         return jsonify(result), result.get("status_code", 200)
 
+@api_blueprint.route('/files/<blob_id>', methods=['GET'])
+def files(blob_id):
+    """
+    Serves a generated image from the blob store. The link itself is the
+    credential: it must carry an unexpired signature. The file is sent with
+    send_file (sendfile where the server supports it), honouring Range and
+    conditional requests.
+    """
+    path = blob_path(blob_id)
+    if path is None or not verify(blob_id, request.args.get("expires"), request.args.get("signature")):
+        return jsonify({"error": "Invalid or expired link", "status_code": 403}), 403
+    try:
+        max_age = max(0, int(request.args["expires"]) - int(time.time()))
+        return send_file(path, mimetype=blob_mimetype(blob_id), conditional=True, max_age=max_age)
+    except FileNotFoundError:
+        return jsonify({"error": "File not found", "status_code": 404}), 404
+
 @api_blueprint.route('/models', methods=['GET', 'POST'])
 def models_list():
     """Lists available models."""
@@ -86,51 +125,47 @@ def usage_details():
     else:
         return jsonify(result), result.get("status_code", 200)
 
+@api_blueprint.route('/metrics', methods=['GET'])
+@requires_system_secret
+def metrics():
+    """Returns the operational metrics shared by all workers (admin only)."""
+    try:
+        return jsonify(get_metrics()), 200
+    except Exception as e:
+        return jsonify({"error": f"Failed to read metrics: {e}", "status_code": 500}), 500
+
+@api_blueprint.route('/providers/stats', methods=['GET'])
+@requires_system_secret
+def provider_stats():
+    """Returns the load balancing weights and per-provider performance stats (admin only)."""
+    try:
+        return jsonify(get_provider_stats()), 200
+    except Exception as e:
+        return jsonify({"error": f"Failed to read provider stats: {e}", "status_code": 500}), 500
+
+@api_blueprint.route('/status', methods=['GET'])
+def status():
+    """
+    Status page API: per model, the current status and the uptime and time
+    to first chunk percentiles over 1h, 24h and 7d from the background
+    uptime probes. Public, and answered from cached totals.
+    """
+    return jsonify(get_status()), 200
+
 @api_blueprint.route('/uptime/<path:model_id>', methods=['GET'])
 def uptime(model_id):
     """
-    Checks if the given model is up by sending a minimal streaming chat request.
+    Reports whether the given model is up.
     
     Example:
       GET /uptime/o3-mini
       GET /uptime/deepseek-ai/DeepSeek-R1
       
-    If the model exists (i.e. is supported), the route sends a basic "ping" message
-    using chat streaming. If the provider returns a chunk (which implies status 200),
-    then the uptime check passes and a 200 response is returned.
-    Otherwise, if an error occurs or if no response chunk is found, the error status
-    and message are returned.
+    Answers from the result of the last background probe (a minimal streamed
+    "ping" sent by uptime_service every UPTIME_PROBE_INTERVAL seconds), so
+    monitoring services polling this route add no upstream load: 200 with
+    the status, time to first chunk and recent history when the model is
+    up, 503 when it is down or has not been probed yet, 404 for unknown models.
     """
-    # Check if a provider for the model exists
-    provider = current_app.provider_manager.select_provider(model_id)
-    if not provider:
-        return jsonify({"error": f"Model '{model_id}' not supported."}), 404
-
-    # Define a very basic payload for the uptime test.
-    test_message = [{"role": "system", "content": "ping"}]
-
-    try:
-        # Trigger a chat completion call in streaming mode.
-        # Some providers (like Provider3) require the 'app' parameter.
-        stream_response = provider.chat_completion(
-            model_id,
-            test_message,
-            stream=True,
-            app=current_app  # Only needed if the provider requires this.
-        )
-
-        # Attempt to get the first chunk from the streaming generator.
-        first_chunk = next(stream_response, None)
-        if first_chunk is None:
-            return jsonify({"error": "No response received from provider."}), 503
-
-        # If a chunk is received without exception, the model should be up.
-        return jsonify({"status": "200 OK"}), 200
-
-    except Exception as e:
-        # If the exception has a response attribute (like some requests exceptions),
-        # use its status_code; otherwise, default to 500.
-        status_code = 500
-        if hasattr(e, 'response') and e.response is not None:
-            status_code = e.response.status_code
-        return jsonify({"error": str(e), "status": status_code}), status_code
+    response_data, status = get_model_uptime(model_id)
+    return jsonify(response_data), status
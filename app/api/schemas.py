@@ -32,6 +32,7 @@ class ImageGenerationRequestSchema(Schema):
     n = fields.Int(required=False, validate=validate.Range(min=1, max=10), default=1)
     size = fields.Str(required=False, validate=validate.OneOf(["256x256", "512x512", "1024x1024"]), default="1024x1024")
     response_format = fields.Str(required=False, validate=validate.OneOf(["url", "b64_json"]), default="url")
+    seed = fields.Int(required=False)
     
     # Dynamic validation of model based on models.json
     def _get_image_models():
@@ -0,0 +1,43 @@
+# app/asgi.py
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Mount
+from . import create_app
+from .config import Config
+from .api.async_routes import build_routes
+from .providers.http_client import aclose_async_http_client
+
+def create_asgi_app(config_class=Config):
+    """
+    Builds the ASGI application served by asgi.py.
+
+    Chat completions, the model list and the health check are handled by the
+    async handlers in api/async_routes.py, so a waiting or streaming request
+    costs a coroutine rather than a worker thread. Every other route is served
+    by the regular Flask app mounted behind a WSGI bridge, so both entry points
+    expose the same API.
+    """
+    flask_app = create_app(config_class)
+    threadpool_size = config_class.ASGI_THREADPOOL_SIZE
+
+    @asynccontextmanager
+    async def lifespan(app):
+        # asyncio.to_thread() (database, Redis, token counting) uses the default executor.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threadpool_size))
+        yield
+        await aclose_async_http_client()
+
+    routes = build_routes() + [Mount("/", app=WSGIMiddleware(flask_app, workers=threadpool_size))]
+    app = Starlette(
+        routes=routes,
+        lifespan=lifespan,
+        middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]
+    )
+    app.state.flask_app = flask_app
+    return app
@@ -1,5 +1,6 @@
 import os
 import json
+import tempfile
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
@@ -74,6 +75,29 @@ class Config:
     IMAGE_REQUEST_LIMIT = 50
     IMAGE_RATE_LIMIT_WINDOW = 60
 
+    # Rate limit algorithm: "fixed" (a counter per window; bursts of up to twice
+    # the limit across a window boundary), "sliding" (a log of the requests of
+    # the last window) or "gcra" (a token bucket holding "burst" requests,
+    # refilled at limit per window). RATE_LIMIT_TIERS (JSON) overrides the
+    # algorithm and the "text"/"image" limits per tier, e.g.
+    # {"pro": {"algorithm": "gcra", "text": {"limit": 120, "window": 60, "burst": 20}}}.
+    # A key's tier is "rate_limit_tier" in API_KEY_SETTINGS, defaulting to
+    # RATE_LIMIT_DEFAULT_TIER; anything a tier leaves out comes from the
+    # limits above. A limit of 0 blocks the tier.
+    RATE_LIMIT_ALGORITHM = os.getenv('RATE_LIMIT_ALGORITHM', 'fixed')
+    RATE_LIMIT_TIERS = json.loads(os.getenv('RATE_LIMIT_TIERS', '{}') or '{}')
+    RATE_LIMIT_DEFAULT_TIER = os.getenv('RATE_LIMIT_DEFAULT_TIER', 'default')
+
+    # Token and cost quotas per API key, enforced before the provider is
+    # called: QUOTA_TOKENS_PER_MINUTE (the prompt tokens plus max_tokens are
+    # reserved up front and the unused part returned once the completion is
+    # counted) and QUOTA_COST_PER_DAY (USD per UTC day, priced with the
+    # model's owner_cost_per_million_tokens). 0 disables a quota. A tier in
+    # RATE_LIMIT_TIERS or a key in API_KEY_SETTINGS can override them with
+    # "tokens_per_minute" and "cost_per_day".
+    QUOTA_TOKENS_PER_MINUTE = int(os.getenv('QUOTA_TOKENS_PER_MINUTE', 0))
+    QUOTA_COST_PER_DAY = float(os.getenv('QUOTA_COST_PER_DAY', 0))
+
     API_KEY_PREFIX = 'ddc-beta-'
     API_KEY_LENGTH = 54
     
@@ -91,6 +115,242 @@ class Config:
     MAX_INPUT_TOKENS = 4000
     MAX_OUTPUT_TOKENS = 4000
 
+    # Per API key overrides (JSON object keyed by API key), e.g.
+    # {"ddc-beta-...": {"sse_coalesce": true}}
+    API_KEY_SETTINGS = json.loads(os.getenv('API_KEY_SETTINGS', '{}') or '{}')
+
+    # SSE write coalescing for streamed chat completions. When enabled (globally,
+    # per API key or via the X-Stream-Coalesce header) consecutive frames are
+    # batched into a single write, flushed at MAX_BYTES or after MAX_DELAY_MS.
+    SSE_COALESCE_ENABLED = os.getenv('SSE_COALESCE_ENABLED', 'false').lower() == 'true'
+    SSE_COALESCE_MAX_BYTES = int(os.getenv('SSE_COALESCE_MAX_BYTES', 4096))
+    SSE_COALESCE_MAX_DELAY_MS = int(os.getenv('SSE_COALESCE_MAX_DELAY_MS', 15))
+
+    # End-to-end request deadlines. Per-model overrides can be set in models.json
+    # (request_timeout, connect_timeout, first_byte_timeout, chunk_timeout).
+    # The total covers a non-streaming request end to end and a stream up to
+    # its first chunk; after that a stream runs for as long as chunks arrive
+    # within UPSTREAM_CHUNK_TIMEOUT of each other.
+    # MAX_REQUEST_TIMEOUT must stay below the gunicorn worker timeout.
+    REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 180))
+    MAX_REQUEST_TIMEOUT = float(os.getenv('MAX_REQUEST_TIMEOUT', 280))
+    UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 10))
+    UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.getenv('UPSTREAM_FIRST_BYTE_TIMEOUT', 90))
+    UPSTREAM_CHUNK_TIMEOUT = float(os.getenv('UPSTREAM_CHUNK_TIMEOUT', 30))
+
+    # Upstream HTTP connection pools used by the raw-HTTP providers.
+    UPSTREAM_POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 10))
+    UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', 100))
+    # When > 0, log any upstream response still open after this many seconds.
+    UPSTREAM_LEAK_DEBUG_SECONDS = float(os.getenv('UPSTREAM_LEAK_DEBUG_SECONDS', 0))
+    # Optional HTTP/2 transport (needs the 'h2' package): comma-separated provider
+    # names, e.g. "provider-1,provider-8", or "*". Upstreams that do not offer h2
+    # are spoken to over HTTP/1.1. PRIOR_KNOWLEDGE forces h2c for http:// upstreams.
+    UPSTREAM_HTTP2_PROVIDERS = [p.strip() for p in os.getenv('UPSTREAM_HTTP2_PROVIDERS', '').split(',') if p.strip()]
+    UPSTREAM_HTTP2_PRIOR_KNOWLEDGE = os.getenv('UPSTREAM_HTTP2_PRIOR_KNOWLEDGE', 'false').lower() == 'true'
+    UPSTREAM_HTTP2_CONNECTIONS_PER_HOST = int(os.getenv('UPSTREAM_HTTP2_CONNECTIONS_PER_HOST', 4))
+
+    # Upstream API key pools (Provider 7). A key answering 429 or with a
+    # Retry-After header is skipped by every worker for that long (capped at
+    # KEY_POOL_MAX_COOLDOWN, DEFAULT_COOLDOWN when no header is sent); workers
+    # re-read the shared cooldowns at most every HEALTH_CACHE_SECONDS.
+    KEY_POOL_DEFAULT_COOLDOWN = float(os.getenv('KEY_POOL_DEFAULT_COOLDOWN', 30))
+    KEY_POOL_MAX_COOLDOWN = float(os.getenv('KEY_POOL_MAX_COOLDOWN', 600))
+    KEY_POOL_HEALTH_CACHE_SECONDS = float(os.getenv('KEY_POOL_HEALTH_CACHE_SECONDS', 1))
+
+    # Exact-match response cache for deterministic (temperature 0) chat
+    # completions, per API key ("response_cache" in API_KEY_SETTINGS) or for
+    # all keys. Entries live RESPONSE_CACHE_TTL seconds; least recently used
+    # entries are evicted beyond RESPONSE_CACHE_MAX_BYTES, and larger
+    # responses than RESPONSE_CACHE_MAX_ENTRY_BYTES are not cached. With
+    # RESPONSE_CACHE_SHARED identical requests from different keys share entries.
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    RESPONSE_CACHE_SHARED = os.getenv('RESPONSE_CACHE_SHARED', 'false').lower() == 'true'
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', 256 * 1024))
+    RESPONSE_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv('RESPONSE_CACHE_REPLAY_CHUNK_CHARS', 64))
+
+    # Single-flight coalescing of identical chat completion requests, per API
+    # key ("single_flight" in API_KEY_SETTINGS) or for all keys: requests that
+    # arrive while an identical one is in flight share its upstream call (and
+    # so its sampled answer) instead of making their own. With
+    # SINGLE_FLIGHT_SHARED requests from different keys share calls. With
+    # SINGLE_FLIGHT_DISTRIBUTED workers also coalesce with each other through
+    # a Redis lock; followers check every POLL_SECONDS that the leading worker
+    # is still alive.
+    SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'false').lower() == 'true'
+    SINGLE_FLIGHT_SHARED = os.getenv('SINGLE_FLIGHT_SHARED', 'true').lower() == 'true'
+    SINGLE_FLIGHT_DISTRIBUTED = os.getenv('SINGLE_FLIGHT_DISTRIBUTED', 'false').lower() == 'true'
+    SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv('SINGLE_FLIGHT_POLL_SECONDS', 2))
+
+    # Cache of generated images keyed by (model, prompt, size, seed), per API
+    # key ("image_cache" in API_KEY_SETTINGS) or for all keys. Image bytes are
+    # stored once in IMAGE_CACHE_DIR (shared by the workers of a host); the
+    # least recently used are deleted beyond IMAGE_CACHE_MAX_BYTES, and a
+    # request's entry is forgotten after IMAGE_CACHE_TTL seconds.
+    IMAGE_CACHE_ENABLED = os.getenv('IMAGE_CACHE_ENABLED', 'false').lower() == 'true'
+    IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ai4free-image-cache'))
+    IMAGE_CACHE_TTL = int(os.getenv('IMAGE_CACHE_TTL', 7 * 24 * 3600))
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+    # Image generations with n > 1 make up to this many upstream calls of a
+    # request at once, each for a different image.
+    IMAGE_FANOUT_CONCURRENCY = int(os.getenv('IMAGE_FANOUT_CONCURRENCY', 4))
+
+    # Generated images requested as "url" are written to BLOB_STORE_DIR and
+    # returned as signed /v1/files links valid for BLOB_URL_TTL seconds, after
+    # which the files are deleted (checked every BLOB_STORE_GC_INTERVAL). Links
+    # are absolute: PUBLIC_BASE_URL when set (e.g. behind a proxy), otherwise
+    # the host of the request. BLOB_SIGNING_SECRET must be set, to a long random
+    # value that is the same on every worker; without it no links are issued and
+    # "url" images are refused.
+    # Upstream image downloads are written to the store, and "b64_json"
+    # images encoded from it into the response, BLOB_CHUNK_BYTES at a time.
+    BLOB_STORE_DIR = os.getenv('BLOB_STORE_DIR', os.path.join(tempfile.gettempdir(), 'ai4free-blobs'))
+    BLOB_URL_TTL = int(os.getenv('BLOB_URL_TTL', 3600))
+    BLOB_STORE_GC_INTERVAL = float(os.getenv('BLOB_STORE_GC_INTERVAL', 300))
+    BLOB_SIGNING_SECRET = os.getenv('BLOB_SIGNING_SECRET', '')
+    PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '')
+    BLOB_CHUNK_BYTES = int(os.getenv('BLOB_CHUNK_BYTES', 64 * 1024))
+
+    # Background uptime probes behind /v1/uptime/<model>: each chat model (or
+    # only those in UPTIME_PROBE_MODELS, comma-separated) gets a one-token
+    # streamed "ping" from one worker every UPTIME_PROBE_INTERVAL seconds,
+    # give or take UPTIME_PROBE_JITTER of it, with at most
+    # UPTIME_PROBE_CONCURRENCY probes of a worker at once. The last
+    # UPTIME_HISTORY results are kept; workers re-read them from Redis every
+    # UPTIME_CACHE_SECONDS. Off by default, since every probe is a real
+    # upstream call; without it models read as "unknown".
+    UPTIME_PROBE_ENABLED = os.getenv('UPTIME_PROBE_ENABLED', 'false').lower() == 'true'
+    UPTIME_PROBE_INTERVAL = float(os.getenv('UPTIME_PROBE_INTERVAL', 300))
+    UPTIME_PROBE_JITTER = float(os.getenv('UPTIME_PROBE_JITTER', 0.1))
+    UPTIME_PROBE_TIMEOUT = float(os.getenv('UPTIME_PROBE_TIMEOUT', 30))
+    UPTIME_PROBE_CONCURRENCY = int(os.getenv('UPTIME_PROBE_CONCURRENCY', 4))
+    UPTIME_PROBE_MODELS = [m.strip() for m in os.getenv('UPTIME_PROBE_MODELS', '').split(',') if m.strip()]
+    UPTIME_HISTORY = int(os.getenv('UPTIME_HISTORY', 20))
+    UPTIME_CACHE_SECONDS = float(os.getenv('UPTIME_CACHE_SECONDS', 5))
+    # Every probe result is also kept for 7 days, with running totals over the
+    # last 1h, 24h and 7d served by /v1/status. Members of a model group whose
+    # probes succeeded less than UPTIME_DEMOTE_BELOW percent of the time over
+    # the last hour (once there are UPTIME_DEMOTE_MIN_PROBES of them) are
+    # tried after the healthy ones.
+    UPTIME_DEMOTE_BELOW = float(os.getenv('UPTIME_DEMOTE_BELOW', 90))
+    UPTIME_DEMOTE_MIN_PROBES = int(os.getenv('UPTIME_DEMOTE_MIN_PROBES', 3))
+
+    # Upstream rate-limit budgets read from x-ratelimit-* / retry-after response
+    # headers. A call to an upstream whose announced limit is used up (at most
+    # RESERVE_REQUESTS requests or RESERVE_TOKENS tokens left) waits for the
+    # reset when that is at most MAX_DELAY seconds away and is otherwise
+    # rerouted. A 429 without Retry-After blocks the key for DEFAULT_BACKOFF
+    # seconds, kept below MAX_DELAY so it is waited out rather than rerouted.
+    # Off by default.
+    UPSTREAM_BUDGET_ENABLED = os.getenv('UPSTREAM_BUDGET_ENABLED', 'false').lower() == 'true'
+    UPSTREAM_BUDGET_RESERVE_REQUESTS = int(os.getenv('UPSTREAM_BUDGET_RESERVE_REQUESTS', 0))
+    UPSTREAM_BUDGET_RESERVE_TOKENS = int(os.getenv('UPSTREAM_BUDGET_RESERVE_TOKENS', 1000))
+    UPSTREAM_BUDGET_MAX_DELAY = float(os.getenv('UPSTREAM_BUDGET_MAX_DELAY', 2))
+    UPSTREAM_BUDGET_DEFAULT_BACKOFF = float(os.getenv('UPSTREAM_BUDGET_DEFAULT_BACKOFF', 1))
+    UPSTREAM_BUDGET_CACHE_SECONDS = float(os.getenv('UPSTREAM_BUDGET_CACHE_SECONDS', 1))
+    UPSTREAM_BUDGET_MIN_TTL = int(os.getenv('UPSTREAM_BUDGET_MIN_TTL', 60))
+
+    # Cross-provider failover within the model groups of models.json. A request
+    # for a group name, or for an alias that belongs to a group, tries up to
+    # MODEL_FAILOVER_MAX_ATTEMPTS members in order; no new attempt is started
+    # with less than MODEL_FAILOVER_MIN_REMAINING seconds left on the deadline.
+    # On by default, so an alias may be served by another provider of its group.
+    MODEL_FAILOVER_ENABLED = os.getenv('MODEL_FAILOVER_ENABLED', 'true').lower() == 'true'
+    MODEL_FAILOVER_MAX_ATTEMPTS = int(os.getenv('MODEL_FAILOVER_MAX_ATTEMPTS', 3))
+    MODEL_FAILOVER_MIN_REMAINING = float(os.getenv('MODEL_FAILOVER_MIN_REMAINING', 5))
+
+    # Load balancing within model groups. Requests for a group name go to the
+    # cheaper of two randomly sampled members, scored on EWMAs (shared via
+    # Redis) of time to first chunk, tokens/sec and error rate:
+    #   WEIGHT_TTFB * ttfb + WEIGHT_TPS * REFERENCE_TOKENS / tps
+    #     + WEIGHT_ERRORS * ERROR_PENALTY * error_rate   (all in seconds)
+    LOAD_BALANCING_ENABLED = os.getenv('LOAD_BALANCING_ENABLED', 'true').lower() == 'true'
+    PROVIDER_STATS_ALPHA = float(os.getenv('PROVIDER_STATS_ALPHA', 0.2))
+    PROVIDER_STATS_CACHE_SECONDS = float(os.getenv('PROVIDER_STATS_CACHE_SECONDS', 2))
+    PROVIDER_SCORE_WEIGHT_TTFB = float(os.getenv('PROVIDER_SCORE_WEIGHT_TTFB', 1.0))
+    PROVIDER_SCORE_WEIGHT_TPS = float(os.getenv('PROVIDER_SCORE_WEIGHT_TPS', 1.0))
+    PROVIDER_SCORE_WEIGHT_ERRORS = float(os.getenv('PROVIDER_SCORE_WEIGHT_ERRORS', 1.0))
+    PROVIDER_SCORE_REFERENCE_TOKENS = int(os.getenv('PROVIDER_SCORE_REFERENCE_TOKENS', 500))
+    PROVIDER_SCORE_ERROR_PENALTY = float(os.getenv('PROVIDER_SCORE_ERROR_PENALTY', 60))
+    PROVIDER_STATS_TTFB_HISTORY = int(os.getenv('PROVIDER_STATS_TTFB_HISTORY', 200))
+
+    # Hedged streams: when a stream has no first chunk after its provider's
+    # p90 time to first chunk (at least HEDGE_MIN_DELAY seconds, and only once
+    # HEDGE_MIN_SAMPLES samples exist), a copy is sent to the next member of
+    # the model group and the first to answer wins. Enabled per key with the
+    # "hedge" setting in API_KEY_SETTINGS, defaulting to HEDGE_ENABLED. At most
+    # HEDGE_BUDGET_PERCENT of eligible requests are hedged, with bursts of up
+    # to HEDGE_BUDGET_BURST hedges per worker.
+    HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+    HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.25))
+    HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+    HEDGE_BUDGET_PERCENT = float(os.getenv('HEDGE_BUDGET_PERCENT', 10))
+    HEDGE_BUDGET_BURST = float(os.getenv('HEDGE_BUDGET_BURST', 5))
+
+    # Bulkheads: per-worker limits on concurrent upstream calls for each
+    # provider, and for models listed in BULKHEAD_LIMITS (JSON keyed by
+    # provider name or model id, e.g. {"provider-3": {"max_concurrent": 20},
+    # "Provider-3/DeepSeek-R1": {"max_concurrent": 5, "max_queue": 5}}).
+    # Calls over the limit queue for up to BULKHEAD_QUEUE_TIMEOUT seconds and
+    # are rejected with 503 when the queue is full or the wait times out. A
+    # stream holds its slots until it is closed. Off by default.
+    BULKHEAD_ENABLED = os.getenv('BULKHEAD_ENABLED', 'false').lower() == 'true'
+    BULKHEAD_MAX_CONCURRENT = int(os.getenv('BULKHEAD_MAX_CONCURRENT', 100))
+    BULKHEAD_MAX_QUEUE = int(os.getenv('BULKHEAD_MAX_QUEUE', 50))
+    BULKHEAD_QUEUE_TIMEOUT = float(os.getenv('BULKHEAD_QUEUE_TIMEOUT', 5))
+    BULKHEAD_LIMITS = json.loads(os.getenv('BULKHEAD_LIMITS', '{}') or '{}')
+
+    # Adaptive concurrency limits. When enabled, each bulkhead's limit (and
+    # each Provider 7 API key's, up to ADAPTIVE_KEY_LIMIT_MAX) starts at
+    # ADAPTIVE_LIMIT_INITIAL and is learned from outcomes: cut by the BACKOFF
+    # factor on 429/5xx/timeouts, shrunk when latency rises beyond TOLERANCE
+    # times its long-term level, grown while latency stays flat.
+    ADAPTIVE_LIMIT_ENABLED = os.getenv('ADAPTIVE_LIMIT_ENABLED', 'false').lower() == 'true'
+    ADAPTIVE_LIMIT_INITIAL = int(os.getenv('ADAPTIVE_LIMIT_INITIAL', 10))
+    ADAPTIVE_LIMIT_MIN = int(os.getenv('ADAPTIVE_LIMIT_MIN', 1))
+    ADAPTIVE_LIMIT_BACKOFF = float(os.getenv('ADAPTIVE_LIMIT_BACKOFF', 0.9))
+    ADAPTIVE_LIMIT_LATENCY_TOLERANCE = float(os.getenv('ADAPTIVE_LIMIT_LATENCY_TOLERANCE', 2.0))
+    ADAPTIVE_LIMIT_SMOOTHING = float(os.getenv('ADAPTIVE_LIMIT_SMOOTHING', 0.2))
+    ADAPTIVE_KEY_LIMIT_MAX = int(os.getenv('ADAPTIVE_KEY_LIMIT_MAX', 20))
+
+    # Circuit breakers per provider and per model (state shared via Redis).
+    # A breaker opens when at least CIRCUIT_MIN_REQUESTS calls in the window
+    # failed at CIRCUIT_ERROR_RATE or were slower than CIRCUIT_SLOW_CALL_SECONDS
+    # at CIRCUIT_SLOW_CALL_RATE (streams are timed to their first chunk). While
+    # open, calls fail fast with 503; after CIRCUIT_OPEN_SECONDS up to
+    # CIRCUIT_HALF_OPEN_PROBES calls are let through to test the upstream.
+    CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+    CIRCUIT_WINDOW_SECONDS = int(os.getenv('CIRCUIT_WINDOW_SECONDS', 60))
+    CIRCUIT_BUCKET_SECONDS = int(os.getenv('CIRCUIT_BUCKET_SECONDS', 10))
+    CIRCUIT_MIN_REQUESTS = int(os.getenv('CIRCUIT_MIN_REQUESTS', 10))
+    CIRCUIT_ERROR_RATE = float(os.getenv('CIRCUIT_ERROR_RATE', 0.5))
+    CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv('CIRCUIT_SLOW_CALL_SECONDS', 30))
+    CIRCUIT_SLOW_CALL_RATE = float(os.getenv('CIRCUIT_SLOW_CALL_RATE', 0.8))
+    CIRCUIT_OPEN_SECONDS = int(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+    CIRCUIT_HALF_OPEN_PROBES = int(os.getenv('CIRCUIT_HALF_OPEN_PROBES', 2))
+
+    # Connection pools, retries and default timeouts of the OpenAI/Azure SDK
+    # clients (Providers 2, 3 and 9). SDK_CLIENT_SETTINGS overrides any of them
+    # per provider, e.g. {"provider-9": {"max_connections": 50, "max_retries": 1}}
+    # (keys: max_connections, max_keepalive_connections, keepalive_expiry,
+    # max_retries, timeout, connect_timeout). Per-request deadlines still cap
+    # the timeout; retries happen inside that budget, hence the default of 0.
+    SDK_POOL_MAX_CONNECTIONS = int(os.getenv('SDK_POOL_MAX_CONNECTIONS', 100))
+    SDK_POOL_MAX_KEEPALIVE = int(os.getenv('SDK_POOL_MAX_KEEPALIVE', 20))
+    SDK_POOL_KEEPALIVE_EXPIRY = float(os.getenv('SDK_POOL_KEEPALIVE_EXPIRY', 30))
+    SDK_MAX_RETRIES = int(os.getenv('SDK_MAX_RETRIES', 0))
+    SDK_TIMEOUT = float(os.getenv('SDK_TIMEOUT', 120))
+    SDK_CLIENT_SETTINGS = json.loads(os.getenv('SDK_CLIENT_SETTINGS', '{}') or '{}')
+
+    # ASGI serving mode (asgi.py): one shared async connection pool per worker
+    # for the raw-HTTP providers, and the thread pool used for blocking work
+    # (database, Redis, token counting).
+    ASYNC_UPSTREAM_MAX_CONNECTIONS = int(os.getenv('ASYNC_UPSTREAM_MAX_CONNECTIONS', 1000))
+    ASGI_THREADPOOL_SIZE = int(os.getenv('ASGI_THREADPOOL_SIZE', 64))
+
     MODEL_SPECIFIC_CONFIG = {
         "Provider-1/DeepSeek-R1": {"max_input_tokens": 32768, "max_output_tokens": 8192},
 
@@ -217,9 +477,27 @@ class Config:
             "max_output_tokens": cls.MAX_OUTPUT_TOKENS,
         })
 
+    @classmethod
+    def get_model_timeouts(cls, model_id):
+        """Returns the deadline settings for a model, falling back to the global defaults."""
+        model_data = next((m for m in cls.ALLOWED_MODELS if m["id"] == model_id), None)
+        if model_data is None:
+            model_data = cls.MODEL_SPECIFIC_CONFIG.get(model_id, {})
+        return {
+            "request_timeout": model_data.get("request_timeout", cls.REQUEST_TIMEOUT),
+            "connect_timeout": model_data.get("connect_timeout", cls.UPSTREAM_CONNECT_TIMEOUT),
+            "first_byte_timeout": model_data.get("first_byte_timeout", cls.UPSTREAM_FIRST_BYTE_TIMEOUT),
+            "chunk_timeout": model_data.get("chunk_timeout", cls.UPSTREAM_CHUNK_TIMEOUT),
+        }
+
     MODEL_LIST_PATH = 'data/models.json'
     TOKEN_ENCODING = 'cl100k_base'
     ALLOWED_MODELS = []
+    # Canonical model groups from the "groups" section of models.json:
+    # {"deepseek-r1": ["Provider-1/DeepSeek-R1", ...]} and the reverse index
+    # {"Provider-1/DeepSeek-R1": ["deepseek-r1"]}.
+    MODEL_GROUPS = {}
+    MODEL_GROUP_OF = {}
 
     @classmethod
     def get_models_config(cls):
@@ -236,9 +514,15 @@ class Config:
                 else:
                     print("Warning: 'data' key not found or not a list in models.json")
                     cls.ALLOWED_MODELS = []
+                cls.MODEL_GROUPS = models_data.get('groups', {})
         except (FileNotFoundError, json.JSONDecodeError) as e:
             print(f"Error loading models from {cls.MODEL_LIST_PATH}: {e}")
             cls.ALLOWED_MODELS = []
+            cls.MODEL_GROUPS = {}
+        cls.MODEL_GROUP_OF = {}
+        for group_name, members in cls.MODEL_GROUPS.items():
+            for member in members:
+                cls.MODEL_GROUP_OF.setdefault(member, []).append(group_name)
 
     DISABLE_AUTO_DB_INIT = False
 
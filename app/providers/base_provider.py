@@ -1,6 +1,26 @@
 # app/providers/base_provider.py
 
 import abc
+import asyncio
+import logging
+import queue
+import threading
+from ..config import Config
+from ..utils.deadline import DeadlineExceeded
+
+log = logging.getLogger(__name__)
+
+class UpstreamHTTPError(Exception):
+    """
+    Raised when an upstream answers with an error status.
+
+    Carries the upstream `status_code` so circuit breakers and adaptive
+    limits can tell requests the upstream rejected (4xx) from outages.
+    """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
 
 class BaseProvider(abc.ABC):
     """
@@ -32,6 +52,20 @@ class BaseProvider(abc.ABC):
         """
         raise NotImplementedError
 
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """
+        Async variant of chat_completion(), used by the ASGI entry point.
+
+        Takes the same arguments and returns the same dict, or an async
+        iterator of chunks when streaming. This default runs the blocking
+        implementation in the default thread pool; providers with an async
+        client override it so no thread is held while waiting on upstream.
+        """
+        result = await asyncio.to_thread(self.chat_completion, model_id, messages, stream, **kwargs)
+        if stream:
+            return iterate_in_thread(result)
+        return result
+
     @abc.abstractmethod
     def get_models(self) -> list:
         """
@@ -60,4 +94,70 @@ class BaseProvider(abc.ABC):
     @abc.abstractmethod
     def get_default_max_tokens(self, model_id: str) -> int:
       """Get the default maximum generation tokens for the given model."""
-      raise NotImplementedError
\ No newline at end of file
+      raise NotImplementedError
+
+_EXHAUSTED = object()
+
+async def iterate_in_thread(iterator):
+    """Drives a blocking chunk iterator from the default thread pool, one chunk at a time."""
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, _EXHAUSTED)
+            if chunk is _EXHAUSTED:
+                return
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+def fan_out(make_call, n, deadline=None, concurrency=None):
+    """
+    Runs make_call(i) for i in range(n), up to `concurrency` (default
+    IMAGE_FANOUT_CONCURRENCY) at a time, and returns the results in index
+    order once every call has finished or the deadline is reached.
+
+    Calls that fail or are still running at the deadline are left out, so
+    fewer than `n` results may come back; when none succeeded the first
+    error (or DeadlineExceeded) is raised. A single call runs inline.
+    """
+    if n == 1:
+        return [make_call(0)]
+    tasks = queue.Queue()
+    for i in range(n):
+        tasks.put(i)
+    outcomes = queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                i = tasks.get_nowait()
+            except queue.Empty:
+                return
+            if deadline is not None and deadline.expired():
+                continue
+            try:
+                outcomes.put((i, make_call(i), None))
+            except Exception as e:
+                outcomes.put((i, None, e))
+
+    for _ in range(min(n, concurrency or Config.IMAGE_FANOUT_CONCURRENCY)):
+        threading.Thread(target=worker, daemon=True).start()
+
+    results, errors = {}, []
+    for _ in range(n):
+        try:
+            i, result, error = outcomes.get(timeout=deadline.remaining() if deadline is not None else None)
+        except queue.Empty:
+            break
+        if error is None:
+            results[i] = result
+        else:
+            errors.append(error)
+    if not results:
+        if errors:
+            raise errors[0]
+        raise DeadlineExceeded(f"Request deadline of {deadline.total:.0f}s exceeded")
+    if len(results) < n:
+        log.warning(f"Returning {len(results)} of {n} results ({len(errors)} failed, {n - len(results) - len(errors)} timed out)")
+    return [results[i] for i in sorted(results)]
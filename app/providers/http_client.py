@@ -0,0 +1,591 @@
+# app/providers/http_client.py
+
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+import anyio
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from ..config import Config
+from ..services.metrics_service import set_gauge
+from ..services.upstream_budget_service import observe_response
+from ..utils.deadline import DeadlineExceeded, is_timeout_error
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+def _set_read_timeout(response, seconds):
+    """Adjusts the socket read timeout of an in-flight streamed response (best effort)."""
+    try:
+        response.raw.connection.sock.settimeout(seconds)
+    except AttributeError:
+        pass
+
+class _StreamCounter:
+    """
+    Counts in-flight upstream responses per host and protocol version in this
+    worker. With HTTP/2 many streams share a connection, so this shows how
+    much multiplexing is actually happening.
+
+    Counts are published as the per-worker gauge "upstream_streams_in_flight"
+    by a background thread every STREAM_METRICS_INTERVAL seconds, keeping
+    Redis writes off the request path.
+    """
+
+    STREAM_METRICS_INTERVAL = 5
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._publisher_pid = None
+
+    def opened(self, host, http_version):
+        """Counts a new stream and returns the callback that releases it (idempotent)."""
+        self._ensure_publisher()
+        key = (host, http_version)
+        self._update(key, 1)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._update(key, -1)
+
+        return release
+
+    def _update(self, key, delta):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + delta
+
+    def snapshot(self):
+        """Returns {host: {http_version: in-flight streams}} for this worker."""
+        with self._lock:
+            result = {}
+            for (host, http_version), count in self._counts.items():
+                result.setdefault(host, {})[http_version] = count
+            return result
+
+    def _ensure_publisher(self):
+        # Started lazily (and again after a fork) so each worker runs its own.
+        if self._publisher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._publisher_pid == os.getpid():
+                return
+            self._publisher_pid = os.getpid()
+        threading.Thread(target=self._publish, daemon=True).start()
+
+    def _publish(self):
+        while True:
+            time.sleep(self.STREAM_METRICS_INTERVAL)
+            for host, versions in self.snapshot().items():
+                for http_version, count in versions.items():
+                    set_gauge("upstream_streams_in_flight", count, per_worker=True, host=host, http_version=http_version)
+
+stream_counter = _StreamCounter()
+
+def get_stream_counts():
+    """In-flight upstream streams per host and protocol version in this worker."""
+    return stream_counter.snapshot()
+
+def _http2_enabled(provider_name):
+    """True if UPSTREAM_HTTP2_PROVIDERS opts this provider into the HTTP/2 transport."""
+    providers = Config.UPSTREAM_HTTP2_PROVIDERS
+    if "*" not in providers and provider_name not in providers:
+        return False
+    if not HTTP2_AVAILABLE:
+        log.warning(f"HTTP/2 requested for {provider_name} but the 'h2' package is not installed; using HTTP/1.1")
+        return False
+    return True
+
+def _httpx_timeout(timeout):
+    """Converts a requests-style timeout (number or (connect, read) tuple) to httpx.Timeout."""
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+@contextmanager
+def _as_requests_errors():
+    """Re-raises httpx errors as their requests equivalents, which is what the providers catch."""
+    try:
+        yield
+    except httpx.ConnectTimeout as e:
+        raise requests.exceptions.ConnectTimeout(str(e)) from e
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.ReadTimeout(str(e)) from e
+    except httpx.TransportError as e:
+        raise requests.exceptions.ConnectionError(str(e)) from e
+
+class HTTP2Response:
+    """
+    Minimal requests.Response look-alike over a streamed httpx response.
+
+    Lets the HTTP/2 transport sit behind UpstreamHTTPClient.request() without
+    changing provider code. Per-chunk read timeouts cannot be changed once
+    an httpx stream is open, so the first-byte timeout applies to every read.
+    """
+
+    raw = None
+
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.request = response.request
+        self.http_version = response.http_version
+
+    @property
+    def content(self):
+        with _as_requests_errors():
+            return self._response.read()
+
+    @property
+    def text(self):
+        with _as_requests_errors():
+            self._response.read()
+        return self._response.text
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        with _as_requests_errors():
+            yield from self._response.iter_bytes(chunk_size)
+
+    def iter_lines(self, chunk_size=None, decode_unicode=False, delimiter=None):
+        with _as_requests_errors():
+            for line in self._response.iter_lines():
+                yield line if decode_unicode else line.encode("utf-8")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._release()
+
+class UpstreamStream:
+    """
+    Iterator over the chunks of a streamed upstream response.
+
+    Exhausting, failing or closing the iterator always releases the underlying
+    connection, even when iteration never started (e.g. the client disconnected
+    before the first chunk was pulled).
+
+    With a deadline, the wait for the first chunk is bounded by its first-byte
+    timeout (capped by the time remaining) and every later wait by its
+    inter-chunk timeout, which each chunk restarts; a stalled upstream raises
+    DeadlineExceeded.
+    """
+
+    def __init__(self, response, chunks, deadline=None):
+        self.response = response
+        self._chunks = chunks
+        self._deadline = deadline
+        self._started = False
+        # Ownership of the response moves to this iterator.
+        response._upstream_detached = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            if self._deadline is not None:
+                if self._started:
+                    _set_read_timeout(self.response, self._deadline.chunk_read_timeout())
+                else:
+                    _set_read_timeout(self.response, self._deadline.first_byte_read_timeout())
+            chunk = next(self._chunks)
+            if self._deadline is not None:
+                self._deadline.chunk_received()
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            self.close()
+            if is_timeout_error(e) and not isinstance(e, DeadlineExceeded):
+                raise DeadlineExceeded(f"Upstream stream stalled: {e}") from e
+            raise
+        except BaseException:
+            self.close()
+            raise
+        self._started = True
+        return chunk
+
+    def close(self):
+        try:
+            self._chunks.close()
+        except ValueError:
+            # The generator is running in another thread (see coalesce_frames).
+            # Closing the socket does not wake a read blocked on it, shutting
+            # the connection down does.
+            shutdown = getattr(getattr(self.response, "raw", None), "shutdown", None)
+            if shutdown is not None:
+                shutdown()
+        finally:
+            self.response.close()
+
+class AsyncUpstreamStream:
+    """
+    Async counterpart of UpstreamStream, used in ASGI mode.
+
+    Wraps any async chunk iterator (a provider's async generator or an SDK
+    AsyncStream). Waits are bounded by the deadline's first-byte and
+    inter-chunk timeouts, and exhausting, failing or closing the stream always
+    runs `on_close` (typically the httpx response's aclose) exactly once.
+    """
+
+    def __init__(self, chunks, deadline=None, on_close=None):
+        self._chunks = chunks
+        self._deadline = deadline
+        self._on_close = on_close
+        self._started = False
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            timeout = None
+            if self._deadline is not None:
+                if self._started:
+                    timeout = self._deadline.chunk_read_timeout()
+                else:
+                    timeout = self._deadline.first_byte_read_timeout()
+            with anyio.fail_after(timeout):
+                chunk = await self._chunks.__anext__()
+            if self._deadline is not None:
+                self._deadline.chunk_received()
+        except StopAsyncIteration:
+            await self.aclose()
+            raise
+        except Exception as e:
+            await self.aclose()
+            if is_timeout_error(e) and not isinstance(e, DeadlineExceeded):
+                raise DeadlineExceeded(f"Upstream stream stalled: {e}") from e
+            raise
+        except BaseException:
+            await self.aclose()
+            raise
+        self._started = True
+        return chunk
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Shielded, so the connection is released even when closing because
+        # the surrounding task was cancelled (client disconnect).
+        with anyio.CancelScope(shield=True):
+            try:
+                close = getattr(self._chunks, "aclose", None) or getattr(self._chunks, "close", None)
+                if close is not None:
+                    await close()
+            except RuntimeError:
+                # The chunk generator is still suspended mid-read; closing the
+                # response below aborts that read instead.
+                pass
+            finally:
+                if self._on_close is not None:
+                    await self._on_close()
+
+class _LeakTracker:
+    """
+    Debug helper that reports upstream responses left open for too long.
+
+    Enabled by setting UPSTREAM_LEAK_DEBUG_SECONDS; every tracked response
+    records where it was opened so the offending code path can be found.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._open = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._scan, daemon=True).start()
+
+    def track(self, provider_name, response):
+        key = id(response)
+        entry = {
+            "provider": provider_name,
+            "request": f"{response.request.method} {response.url}",
+            "opened_at": time.monotonic(),
+            "stack": "".join(traceback.format_stack(limit=10)[:-3]),
+            "reported": False,
+        }
+        with self._lock:
+            self._open[key] = entry
+
+        original_close = response.close
+
+        def close():
+            with self._lock:
+                self._open.pop(key, None)
+            original_close()
+
+        response.close = close
+
+    def open_responses(self):
+        """Returns (provider, request, age in seconds) for every open response."""
+        now = time.monotonic()
+        with self._lock:
+            return [(e["provider"], e["request"], now - e["opened_at"]) for e in self._open.values()]
+
+    def _scan(self):
+        interval = max(1.0, self.threshold / 2)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                stale = [e for e in self._open.values()
+                         if not e["reported"] and now - e["opened_at"] > self.threshold]
+                for entry in stale:
+                    entry["reported"] = True
+            for entry in stale:
+                log.warning(
+                    f"Upstream response from {entry['provider']} ({entry['request']}) still open after "
+                    f"{now - entry['opened_at']:.0f}s. Opened at:\n{entry['stack']}"
+                )
+
+_leak_tracker = None
+_leak_tracker_lock = threading.Lock()
+
+def get_leak_tracker():
+    """Returns the process-wide leak tracker, or None when leak debugging is off."""
+    global _leak_tracker
+    if Config.UPSTREAM_LEAK_DEBUG_SECONDS <= 0:
+        return None
+    with _leak_tracker_lock:
+        if _leak_tracker is None:
+            _leak_tracker = _LeakTracker(Config.UPSTREAM_LEAK_DEBUG_SECONDS)
+        return _leak_tracker
+
+class _HTTP2ClientPool:
+    """
+    A few HTTP/2 clients shared by the providers opted into HTTP/2.
+
+    Each client keeps one multiplexed connection per upstream host. httpcore
+    queues new streams once a connection reaches the server's
+    MAX_CONCURRENT_STREAMS rather than opening a second one, so every stream
+    is assigned to the client with the fewest in-flight streams for its host.
+    That gives up to UPSTREAM_HTTP2_CONNECTIONS_PER_HOST connections per host.
+    """
+
+    def __init__(self, client_class):
+        self._client_class = client_class
+        self._clients = []
+        self._load = {}
+        self._lock = threading.Lock()
+
+    def _new_client(self):
+        # Without prior knowledge h2 is negotiated via TLS ALPN, and anything
+        # that does not offer it is spoken to over HTTP/1.1.
+        return self._client_class(http2=True, http1=not Config.UPSTREAM_HTTP2_PRIOR_KNOWLEDGE)
+
+    def acquire(self, host):
+        """Returns (client, release) for a new stream to `host`."""
+        with self._lock:
+            if not self._clients:
+                self._clients = [self._new_client() for _ in range(max(1, Config.UPSTREAM_HTTP2_CONNECTIONS_PER_HOST))]
+            index = min(range(len(self._clients)), key=lambda i: self._load.get((host, i), 0))
+            self._load[(host, index)] = self._load.get((host, index), 0) + 1
+            client = self._clients[index]
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                with self._lock:
+                    self._load[(host, index)] -= 1
+
+        return client, release
+
+    def clients(self):
+        with self._lock:
+            clients, self._clients, self._load = self._clients, [], {}
+        return clients
+
+http2_pool = _HTTP2ClientPool(httpx.Client)
+async_http2_pool = _HTTP2ClientPool(httpx.AsyncClient)
+
+_async_client = None
+
+def get_async_http_client():
+    """
+    Returns the worker-wide httpx.AsyncClient shared by the raw-HTTP providers
+    in ASGI mode. Idle streams only hold a pooled connection, so a single
+    event loop can keep thousands of them open.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=Config.ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.UPSTREAM_POOL_MAXSIZE
+            )
+        )
+    return _async_client
+
+async def aclose_async_http_client():
+    """Closes the shared async clients (called on ASGI shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    for client in async_http2_pool.clients():
+        await client.aclose()
+
+class UpstreamHTTPClient:
+    """
+    Shared HTTP layer for the raw-HTTP providers.
+
+    Each provider gets its own pooled requests.Session, and every response is
+    handed out through a managed context that returns the connection to the
+    pool on every exit path, including errors raised before the body is read.
+
+    Rate-limit headers of every response are recorded in the provider's
+    upstream budget (see upstream_budget_service).
+
+    Providers listed in UPSTREAM_HTTP2_PROVIDERS send their requests through
+    the shared HTTP/2 client instead; responses then come back as
+    HTTP2Response, which offers the subset of requests.Response the
+    providers use.
+    """
+
+    def __init__(self, provider_name):
+        self.provider_name = provider_name
+        self.http2 = _http2_enabled(provider_name)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=Config.UPSTREAM_POOL_CONNECTIONS,
+            pool_maxsize=Config.UPSTREAM_POOL_MAXSIZE
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @contextmanager
+    def request(self, method, url, **kwargs):
+        """
+        Issues a request and closes the response when the block exits.
+
+        If the response is handed to stream_chunks() inside the block, the
+        returned UpstreamStream takes over and closes it when it is done.
+        """
+        if self.http2:
+            response = self._send_http2(method, url, **kwargs)
+        else:
+            response = self.session.request(method, url, **kwargs)
+            release = stream_counter.opened(urlsplit(url).netloc, "HTTP/1.1")
+            original_close = response.close
+
+            def close():
+                release()
+                original_close()
+
+            response.close = close
+        observe_response(self.provider_name, response.headers, response.status_code, response.request.headers)
+        tracker = get_leak_tracker()
+        if tracker:
+            tracker.track(self.provider_name, response)
+        try:
+            yield response
+        except BaseException:
+            response.close()
+            raise
+        else:
+            if not getattr(response, "_upstream_detached", False):
+                response.close()
+
+    def _send_http2(self, method, url, stream=False, timeout=None, **kwargs):
+        host = urlsplit(url).netloc
+        client, release_client = http2_pool.acquire(host)
+        try:
+            with _as_requests_errors():
+                request = client.build_request(method, url, timeout=_httpx_timeout(timeout), **kwargs)
+                response = client.send(request, stream=True)
+        except BaseException:
+            release_client()
+            raise
+        release_stream = stream_counter.opened(host, response.http_version)
+
+        def release():
+            release_stream()
+            release_client()
+
+        wrapped = HTTP2Response(response, release)
+        if not stream:
+            try:
+                wrapped.content
+            except BaseException:
+                wrapped.close()
+                raise
+        return wrapped
+
+    def stream_chunks(self, response, chunks, deadline=None):
+        """Wraps a chunk generator reading from `response` in an UpstreamStream."""
+        return UpstreamStream(response, chunks, deadline)
+
+    @asynccontextmanager
+    async def arequest(self, method, url, stream=False, timeout=None, **kwargs):
+        """
+        Async counterpart of request() backed by the shared httpx.AsyncClient.
+
+        Unless `stream` is set the body is read before the block is entered,
+        mirroring requests. `timeout` takes an httpx.Timeout (see
+        Deadline.sdk_timeout()). A response handed to astream_chunks() inside
+        the block is closed by the returned AsyncUpstreamStream instead.
+        """
+        host = urlsplit(url).netloc
+        if self.http2:
+            client, release_client = async_http2_pool.acquire(host)
+        else:
+            client, release_client = get_async_http_client(), lambda: None
+        try:
+            request = client.build_request(method, url, timeout=timeout, **kwargs)
+            response = await client.send(request, stream=True)
+        except BaseException:
+            release_client()
+            raise
+        release_stream = stream_counter.opened(host, response.http_version)
+        observe_response(self.provider_name, response.headers, response.status_code, request.headers)
+        original_aclose = response.aclose
+
+        async def aclose():
+            release_stream()
+            release_client()
+            await original_aclose()
+
+        response.aclose = aclose
+        try:
+            if not stream:
+                await response.aread()
+            yield response
+        except BaseException:
+            await response.aclose()
+            raise
+        else:
+            if not getattr(response, "_upstream_detached", False):
+                await response.aclose()
+
+    def astream_chunks(self, response, chunks, deadline=None):
+        """Wraps an async chunk generator reading from `response` in an AsyncUpstreamStream."""
+        response._upstream_detached = True
+        return AsyncUpstreamStream(chunks, deadline, on_close=response.aclose)
@@ -0,0 +1,181 @@
+# app/providers/key_pool.py
+
+import logging
+import math
+import threading
+import time
+from ..config import Config
+from ..extensions import redis_client
+from ..services.bulkhead_service import AdaptiveLimit
+from ..services.metrics_service import increment
+from ..services.upstream_budget_service import key_budget_waits, key_id, parse_retry_after
+
+log = logging.getLogger(__name__)
+
+# Pools of upstream API keys. Requests go to the key with the fewest calls in
+# flight in this worker (ties taken in turn), so concurrent traffic is spread
+# over every key instead of pinned to one. A key that is rate limited is
+# cooled down for its Retry-After; cooldowns are shared by all workers through
+# Redis ("key_pool:<pool>:<key id>", expiring with the cooldown) and read
+# through a short per-worker cache. With ADAPTIVE_LIMIT_ENABLED every key also
+# gets its own learned concurrency limit (see AdaptiveLimit), so a key is
+# not handed out beyond what its upstream rate limit sustains. Keys whose
+# rate-limit headers say they are used up (see upstream_budget_service) are
+# skipped until their reset.
+
+class NoAvailableKeyError(Exception):
+    """
+    Raised when every key of a pool is cooling down or has already been tried,
+    or (`saturated`) when the remaining keys are all at their concurrency limit.
+    """
+
+    def __init__(self, message, retry_after=None, saturated=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.saturated = saturated
+
+class APIKeyPool:
+    """
+    A provider's API keys with per-key in-flight counts and cooldowns.
+
+    acquire() hands out a key and a release callable; the release must run
+    when the call (or the stream it opened) is finished.
+    """
+
+    def __init__(self, name, api_keys):
+        self.name = name
+        self.api_keys = list(dict.fromkeys(api_keys))
+        self._ids = {api_key: key_id(api_key) for api_key in self.api_keys}
+        self._in_flight = {api_key: 0 for api_key in self.api_keys}
+        self._limits = {}
+        if Config.ADAPTIVE_LIMIT_ENABLED:
+            self._limits = {
+                api_key: AdaptiveLimit(f"{name}:{self._ids[api_key]}", Config.ADAPTIVE_KEY_LIMIT_MAX)
+                for api_key in self.api_keys
+            }
+        self._cooldowns = {}
+        self._cooldowns_read_at = None
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.api_keys)
+
+    def _redis_key(self, api_key):
+        return f"key_pool:{self.name}:{self._ids[api_key]}"
+
+    def _shared_cooldowns(self):
+        """Cooldown end times of every key, refreshed from Redis at most every KEY_POOL_HEALTH_CACHE_SECONDS."""
+        now = time.monotonic()
+        if self._cooldowns_read_at is not None and now - self._cooldowns_read_at < Config.KEY_POOL_HEALTH_CACHE_SECONDS:
+            return self._cooldowns
+        try:
+            values = redis_client.mget([self._redis_key(api_key) for api_key in self.api_keys])
+            shared = {api_key: float(v) for api_key, v in zip(self.api_keys, values) if v is not None}
+        except Exception as e:
+            log.debug(f"Failed to read key pool health for {self.name}: {e}")
+            shared = {}
+        with self._lock:
+            for api_key, until in shared.items():
+                self._cooldowns[api_key] = max(until, self._cooldowns.get(api_key, 0))
+            self._cooldowns_read_at = now
+        return self._cooldowns
+
+    def acquire(self, exclude=()):
+        """
+        Returns (api key, release) for the available key with the fewest calls
+        in flight, skipping keys in `exclude`, keys cooling down and keys at
+        their concurrency limit. Raises NoAvailableKeyError when there is none.
+        """
+        if not self.api_keys:
+            raise NoAvailableKeyError(f"No API keys configured for {self.name}")
+        cooldowns = self._shared_cooldowns()
+        now = time.time()
+        # Keys whose announced rate limit is used up wait for its reset like a cooldown
+        budget_waits = key_budget_waits(self.name)
+        if budget_waits:
+            cooldowns = dict(cooldowns)
+            for api_key in self.api_keys:
+                wait = budget_waits.get(self._ids[api_key])
+                if wait:
+                    cooldowns[api_key] = max(cooldowns.get(api_key, 0), now + wait)
+        with self._lock:
+            count = len(self.api_keys)
+            order = [self.api_keys[(self._next + i) % count] for i in range(count)]
+            healthy = [k for k in order if k not in exclude and cooldowns.get(k, 0) <= now]
+            available = [k for k in healthy if k not in self._limits or self._in_flight[k] < self._limits[k].current()]
+            if healthy and not available:
+                raise NoAvailableKeyError(f"All {self.name} API keys are at their concurrency limit", 1, saturated=True)
+            if not available:
+                waits = [cooldowns[k] - now for k in order if k not in exclude and k in cooldowns]
+                retry_after = math.ceil(min(waits)) if waits else None
+                if retry_after is not None:
+                    raise NoAvailableKeyError(
+                        f"All {self.name} API keys are rate limited; retry in {retry_after}s", retry_after
+                    )
+                raise NoAvailableKeyError(f"All {self.name} API keys have been tried and failed")
+            api_key = min(available, key=lambda k: self._in_flight[k])
+            self._in_flight[api_key] += 1
+            self._next = (self.api_keys.index(api_key) + 1) % count
+
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                with self._lock:
+                    self._in_flight[api_key] -= 1
+
+        return api_key, release
+
+    def record(self, api_key, latency=None, dropped=False):
+        """Feeds a call outcome on `api_key` to its adaptive limit, if any."""
+        limit = self._limits.get(api_key)
+        if limit is not None:
+            limit.sample(latency, self._in_flight[api_key], dropped)
+
+    def cooldown(self, api_key, seconds, reason=""):
+        """Takes a key out of rotation for `seconds`, in every worker."""
+        seconds = min(max(seconds, 1.0), Config.KEY_POOL_MAX_COOLDOWN)
+        until = time.time() + seconds
+        with self._lock:
+            self._cooldowns[api_key] = max(until, self._cooldowns.get(api_key, 0))
+        log.warning(f"{self.name} API key {self._ids[api_key]} cooling down for {seconds:.0f}s ({reason})")
+        increment("api_key_cooldowns", pool=self.name, key=self._ids[api_key])
+        try:
+            redis_client.set(self._redis_key(api_key), until, ex=math.ceil(seconds))
+        except Exception as e:
+            log.debug(f"Failed to share key pool cooldown for {self.name}: {e}")
+
+    def snapshot(self):
+        """Returns {key id: {"in_flight", "limit", "cooldown_remaining"}} as seen by this worker."""
+        cooldowns = self._shared_cooldowns()
+        now = time.time()
+        with self._lock:
+            return {
+                self._ids[k]: {
+                    "in_flight": self._in_flight[k],
+                    "limit": self._limits[k].current() if k in self._limits else None,
+                    "cooldown_remaining": max(0.0, round(cooldowns.get(k, 0) - now, 1)),
+                }
+                for k in self.api_keys
+            }
+
+def release_on_close(response, release):
+    """Runs `release` when `response` (requests, HTTP2Response or httpx async) is closed."""
+    if hasattr(response, "aclose"):
+        original_aclose = response.aclose
+
+        async def aclose():
+            release()
+            await original_aclose()
+
+        response.aclose = aclose
+    else:
+        original_close = response.close
+
+        def close():
+            release()
+            original_close()
+
+        response.close = close
@@ -1,4 +1,3 @@
-import requests
 import json
 import time
 import logging
@@ -6,6 +5,9 @@ import os
 from dotenv import load_dotenv; load_dotenv()
 from ..utils.token_counter import count_tokens
 from ..config import Config
+from ..utils.deadline import Deadline
+from .base_provider import UpstreamHTTPError
+from .http_client import UpstreamHTTPClient
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +22,7 @@ class Provider1:
     def __init__(self):
         self.models = self._load_models()
         self.url = os.environ.get("PROVIDER_1_BASE_URL")
+        self.http = UpstreamHTTPClient("provider-1")
         self.headers = {
             "accept": "*/*",
             "accept-encoding": "gzip, deflate, br, zstd",
@@ -68,34 +71,40 @@ class Provider1:
         """
         # Map alias to original model name if available; else use model_id as provided.
         actual_model = self.alias_to_actual.get(model_id, model_id)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
         payload = {
             "messages": messages,
             "model": actual_model
         }
-        response = requests.post(self.url, headers=self.headers, json=payload, stream=True)
-
-        if response.status_code != 200:
-            log.error(f"Provider 1 API error: Status {response.status_code}, Response: {response.text}")
-            raise Exception(f"Provider 1 API error: Status {response.status_code}, Detail: {response.text}")
-
-        if stream:
-            def generate():
-                for line in response.iter_lines(decode_unicode=True):
-                    if line and line.startswith("data: "):
-                        json_data = line[6:]
-                        if json_data.strip() == "[DONE]":
-                            continue
-                        try:
-                            chunk = json.loads(json_data)
-                            if isinstance(chunk, dict) and "choices" in chunk and chunk["choices"]:
-                                yield chunk
-                        except json.JSONDecodeError as e:
-                            log.error(f"JSON parsing error in stream: {e}")
-                            continue
-            return generate()
-        else:
+        # The upstream always answers with an SSE stream, so the body is read
+        # incrementally in both modes; the managed request guarantees the
+        # connection goes back to the pool on every path.
+        with self.http.request("POST", self.url, headers=self.headers, json=payload, stream=True,
+                               timeout=deadline.timeout()) as response:
+            if response.status_code != 200:
+                log.error(f"Provider 1 API error: Status {response.status_code}, Response: {response.text}")
+                raise UpstreamHTTPError(f"Provider 1 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+
+            if stream:
+                def generate():
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line and line.startswith("data: "):
+                            json_data = line[6:]
+                            if json_data.strip() == "[DONE]":
+                                continue
+                            try:
+                                chunk = json.loads(json_data)
+                                if isinstance(chunk, dict) and "choices" in chunk and chunk["choices"]:
+                                    yield chunk
+                            except json.JSONDecodeError as e:
+                                log.error(f"JSON parsing error in stream: {e}")
+                                continue
+                return self.http.stream_chunks(response, generate(), deadline)
+
             full_response_content = ""
             for line in response.iter_lines(decode_unicode=True):
+                # Nothing reaches the client before the end, so the total budget applies throughout.
+                deadline.check()
                 if line:
                     json_data = line[6:] if line.startswith("data: ") else line
                     try:
@@ -106,38 +115,90 @@ class Provider1:
                                 full_response_content += delta["content"]
                     except json.JSONDecodeError:
                         continue
-            completion_tokens = count_tokens(
-                [{"role": "assistant", "content": full_response_content}],
-                model_id,
-                kwargs.get('app')
-            )
-            prompt_tokens = count_tokens(messages, model_id, kwargs.get('app'))
-            total_tokens = prompt_tokens + completion_tokens
-            return {
-                "id": "chatcmpl-" + self._generate_fake_id(),
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model_id,
-                "choices": [{
-                    "index": 0,
-                    "message": {"role": "assistant", "content": full_response_content},
-                    "logprobs": None,
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": total_tokens,
-                    "completion_tokens_details": {
-                        "accepted_prediction_tokens": 0,
-                        "rejected_prediction_tokens": 0,
-                        "reasoning_tokens": 0
-                    },
-                    "prompt_tokens_details": {"audio_tokens": 0, "cached_tokens": 0}
+
+        return self._build_completion(model_id, messages, full_response_content, kwargs.get('app'))
+
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using the shared async HTTP client."""
+        actual_model = self.alias_to_actual.get(model_id, model_id)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        payload = {
+            "messages": messages,
+            "model": actual_model
+        }
+        async with self.http.arequest("POST", self.url, headers=self.headers, json=payload, stream=True,
+                                      timeout=deadline.sdk_timeout()) as response:
+            if response.status_code != 200:
+                await response.aread()
+                log.error(f"Provider 1 API error: Status {response.status_code}, Response: {response.text}")
+                raise UpstreamHTTPError(f"Provider 1 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+
+            if stream:
+                async def generate():
+                    async for line in response.aiter_lines():
+                        if line and line.startswith("data: "):
+                            json_data = line[6:]
+                            if json_data.strip() == "[DONE]":
+                                continue
+                            try:
+                                chunk = json.loads(json_data)
+                                if isinstance(chunk, dict) and "choices" in chunk and chunk["choices"]:
+                                    yield chunk
+                            except json.JSONDecodeError as e:
+                                log.error(f"JSON parsing error in stream: {e}")
+                                continue
+                return self.http.astream_chunks(response, generate(), deadline)
+
+            full_response_content = ""
+            async for line in response.aiter_lines():
+                deadline.check()
+                if line:
+                    json_data = line[6:] if line.startswith("data: ") else line
+                    try:
+                        chunk = json.loads(json_data)
+                        if isinstance(chunk, dict) and "choices" in chunk and chunk["choices"]:
+                            delta = chunk["choices"][0].get("delta", {})
+                            if "content" in delta:
+                                full_response_content += delta["content"]
+                    except json.JSONDecodeError:
+                        continue
+
+        return self._build_completion(model_id, messages, full_response_content, kwargs.get('app'))
+
+    def _build_completion(self, model_id, messages, full_response_content, app):
+        """Wraps the accumulated text in an OpenAI-style chat.completion response."""
+        completion_tokens = count_tokens(
+            [{"role": "assistant", "content": full_response_content}],
+            model_id,
+            app
+        )
+        prompt_tokens = count_tokens(messages, model_id, app)
+        total_tokens = prompt_tokens + completion_tokens
+        return {
+            "id": "chatcmpl-" + self._generate_fake_id(),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model_id,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": full_response_content},
+                "logprobs": None,
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": total_tokens,
+                "completion_tokens_details": {
+                    "accepted_prediction_tokens": 0,
+                    "rejected_prediction_tokens": 0,
+                    "reasoning_tokens": 0
                 },
-                "service_tier": "default",
-                "system_fingerprint": "fp_dummy"
-            }
+                "prompt_tokens_details": {"audio_tokens": 0, "cached_tokens": 0}
+            },
+            "service_tier": "default",
+            "system_fingerprint": "fp_dummy"
+        }
 
     def get_models(self) -> list:
         """Returns the supported models information for Provider 1."""
@@ -1,9 +1,12 @@
 from .base_provider import BaseProvider
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import logging
 import os
 from dotenv import load_dotenv; load_dotenv()
 from ..config import Config
+from ..utils.deadline import Deadline
+from .http_client import AsyncUpstreamStream
+from .sdk_clients import ProcessLocalClient, sdk_client_kwargs
 
 log = logging.getLogger(__name__)
 
@@ -13,12 +16,28 @@ class Provider2(BaseProvider):
     """
 
     def __init__(self):
-        self.client = OpenAI(
+        self._client = ProcessLocalClient(lambda: OpenAI(
             base_url=os.getenv("PROVIDER_2_BASE_URL"),
-            api_key=os.getenv("PROVIDER_2_API_KEY")
-        )
+            api_key=os.getenv("PROVIDER_2_API_KEY"),
+            **sdk_client_kwargs("provider-2")
+        ))
+        self._async_client = ProcessLocalClient(lambda: AsyncOpenAI(
+            base_url=os.getenv("PROVIDER_2_BASE_URL"),
+            api_key=os.getenv("PROVIDER_2_API_KEY"),
+            **sdk_client_kwargs("provider-2", is_async=True)
+        ))
         self.models = self._load_models()
 
+    @property
+    def client(self):
+        """OpenAI client of the current process."""
+        return self._client.get()
+
+    @property
+    def async_client(self):
+        """AsyncOpenAI client for ASGI mode, created on first use."""
+        return self._async_client.get()
+
     def _load_models(self):
         """Loads model information and filters for Provider-2 models."""
         try:
@@ -43,11 +62,13 @@ class Provider2(BaseProvider):
     def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs) -> dict:
         """Performs a chat completion using Provider 2 API."""
         kwargs.pop('app', None)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
         try:
             completion = self.client.chat.completions.create(
                 model=model_id,
                 messages=messages,
                 stream=stream,
+                timeout=deadline.sdk_timeout(),
                 **kwargs
             )
             if stream:
@@ -58,6 +79,26 @@ class Provider2(BaseProvider):
             log.error(f"Provider 2 API error: {e}")
             raise
 
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using AsyncOpenAI."""
+        kwargs.pop('app', None)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        try:
+            completion = await self.async_client.chat.completions.create(
+                model=model_id,
+                messages=messages,
+                stream=stream,
+                timeout=deadline.sdk_timeout(),
+                **kwargs
+            )
+            if stream:
+                return AsyncUpstreamStream(completion, deadline)
+            else:
+                return completion.model_dump()
+        except Exception as e:
+            log.error(f"Provider 2 API error: {e}")
+            raise
+
     def get_models(self) -> list:
         """Returns the list of models supported by Provider-2."""
         return self.models
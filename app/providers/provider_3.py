@@ -1,9 +1,12 @@
 import logging
-from openai import OpenAI
-from .base_provider import BaseProvider
+from openai import AsyncOpenAI, OpenAI
+from .base_provider import BaseProvider, UpstreamHTTPError, fan_out
+from .http_client import AsyncUpstreamStream, UpstreamHTTPClient
+from .sdk_clients import ProcessLocalClient, sdk_client_kwargs
+from ..services.blob_store_service import Base64Blob, put_blob_stream, require_signing, signed_url
 from ..config import Config
+from ..utils.deadline import Deadline
 import os
-import requests
 import json
 import time
 import base64
@@ -24,12 +27,19 @@ class Provider3(BaseProvider):
     """
 
     def __init__(self):
-        self.client = OpenAI(
-            base_url=os.environ.get("PROVIDER_3_BASE_URL"), 
-            api_key=os.environ.get("PROVIDER_3_API_KEY")
-        )
+        self._client = ProcessLocalClient(lambda: OpenAI(
+            base_url=os.environ.get("PROVIDER_3_BASE_URL"),
+            api_key=os.environ.get("PROVIDER_3_API_KEY"),
+            **sdk_client_kwargs("provider-3")
+        ))
+        self._async_client = ProcessLocalClient(lambda: AsyncOpenAI(
+            base_url=os.environ.get("PROVIDER_3_BASE_URL"),
+            api_key=os.environ.get("PROVIDER_3_API_KEY"),
+            **sdk_client_kwargs("provider-3", is_async=True)
+        ))
         self.typegpt_api_key = os.environ.get("PROVIDER_3_API_KEY")
         self.typegpt_base_url = os.environ.get("PROVIDER_3_BASE_URL")
+        self.http = UpstreamHTTPClient("provider-3")
         
         self.alias_to_actual = {
             "Provider-3/DeepSeek-R1": "deepseek-r1",
@@ -89,12 +99,14 @@ class Provider3(BaseProvider):
         """
         actual_model = self.alias_to_actual.get(model_id, model_id)
         kwargs.pop('app', None)  # Remove any unwanted keys
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
         
         try:
             completion = self.client.chat.completions.create(
                 model=actual_model,
                 messages=messages,
                 stream=stream,
+                timeout=deadline.sdk_timeout(),
                 **kwargs
             )
             if stream:
@@ -105,6 +117,38 @@ class Provider3(BaseProvider):
             log.error(f"Provider 3 API error: {e}")
             raise
 
+    @property
+    def client(self):
+        """OpenAI client of the current process."""
+        return self._client.get()
+
+    @property
+    def async_client(self):
+        """AsyncOpenAI client for ASGI mode, created on first use."""
+        return self._async_client.get()
+
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using AsyncOpenAI."""
+        actual_model = self.alias_to_actual.get(model_id, model_id)
+        kwargs.pop('app', None)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+
+        try:
+            completion = await self.async_client.chat.completions.create(
+                model=actual_model,
+                messages=messages,
+                stream=stream,
+                timeout=deadline.sdk_timeout(),
+                **kwargs
+            )
+            if stream:
+                return AsyncUpstreamStream(completion, deadline)
+            else:
+                return completion.model_dump()
+        except Exception as e:
+            log.error(f"Provider 3 API error: {e}")
+            raise
+
     def image_generation(self, prompt: str, size: str = "1024x1024", n: int = 1, 
                      response_format: str = "url", model: str = "Provider-3/flux-1.1-ultra", **kwargs):
         """
@@ -113,13 +157,39 @@ class Provider3(BaseProvider):
         Args:
             prompt (str): The prompt to generate the image from
             size (str): Image size (not used by TypeGPT but kept for compatibility)
-            n (int): Number of images to generate (only returns first one in this implementation)
+            n (int): Number of images to generate, requested from the upstream concurrently
             response_format (str): Format of the response. Can be "url" or "b64_json"
             model (str): Should be mapped to "Image-Generator" internally
                 
         Returns:
             Dictionary with a timestamp and image data in OpenAI-compatible format
         """
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model)
+        require_signing(response_format)
+
+        try:
+            images = fan_out(lambda i: self._generate_image(prompt, deadline), n, deadline)
+
+            # Return data in the requested format
+            result = {
+                "created": int(time.time()),
+                "data": []
+            }
+            for blob_id in images:
+                if response_format == "b64_json":
+                    # Encoded from the stored file as the response is sent
+                    result["data"].append({"b64_json": Base64Blob(blob_id)})
+                else:  # Default to "url" format: a signed link to the stored image
+                    result["data"].append({"url": signed_url(blob_id)})
+
+            return result
+
+        except Exception as e:
+            log.error(f"Error in Provider3 image_generation: {e}")
+            raise
+
+    def _generate_image(self, prompt: str, deadline: Deadline) -> str:
+        """Generates one image, streams it into the blob store and returns its blob id."""
         url = f"{self.typegpt_base_url}/chat/completions"
         headers = {
             "Authorization": f"Bearer {self.typegpt_api_key}",
@@ -130,49 +200,25 @@ class Provider3(BaseProvider):
             "model": "flux",
             "messages": [{"role": "user", "content": prompt}]
         }
-        
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            
+
+        with self.http.request("POST", url, headers=headers, json=data,
+                               timeout=deadline.timeout()) as response:
             # Check for successful status code
-            if response.status_code == 200:
-                response_data = response.json()
-                content = response_data["choices"][0]["message"]["content"]
-                # Extract URL using a simple split logic for efficiency
-                image_url = content.split('(')[-1].strip(')')
-                
-                # Download the image from the URL
-                img_response = requests.get(image_url)
-                if img_response.status_code != 200:
-                    raise Exception(f"Failed to download image from URL: {img_response.status_code}")
-                
-                # Convert image to base64
-                image_b64 = base64.b64encode(img_response.content).decode('utf-8')
-                
-                # Create timestamp
-                timestamp = int(time.time())
-                
-                # Return data in the requested format
-                result = {
-                    "created": timestamp,
-                    "data": []
-                }
-                
-                # Generate n images (though we're using the same image n times in this implementation)
-                for _ in range(n):
-                    if response_format == "b64_json":
-                        result["data"].append({"b64_json": image_b64})
-                    else:  # Default to "url" format
-                        result["data"].append({"url": f"data:image/jpeg;base64,{image_b64}"})
-                
-                return result
-            else:
+            if response.status_code != 200:
                 log.error(f"TypeGPT API error: Status {response.status_code}, Response: {response.text}")
-                raise Exception(f"TypeGPT API error: Status {response.status_code}, Detail: {response.text}")
-                
-        except Exception as e:
-            log.error(f"Error in Provider3 image_generation: {e}")
-            raise
+                raise UpstreamHTTPError(f"TypeGPT API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+            response_data = response.json()
+
+        content = response_data["choices"][0]["message"]["content"]
+        # Extract URL using a simple split logic for efficiency
+        image_url = content.split('(')[-1].strip(')')
+
+        # Download the image from the URL
+        with self.http.request("GET", image_url, stream=True, timeout=deadline.timeout()) as img_response:
+            if img_response.status_code != 200:
+                raise UpstreamHTTPError(f"Failed to download image from URL: {img_response.status_code}", img_response.status_code)
+
+            return put_blob_stream(img_response.iter_content(Config.BLOB_CHUNK_BYTES))
 
     def get_models(self) -> list:
         """Returns Provider 3 models (with aliases)."""
@@ -1,10 +1,11 @@
-from .base_provider import BaseProvider
-import requests
+from .base_provider import BaseProvider, UpstreamHTTPError
+from .http_client import UpstreamHTTPClient
 import json
 import os
 from dotenv import load_dotenv; load_dotenv()
 import logging
 from ..config import Config
+from ..utils.deadline import Deadline
 
 log = logging.getLogger(__name__)
 
@@ -27,17 +28,15 @@ class Provider4(BaseProvider):
         self.api_key = os.environ.get("PROVIDER_4_API_KEY")
         self.base_url = os.environ.get("PROVIDER_4_BASE_URL")
         self.endpoint = f"{self.base_url}/chat/completions"
+        self.http = UpstreamHTTPClient("provider-4")
         self.alias_to_actual = {
             "Provider-4/DeepSeek-R1": "deepseek-ai/DeepSeek-R1",
             "Provider-4/DeepSeek-R1-Distill-Llama-70B": "deepseek-ai/DeepSeek-R1-Distill-Llama-70B",
             "Provider-4/DeepSeekV3": "deepseek-ai/DeepSeek-V3"
         }
 
-    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs) -> dict:
-        """
-        Performs a streaming chat completion.
-        Maps the alias to the actual model name.
-        """
+    def _build_request(self, model_id: str, messages: list, stream: bool, kwargs: dict):
+        """Validates the call and returns the (headers, payload) for the upstream request."""
         if not stream:
             raise Exception("Provider4 does not support non-streaming requests. Enable streaming by setting stream=True.")
         if model_id not in self.alias_to_actual:
@@ -58,30 +57,71 @@ class Provider4(BaseProvider):
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        return headers, payload
+
+    def _parse_line(self, line):
+        """Parses one SSE line. Returns the chunk, None to skip the line, or "[DONE]"."""
+        if not line:
+            return None
+        data_str = line[len("data:"):].strip() if line.startswith("data:") else line.strip()
+        if data_str == "[DONE]":
+            return data_str
+        try:
+            return json.loads(data_str)
+        except json.JSONDecodeError as e:
+            log.error(f"JSON decoding error in Provider4 stream: {e}")
+            return None
+
+    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs) -> dict:
+        """
+        Performs a streaming chat completion.
+        Maps the alias to the actual model name.
+        """
+        headers, payload = self._build_request(model_id, messages, stream, kwargs)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
 
         try:
-            response = requests.post(self.endpoint, headers=headers, json=payload, stream=True)
-            if response.status_code != 200:
-                log.error(f"Provider4 API error: Status {response.status_code}, Response: {response.text}")
-                raise Exception(f"Provider4 API error: Status {response.status_code}, Detail: {response.text}")
-            def generate():
-                for line in response.iter_lines(decode_unicode=True, chunk_size=1):
-                    if not line:
-                        continue
-                    data_str = line[len("data:"):].strip() if line.startswith("data:") else line.strip()
-                    if data_str == "[DONE]":
-                        break
-                    try:
-                        chunk = json.loads(data_str)
-                    except json.JSONDecodeError as e:
-                        log.error(f"JSON decoding error in Provider4 stream: {e}")
-                        continue
-                    yield chunk
-            return generate()
+            with self.http.request("POST", self.endpoint, headers=headers, json=payload, stream=True,
+                                   timeout=deadline.timeout()) as response:
+                if response.status_code != 200:
+                    log.error(f"Provider4 API error: Status {response.status_code}, Response: {response.text}")
+                    raise UpstreamHTTPError(f"Provider4 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+                def generate():
+                    for line in response.iter_lines(decode_unicode=True, chunk_size=1):
+                        chunk = self._parse_line(line)
+                        if chunk == "[DONE]":
+                            break
+                        if chunk is not None:
+                            yield chunk
+                return self.http.stream_chunks(response, generate(), deadline)
         except Exception as e:
             log.error(f"Error in Provider4 chat_completion: {e}")
             raise
 
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using the shared async HTTP client."""
+        headers, payload = self._build_request(model_id, messages, stream, kwargs)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+
+        try:
+            async with self.http.arequest("POST", self.endpoint, headers=headers, json=payload, stream=True,
+                                          timeout=deadline.sdk_timeout()) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    log.error(f"Provider4 API error: Status {response.status_code}, Response: {response.text}")
+                    raise UpstreamHTTPError(f"Provider4 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+                async def generate():
+                    async for line in response.aiter_lines():
+                        chunk = self._parse_line(line)
+                        if chunk == "[DONE]":
+                            break
+                        if chunk is not None:
+                            yield chunk
+                return self.http.astream_chunks(response, generate(), deadline)
+        except Exception as e:
+            log.error(f"Error in Provider4 achat_completion: {e}")
+            raise
+
     def get_models(self) -> list:
         """Returns the list of models for Provider4 using alias names."""
         models = []
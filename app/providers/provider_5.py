@@ -1,4 +1,3 @@
-import requests
 import json
 import random
 import base64
@@ -6,8 +5,11 @@ import time
 import logging
 import os
 from dotenv import load_dotenv
-from .base_provider import BaseProvider
+from .base_provider import BaseProvider, UpstreamHTTPError, fan_out
+from .http_client import UpstreamHTTPClient
+from ..services.blob_store_service import Base64Blob, put_blob_stream, require_signing, signed_url
 from ..config import Config
+from ..utils.deadline import Deadline
 
 log = logging.getLogger(__name__)
 load_dotenv()
@@ -22,6 +24,7 @@ class Provider5(BaseProvider):
         self.api_key = os.environ.get("PROVIDER_5_API_KEY")
         self.base_url = os.environ.get("PROVIDER_5_BASE_URL")
         self.endpoint = f"{self.base_url}/openai/chat/completions"
+        self.http = UpstreamHTTPClient("provider-5")
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -84,10 +87,8 @@ class Provider5(BaseProvider):
             log.error(f"Error loading models for Provider5: {e}")
             return []
     
-    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
-        """        
-        This method handles both streaming and non-streaming requests.
-        """
+    def _build_payload(self, model_id: str, messages: list, stream: bool, kwargs: dict):
+        """Validates the model and returns the (stream, payload) for the upstream request."""
         # Check if the model is supported
         if model_id not in self.alias_to_actual:
             raise ValueError(f"Model '{model_id}' is not supported by Provider5")
@@ -118,87 +119,132 @@ class Provider5(BaseProvider):
             if param in kwargs:
                 payload[param] = kwargs[param]
         
+        return stream, payload
+
+    def _parse_line(self, line):
+        """Parses one SSE line. Returns the chunk, None to skip the line, or "[DONE]"."""
+        if not line:
+            return None
+        data_str = line[len("data:"):].strip() if line.startswith("data:") else line.strip()
+        if data_str == "[DONE]":
+            return data_str
         try:
-            # Make the API request
-            response = requests.post(
-                self.endpoint, 
-                headers=self.headers, 
-                json=payload,
-                stream=stream
-            )
-            
-            # Check for successful response
-            if response.status_code != 200:
-                log.error(f"Provider 5 API error: Status {response.status_code}, Response: {response.text}")
-                raise Exception(f"Provider 5 API error: Status {response.status_code}, Detail: {response.text}")
-            
-            # Handle streaming response
-            if stream:
-                def generate():
-                    for line in response.iter_lines(decode_unicode=True, chunk_size=1):
-                        if not line:
-                            continue
-                        data_str = line[len("data:"):].strip() if line.startswith("data:") else line.strip()
-                        if data_str == "[DONE]":
-                            break
-                        try:
-                            chunk = json.loads(data_str)
-                            yield chunk
-                        except json.JSONDecodeError as e:
-                            log.error(f"JSON parsing error in stream: {e}")
-                            continue
-                return generate()
+            return json.loads(data_str)
+        except json.JSONDecodeError as e:
+            log.error(f"JSON parsing error in stream: {e}")
+            return None
+
+    def _parse_completion(self, model_id: str, response, kwargs: dict):
+        """
+        Parses a non-streaming response. Works with both requests and httpx
+        responses (the body must already be read).
+        """
+        # Log the raw response for debugging
+        log.debug(f"Raw response from Provider 5 API: {response.text[:200]}...")
+    
+        # Check if the response has content before parsing as JSON
+        if response.content:
+            try:
+                return response.json()
+            except json.JSONDecodeError as e:
+                log.error(f"JSON parsing error in non-streaming response: {e}")
+                log.error(f"Response content: {response.text[:500]}")
             
-            # Handle non-streaming response
-            else:
-                # Log the raw response for debugging
-                log.debug(f"Raw response from Provider 5 API: {response.text[:200]}...")
-                
-                # Check if the response has content before parsing as JSON
-                if response.content:
-                    try:
-                        return response.json()
-                    except json.JSONDecodeError as e:
-                        log.error(f"JSON parsing error in non-streaming response: {e}")
-                        log.error(f"Response content: {response.text[:500]}")
-                        
-                        # For audio model, we might get a different response format
-                        if model_id == "Provider-5/gpt-4o-audio-preview":
-                            # Return a structured response that matches expected format
-                            return {
-                                "choices": [
-                                    {
-                                        "message": {
-                                            "content": None,
-                                            "role": "assistant",
-                                            "audio": {
-                                                "data": base64.b64encode(response.content).decode('utf-8') if response.content else "",
-                                                "format": kwargs.get("format", "wav")
-                                            }
-                                        }
-                                    }
-                                ]
-                            }
-                        
-                        # For regular models, create a fallback response
-                        # This is a workaround for Provider 5's API inconsistency
-                        return {
-                            "choices": [
-                                {
-                                    "message": {
-                                        "content": response.text,
-                                        "role": "assistant"
+                # For audio model, we might get a different response format
+                if model_id == "Provider-5/gpt-4o-audio-preview":
+                    # Return a structured response that matches expected format
+                    return {
+                        "choices": [
+                            {
+                                "message": {
+                                    "content": None,
+                                    "role": "assistant",
+                                    "audio": {
+                                        "data": base64.b64encode(response.content).decode('utf-8') if response.content else "",
+                                        "format": kwargs.get("format", "wav")
                                     }
                                 }
-                            ]
+                            }
+                        ]
+                    }
+            
+                # For regular models, create a fallback response
+                # This is a workaround for Provider 5's API inconsistency
+                return {
+                    "choices": [
+                        {
+                            "message": {
+                                "content": response.text,
+                                "role": "assistant"
+                            }
                         }
-                else:
-                    log.error("Empty response from Provider 5 API")
-                    raise Exception("Empty response from Provider 5 API")
+                    ]
+                }
+        else:
+            log.error("Empty response from Provider 5 API")
+            raise Exception("Empty response from Provider 5 API")
+
+    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """        
+        This method handles both streaming and non-streaming requests.
+        """
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        stream, payload = self._build_payload(model_id, messages, stream, kwargs)
+        
+        try:
+            # Make the API request
+            with self.http.request("POST", self.endpoint, headers=self.headers, json=payload, stream=stream,
+                                   timeout=deadline.timeout()) as response:
+                # Check for successful response
+                if response.status_code != 200:
+                    log.error(f"Provider 5 API error: Status {response.status_code}, Response: {response.text}")
+                    raise UpstreamHTTPError(f"Provider 5 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+            
+                # Handle streaming response
+                if stream:
+                    def generate():
+                        for line in response.iter_lines(decode_unicode=True, chunk_size=1):
+                            chunk = self._parse_line(line)
+                            if chunk == "[DONE]":
+                                break
+                            if chunk is not None:
+                                yield chunk
+                    return self.http.stream_chunks(response, generate(), deadline)
+            
+                # Handle non-streaming response
+                return self._parse_completion(model_id, response, kwargs)
         except Exception as e:
             log.error(f"Error in Provider5 chat_completion: {e}")
             raise
 
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using the shared async HTTP client."""
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        stream, payload = self._build_payload(model_id, messages, stream, kwargs)
+
+        try:
+            async with self.http.arequest("POST", self.endpoint, headers=self.headers, json=payload, stream=stream,
+                                          timeout=deadline.sdk_timeout()) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    log.error(f"Provider 5 API error: Status {response.status_code}, Response: {response.text}")
+                    raise UpstreamHTTPError(f"Provider 5 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+
+                if stream:
+                    async def generate():
+                        async for line in response.aiter_lines():
+                            chunk = self._parse_line(line)
+                            if chunk == "[DONE]":
+                                break
+                            if chunk is not None:
+                                yield chunk
+                    return self.http.astream_chunks(response, generate(), deadline)
+
+                return self._parse_completion(model_id, response, kwargs)
+        except Exception as e:
+            log.error(f"Error in Provider5 achat_completion: {e}")
+            raise
+
     def image_generation(self, prompt: str, size: str = "1024x1024", n: int = 1, 
                     response_format: str = "url", model: str = "Provider-5/flux-pro", **kwargs):
         """
@@ -207,7 +253,7 @@ class Provider5(BaseProvider):
         Args:
             prompt (str): The prompt to generate the image from
             size (str): Image size in format "widthxheight", e.g. "1024x1024"
-            n (int): Number of images to generate (only returns first one in this implementation)
+            n (int): Number of images to generate, requested from the upstream concurrently
             response_format (str): Format of the response. Can be "url" or "b64_json"
             model (str): Model to use (default is "Provider-5/flux-pro")
                 
@@ -235,24 +281,32 @@ class Provider5(BaseProvider):
         except ValueError:
             width, height = 1024, 1024  # Default to 1024x1024 if parsing fails
         
-        # Generate a random seed for variety
-        seed = random.randint(1, 10000)
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model)
+        require_signing(response_format)
+
+        # Every image gets its own seed: consecutive ones from the requested
+        # seed, or distinct random ones for variety
+        seed = kwargs.pop("seed", None)
+        seeds = [seed + i for i in range(n)] if seed is not None else random.sample(range(1, 10001), n)
         
         # Build the API URL with supported parameters
         base_url = os.environ.get('PROVIDER_5_IMG_BASE_URL')
-        api_url = f"{base_url}/{prompt}?width={width}&height={height}&model={actual_model}&seed={seed}&nologo=true&nofeed=yes"
+        api_url = f"{base_url}/{prompt}?width={width}&height={height}&model={actual_model}&nologo=true&nofeed=yes"
+
+        def generate(i):
+            # Stream the image into the blob store
+            with self.http.request("GET", f"{api_url}&seed={seeds[i]}", stream=True,
+                                   timeout=deadline.timeout()) as response:
+                # Check if the response was successful
+                if response.status_code != 200:
+                    log.error(f"Provider 5 image generation API error: Status {response.status_code}")
+                    raise UpstreamHTTPError(f"Provider 5 image generation API error: Status {response.status_code}", response.status_code)
+
+                return put_blob_stream(response.iter_content(Config.BLOB_CHUNK_BYTES))
         
         try:
-            # Download the image
-            response = requests.get(api_url)
-            
-            # Check if the response was successful
-            if response.status_code != 200:
-                log.error(f"Provider 5 image generation API error: Status {response.status_code}")
-                raise Exception(f"Provider 5 image generation API error: Status {response.status_code}")
-            
-            # Convert the image to base64
-            image_data = base64.b64encode(response.content).decode('utf-8')
+            # Request the n images concurrently
+            images = fan_out(generate, n, deadline)
             
             # Create a timestamp
             timestamp = int(time.time())
@@ -263,12 +317,12 @@ class Provider5(BaseProvider):
                 "data": []
             }
             
-            # Generate n images (though we're using the same image n times in this implementation)
-            for _ in range(n):
+            for blob_id in images:
                 if response_format == "b64_json":
-                    result["data"].append({"b64_json": image_data})
-                else:  # Default to "url" format
-                    result["data"].append({"url": f"data:image/jpeg;base64,{image_data}"})
+                    # Encoded from the stored file as the response is sent
+                    result["data"].append({"b64_json": Base64Blob(blob_id)})
+                else:  # Default to "url" format: a signed link to the stored image
+                    result["data"].append({"url": signed_url(blob_id)})
             
             return result
             
@@ -6,8 +6,11 @@ import time
 from typing import List, Optional, Union
 import requests
 
-from .base_provider import BaseProvider
+from .base_provider import BaseProvider, fan_out
+from .http_client import UpstreamHTTPClient
+from ..services.blob_store_service import blob_url, require_signing
 from ..config import Config
+from ..utils.deadline import Deadline
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +29,7 @@ class Provider6(BaseProvider):
         self.api_endpoint = os.getenv("PROVIDER_6_BASE_URL")
         if not self.api_endpoint:
             log.warning("PROVIDER_6_BASE_URL not set in environment variables")
+        self.http = UpstreamHTTPClient("provider-6")
         
         # Map our model aliases to provider's actual model names
         self.alias_to_actual = {
@@ -87,7 +91,7 @@ class Provider6(BaseProvider):
         Args:
             prompt (str): The prompt to generate the image from
             size (str): Image size (not directly used by Provider 6 but mapped to aspect ratio)
-            n (int): Number of images to generate
+            n (int): Number of images to generate, requested from the upstream concurrently
             response_format (str): Format of the response. Can be "url" or "b64_json"
             model (str): Model to use (default is "Provider-6/flux-schnell")
                 
@@ -101,6 +105,9 @@ class Provider6(BaseProvider):
         else:
             actual_model = self.alias_to_actual[model]
         
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model)
+        require_signing(response_format)
+
         # Map size to Provider 6 aspect ratio format
         # Provider 6 uses "1_1" format for square images
         size_mapping = {
@@ -129,6 +136,29 @@ class Provider6(BaseProvider):
             "isPublic": False  # Set to False for privacy
         }
         
+        def generate(i):
+            # Make the API request
+            try:
+                log.info(f"Sending request to Provider 6 API: {self.api_endpoint}")
+                log.debug(f"Payload: {payload}")
+
+                with self.http.request("POST", self.api_endpoint, json=payload, headers=headers,
+                                       timeout=deadline.timeout()) as response:
+                    # Check for successful response
+                    response.raise_for_status()
+                    log.info(f"Provider 6 API response status: {response.status_code}")
+
+                    # Parse the response
+                    response_data = response.json()
+            except requests.exceptions.RequestException as e:
+                log.error(f"Provider 6 API request failed: {e}")
+                raise Exception(f"Provider 6 API connection error: {e}") from e
+
+            if not response_data or 'result' not in response_data:
+                raise Exception("Invalid response format from Provider 6 API")
+            # The result is in format "data:image/png;base64,BASE64_DATA"
+            return response_data['result']
+
         # Initialize result
         result = {
             "created": int(time.time()),
@@ -136,44 +166,15 @@ class Provider6(BaseProvider):
         }
         
         try:
-            # Generate n images
-            for i in range(n):
-                # Make the API request
-                try:
-                    log.info(f"Sending request to Provider 6 API: {self.api_endpoint}")
-                    log.debug(f"Payload: {payload}")
-                    
-                    response = requests.post(
-                        self.api_endpoint,
-                        json=payload,
-                        headers=headers,
-                    )
-                    
-                    # Check for successful response
-                    response.raise_for_status()
-                    log.info(f"Provider 6 API response status: {response.status_code}")
-                except requests.exceptions.RequestException as e:
-                    log.error(f"Provider 6 API request failed: {e}")
-                    raise Exception(f"Provider 6 API connection error: {e}")
-                
-                # Parse the response
-                response_data = response.json()
-                
-                if response_data and 'result' in response_data:
-                    # Get base64 data and remove header
-                    image_data = response_data['result']
-                    # The result is in format "data:image/png;base64,BASE64_DATA"
+            # Generate the n images concurrently
+            for image_data in fan_out(generate, n, deadline):
+                # Add to result based on requested format
+                if response_format == "b64_json":
                     # Extract just the base64 part
-                    base64_data = image_data.split(',')[1]
-                    
-                    # Add to result based on requested format
-                    if response_format == "b64_json":
-                        result["data"].append({"b64_json": base64_data})
-                    else:  # Default to "url" format
-                        # For URL format, return a data URL
-                        result["data"].append({"url": image_data})  # Use the full data URL
-                else:
-                    raise Exception("Invalid response format from Provider 6 API")
+                    result["data"].append({"b64_json": image_data.split(',')[1]})
+                else:  # Default to "url" format
+                    # For URL format, return a signed link to the stored image
+                    result["data"].append({"url": blob_url(base64.b64decode(image_data.split(',')[1]))})
             
             return result
                 
@@ -1,3 +1,4 @@
+import httpx
 import requests
 import json
 import time
@@ -6,7 +7,12 @@ import os
 from dotenv import load_dotenv; load_dotenv()
 from ..utils.token_counter import count_tokens
 from ..config import Config
+from ..utils.deadline import Deadline
 from . import BaseProvider
+from .base_provider import UpstreamHTTPError
+from .http_client import UpstreamHTTPClient
+from ..services.bulkhead_service import BulkheadFullError
+from .key_pool import APIKeyPool, NoAvailableKeyError, key_id, parse_retry_after, release_on_close
 
 log = logging.getLogger(__name__)
 
@@ -19,21 +25,19 @@ class Provider7(BaseProvider):
     Provider 7 implementation.
     
     Features:
-    - Supports multiple API keys with automatic rotation on errors
-    - Configurable error codes that trigger rotation
-    - Prevents infinite rotation loops by tracking rotation count
+    - Spreads concurrent requests over multiple API keys (fewest in flight first)
+    - Retries a failed request on another key for configurable error codes
+    - Cools a rate limited key down for its Retry-After, shared across workers
     
     Configuration:
     - PROVIDER_7_API_KEYS: JSON array of API keys
     - PROVIDER_7_ERROR_CODES: JSON array of status codes that trigger rotation, or ["*"] for all errors
     """
-    # Class variables to track API key rotation
-    _current_key_index = 0
-    _rotation_count = 0
 
     def __init__(self):
         self.models = self._load_models()
         self.base_url = os.environ.get("PROVIDER_7_BASE_URL")
+        self.http = UpstreamHTTPClient("provider-7")
         
         # Support for multiple API keys
         api_keys_str = os.environ.get("PROVIDER_7_API_KEYS", "[]")
@@ -49,17 +53,9 @@ class Provider7(BaseProvider):
         error_codes_str = os.environ.get("PROVIDER_7_ERROR_CODES", "[429]")
         self.error_codes = json.loads(error_codes_str) if error_codes_str else [429]
         
-        # Set current API key
-        self.current_api_key = self.api_keys[self._current_key_index] if self.api_keys else ""
-        
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.current_api_key}"
-        }
-        
-        # Log the initial API key being used
+        self.key_pool = APIKeyPool("provider-7", self.api_keys)
         if self.api_keys:
-            log.info(f"Provider 7 initialized with API key #{Provider7._current_key_index + 1}/{len(self.api_keys)}: {self._mask_api_key(self.current_api_key)}")
+            log.info(f"Provider 7 initialized with {len(self.key_pool)} API key(s)")
 
     def _load_models(self):
         """Loads the model information from the centralized file."""
@@ -84,11 +80,11 @@ class Provider7(BaseProvider):
         """Generate a dummy unique identifier for the chat completion."""
         return str(int(time.time() * 1000))
 
-    def _mask_api_key(self, api_key):
-        """Mask API key for logging purposes, showing only first 8 and last 4 characters."""
-        if not api_key or len(api_key) < 12:
-            return "****"
-        return f"{api_key[:8]}...{api_key[-4:]}"
+    def _headers(self, api_key):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
         
     def _should_rotate_key(self, status_code):
         """
@@ -106,50 +102,47 @@ class Provider7(BaseProvider):
         
         # Check if specific status code should trigger rotation
         return status_code in self.error_codes
-    
-    def _rotate_api_key(self, error_info=""):
+
+    def _acquire_key(self, tried):
         """
-        Rotate to the next API key in the list.
-        
-        Args:
-            error_info: Information about the error that triggered rotation
-            
+        Takes the least busy API key not yet tried for this request.
+
         Raises:
-            MaxAPIKeyRotationsError: If all keys have been tried and failed
+            MaxAPIKeyRotationsError: If every key has been tried or is cooling down
         """
-        if not self.api_keys:
-            raise MaxAPIKeyRotationsError("No API keys available for rotation")
-        
-        # Log the current key that failed
-        current_key_num = Provider7._current_key_index + 1
-        masked_key = self._mask_api_key(self.current_api_key)
-        log.warning(f"API key #{current_key_num}/{len(self.api_keys)} ({masked_key}) failed: {error_info}")
-            
-        # Increment rotation count
-        Provider7._rotation_count += 1
-        
-        # Check if we've tried all keys
-        if Provider7._rotation_count > len(self.api_keys):
-            # Reset rotation count
-            Provider7._rotation_count = 0
-            raise MaxAPIKeyRotationsError("All API keys have been tried and failed")
-        
-        # Move to next key
-        Provider7._current_key_index = (Provider7._current_key_index + 1) % len(self.api_keys)
-        self.current_api_key = self.api_keys[Provider7._current_key_index]
-        
-        # Update authorization header
-        self.headers["Authorization"] = f"Bearer {self.current_api_key}"
-        
-        # Log the new key being used
-        new_key_num = Provider7._current_key_index + 1
-        masked_new_key = self._mask_api_key(self.current_api_key)
-        log.info(f"Rotated to API key #{new_key_num}/{len(self.api_keys)}: {masked_new_key}")
+        try:
+            return self.key_pool.acquire(exclude=tried)
+        except NoAvailableKeyError as e:
+            if e.saturated:
+                raise BulkheadFullError(f"{self.key_pool.name} API keys", "key_limits") from e
+            log.error(f"All API keys failed: {e}")
+            raise MaxAPIKeyRotationsError(str(e)) from e
 
-    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+    def _record_key_outcome(self, api_key, status_code, started):
+        """Feeds the key's adaptive limit: latency to the response headers, or a drop on 429/5xx."""
+        if status_code == 200:
+            self.key_pool.record(api_key, latency=time.monotonic() - started)
+        elif status_code == 429 or status_code >= 500:
+            self.key_pool.record(api_key, dropped=True)
+
+    def _key_failed(self, api_key, response):
         """
-        With automatic API key rotation on specified errors.
+        Handles a response that triggers rotation. Rate limited keys (429 or a
+        Retry-After header) are cooled down for every request; otherwise only
+        this request moves on to another key.
         """
+        retry_after = parse_retry_after(response.headers)
+        if response.status_code == 429 or retry_after is not None:
+            self.key_pool.cooldown(
+                api_key,
+                retry_after if retry_after is not None else Config.KEY_POOL_DEFAULT_COOLDOWN,
+                f"status {response.status_code}"
+            )
+        else:
+            log.warning(f"API key {key_id(api_key)} failed: Status {response.status_code}; trying the next key")
+
+    def _build_payload(self, model_id: str, messages: list, stream: bool, kwargs: dict) -> dict:
+        """Builds the upstream request payload."""
         # Extract model name without the provider prefix
         actual_model = model_id.split("/", 1)[1] if "/" in model_id else model_id
         
@@ -164,115 +157,156 @@ class Provider7(BaseProvider):
         for param in ["temperature", "top_p", "presence_penalty", "frequency_penalty", "max_tokens"]:
             if param in kwargs and kwargs[param] is not None:
                 payload[param] = kwargs[param]
-        
+        return payload
+
+    def _parse_line(self, line_text):
+        """Parses one SSE line. Returns the chunk, or None if the line carries no chunk."""
+        # Remove the "data: " prefix if present
+        if not line_text.startswith("data: "):
+            return None
+        data = line_text[6:]
+    
+        # Check for the end of the stream
+        if data == "[DONE]":
+            return None
+    
+        try:
+            # Parse the JSON data
+            return json.loads(data)
+        except json.JSONDecodeError as e:
+            log.error(f"Error decoding JSON: {e}")
+            return None
+
+    def _ensure_usage(self, response_data, model_id, messages, app):
+        """Calculates token usage if not provided by the API."""
+        if not response_data.get("usage"):
+            completion_content = response_data["choices"][0]["message"]["content"]
+            completion_tokens = count_tokens(
+                [{"role": "assistant", "content": completion_content}],
+                model_id,
+                app
+            )
+            prompt_tokens = count_tokens(messages, model_id, app)
+            total_tokens = prompt_tokens + completion_tokens
+            
+            response_data["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": total_tokens
+            }
+        return response_data
+
+    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """
+        With automatic API key rotation on specified errors.
+        """
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        payload = self._build_payload(model_id, messages, stream, kwargs)
         endpoint = f"{self.base_url}/chat/completions"
+        tried = set()
         
         while True:  # Keep trying until success or all keys fail
+            api_key, release = self._acquire_key(tried)
+            tried.add(api_key)
+            # A returned stream keeps its key busy until the response is closed.
+            handed_over = False
+            started = time.monotonic()
             try:
-                if stream:
-                    # For streaming responses
-                    response = requests.post(
-                        endpoint, 
-                        headers=self.headers, 
-                        json=payload, 
-                        stream=True
-                    )
-                    
+                with self.http.request("POST", endpoint, headers=self._headers(api_key), json=payload, stream=stream,
+                                       timeout=deadline.timeout()) as response:
+                    self._record_key_outcome(api_key, response.status_code, started)
                     if response.status_code != 200:
                         # Check if we should rotate key
                         if self._should_rotate_key(response.status_code):
-                            error_info = f"Status {response.status_code}"
-                            self._rotate_api_key(error_info)
-                            continue  # Try again with new key
-                        else:
-                            log.error(f"Provider 7 API error: Status {response.status_code}, Response: {response.text}")
-                            raise Exception(f"Provider 7 API error: Status {response.status_code}, Detail: {response.text}")
-                    
-                    # Reset rotation count on success
-                    Provider7._rotation_count = 0
-                    
-                    def generate():
-                        for line in response.iter_lines():
-                            if line:
-                                # Remove the "data: " prefix if present
-                                line_text = line.decode('utf-8')
-                                if line_text.startswith("data: "):
-                                    data = line_text[6:]
-                                    
-                                    # Check for the end of the stream
-                                    if data == "[DONE]":
-                                        continue
-                                    
-                                    try:
-                                        # Parse the JSON data
-                                        chunk = json.loads(data)
+                            self._key_failed(api_key, response)
+                            continue  # Try again with another key
+                        log.error(f"Provider 7 API error: Status {response.status_code}, Response: {response.text}")
+                        raise UpstreamHTTPError(f"Provider 7 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+
+                    if stream:
+                        def generate():
+                            for line in response.iter_lines():
+                                if line:
+                                    chunk = self._parse_line(line.decode('utf-8'))
+                                    if chunk is not None:
                                         yield chunk
-                                    except json.JSONDecodeError as e:
-                                        log.error(f"Error decoding JSON: {e}")
-                                        continue
-                    
-                    return generate()
-                else:
-                    # For non-streaming responses
-                    response = requests.post(
-                        endpoint, 
-                        headers=self.headers, 
-                        json=payload
-                    )
-                    
+
+                        release_on_close(response, release)
+                        handed_over = True
+                        return self.http.stream_chunks(response, generate(), deadline)
+
+                    # Parse the response
+                    response_data = response.json()
+
+                return self._ensure_usage(response_data, model_id, messages, kwargs.get('app'))
+
+            except requests.exceptions.RequestException as e:
+                # Connection errors are retried on another key
+                self.key_pool.record(api_key, dropped=True)
+                log.warning(f"API key {key_id(api_key)} failed: Connection error: {str(e)[:100]}")
+                continue
+            except Exception as e:
+                # Other errors are propagated
+                log.error(f"Error in Provider 7 chat completion: {e}")
+                raise
+            finally:
+                if not handed_over:
+                    release()
+
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion(), with the same API key rotation."""
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        payload = self._build_payload(model_id, messages, stream, kwargs)
+        endpoint = f"{self.base_url}/chat/completions"
+        tried = set()
+
+        while True:  # Keep trying until success or all keys fail
+            api_key, release = self._acquire_key(tried)
+            tried.add(api_key)
+            # A returned stream keeps its key busy until the response is closed.
+            handed_over = False
+            started = time.monotonic()
+            try:
+                async with self.http.arequest("POST", endpoint, headers=self._headers(api_key), json=payload,
+                                              stream=stream, timeout=deadline.sdk_timeout()) as response:
+                    self._record_key_outcome(api_key, response.status_code, started)
                     if response.status_code != 200:
                         # Check if we should rotate key
                         if self._should_rotate_key(response.status_code):
-                            error_info = f"Status {response.status_code}"
-                            self._rotate_api_key(error_info)
-                            continue  # Try again with new key
-                        else:
-                            log.error(f"Provider 7 API error: Status {response.status_code}, Response: {response.text}")
-                            raise Exception(f"Provider 7 API error: Status {response.status_code}, Detail: {response.text}")
-                    
-                    # Reset rotation count on success
-                    Provider7._rotation_count = 0
-                    
-                    # Parse the response
+                            self._key_failed(api_key, response)
+                            continue  # Try again with another key
+                        await response.aread()
+                        log.error(f"Provider 7 API error: Status {response.status_code}, Response: {response.text}")
+                        raise UpstreamHTTPError(f"Provider 7 API error: Status {response.status_code}, Detail: {response.text}", response.status_code)
+
+                    if stream:
+                        async def generate():
+                            async for line in response.aiter_lines():
+                                if line:
+                                    chunk = self._parse_line(line)
+                                    if chunk is not None:
+                                        yield chunk
+
+                        release_on_close(response, release)
+                        handed_over = True
+                        return self.http.astream_chunks(response, generate(), deadline)
+
                     response_data = response.json()
-                    
-                    # Calculate token usage if not provided by the API
-                    if not response_data.get("usage"):
-                        completion_content = response_data["choices"][0]["message"]["content"]
-                        completion_tokens = count_tokens(
-                            [{"role": "assistant", "content": completion_content}],
-                            model_id,
-                            kwargs.get('app')
-                        )
-                        prompt_tokens = count_tokens(messages, model_id, kwargs.get('app'))
-                        total_tokens = prompt_tokens + completion_tokens
-                        
-                        response_data["usage"] = {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": total_tokens
-                        }
-                    
-                    return response_data
-                    
-            except MaxAPIKeyRotationsError as e:
-                # All keys failed, propagate the error
-                log.error(f"All API keys failed: {e}")
-                raise
+
+                return self._ensure_usage(response_data, model_id, messages, kwargs.get('app'))
+
+            except httpx.TransportError as e:
+                # Connection errors are retried on another key
+                self.key_pool.record(api_key, dropped=True)
+                log.warning(f"API key {key_id(api_key)} failed: Connection error: {str(e)[:100]}")
+                continue
             except Exception as e:
-                # For other exceptions, try to rotate if it's a connection error
-                if isinstance(e, requests.exceptions.RequestException):
-                    try:
-                        error_info = f"Connection error: {str(e)[:100]}"
-                        self._rotate_api_key(error_info)
-                        continue  # Try again with new key
-                    except MaxAPIKeyRotationsError as max_err:
-                        log.error(f"All API keys failed: {max_err}")
-                        raise
-                
                 # Other errors are propagated
                 log.error(f"Error in Provider 7 chat completion: {e}")
                 raise
+            finally:
+                if not handed_over:
+                    release()
 
     def get_models(self) -> list:
         """Returns the supported models information for Provider 7."""
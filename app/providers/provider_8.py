@@ -1,10 +1,13 @@
+import httpx
 import requests
 import json
 import os
 import logging
 from dotenv import load_dotenv
 from .base_provider import BaseProvider
+from .http_client import UpstreamHTTPClient
 from ..config import Config
+from ..utils.deadline import Deadline
 from ..utils.token_counter import count_tokens # Import for potential future use
 
 log = logging.getLogger(__name__)
@@ -21,6 +24,7 @@ class Provider8(BaseProvider):
         self.base_url = os.environ.get("PROVIDER_8_BASE_URL")
 
         self.endpoint = f"{self.base_url}/chat/completions"
+        self.http = UpstreamHTTPClient("provider-8")
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -112,10 +116,8 @@ class Provider8(BaseProvider):
             log.error(f"Error loading models for Provider8: {e}")
             return []
 
-    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
-        """
-        Handles chat completion requests. Uses model mapping. Does not support streaming.
-        """
+    def _build_payload(self, model_id: str, messages: list, kwargs: dict) -> dict:
+        """Maps the model alias and builds the upstream request payload."""
         # Map the external model_id to the internal ID required by the API
         if model_id not in self.alias_to_actual:
             log.error(f"Model alias '{model_id}' not found in Provider 8 mapping.")
@@ -134,37 +136,68 @@ class Provider8(BaseProvider):
         for param in ["temperature", "max_tokens", "top_p", "presence_penalty", "frequency_penalty", "stop"]:
             if param in kwargs and kwargs[param] is not None:
                 payload[param] = kwargs[param]
-        
+        return payload
+
+    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """
+        Handles chat completion requests. Uses model mapping. Does not support streaming.
+        """
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        payload = self._build_payload(model_id, messages, kwargs)
+
         try:
-            response = requests.post(
+            # Streaming is disabled upstream, so the body is always read in full
+            with self.http.request(
+                "POST",
                 self.endpoint,
                 headers=self.headers,
                 json=payload,
-                stream=stream,
-                timeout=180 # Add a timeout
-            )
-
-            # Raise exceptions for bad status codes immediately
-            response.raise_for_status()
-
-            # Since streaming is disabled, always process as non-streaming
-            try:
-                response_data = response.json()
-                # Note: Token counting is deferred as per requirements
-                return response_data
-            except json.JSONDecodeError as e:
-                log.error(f"Provider 8 JSON parsing error: {e}")
-                log.error(f"Response text: {response.text[:500]}") # Log part of the raw response
-                raise Exception(f"Failed to parse JSON response from Provider 8: {e}")
+                timeout=deadline.timeout()
+            ) as response:
+
+                # Raise exceptions for bad status codes immediately
+                response.raise_for_status()
+
+                try:
+                    response_data = response.json()
+                    # Note: Token counting is deferred as per requirements
+                    return response_data
+                except json.JSONDecodeError as e:
+                    log.error(f"Provider 8 JSON parsing error: {e}")
+                    log.error(f"Response text: {response.text[:500]}") # Log part of the raw response
+                    raise Exception(f"Failed to parse JSON response from Provider 8: {e}")
 
         except requests.exceptions.RequestException as e:
             log.error(f"Provider 8 API request failed: {e}")
             # Re-raise a more generic exception or handle specific errors
-            raise Exception(f"Provider 8 API request error: {e}")
+            raise Exception(f"Provider 8 API request error: {e}") from e
         except Exception as e:
             log.error(f"Unexpected error in Provider 8 chat_completion: {e}")
             raise # Re-raise unexpected errors
 
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using the shared async HTTP client."""
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        payload = self._build_payload(model_id, messages, kwargs)
+
+        try:
+            async with self.http.arequest("POST", self.endpoint, headers=self.headers, json=payload,
+                                          timeout=deadline.sdk_timeout()) as response:
+                response.raise_for_status()
+                try:
+                    return response.json()
+                except json.JSONDecodeError as e:
+                    log.error(f"Provider 8 JSON parsing error: {e}")
+                    log.error(f"Response text: {response.text[:500]}")
+                    raise Exception(f"Failed to parse JSON response from Provider 8: {e}")
+
+        except httpx.HTTPError as e:
+            log.error(f"Provider 8 API request failed: {e}")
+            raise Exception(f"Provider 8 API request error: {e}") from e
+        except Exception as e:
+            log.error(f"Unexpected error in Provider 8 achat_completion: {e}")
+            raise
+
     def get_models(self) -> list:
         """Returns the list of supported models for Provider 8."""
         # Reload models in case config changed, or rely on initialized list
@@ -1,9 +1,12 @@
 import os
 import logging
 from dotenv import load_dotenv
-from openai import AzureOpenAI, APIError, APITimeoutError, RateLimitError
+from openai import AsyncAzureOpenAI, AzureOpenAI, APIError, APITimeoutError, RateLimitError
 from .base_provider import BaseProvider
 from ..config import Config
+from ..utils.deadline import Deadline
+from .http_client import AsyncUpstreamStream
+from .sdk_clients import ProcessLocalClient, sdk_client_kwargs
 
 log = logging.getLogger(__name__)
 load_dotenv()
@@ -37,13 +40,22 @@ class Provider9(BaseProvider):
         # Force API version to match the working example
         forced_api_version = "2024-12-01-preview"
         log.info(f"Forcing Azure API Version to: {forced_api_version}")
+        self.forced_api_version = forced_api_version
+        self._client = ProcessLocalClient(lambda: AzureOpenAI(
+            api_key=self.api_key,
+            azure_endpoint=self.azure_endpoint,
+            api_version=forced_api_version, # Use the forced API version
+            **sdk_client_kwargs("provider-9")
+        ))
+        self._async_client = ProcessLocalClient(lambda: AsyncAzureOpenAI(
+            api_key=self.api_key,
+            azure_endpoint=self.azure_endpoint,
+            api_version=forced_api_version,
+            **sdk_client_kwargs("provider-9", is_async=True)
+        ))
 
         try:
-            self.client = AzureOpenAI(
-                api_key=self.api_key,
-                azure_endpoint=self.azure_endpoint,
-                api_version=forced_api_version, # Use the forced API version
-            )
+            self.client
             log.info("AzureOpenAI client initialized successfully.")
         except Exception as e:
             log.error(f"Failed to initialize AzureOpenAI client: {e}")
@@ -81,11 +93,18 @@ class Provider9(BaseProvider):
             log.error(f"Error loading models for Provider9: {e}")
             return []
 
-    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
-        """
-        Generates chat completions using Azure OpenAI.
-        Handles both streaming and non-streaming requests.
-        """
+    @property
+    def client(self):
+        """AzureOpenAI client of the current process."""
+        return self._client.get()
+
+    @property
+    def async_client(self):
+        """AsyncAzureOpenAI client for ASGI mode, created on first use."""
+        return self._async_client.get()
+
+    def _build_params(self, model_id: str, messages: list, stream: bool, kwargs: dict) -> dict:
+        """Validates the model and builds the parameters for the Azure API call."""
         supported_model_ids = [model['id'] for model in self.models]
         if model_id not in supported_model_ids:
              raise ValueError(f"Model '{model_id}' is not supported by Provider9. Supported models: {', '.join(supported_model_ids)}")
@@ -116,9 +135,18 @@ class Provider9(BaseProvider):
         # Remove None values to avoid sending them to the API
         # Also remove 'max_tokens' if it somehow made it into kwargs
         params = {k: v for k, v in params.items() if v is not None and k != 'max_tokens'}
+        return params
+
+    def chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """
+        Generates chat completions using Azure OpenAI.
+        Handles both streaming and non-streaming requests.
+        """
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        params = self._build_params(model_id, messages, stream, kwargs)
 
         try:
-            response = self.client.chat.completions.create(**params)
+            response = self.client.chat.completions.create(**params, timeout=deadline.sdk_timeout())
 
             if stream:
                 return response
@@ -133,6 +161,27 @@ class Provider9(BaseProvider):
             log.error(f"Unexpected error in Provider9 chat_completion: {e}")
             raise
 
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of chat_completion() using AsyncAzureOpenAI."""
+        deadline = kwargs.pop("deadline", None) or Deadline.for_model(model_id)
+        params = self._build_params(model_id, messages, stream, kwargs)
+
+        try:
+            response = await self.async_client.chat.completions.create(**params, timeout=deadline.sdk_timeout())
+
+            if stream:
+                return AsyncUpstreamStream(response, deadline)
+            else:
+                return response.model_dump()
+
+        except (APITimeoutError, RateLimitError, APIError) as e:
+            log.error(f"Azure API error: {type(e).__name__} - {e}")
+            # Re-raise a more generic exception or handle specific errors
+            raise Exception(f"Azure API Error: {e}") from e
+        except Exception as e:
+            log.error(f"Unexpected error in Provider9 achat_completion: {e}")
+            raise
+
     def get_models(self) -> list:
         """Returns the list of supported models for Provider9."""
         return self.models
@@ -9,12 +9,30 @@ from .provider_6 import Provider6
 from .provider_7 import Provider7
 from .provider_8 import Provider8
 from .provider_9 import Provider9
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import logging
+import queue
+import threading
+import time
+import anyio
 from . import BaseProvider
+from ..config import Config
+from ..services.bulkhead_service import BulkheadFullError, BulkheadPermit, aacquire_bulkheads, acquire_bulkheads
+from ..services.circuit_breaker_service import (
+    CircuitOpenError, allow_call, breaker_names, is_breaker_failure, record_result, release_probes
+)
+from ..services.hedge_service import hedge_delay, record_hedge_eligible, record_hedge_winner, should_hedge
+from ..services.provider_stats_service import rank, record_call
+from ..services.upstream_budget_service import UpstreamBudgetExhaustedError, await_budget, wait_for_budget
+from ..services.uptime_service import demote_degraded
 
 log = logging.getLogger(__name__)
 
+# Calls turned away before reaching the upstream; failover moves on without
+# counting them as failed attempts.
+UPSTREAM_REJECTIONS = (CircuitOpenError, BulkheadFullError, UpstreamBudgetExhaustedError)
+
 class ProviderManager:
     """
     Manages available LLM providers.
@@ -24,11 +42,16 @@ class ProviderManager:
 
     def __init__(self):
         self.providers: Dict[str, BaseProvider] = {}
+        # model id -> provider name, so lookups don't scan every provider's model list
+        self._model_index: Dict[str, str] = {}
 
     def register_provider(self, provider_name: str, provider: BaseProvider):
         if provider_name in self.providers:
             log.warning(f"Provider '{provider_name}' already registered. Overwriting.")
+            self._model_index = {m: p for m, p in self._model_index.items() if p != provider_name}
         self.providers[provider_name] = provider
+        for model in provider.get_models():
+            self._model_index.setdefault(model["id"], provider_name)
         log.info(f"Provider '{provider_name}' registered.")
 
     def register_providers(self, app):
@@ -43,21 +66,575 @@ class ProviderManager:
         self.register_provider("provider-8", Provider8())
         self.register_provider("provider-9", Provider9())
 
+    def resolve(self, model_id: str) -> Optional[Tuple[str, BaseProvider]]:
+        """Returns (provider name, provider) serving the model id, or None."""
+        provider_name = self._model_index.get(model_id)
+        if provider_name is None:
+            return None
+        return provider_name, self.providers[provider_name]
+
+    def candidates(self, model_id: str) -> List[str]:
+        """
+        Returns the provider model ids that can serve `model_id`, in the order
+        they should be tried.
+
+        A canonical group name (see "groups" in models.json) expands to its
+        registered members, ordered by recent performance when
+        LOAD_BALANCING_ENABLED is set (see provider_stats_service.rank()).
+        A provider alias comes first, followed by the
+        other members of its group when MODEL_FAILOVER_ENABLED is set.
+        Members failing their uptime probes go last (see
+        uptime_service.demote_degraded()). Returns an empty list for
+        unknown models.
+        """
+        group = Config.MODEL_GROUPS.get(model_id)
+        if group is not None:
+            members = [m for m in group if m in self._model_index]
+            if Config.LOAD_BALANCING_ENABLED:
+                members = rank(members)
+            members = demote_degraded(members)
+        elif model_id in self._model_index:
+            members = [model_id]
+            if Config.MODEL_FAILOVER_ENABLED:
+                fallbacks = []
+                for group_name in Config.MODEL_GROUP_OF.get(model_id, []):
+                    fallbacks += [m for m in Config.MODEL_GROUPS[group_name] if m in self._model_index and m not in members + fallbacks]
+                members += demote_degraded(fallbacks)
+        else:
+            return []
+        return members[:max(1, Config.MODEL_FAILOVER_MAX_ATTEMPTS)]
+
     def select_provider(self, model_id: str) -> Optional[BaseProvider]:
         """
         Selects a provider based on the model id.
-        For example, if model_id is "deepseek-r1", Provider3 will be selected.
+        For example, if model_id is "Provider-3/DeepSeek-R1", Provider3 will be selected.
+        For a canonical group name such as "deepseek-r1" the member ranked first
+        by candidates() is used.
         """
-        for provider in self.providers.values():
-            for model in provider.get_models():
-                if model["id"] == model_id:
-                    return provider
+        if model_id in Config.MODEL_GROUPS:
+            candidates = self.candidates(model_id)
+            model_id = candidates[0] if candidates else model_id
+        resolved = self.resolve(model_id)
+        if resolved:
+            return resolved[1]
         log.warning(f"No provider found for model ID: {model_id}")
         return None
 
+    def _resolve_or_raise(self, model_id: str) -> Tuple[str, BaseProvider]:
+        resolved = self.resolve(model_id)
+        if not resolved:
+            raise ValueError(f"Model '{model_id}' not supported or provider unavailable.")
+        return resolved
+
+    def chat_completion(self, model_id: str, messages: list, stream: bool = False, attempts: Optional[list] = None,
+                          candidates: Optional[List[str]] = None, **kwargs):
+        """
+        Performs a chat completion for `model_id`, failing over across its
+        candidates() until one succeeds.
+
+        A failed non-streamed call, or a stream that fails before its first
+        chunk, moves on to the next candidate as long as the request deadline
+        leaves at least MODEL_FAILOVER_MIN_REMAINING seconds. Errors caused by
+        the request itself (upstream 4xx) are raised straight away. Streams are
+        returned already started, so their first chunk has been received.
+
+        `candidates` overrides the candidates() order, e.g. to keep the one
+        the request was validated against. Every upstream call is appended
+        to `attempts` (if given) as
+        {"model_id", "error"}; the last entry is the one that served the
+        request. Candidates whose circuit breaker is open or whose bulkhead is
+        full are skipped; if all of them are, that rejection is raised.
+
+        With `hedge=True` the first attempt of a stream is hedged: if it has
+        not produced a chunk within its p90 time to first chunk, the next
+        candidate is started too and the first to answer wins (see
+        hedge_service).
+        """
+        hedge = kwargs.pop("hedge", False)
+        deadline = kwargs.get("deadline")
+        last_error = None
+        tried = set()
+        for candidate in candidates or self._failover_candidates(model_id):
+            if candidate in tried:
+                continue
+            if last_error is not None and not _has_time_for_retry(deadline):
+                break
+            backup = self._hedge_backup(candidate, candidates, tried) if stream and hedge else None
+            tried.add(candidate)
+            delay = hedge_delay(candidate) if backup else None
+            try:
+                if delay is not None:
+                    record_hedge_eligible(candidate)
+                    return self._hedged_stream(candidate, backup, delay, messages, attempts, tried, **kwargs)
+                return self._start_attempt(candidate, messages, stream, attempts, **kwargs)
+            except UPSTREAM_REJECTIONS as e:
+                last_error = _keep_real_error(last_error, e)
+                continue
+            except Exception as e:
+                last_error = e
+                if not is_breaker_failure(e):
+                    raise
+                log.warning(f"Chat completion on {candidate} failed ({e}); trying the next provider")
+                continue
+        raise last_error
+
+    async def achat_completion(self, model_id: str, messages: list, stream: bool = False, attempts: Optional[list] = None,
+                                candidates: Optional[List[str]] = None, **kwargs):
+        """Async variant of chat_completion() used by the ASGI handlers."""
+        hedge = kwargs.pop("hedge", False)
+        deadline = kwargs.get("deadline")
+        last_error = None
+        tried = set()
+        for candidate in candidates or self._failover_candidates(model_id):
+            if candidate in tried:
+                continue
+            if last_error is not None and not _has_time_for_retry(deadline):
+                break
+            backup = self._hedge_backup(candidate, candidates, tried) if stream and hedge else None
+            tried.add(candidate)
+            delay = await asyncio.to_thread(hedge_delay, candidate) if backup else None
+            try:
+                if delay is not None:
+                    await asyncio.to_thread(record_hedge_eligible, candidate)
+                    return await self._ahedged_stream(candidate, backup, delay, messages, attempts, tried, **kwargs)
+                return await self._astart_attempt(candidate, messages, stream, attempts, **kwargs)
+            except UPSTREAM_REJECTIONS as e:
+                last_error = _keep_real_error(last_error, e)
+                continue
+            except Exception as e:
+                last_error = e
+                if not is_breaker_failure(e):
+                    raise
+                log.warning(f"Chat completion on {candidate} failed ({e}); trying the next provider")
+                continue
+        raise last_error
+
+    def _failover_candidates(self, model_id: str) -> List[str]:
+        candidates = self.candidates(model_id)
+        if not candidates:
+            raise ValueError(f"Model '{model_id}' not supported or provider unavailable.")
+        return candidates
+
+    def _hedge_backup(self, candidate: str, candidates: Optional[List[str]], tried: set) -> Optional[str]:
+        """The candidate a stream on `candidate` may be hedged to: the next untried one, first attempt only."""
+        if tried:
+            return None
+        for other in candidates or self._failover_candidates(candidate):
+            if other != candidate:
+                return other
+        return None
+
+    def _start_attempt(self, model_id: str, messages: list, stream: bool, attempts: Optional[list], **kwargs):
+        """One guarded call (a started stream when streaming), recorded in `attempts` unless the circuit was open."""
+        try:
+            result = self._guarded_chat_completion(model_id, messages, stream, **kwargs)
+            if stream:
+                result.start()
+        except UPSTREAM_REJECTIONS:
+            raise
+        except Exception as e:
+            _record_attempt(attempts, model_id, e)
+            raise
+        _record_attempt(attempts, model_id)
+        return result
+
+    async def _astart_attempt(self, model_id: str, messages: list, stream: bool, attempts: Optional[list], **kwargs):
+        """Async variant of _start_attempt()."""
+        try:
+            result = await self._aguarded_chat_completion(model_id, messages, stream, **kwargs)
+            if stream:
+                await result.start()
+        except UPSTREAM_REJECTIONS:
+            raise
+        except Exception as e:
+            _record_attempt(attempts, model_id, e)
+            raise
+        _record_attempt(attempts, model_id)
+        return result
+
+    def _hedged_stream(self, primary: str, backup: str, delay: float, messages: list, attempts: Optional[list],
+                       tried: set, **kwargs):
+        """
+        Starts a stream on `primary` and, if it has no first chunk after
+        `delay` seconds and the hedge budget allows, on `backup` as well.
+        Returns the first copy to produce a chunk; the other one is closed as
+        soon as its call returns (a blocking read cannot be interrupted from
+        another thread), or right away if it already has.
+
+        Raises like _start_attempt() when every copy failed. `backup` is
+        added to `tried` once it has been started.
+        """
+        outcomes = queue.Queue()
+        lock = threading.Lock()
+        decided = threading.Event()
+
+        def run(candidate):
+            try:
+                stream = self._guarded_chat_completion(candidate, messages, True, **kwargs)
+                stream.start()
+            except Exception as e:
+                outcomes.put((candidate, None, e))
+                return
+            with lock:
+                if not decided.is_set():
+                    outcomes.put((candidate, stream, None))
+                    return
+            stream.close()
+
+        threading.Thread(target=run, args=(primary,), daemon=True).start()
+        running = 1
+        last_error = None
+        try:
+            try:
+                outcome = outcomes.get(timeout=delay)
+            except queue.Empty:
+                if should_hedge(primary):
+                    tried.add(backup)
+                    running += 1
+                    threading.Thread(target=run, args=(backup,), daemon=True).start()
+                outcome = outcomes.get()
+            while True:
+                candidate, stream, error = outcome
+                running -= 1
+                if error is None:
+                    break
+                last_error = _hedge_failure(attempts, candidate, error, last_error)
+                if running == 0 or not is_breaker_failure(error):
+                    raise last_error
+                outcome = outcomes.get()
+        finally:
+            with lock:
+                decided.set()
+            # A copy that succeeded while the winner was being picked
+            while True:
+                try:
+                    _, extra, _ = outcomes.get_nowait()
+                except queue.Empty:
+                    break
+                if extra is not None:
+                    extra.close()
+
+        _record_attempt(attempts, candidate)
+        if backup in tried:
+            record_hedge_winner(primary, candidate == backup)
+        return stream
+
+    async def _ahedged_stream(self, primary: str, backup: str, delay: float, messages: list, attempts: Optional[list],
+                              tried: set, **kwargs):
+        """Async variant of _hedged_stream(); the losing copy is cancelled, which closes its connection."""
+        async def run(candidate):
+            stream = await self._aguarded_chat_completion(candidate, messages, True, **kwargs)
+            await stream.start()
+            return stream
+
+        tasks = {asyncio.create_task(run(primary)): primary}
+        winner = None
+        last_error = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and await asyncio.to_thread(should_hedge, primary):
+                tried.add(backup)
+                tasks[asyncio.create_task(run(backup))] = backup
+            while tasks and winner is None:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    candidate = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if winner is None:
+                            winner = candidate, task.result()
+                        else:
+                            await task.result().aclose()
+                        continue
+                    last_error = _hedge_failure(attempts, candidate, error, last_error)
+                    if not is_breaker_failure(error):
+                        raise last_error
+        finally:
+            with anyio.CancelScope(shield=True):
+                for task in tasks:
+                    task.cancel()
+                for task in tasks:
+                    try:
+                        stream = await task
+                    except BaseException:
+                        continue
+                    await stream.aclose()
+
+        if winner is None:
+            raise last_error
+        candidate, stream = winner
+        _record_attempt(attempts, candidate)
+        if backup in tried:
+            await asyncio.to_thread(record_hedge_winner, primary, candidate == backup)
+        return stream
+
+    def _guarded_chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """
+        Calls the provider serving `model_id` behind its bulkheads and circuit
+        breakers.
+
+        Raises UpstreamBudgetExhaustedError when the provider's announced
+        rate limit is used up for longer than UPSTREAM_BUDGET_MAX_DELAY,
+        BulkheadFullError when the provider (or model) has no free
+        slot within the queue timeout, and CircuitOpenError without touching
+        the upstream while the provider's or the model's breaker is open.
+        Non-streamed calls are judged on their result and latency, streams on
+        their first chunk; streams keep their bulkhead slots until closed.
+        """
+        provider_name, provider = self._resolve_or_raise(model_id)
+        wait_for_budget(provider_name, kwargs.get("deadline"))
+        permit = acquire_bulkheads(provider_name, model_id, kwargs.get("deadline"))
+        try:
+            names = breaker_names(provider_name, model_id)
+            probes = allow_call(names)
+            started = time.monotonic()
+            try:
+                result = provider.chat_completion(model_id=model_id, messages=messages, stream=stream, **kwargs)
+            except Exception as e:
+                permit.record(started, e)
+                _settle(model_id, names, probes, started, e)
+                raise
+            except BaseException:
+                release_probes(probes)
+                raise
+        except BaseException:
+            permit.release()
+            raise
+        if stream:
+            return GuardedStream(result, model_id, names, probes, started, permit)
+        permit.record(started)
+        permit.release()
+        _settle(model_id, names, probes, started)
+        return result
+
+    async def _aguarded_chat_completion(self, model_id: str, messages: list, stream: bool = False, **kwargs):
+        """Async variant of _guarded_chat_completion()."""
+        provider_name, provider = self._resolve_or_raise(model_id)
+        await await_budget(provider_name, kwargs.get("deadline"))
+        permit = await aacquire_bulkheads(provider_name, model_id, kwargs.get("deadline"))
+        try:
+            names = breaker_names(provider_name, model_id)
+            probes = await asyncio.to_thread(allow_call, names)
+            started = time.monotonic()
+            try:
+                result = await provider.achat_completion(model_id=model_id, messages=messages, stream=stream, **kwargs)
+            except Exception as e:
+                permit.record(started, e)
+                await asyncio.to_thread(_settle, model_id, names, probes, started, e)
+                raise
+            except BaseException:
+                await asyncio.to_thread(release_probes, probes)
+                raise
+        except BaseException:
+            permit.release()
+            raise
+        if stream:
+            return AsyncGuardedStream(result, model_id, names, probes, started, permit)
+        permit.record(started)
+        permit.release()
+        await asyncio.to_thread(_settle, model_id, names, probes, started)
+        return result
+
+    def image_generation(self, model_id: str, **kwargs):
+        """Calls the image provider serving `model_id` behind its bulkheads and circuit breakers."""
+        provider_name, provider = self._resolve_or_raise(model_id)
+        wait_for_budget(provider_name, kwargs.get("deadline"))
+        permit = acquire_bulkheads(provider_name, model_id, kwargs.get("deadline"))
+        try:
+            names = breaker_names(provider_name, model_id)
+            probes = allow_call(names)
+            started = time.monotonic()
+            try:
+                result = provider.image_generation(model=model_id, **kwargs)
+            except Exception as e:
+                permit.record(started, e)
+                _settle(model_id, names, probes, started, e)
+                raise
+            except BaseException:
+                release_probes(probes)
+                raise
+            permit.record(started)
+        finally:
+            permit.release()
+        _settle(model_id, names, probes, started)
+        return result
+
     def list_models(self) -> List[dict]:
-        """Lists all available models from all providers."""
+        """Lists all available models from all providers, plus the canonical model groups."""
         all_models = []
         for provider in self.providers.values():
             all_models.extend(provider.get_models())
+        models_by_id = {model["id"]: model for model in all_models}
+        for group_name, members in Config.MODEL_GROUPS.items():
+            available = [m for m in members if m in models_by_id]
+            if available:
+                all_models.append({
+                    "id": group_name,
+                    "description": f"Routed to the first healthy of: {', '.join(available)}",
+                    "provider": "group",
+                    "owner_cost_per_million_tokens": models_by_id[available[0]].get("owner_cost_per_million_tokens", 0.0)
+                })
         return all_models
+
+def _has_time_for_retry(deadline):
+    return deadline is None or deadline.remaining() >= Config.MODEL_FAILOVER_MIN_REMAINING
+
+def _keep_real_error(last_error, rejection):
+    """An upstream error says more than a rejection (open circuit, full bulkhead); among rejections keep the soonest retry."""
+    if last_error is None:
+        return rejection
+    if isinstance(last_error, UPSTREAM_REJECTIONS) and rejection.retry_after < last_error.retry_after:
+        return rejection
+    return last_error
+
+def _hedge_failure(attempts, model_id, error, last_error):
+    """Records a failed copy of a hedged stream; returns the error to raise if no copy succeeds."""
+    if isinstance(error, UPSTREAM_REJECTIONS):
+        return _keep_real_error(last_error, error)
+    _record_attempt(attempts, model_id, error)
+    return error
+
+def _record_attempt(attempts, model_id, error=None):
+    if attempts is not None:
+        attempts.append({"model_id": model_id, "error": None if error is None else str(error)})
+
+def _settle(model_id, names, probes, started, exc=None):
+    """
+    Records a call outcome on its breakers and in the provider stats used for
+    load balancing. Errors caused by the request itself, and rejections
+    raised by the provider (e.g. every API key at its limit), only free the
+    probes.
+    """
+    if exc is not None and (isinstance(exc, UPSTREAM_REJECTIONS) or not is_breaker_failure(exc)):
+        release_probes(probes)
+        return
+    latency = time.monotonic() - started
+    record_result(names, exc is not None, latency, probes)
+    record_call(model_id, exc is not None, None if exc is not None else latency)
+
+class GuardedStream:
+    """
+    Wraps a provider stream so its breakers learn the outcome from the first
+    chunk: success (with time to first chunk as latency) or the error raised
+    before it. A stream closed before its first chunk has no verdict.
+    The same outcome goes to the adaptive limits of its bulkhead `permit`,
+    whose slots are released once the stream ends or is closed.
+    """
+
+    def __init__(self, stream, model_id, names, probes, started, permit=None):
+        self._stream = stream
+        self._model_id = model_id
+        self._iterator = iter(stream)
+        self._names = names
+        self._probes = probes
+        self._started = started
+        self._permit = permit or BulkheadPermit()
+        self._pending = True
+        self._buffered = []
+
+    def start(self):
+        """Waits for the first chunk, so an upstream failure is raised here rather than mid-response."""
+        try:
+            self._buffered.append(next(self))
+        except StopIteration:
+            pass
+        except BaseException:
+            self.close()
+            raise
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._buffered:
+            return self._buffered.pop()
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._permit.release()
+            self._settle()
+            raise
+        except Exception as e:
+            self._permit.release()
+            self._settle(e)
+            raise
+        self._settle()
+        return chunk
+
+    def _settle(self, exc=None):
+        if self._pending:
+            self._pending = False
+            self._permit.record(self._started, exc)
+            _settle(self._model_id, self._names, self._probes, self._started, exc)
+
+    def close(self):
+        if self._pending:
+            self._pending = False
+            release_probes(self._probes)
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._permit.release()
+
+class AsyncGuardedStream:
+    """Async counterpart of GuardedStream."""
+
+    def __init__(self, stream, model_id, names, probes, started, permit=None):
+        self._stream = stream
+        self._model_id = model_id
+        self._iterator = stream.__aiter__()
+        self._names = names
+        self._probes = probes
+        self._started = started
+        self._permit = permit or BulkheadPermit()
+        self._pending = True
+        self._buffered = []
+
+    async def start(self):
+        """Waits for the first chunk, so an upstream failure is raised here rather than mid-response."""
+        try:
+            self._buffered.append(await self.__anext__())
+        except StopAsyncIteration:
+            pass
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await self.aclose()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._buffered:
+            return self._buffered.pop()
+        try:
+            chunk = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._permit.release()
+            await self._settle()
+            raise
+        except Exception as e:
+            self._permit.release()
+            await self._settle(e)
+            raise
+        await self._settle()
+        return chunk
+
+    async def _settle(self, exc=None):
+        if self._pending:
+            self._pending = False
+            self._permit.record(self._started, exc)
+            await asyncio.to_thread(_settle, self._model_id, self._names, self._probes, self._started, exc)
+
+    async def aclose(self):
+        if self._pending:
+            self._pending = False
+            await asyncio.to_thread(release_probes, self._probes)
+        try:
+            close = getattr(self._stream, "aclose", None)
+            if close is not None:
+                await close()
+        finally:
+            self._permit.release()
@@ -0,0 +1,250 @@
+# app/providers/sdk_clients.py
+
+import logging
+import os
+import threading
+import time
+import httpx
+from ..config import Config
+from ..services.metrics_service import set_gauge
+from ..services.upstream_budget_service import observe_response
+
+log = logging.getLogger(__name__)
+
+# Connection pools for the OpenAI/Azure SDK clients (Providers 2, 3 and 9).
+# The SDKs are handed their own httpx clients so pool size, keep-alive expiry,
+# retries and timeouts come from configuration, and every pool reports its
+# in-use/idle connections and queued requests as per-worker gauges. The
+# transports also record the rate-limit headers of every response (see
+# upstream_budget_service).
+
+def sdk_client_settings(provider_name):
+    """SDK_* defaults merged with the SDK_CLIENT_SETTINGS overrides for this provider."""
+    settings = {
+        "max_connections": Config.SDK_POOL_MAX_CONNECTIONS,
+        "max_keepalive_connections": Config.SDK_POOL_MAX_KEEPALIVE,
+        "keepalive_expiry": Config.SDK_POOL_KEEPALIVE_EXPIRY,
+        "max_retries": Config.SDK_MAX_RETRIES,
+        "timeout": Config.SDK_TIMEOUT,
+        "connect_timeout": Config.UPSTREAM_CONNECT_TIMEOUT,
+    }
+    settings.update(Config.SDK_CLIENT_SETTINGS.get(provider_name, {}))
+    return settings
+
+class _PoolStats:
+    """
+    Tracks one httpx transport's connection pool.
+
+    In-use and idle connections come from the httpcore pool; requests are
+    counted from the moment they are sent until their response is closed, so
+    any request without a connection of its own is waiting on the pool.
+    """
+
+    def __init__(self, provider_name, transport):
+        self.provider_name = provider_name
+        self.transport = transport
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def update(self, delta):
+        with self._lock:
+            self.requests += delta
+
+    def snapshot(self):
+        connections = getattr(getattr(self.transport, "_pool", None), "connections", [])
+        idle = sum(1 for connection in connections if connection.is_idle())
+        in_use = len(connections) - idle
+        return {"in_use": in_use, "idle": idle, "waiters": max(0, self.requests - in_use)}
+
+class _CountedStream(httpx.SyncByteStream):
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+class _AsyncCountedStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+def _releaser(stats):
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            stats.update(-1)
+
+    return release
+
+class _CountingTransport(httpx.HTTPTransport):
+    def __init__(self, provider_name, stats_name, **kwargs):
+        super().__init__(**kwargs)
+        self.provider_name = provider_name
+        self.stats = pool_registry.register(stats_name, self)
+
+    def handle_request(self, request):
+        self.stats.update(1)
+        release = _releaser(self.stats)
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            release()
+            raise
+        observe_response(self.provider_name, response.headers, response.status_code, request.headers)
+        response.stream = _CountedStream(response.stream, release)
+        return response
+
+class _AsyncCountingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, provider_name, stats_name, **kwargs):
+        super().__init__(**kwargs)
+        self.provider_name = provider_name
+        self.stats = pool_registry.register(stats_name, self)
+
+    async def handle_async_request(self, request):
+        self.stats.update(1)
+        release = _releaser(self.stats)
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        observe_response(self.provider_name, response.headers, response.status_code, request.headers)
+        response.stream = _AsyncCountedStream(response.stream, release)
+        return response
+
+class _PoolRegistry:
+    """
+    The SDK pools of this worker, published every POOL_METRICS_INTERVAL
+    seconds by a background thread as the per-worker gauges
+    sdk_pool_connections_in_use, sdk_pool_connections_idle and
+    sdk_pool_waiters.
+    """
+
+    POOL_METRICS_INTERVAL = 5
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._publisher_pid = None
+
+    def register(self, name, transport):
+        stats = _PoolStats(name, transport)
+        with self._lock:
+            self._stats[name] = stats
+        self._ensure_publisher()
+        return stats
+
+    def snapshot(self):
+        """Returns {pool name: {"in_use", "idle", "waiters"}} for this worker."""
+        with self._lock:
+            stats = list(self._stats.values())
+        return {s.provider_name: s.snapshot() for s in stats}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._publisher_pid = None
+
+    def _ensure_publisher(self):
+        with self._lock:
+            if self._publisher_pid == os.getpid():
+                return
+            self._publisher_pid = os.getpid()
+        threading.Thread(target=self._publish, daemon=True).start()
+
+    def _publish(self):
+        pid = os.getpid()
+        while self._publisher_pid == pid:
+            time.sleep(self.POOL_METRICS_INTERVAL)
+            for name, pool in self.snapshot().items():
+                set_gauge("sdk_pool_connections_in_use", pool["in_use"], per_worker=True, pool=name)
+                set_gauge("sdk_pool_connections_idle", pool["idle"], per_worker=True, pool=name)
+                set_gauge("sdk_pool_waiters", pool["waiters"], per_worker=True, pool=name)
+
+pool_registry = _PoolRegistry()
+
+def get_sdk_pool_stats():
+    """Connection pool usage of the SDK clients in this worker."""
+    return pool_registry.snapshot()
+
+def _limits(settings):
+    return httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"]
+    )
+
+def _timeout(settings):
+    return httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"])
+
+def sdk_client_kwargs(provider_name, is_async=False):
+    """
+    Keyword arguments for an OpenAI/AzureOpenAI (or async) client: a
+    configured, instrumented httpx client plus the retry and timeout policy.
+    """
+    settings = sdk_client_settings(provider_name)
+    name = f"{provider_name}-async" if is_async else provider_name
+    transport_class = _AsyncCountingTransport if is_async else _CountingTransport
+    client_class = httpx.AsyncClient if is_async else httpx.Client
+    transport = transport_class(provider_name, name, limits=_limits(settings))
+    return {
+        "http_client": client_class(transport=transport, timeout=_timeout(settings)),
+        "max_retries": settings["max_retries"],
+        "timeout": _timeout(settings),
+    }
+
+class ProcessLocalClient:
+    """
+    Lazily builds an SDK client and rebuilds it in a forked child.
+
+    A client created before a gunicorn fork shares its sockets with the
+    parent, so each process must use its own. The client is keyed on the
+    pid, and reset_after_fork() (called from gunicorn's post_fork hook)
+    drops every inherited client without closing the parent's sockets.
+    """
+
+    _instances = []
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        ProcessLocalClient._instances.append(self)
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    def reset(self):
+        self._client = None
+        self._pid = None
+
+def reset_after_fork():
+    """Drops SDK clients and pool stats inherited from the parent process."""
+    for instance in ProcessLocalClient._instances:
+        instance.reset()
+    pool_registry.reset()
@@ -3,6 +3,7 @@
 from ..models.api_key import APIKey
 from ..models.usage import User
 from ..extensions import db
+from ..config import Config
 from ..utils.external_auth import (
     initialize_firebase, 
     process_user_for_api_key, 
@@ -197,3 +198,7 @@ def get_api_key_from_request(request):
 def get_api_key_record(api_key):
     """Retrieves the APIKey object from the database."""
     return APIKey.query.filter_by(api_key=api_key, is_active=True).first()
+
+def get_api_key_settings(api_key):
+    """Returns the per-key overrides configured in Config.API_KEY_SETTINGS."""
+    return Config.API_KEY_SETTINGS.get(api_key, {})
@@ -0,0 +1,279 @@
+# app/services/blob_store_service.py
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, parse_qs
+from flask import Response, has_request_context, request
+from ..config import Config
+from ..extensions import redis_client
+
+log = logging.getLogger(__name__)
+
+# Local store for generated images, served as short-lived signed URLs
+# (GET /v1/files/<blob id>?expires=...&signature=...) instead of inline
+# base64 data URIs. Blobs are content addressed ("<sha256 prefix>.<ext>",
+# under BLOB_STORE_DIR/<first 2 characters>/), so the same image is written
+# once; storing it again only refreshes its age. Files not stored again for
+# BLOB_URL_TTL, so that every URL issued for them has expired, are deleted by
+# a background thread, run by one worker at a time through the Redis lock
+# "blob_store:gc".
+#
+# Image bytes never need to be held whole: put_blob_stream() writes a
+# download to a temporary file (under "tmp/") while hashing it, then renames
+# it to its blob id, and "b64_json" images are placed in response bodies as
+# Base64Blob values that json_response() encodes from the file as the body is
+# sent. Memory per image is bounded by BLOB_CHUNK_BYTES.
+
+_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+_MIME_TYPES = {ext: content_type for content_type, ext in _EXTENSIONS.items()}
+_BLOB_ID = re.compile(r"^[0-9a-f]{32}\.[a-z]+$")
+
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+_gc_pid = None
+_gc_lock = threading.Lock()
+
+def sniff_content_type(data, default="image/jpeg"):
+    """MIME type of image bytes from their signature."""
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+def blob_path(blob_id):
+    """Path of a blob on disk, or None for an id that is not one of ours."""
+    if not _BLOB_ID.match(blob_id):
+        return None
+    return os.path.join(Config.BLOB_STORE_DIR, blob_id[:2], blob_id)
+
+def blob_mimetype(blob_id):
+    return _MIME_TYPES.get(os.path.splitext(blob_id)[1], "application/octet-stream")
+
+def put_blob(data, content_type=None):
+    """Stores `data` (once) and returns its blob id."""
+    return put_blob_stream((data,), content_type)
+
+def put_blob_stream(chunks, content_type=None):
+    """
+    Stores the bytes of an iterable of chunks (once) and returns its blob id,
+    holding one chunk at a time. The content type defaults to the one sniffed
+    from the first bytes.
+    """
+    directory = os.path.join(Config.BLOB_STORE_DIR, "tmp")
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        digest = hashlib.sha256()
+        head = b""
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                if len(head) < 16:
+                    head += chunk[:16]
+                digest.update(chunk)
+                f.write(chunk)
+        content_type = content_type or sniff_content_type(head)
+        blob_id = digest.hexdigest()[:32] + _EXTENSIONS.get(content_type, ".bin")
+        path = blob_path(blob_id)
+        try:
+            # Already stored: restart its time to live
+            os.utime(path)
+            os.unlink(tmp)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    _ensure_gc()
+    return blob_id
+
+def put_blob_file(path, blob_id):
+    """Stores the file at `path` as `blob_id`, which must be the id of its contents."""
+    copy_file(path, blob_path(blob_id))
+    _ensure_gc()
+    return blob_id
+
+def copy_file(source, target):
+    """
+    Places the file `source` at `target` (a hard link when both are on the
+    same filesystem, else a chunked copy that appears whole), or refreshes
+    the modification time of `target` when it already exists.
+    """
+    try:
+        os.utime(target)
+        return
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with open(source, "rb") as src, os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, Config.BLOB_CHUNK_BYTES)
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+def signing_enabled():
+    """True when BLOB_SIGNING_SECRET is set, so that links can be issued and verified."""
+    return bool(Config.BLOB_SIGNING_SECRET)
+
+def require_signing(response_format):
+    """
+    Raises RuntimeError when `response_format` needs signed links and there is
+    no signing secret. Image providers call it before spending anything
+    upstream.
+    """
+    if response_format != "b64_json" and not signing_enabled():
+        raise RuntimeError('response_format "url" needs BLOB_SIGNING_SECRET; use "b64_json"')
+
+def _signature(blob_id, expires):
+    if not signing_enabled():
+        raise RuntimeError("BLOB_SIGNING_SECRET is not set")
+    message = f"{blob_id}:{expires}".encode()
+    return hmac.new(Config.BLOB_SIGNING_SECRET.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+def signed_url(blob_id):
+    """Absolute URL of a blob, valid for BLOB_URL_TTL seconds. Raises RuntimeError without a signing secret."""
+    expires = int(time.time()) + Config.BLOB_URL_TTL
+    base = Config.PUBLIC_BASE_URL or (request.host_url if has_request_context() else "")
+    return f"{base.rstrip('/')}/v1/files/{blob_id}?expires={expires}&signature={_signature(blob_id, expires)}"
+
+def blob_url(data, content_type=None):
+    """Stores image bytes and returns a signed URL to them."""
+    return signed_url(put_blob(data, content_type))
+
+def verify(blob_id, expires, signature):
+    """True when a /v1/files request carries a valid, unexpired signature for `blob_id`."""
+    if not signing_enabled():
+        return False
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_signature(blob_id, expires), signature or "")
+
+def blob_id_from_url(url):
+    """Id of the blob a valid signed URL of ours points to, or None for any other URL."""
+    parts = urlsplit(url)
+    if not parts.path.startswith("/v1/files/"):
+        return None
+    blob_id = parts.path.rsplit("/", 1)[-1]
+    query = parse_qs(parts.query)
+    if blob_path(blob_id) is None or not verify(blob_id, query.get("expires", [None])[0], query.get("signature", [None])[0]):
+        return None
+    return blob_id
+
+class Base64Blob:
+    """The base64 text of a stored blob, as a value of a json_response() body."""
+
+    def __init__(self, blob_id):
+        self.blob_id = blob_id
+
+    def chunks(self):
+        """Yields the base64 text, encoding whole 3-byte groups of BLOB_CHUNK_BYTES or so at a time."""
+        size = max(3, Config.BLOB_CHUNK_BYTES - Config.BLOB_CHUNK_BYTES % 3)
+        with open(blob_path(self.blob_id), "rb") as f:
+            while True:
+                data = f.read(size)
+                if not data:
+                    return
+                yield base64.b64encode(data).decode("ascii")
+
+def iter_json(body):
+    """Yields the JSON text of `body`, streaming the base64 of its Base64Blob values from disk."""
+    blobs = []
+    marker = uuid.uuid4().hex
+
+    def placeholder(value):
+        if not isinstance(value, Base64Blob):
+            raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+        blobs.append(value)
+        return f"{marker}{len(blobs) - 1}"
+
+    text = json.dumps(body, separators=(",", ":"), default=placeholder)
+    # Splitting on the placeholders leaves the quotes around them in place.
+    parts = re.split(f"{marker}(\\d+)", text)
+    for i, part in enumerate(parts):
+        if i % 2:
+            yield from blobs[int(part)].chunks()
+        elif part:
+            yield part
+    yield "\n"
+
+def json_response(body, status=200, headers=None):
+    """A streamed application/json response for a body that may hold Base64Blob values."""
+    return Response(iter_json(body), status=status, headers=headers, mimetype="application/json")
+
+def _ensure_gc():
+    global _gc_pid
+    with _gc_lock:
+        if _gc_pid == os.getpid():
+            return
+        _gc_pid = os.getpid()
+    threading.Thread(target=_collect_garbage, daemon=True).start()
+
+def _collect_garbage():
+    """Deletes expired blobs every BLOB_STORE_GC_INTERVAL seconds."""
+    pid = os.getpid()
+    while _gc_pid == pid:
+        time.sleep(Config.BLOB_STORE_GC_INTERVAL)
+        try:
+            if not redis_client.set("blob_store:gc", pid, nx=True, ex=max(1, int(Config.BLOB_STORE_GC_INTERVAL) - 1)):
+                continue
+        except Exception as e:
+            log.debug(f"Failed to take the blob store GC lock: {e}")
+        collect_garbage()
+
+def collect_garbage(now=None):
+    """Deletes blobs that have not been stored again for BLOB_URL_TTL seconds; returns how many."""
+    cutoff = (now or time.time()) - Config.BLOB_URL_TTL
+    removed = 0
+    try:
+        shards = os.listdir(Config.BLOB_STORE_DIR)
+    except FileNotFoundError:
+        return 0
+    for shard in shards:
+        directory = os.path.join(Config.BLOB_STORE_DIR, shard)
+        try:
+            names = os.listdir(directory)
+        except NotADirectoryError:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    if removed:
+        log.info(f"Deleted {removed} expired blobs")
+    return removed
@@ -0,0 +1,357 @@
+# app/services/bulkhead_service.py
+
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+from ..config import Config
+from .circuit_breaker_service import is_breaker_failure
+from .metrics_service import increment, observe, set_gauge
+
+log = logging.getLogger(__name__)
+
+# Bulkheads: per-worker limits on concurrent upstream calls, one per provider
+# and optionally one per model, so a slow upstream cannot take every greenlet
+# (or event loop slot) of a worker. A call over the limit waits in a bounded
+# queue for up to BULKHEAD_QUEUE_TIMEOUT seconds; when the queue is full or
+# the wait times out it is rejected with BulkheadFullError (503).
+# Limits come from BULKHEAD_MAX_CONCURRENT / BULKHEAD_MAX_QUEUE, overridden per
+# provider name or model id in BULKHEAD_LIMITS; models only get a bulkhead of
+# their own when listed there. With ADAPTIVE_LIMIT_ENABLED the concurrency
+# limit of each bulkhead is learned (see AdaptiveLimit), up to its maximum.
+
+class BulkheadFullError(Exception):
+    """Raised instead of calling an upstream whose bulkhead has no room left."""
+
+    def __init__(self, name, reason, retry_after=1):
+        super().__init__(f"Upstream '{name}' is at capacity ({reason.replace('_', ' ')}); retry in {retry_after}s.")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdaptiveLimit:
+    """
+    Concurrency limit learned from call outcomes, after the AIMD and
+    gradient limiters of Netflix's concurrency-limits.
+
+    A dropped call (429, 5xx, timeout) cuts the limit by ADAPTIVE_LIMIT_BACKOFF.
+    Otherwise a short and a long EWMA of latency are compared: while latency
+    stays within ADAPTIVE_LIMIT_LATENCY_TOLERANCE of its long-term level the
+    limit grows by about sqrt(limit) per sample, and as latency rises the
+    gradient long/short pulls it down (never below half per step). Changes are
+    smoothed by ADAPTIVE_LIMIT_SMOOTHING, and the limit only grows while at
+    least half of it is in use.
+    """
+
+    SHORT_ALPHA = 0.3
+    LONG_ALPHA = 0.02
+
+    def __init__(self, name, maximum):
+        self.name = name
+        self.maximum = maximum
+        self.limit = float(min(maximum, Config.ADAPTIVE_LIMIT_INITIAL))
+        self._short = None
+        self._long = None
+        self._lock = threading.Lock()
+        _adaptive_limits[name] = self
+
+    def current(self):
+        return max(1, int(self.limit))
+
+    def sample(self, latency, in_flight, dropped):
+        """Feeds one call outcome; `latency` may be None for a success without a timing."""
+        minimum = min(self.maximum, Config.ADAPTIVE_LIMIT_MIN)
+        with self._lock:
+            if dropped:
+                self.limit = max(minimum, self.limit * Config.ADAPTIVE_LIMIT_BACKOFF)
+                return
+            if latency is None:
+                return
+            self._short = latency if self._short is None else self._short + self.SHORT_ALPHA * (latency - self._short)
+            self._long = latency if self._long is None else self._long + self.LONG_ALPHA * (latency - self._long)
+            gradient = max(0.5, min(1.0, Config.ADAPTIVE_LIMIT_LATENCY_TOLERANCE * self._long / max(self._short, 1e-6)))
+            if gradient >= 1.0 and in_flight * 2 < self.limit:
+                return
+            target = self.limit * gradient + self.limit ** 0.5
+            smoothing = Config.ADAPTIVE_LIMIT_SMOOTHING
+            self.limit = min(self.maximum, max(minimum, self.limit * (1 - smoothing) + target * smoothing))
+
+# Every AdaptiveLimit in this worker (bulkheads and API keys), for the gauges.
+_adaptive_limits = {}
+
+class _Bulkhead:
+    """Concurrency limit with a bounded wait queue for threads (greenlets under gevent)."""
+
+    def __init__(self, name, max_concurrent, max_queue):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.adaptive = AdaptiveLimit(name, max_concurrent) if Config.ADAPTIVE_LIMIT_ENABLED else None
+        self._cond = threading.Condition()
+
+    def limit(self):
+        return self.adaptive.current() if self.adaptive else self.max_concurrent
+
+    def acquire(self, timeout):
+        """Takes a slot; returns the seconds spent queued. Raises BulkheadFullError."""
+        with self._cond:
+            if self.in_flight < self.limit():
+                self.in_flight += 1
+                return 0.0
+            if self.waiting >= self.max_queue:
+                raise BulkheadFullError(self.name, "queue_full")
+            self.waiting += 1
+            started = time.monotonic()
+            try:
+                while self.in_flight >= self.limit():
+                    remaining = started + timeout - time.monotonic()
+                    if remaining <= 0:
+                        raise BulkheadFullError(self.name, "queue_timeout")
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+            return time.monotonic() - started
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def sample(self, latency, dropped):
+        if self.adaptive:
+            self.adaptive.sample(latency, self.in_flight, dropped)
+            with self._cond:
+                self._cond.notify(max(0, self.limit() - self.in_flight))
+
+class _AsyncBulkhead:
+    """
+    asyncio counterpart of _Bulkhead, used by the ASGI handlers. Slots are
+    handed to waiters in order by release(), which therefore stays a plain
+    function callable from synchronous cleanup code.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.adaptive = AdaptiveLimit(f"{name}:async", max_concurrent) if Config.ADAPTIVE_LIMIT_ENABLED else None
+        self._waiters = collections.deque()
+
+    def limit(self):
+        return self.adaptive.current() if self.adaptive else self.max_concurrent
+
+    async def acquire(self, timeout):
+        if self.in_flight < self.limit() and not self.waiting:
+            self.in_flight += 1
+            return 0.0
+        if self.waiting >= self.max_queue:
+            raise BulkheadFullError(self.name, "queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            # The slot is taken by _wake() when it resolves the waiter.
+            await asyncio.wait_for(waiter, max(0.0, timeout))
+        except asyncio.TimeoutError:
+            raise BulkheadFullError(self.name, "queue_timeout") from None
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            self.waiting -= 1
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return time.monotonic() - started
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.limit():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def sample(self, latency, dropped):
+        if self.adaptive:
+            self.adaptive.sample(latency, self.in_flight, dropped)
+            self._wake()
+
+class BulkheadPermit:
+    """
+    The bulkhead slots held by one upstream call. record() feeds the call's
+    outcome to adaptive limits; release() frees the slots. Both act once.
+    """
+
+    def __init__(self, bulkheads=()):
+        self._bulkheads = list(bulkheads)
+        self._recorded = False
+        self._released = False
+
+    def record(self, started, exc=None):
+        """Reports the call that began at `started` (monotonic) and its error, if any."""
+        if self._recorded:
+            return
+        self._recorded = True
+        if exc is not None and (isinstance(exc, BulkheadFullError) or not is_breaker_failure(exc)):
+            return
+        latency = time.monotonic() - started if exc is None else None
+        for bulkhead in self._bulkheads:
+            bulkhead.sample(latency, exc is not None)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            for bulkhead in reversed(self._bulkheads):
+                bulkhead.release()
+
+class _BulkheadRegistry:
+    """
+    The bulkheads of this worker, created on first use and published every
+    METRICS_INTERVAL seconds as the per-worker gauges bulkhead_in_flight and
+    bulkhead_queue_depth.
+    """
+
+    METRICS_INTERVAL = 5
+
+    def __init__(self):
+        self._bulkheads = {}
+        self._lock = threading.Lock()
+        self._publisher_pid = None
+
+    def get(self, name, is_async=False):
+        key = (name, is_async)
+        bulkhead = self._bulkheads.get(key)
+        if bulkhead is None:
+            limits = _limits(name)
+            bulkhead_class = _AsyncBulkhead if is_async else _Bulkhead
+            with self._lock:
+                bulkhead = self._bulkheads.setdefault(
+                    key, bulkhead_class(name, limits["max_concurrent"], limits["max_queue"])
+                )
+            self._ensure_publisher()
+        return bulkhead
+
+    def snapshot(self):
+        """Returns {name: {"in_flight", "waiting", "limit", "max_concurrent", "max_queue"}} for this worker."""
+        snapshot = {}
+        with self._lock:
+            bulkheads = list(self._bulkheads.values())
+        for bulkhead in bulkheads:
+            entry = snapshot.setdefault(bulkhead.name, {
+                "in_flight": 0, "waiting": 0, "limit": 0,
+                "max_concurrent": bulkhead.max_concurrent, "max_queue": bulkhead.max_queue
+            })
+            entry["in_flight"] += bulkhead.in_flight
+            entry["waiting"] += bulkhead.waiting
+            entry["limit"] = max(entry["limit"], bulkhead.limit())
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._bulkheads = {}
+            self._publisher_pid = None
+        _adaptive_limits.clear()
+
+    def _ensure_publisher(self):
+        with self._lock:
+            if self._publisher_pid == os.getpid():
+                return
+            self._publisher_pid = os.getpid()
+        threading.Thread(target=self._publish, daemon=True).start()
+
+    def _publish(self):
+        pid = os.getpid()
+        while self._publisher_pid == pid:
+            time.sleep(self.METRICS_INTERVAL)
+            for name, bulkhead in self.snapshot().items():
+                set_gauge("bulkhead_in_flight", bulkhead["in_flight"], per_worker=True, bulkhead=name)
+                set_gauge("bulkhead_queue_depth", bulkhead["waiting"], per_worker=True, bulkhead=name)
+            for name, limit in list(_adaptive_limits.items()):
+                set_gauge("adaptive_concurrency_limit", round(limit.limit, 2), per_worker=True, limit=name)
+
+bulkhead_registry = _BulkheadRegistry()
+
+def _limits(name):
+    limits = {"max_concurrent": Config.BULKHEAD_MAX_CONCURRENT, "max_queue": Config.BULKHEAD_MAX_QUEUE}
+    limits.update(Config.BULKHEAD_LIMITS.get(name, {}))
+    return limits
+
+def bulkhead_names(provider_name, model_id):
+    """The bulkheads a call goes through: the model's (if configured), then the provider's."""
+    if model_id in Config.BULKHEAD_LIMITS:
+        return [model_id, provider_name]
+    return [provider_name]
+
+def _queue_timeout(deadline):
+    if deadline is None:
+        return Config.BULKHEAD_QUEUE_TIMEOUT
+    return min(Config.BULKHEAD_QUEUE_TIMEOUT, deadline.remaining())
+
+def _record_admission(name, waited):
+    if waited > 0:
+        observe("bulkhead_wait_seconds", waited, bulkhead=name)
+
+def _record_rejection(error):
+    log.warning(str(error))
+    increment("bulkhead_rejections", bulkhead=error.name, reason=error.reason)
+
+def acquire_bulkheads(provider_name, model_id, deadline=None):
+    """
+    Takes a slot in every bulkhead guarding a call, waiting in their queues
+    if needed. Returns the BulkheadPermit to release once the call is done.
+    Raises BulkheadFullError.
+    """
+    if not Config.BULKHEAD_ENABLED:
+        return BulkheadPermit()
+    held = []
+    try:
+        for name in bulkhead_names(provider_name, model_id):
+            bulkhead = bulkhead_registry.get(name)
+            waited = bulkhead.acquire(_queue_timeout(deadline))
+            held.append(bulkhead)
+            _record_admission(name, waited)
+    except BulkheadFullError as e:
+        BulkheadPermit(held).release()
+        _record_rejection(e)
+        raise
+    except BaseException:
+        BulkheadPermit(held).release()
+        raise
+    return BulkheadPermit(held)
+
+async def aacquire_bulkheads(provider_name, model_id, deadline=None):
+    """Async variant of acquire_bulkheads()."""
+    if not Config.BULKHEAD_ENABLED:
+        return BulkheadPermit()
+    held = []
+    try:
+        for name in bulkhead_names(provider_name, model_id):
+            bulkhead = bulkhead_registry.get(name, is_async=True)
+            waited = await bulkhead.acquire(_queue_timeout(deadline))
+            held.append(bulkhead)
+            if waited > 0:
+                await asyncio.to_thread(_record_admission, name, waited)
+    except BulkheadFullError as e:
+        BulkheadPermit(held).release()
+        await asyncio.to_thread(_record_rejection, e)
+        raise
+    except BaseException:
+        BulkheadPermit(held).release()
+        raise
+    return BulkheadPermit(held)
+
+def get_bulkhead_stats():
+    """Bulkhead usage in this worker."""
+    return bulkhead_registry.snapshot()
@@ -0,0 +1,207 @@
+# app/services/circuit_breaker_service.py
+
+import logging
+import time
+from ..config import Config
+from ..extensions import redis_client
+from .metrics_service import increment
+
+log = logging.getLogger(__name__)
+
+# Circuit breakers for upstream providers, one per provider and one per model.
+# State lives in Redis so every gunicorn worker sees the same breaker:
+#   circuit:<name>          hash: state (closed/open/half_open), opened_at
+#   circuit:<name>:probes   number of half-open probes in flight (expires)
+#   circuit:<name>:<bucket> hash: total/errors/slow calls in a time bucket
+# A breaker opens when, over CIRCUIT_WINDOW_SECONDS, at least
+# CIRCUIT_MIN_REQUESTS calls were made and the error or slow-call rate reaches
+# its threshold. After CIRCUIT_OPEN_SECONDS it lets CIRCUIT_HALF_OPEN_PROBES
+# calls through: the first to succeed closes it, a failure re-opens it.
+
+# Returns {1, "closed"|"probe"} when the call may proceed, {0, retry_after} otherwise.
+ALLOW_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state or state == 'closed' then
+    return {1, 'closed'}
+end
+local now = tonumber(ARGV[1])
+local open_seconds = tonumber(ARGV[2])
+if state == 'open' then
+    local opened_at = tonumber(redis.call('HGET', KEYS[1], 'opened_at') or '0')
+    local remaining = opened_at + open_seconds - now
+    if remaining > 0 then
+        return {0, tostring(math.ceil(remaining))}
+    end
+    redis.call('HSET', KEYS[1], 'state', 'half_open')
+    redis.call('DEL', KEYS[2])
+end
+local probes = redis.call('INCR', KEYS[2])
+if probes == 1 then
+    redis.call('EXPIRE', KEYS[2], math.ceil(open_seconds))
+end
+if probes > tonumber(ARGV[3]) then
+    redis.call('DECR', KEYS[2])
+    return {0, '1'}
+end
+return {1, 'probe'}
+"""
+
+# Records one call outcome; returns the new state if it changed, else ''.
+RECORD_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+local failed = tonumber(ARGV[2]) == 1
+local now = ARGV[1]
+if state == 'half_open' then
+    if tonumber(ARGV[8]) == 0 then
+        return ''
+    end
+    redis.call('DEL', KEYS[2])
+    if failed then
+        redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', now)
+        return 'open'
+    end
+    redis.call('HSET', KEYS[1], 'state', 'closed')
+    for i = 3, #KEYS do
+        redis.call('DEL', KEYS[i])
+    end
+    return 'closed'
+end
+if state == 'open' then
+    return ''
+end
+redis.call('HINCRBY', KEYS[3], 'total', 1)
+redis.call('HINCRBY', KEYS[3], 'errors', tonumber(ARGV[2]))
+redis.call('HINCRBY', KEYS[3], 'slow', tonumber(ARGV[3]))
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+local total, errors, slow = 0, 0, 0
+for i = 3, #KEYS do
+    local bucket = redis.call('HMGET', KEYS[i], 'total', 'errors', 'slow')
+    total = total + tonumber(bucket[1] or '0')
+    errors = errors + tonumber(bucket[2] or '0')
+    slow = slow + tonumber(bucket[3] or '0')
+end
+if total >= tonumber(ARGV[5]) and
+        (errors / total >= tonumber(ARGV[6]) or slow / total >= tonumber(ARGV[7])) then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', now)
+    return 'open'
+end
+return ''
+"""
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Upstream '{name}' is temporarily unavailable (circuit open); retry in {retry_after}s.")
+        self.name = name
+        self.retry_after = retry_after
+
+def init_circuit_breakers(app):
+    """Registers the circuit breaker Lua scripts."""
+    with app.app_context():
+        global allow_script, record_script
+        allow_script = redis_client.register_script(ALLOW_SCRIPT)
+        record_script = redis_client.register_script(RECORD_SCRIPT)
+
+def breaker_names(provider_name, model_id):
+    """The breakers guarding a call: the provider as a whole and the model on it."""
+    if model_id:
+        return [provider_name, f"{provider_name}:{model_id}"]
+    return [provider_name]
+
+def _bucket_keys(name, now):
+    bucket_seconds = Config.CIRCUIT_BUCKET_SECONDS
+    current = int(now // bucket_seconds)
+    count = max(1, int(Config.CIRCUIT_WINDOW_SECONDS // bucket_seconds))
+    return [f"circuit:{name}:{bucket}" for bucket in range(current, current - count, -1)]
+
+def allow_call(names):
+    """
+    Checks every breaker in `names` before calling upstream.
+
+    Raises CircuitOpenError if one of them is open (or half-open with all
+    probe slots taken), releasing any probe slots the call already took.
+    Returns the names for which this call is a half-open probe. Fails open if
+    Redis is unavailable.
+    """
+    if not Config.CIRCUIT_BREAKER_ENABLED:
+        return []
+    probes = []
+    for name in names:
+        try:
+            allowed, detail = allow_script(
+                keys=[f"circuit:{name}", f"circuit:{name}:probes"],
+                args=[time.time(), Config.CIRCUIT_OPEN_SECONDS, Config.CIRCUIT_HALF_OPEN_PROBES],
+                client=redis_client
+            )
+        except Exception as e:
+            log.error(f"Circuit breaker check failed for {name}: {e}")
+            continue
+        if not int(allowed):
+            increment("circuit_breaker_rejections", breaker=name)
+            # Probes already taken on earlier breakers will never get a verdict.
+            release_probes(probes)
+            raise CircuitOpenError(name, int(detail))
+        if detail == "probe":
+            probes.append(name)
+    return probes
+
+def record_result(names, failed, latency, probes=()):
+    """
+    Records the outcome of an upstream call on every breaker in `names`.
+
+    While a breaker is half-open only its probes (as returned by
+    allow_call()) decide whether it closes or re-opens.
+    """
+    if not Config.CIRCUIT_BREAKER_ENABLED:
+        return
+    now = time.time()
+    slow = latency is not None and latency >= Config.CIRCUIT_SLOW_CALL_SECONDS
+    for name in names:
+        try:
+            transition = record_script(
+                keys=[f"circuit:{name}", f"circuit:{name}:probes"] + _bucket_keys(name, now),
+                args=[
+                    now, int(failed), int(slow), int(Config.CIRCUIT_WINDOW_SECONDS) + Config.CIRCUIT_BUCKET_SECONDS,
+                    Config.CIRCUIT_MIN_REQUESTS, Config.CIRCUIT_ERROR_RATE, Config.CIRCUIT_SLOW_CALL_RATE,
+                    int(name in probes)
+                ],
+                client=redis_client
+            )
+        except Exception as e:
+            log.error(f"Failed to record circuit breaker result for {name}: {e}")
+            continue
+        if transition:
+            log.warning(f"Circuit breaker for {name} is now {transition}")
+            increment("circuit_breaker_transitions", breaker=name, state=transition)
+
+def release_probes(probes):
+    """Frees the half-open probe slots of a call that ended without a verdict."""
+    for name in probes:
+        try:
+            if redis_client.decr(f"circuit:{name}:probes") < 0:
+                redis_client.delete(f"circuit:{name}:probes")
+        except Exception as e:
+            log.error(f"Failed to release circuit breaker probe for {name}: {e}")
+
+def is_breaker_failure(exc):
+    """
+    Returns True if `exc` says the upstream is unhealthy.
+
+    Upstream 4xx responses (other than 408 and 429) mean the request itself
+    was rejected, so they do not count against the breaker. Providers often
+    re-raise upstream errors as a plain Exception, so the cause chain is
+    inspected too.
+    """
+    seen = set()
+    current = exc
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        status = getattr(current, "status_code", None)
+        response = getattr(current, "response", None)
+        if status is None and response is not None:
+            status = getattr(response, "status_code", None)
+        if isinstance(status, int):
+            return not (400 <= status < 500 and status not in (408, 429))
+        current = current.__cause__ or current.__context__
+    return True
@@ -0,0 +1,64 @@
+# app/services/hedge_service.py
+
+import logging
+import threading
+from ..config import Config
+from .metrics_service import increment
+from .provider_stats_service import get_stats
+
+log = logging.getLogger(__name__)
+
+# Hedged streaming requests. When a stream has not produced its first chunk
+# within the provider's observed p90 time to first chunk, a second copy is
+# sent to the next member of its model group and the first to answer wins.
+# Hedges are paid for out of a per-worker budget that grows by
+# HEDGE_BUDGET_PERCENT of a hedge with every eligible request, so at most that
+# share of traffic is ever duplicated.
+
+class HedgeBudget:
+    """Token bucket funding hedges: each eligible request deposits a fraction, each hedge costs one."""
+
+    def __init__(self):
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(Config.HEDGE_BUDGET_BURST, self._tokens + Config.HEDGE_BUDGET_PERCENT / 100.0)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+hedge_budget = HedgeBudget()
+
+def hedge_delay(model_id):
+    """
+    Seconds to wait for `model_id`'s first chunk before hedging: its p90 time
+    to first chunk, at least HEDGE_MIN_DELAY. None until HEDGE_MIN_SAMPLES
+    samples have been seen, since a percentile of a few calls is noise.
+    """
+    stats = get_stats([model_id])[model_id]
+    if stats.get("ttfb_history", 0) < Config.HEDGE_MIN_SAMPLES:
+        return None
+    return max(Config.HEDGE_MIN_DELAY, stats["ttfb_p90"])
+
+def should_hedge(model_id):
+    """Called once the primary is overdue: spends from the budget and counts the outcome."""
+    if hedge_budget.try_spend():
+        increment("hedged_requests", model=model_id)
+        return True
+    increment("hedge_budget_exhausted", model=model_id)
+    return False
+
+def record_hedge_eligible(model_id):
+    """Counts a request that could be hedged and funds the budget with it."""
+    hedge_budget.deposit()
+    increment("hedge_eligible_requests", model=model_id)
+
+def record_hedge_winner(model_id, hedged):
+    """Counts which copy of a hedged request answered first."""
+    increment("hedge_wins", model=model_id, winner="hedge" if hedged else "primary")
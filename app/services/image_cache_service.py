@@ -0,0 +1,184 @@
+# app/services/image_cache_service.py
+
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import time
+from ..config import Config
+from ..extensions import redis_client
+from .api_key_service import get_api_key_settings
+from .blob_store_service import (
+    Base64Blob, blob_id_from_url, blob_mimetype, blob_path, copy_file, put_blob, put_blob_file, signed_url,
+    sniff_content_type
+)
+from .metrics_service import increment
+
+log = logging.getLogger(__name__)
+
+# Cache of generated images, keyed by (model, prompt, size, seed). The image
+# files are stored once on disk under IMAGE_CACHE_DIR, content addressed by
+# their blob id ("<dir>/<first 2 characters>/<rest>"), so identical images
+# produced for different requests share a file. Files move between the blob
+# store and the cache as hard links (or chunked copies), never through
+# memory. Redis holds the index and the LRU bookkeeping shared by all workers:
+#   image_cache:<sha256>  JSON list of the {"digest", "content_type"} of the
+#                         images generated for a request, expiring after
+#                         IMAGE_CACHE_TTL
+#   image_cache:lru       sorted set of image digests by last use
+#   image_cache:sizes     hash of digest -> bytes on disk
+#   image_cache:bytes     total bytes on disk
+# Beyond IMAGE_CACHE_MAX_BYTES the least recently used images are evicted
+# and their files deleted by the worker that stored the newest one.
+
+LRU_KEY = "image_cache:lru"
+SIZES_KEY = "image_cache:sizes"
+BYTES_KEY = "image_cache:bytes"
+
+# KEYS: lru, sizes, bytes. ARGV: now, max bytes, then digest, size pairs.
+# Returns the digests evicted to bring the total under the cap; the images
+# just stored are the most recently used, so they go last.
+PUT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+for i = 3, #ARGV, 2 do
+    if redis.call('HSETNX', KEYS[2], ARGV[i], ARGV[i + 1]) == 1 then
+        total = redis.call('INCRBY', KEYS[3], tonumber(ARGV[i + 1]))
+    end
+    redis.call('ZADD', KEYS[1], now, ARGV[i])
+end
+local evicted = {}
+while total > tonumber(ARGV[2]) do
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0)
+    if #oldest == 0 then
+        break
+    end
+    local size = tonumber(redis.call('HGET', KEYS[2], oldest[1]) or '0')
+    redis.call('ZREM', KEYS[1], oldest[1])
+    redis.call('HDEL', KEYS[2], oldest[1])
+    total = redis.call('INCRBY', KEYS[3], -size)
+    table.insert(evicted, oldest[1])
+end
+return evicted
+"""
+
+def init_image_cache(app):
+    """Registers the image cache Lua script."""
+    with app.app_context():
+        global put_script
+        put_script = redis_client.register_script(PUT_SCRIPT)
+
+def image_cache_policy(model_id, prompt, size, seed, api_key, request_headers):
+    """
+    How an image generation request may use the cache: a dict with the
+    index "key", the "model" and whether to "read" and "write" it, or None
+    when caching is off for this API key ("image_cache" in API_KEY_SETTINGS,
+    defaulting to IMAGE_CACHE_ENABLED). Cache-Control: no-cache skips the
+    lookup, no-store skips the write.
+    """
+    if not get_api_key_settings(api_key).get("image_cache", Config.IMAGE_CACHE_ENABLED):
+        return None
+    canonical = json.dumps([model_id, prompt, size, seed], separators=(",", ":"))
+    cache_control = (request_headers.get("Cache-Control") or "").lower()
+    return {
+        "key": f"image_cache:{hashlib.sha256(canonical.encode()).hexdigest()}",
+        "model": model_id,
+        "read": "no-cache" not in cache_control,
+        "write": "no-store" not in cache_control,
+    }
+
+def _path(digest):
+    return os.path.join(Config.IMAGE_CACHE_DIR, digest[:2], digest[2:])
+
+def _blob_id(item):
+    """Blob id of one image of a provider response (stored now if inline), or None for a remote URL."""
+    if "b64_json" in item:
+        if isinstance(item["b64_json"], Base64Blob):
+            return item["b64_json"].blob_id
+        return put_blob(base64.b64decode(item["b64_json"]))
+    url = item.get("url") or ""
+    if not url.startswith("data:") or ";base64," not in url:
+        return blob_id_from_url(url)
+    header, encoded = url.split(",", 1)
+    data = base64.b64decode(encoded)
+    return put_blob(data, sniff_content_type(data, header[5:].split(";")[0] or "image/jpeg"))
+
+def _to_blob(entry):
+    """Places a cached image in the blob store and returns its blob id."""
+    return put_blob_file(_path(entry["digest"]), entry["digest"])
+
+def get_cached_images(policy, n):
+    """
+    Blob ids of the images cached for a request, placed in the blob store,
+    or None when fewer than `n` are cached or a file has been evicted.
+    """
+    if not policy or not policy["read"]:
+        return None
+    try:
+        value = redis_client.get(policy["key"])
+    except Exception as e:
+        log.debug(f"Failed to read the image cache: {e}")
+        return None
+    entries = json.loads(value) if value else []
+    if len(entries) < n:
+        increment("image_cache_misses", model=policy["model"])
+        return None
+    images = []
+    for entry in entries[:n]:
+        try:
+            images.append(_to_blob(entry))
+        except OSError:
+            increment("image_cache_misses", model=policy["model"])
+            return None
+    try:
+        redis_client.zadd(LRU_KEY, {entry["digest"]: time.time() for entry in entries[:n]}, xx=True)
+    except Exception as e:
+        log.debug(f"Failed to touch the image cache: {e}")
+    increment("image_cache_hits", model=policy["model"])
+    return images
+
+def store_images(policy, response):
+    """Caches the images of a successful image generation response. Never raises."""
+    if not policy or not policy["write"]:
+        return
+    try:
+        images = [_blob_id(item) for item in response.get("data", [])]
+        if not images or None in images:
+            return
+        entries, args = [], []
+        for blob_id in images:
+            size = os.path.getsize(blob_path(blob_id))
+            if size > Config.IMAGE_CACHE_MAX_BYTES:
+                return
+            copy_file(blob_path(blob_id), _path(blob_id))
+            entries.append({"digest": blob_id, "content_type": blob_mimetype(blob_id)})
+            args += [blob_id, size]
+        evicted = put_script(keys=[LRU_KEY, SIZES_KEY, BYTES_KEY],
+                             args=[time.time(), Config.IMAGE_CACHE_MAX_BYTES, *args], client=redis_client)
+        redis_client.set(policy["key"], json.dumps(entries), ex=Config.IMAGE_CACHE_TTL)
+        for digest in evicted:
+            try:
+                os.unlink(_path(digest))
+            except FileNotFoundError:
+                pass
+        increment("image_cache_stores", model=policy["model"])
+    except (OSError, binascii.Error, ValueError) as e:
+        log.warning(f"Failed to write the image cache: {e}")
+    except Exception as e:
+        log.debug(f"Failed to write the image cache: {e}")
+
+def image_response(images, n, response_format):
+    """
+    OpenAI-compatible image generation response for cached images, by blob
+    id: base64 JSON (as Base64Blob values, see json_response()) or signed
+    URLs to them in the blob store.
+    """
+    data = []
+    for blob_id in images[:n]:
+        if response_format == "b64_json":
+            data.append({"b64_json": Base64Blob(blob_id)})
+        else:
+            data.append({"url": signed_url(blob_id)})
+    return {"created": int(time.time()), "data": data}
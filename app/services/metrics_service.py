@@ -0,0 +1,60 @@
+# app/services/metrics_service.py
+
+import logging
+import os
+from ..extensions import redis_client
+
+log = logging.getLogger(__name__)
+
+# All metrics live in three Redis hashes so every gunicorn worker reports into
+# the same place. Field names are "<name>{label=value,...}".
+COUNTERS_KEY = "metrics:counters"
+GAUGES_KEY = "metrics:gauges"
+OBSERVATIONS_KEY = "metrics:observations"
+
+def _field(name, labels):
+    """Builds the hash field for a metric name and its labels."""
+    if not labels:
+        return name
+    label_str = ",".join(f"{key}={labels[key]}" for key in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+def increment(name, amount=1, **labels):
+    """Increments a counter. Metrics are best effort and never raise."""
+    try:
+        redis_client.hincrbyfloat(COUNTERS_KEY, _field(name, labels), amount)
+    except Exception as e:
+        log.debug(f"Failed to record metric {name}: {e}")
+
+def set_gauge(name, value, per_worker=False, **labels):
+    """
+    Sets a gauge to the given value.
+
+    Gauges describing worker-local state (pools, queues) should pass
+    per_worker=True so each worker reports under its own pid label.
+    """
+    if per_worker:
+        labels["pid"] = os.getpid()
+    try:
+        redis_client.hset(GAUGES_KEY, _field(name, labels), value)
+    except Exception as e:
+        log.debug(f"Failed to record metric {name}: {e}")
+
+def observe(name, value, **labels):
+    """Records an observation (e.g. a latency) as a running sum and count."""
+    field = _field(name, labels)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrbyfloat(OBSERVATIONS_KEY, f"{field}:sum", value)
+        pipe.hincrby(OBSERVATIONS_KEY, f"{field}:count", 1)
+        pipe.execute()
+    except Exception as e:
+        log.debug(f"Failed to record metric {name}: {e}")
+
+def get_metrics():
+    """Returns a snapshot of all counters, gauges and observations."""
+    return {
+        "counters": {k: float(v) for k, v in (redis_client.hgetall(COUNTERS_KEY) or {}).items()},
+        "gauges": {k: float(v) for k, v in (redis_client.hgetall(GAUGES_KEY) or {}).items()},
+        "observations": {k: float(v) for k, v in (redis_client.hgetall(OBSERVATIONS_KEY) or {}).items()},
+    }
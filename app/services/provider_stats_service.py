@@ -0,0 +1,137 @@
+# app/services/provider_stats_service.py
+
+import logging
+import random
+import time
+from ..config import Config
+from ..extensions import redis_client
+
+log = logging.getLogger(__name__)
+
+# Recent performance of every provider model, shared by all workers through
+# Redis (hash "provider_stats:<model id>"). Each field is an exponentially
+# weighted moving average with weight PROVIDER_STATS_ALPHA for a new sample:
+#   ttfb        seconds to the first chunk (whole call when not streaming)
+#   tps         completion tokens per second after the first chunk
+#   error_rate  share of failed calls (1 for a failure, 0 for a success)
+# The last PROVIDER_STATS_TTFB_HISTORY raw ttfb samples are also kept (list
+# "provider_stats:<model id>:ttfb") for percentiles such as the hedging delay.
+
+# ARGV: alpha, now, history size, then field/value pairs. The first sample
+# seeds the average.
+EWMA_SCRIPT = """
+local alpha = tonumber(ARGV[1])
+for i = 4, #ARGV, 2 do
+    local field = ARGV[i]
+    local value = tonumber(ARGV[i + 1])
+    if field == 'ttfb' then
+        redis.call('LPUSH', KEYS[2], value)
+        redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[3]) - 1)
+    end
+    local old = redis.call('HGET', KEYS[1], field)
+    if old then
+        value = alpha * value + (1 - alpha) * tonumber(old)
+    end
+    redis.call('HSET', KEYS[1], field, value)
+end
+redis.call('HINCRBY', KEYS[1], 'samples', 1)
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[2])
+return 1
+"""
+
+STATS_FIELDS = ("ttfb", "tps", "error_rate", "samples", "updated_at")
+
+# Per-worker cache of the Redis stats, so routing a request costs no round trip.
+_cache = {}
+
+def init_provider_stats(app):
+    """Registers the EWMA update script."""
+    with app.app_context():
+        global ewma_script
+        ewma_script = redis_client.register_script(EWMA_SCRIPT)
+
+def _update(model_id, **samples):
+    args = [Config.PROVIDER_STATS_ALPHA, time.time(), Config.PROVIDER_STATS_TTFB_HISTORY]
+    for field, value in samples.items():
+        args += [field, value]
+    try:
+        ewma_script(keys=[f"provider_stats:{model_id}", f"provider_stats:{model_id}:ttfb"], args=args, client=redis_client)
+    except Exception as e:
+        log.debug(f"Failed to record provider stats for {model_id}: {e}")
+
+def record_call(model_id, failed, ttfb=None):
+    """Records the outcome of an upstream call and, on success, its time to first chunk."""
+    if failed:
+        _update(model_id, error_rate=1)
+    elif ttfb is not None:
+        _update(model_id, error_rate=0, ttfb=ttfb)
+    else:
+        _update(model_id, error_rate=0)
+
+def record_throughput(model_id, completion_tokens, seconds):
+    """Records the generation speed of a finished stream."""
+    if completion_tokens > 0 and seconds > 0:
+        _update(model_id, tps=completion_tokens / seconds)
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def get_stats(model_ids):
+    """
+    Returns {model id: stats dict} for the given models, cached per worker.
+    Besides the averages, "ttfb_p90" is the 90th percentile of the recent
+    ttfb samples and "ttfb_history" their number.
+    """
+    now = time.monotonic()
+    missing = [m for m in model_ids if m not in _cache or now - _cache[m][0] > Config.PROVIDER_STATS_CACHE_SECONDS]
+    if missing:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for model_id in missing:
+                pipe.hmget(f"provider_stats:{model_id}", *STATS_FIELDS)
+                pipe.lrange(f"provider_stats:{model_id}:ttfb", 0, -1)
+            results = pipe.execute()
+            for model_id, values, history in zip(missing, results[::2], results[1::2]):
+                stats = {field: float(value) for field, value in zip(STATS_FIELDS, values) if value is not None}
+                if history:
+                    stats["ttfb_p90"] = _percentile([float(v) for v in history], 0.9)
+                    stats["ttfb_history"] = len(history)
+                _cache[model_id] = (now, stats)
+        except Exception as e:
+            log.debug(f"Failed to read provider stats: {e}")
+            for model_id in missing:
+                _cache.setdefault(model_id, (now, {}))
+    return {m: _cache[m][1] for m in model_ids}
+
+def score(stats):
+    """
+    Expected cost of routing a request to a model; lower is better.
+
+    Time to first chunk, plus the time to generate PROVIDER_SCORE_REFERENCE_TOKENS
+    at the observed speed, plus PROVIDER_SCORE_ERROR_PENALTY seconds scaled by
+    the error rate, each multiplied by its weight. Metrics without samples
+    count as zero, so new members get tried.
+    """
+    tps = stats.get("tps")
+    generation = Config.PROVIDER_SCORE_REFERENCE_TOKENS / tps if tps else 0.0
+    return (
+        Config.PROVIDER_SCORE_WEIGHT_TTFB * stats.get("ttfb", 0.0)
+        + Config.PROVIDER_SCORE_WEIGHT_TPS * generation
+        + Config.PROVIDER_SCORE_WEIGHT_ERRORS * Config.PROVIDER_SCORE_ERROR_PENALTY * stats.get("error_rate", 0.0)
+    )
+
+def rank(model_ids):
+    """
+    Orders equivalent models for routing with the power of two choices: two
+    random members are compared and the cheaper one goes first, the rest
+    follow by score as failover targets. Sampling two instead of always
+    taking the best keeps every worker from herding onto the same upstream.
+    """
+    if len(model_ids) < 2:
+        return list(model_ids)
+    stats = get_stats(model_ids)
+    scores = {m: score(stats[m]) for m in model_ids}
+    first = min(random.sample(model_ids, 2), key=lambda m: scores[m])
+    rest = sorted((m for m in model_ids if m != first), key=lambda m: scores[m])
+    return [first] + rest
@@ -0,0 +1,200 @@
+# app/services/quota_service.py
+
+import math
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from ..config import Config
+from ..extensions import redis_client
+from .api_key_service import get_api_key_settings
+from .metrics_service import increment
+from .rate_limit_service import rate_limit_tier
+from .usage_service import model_cost_per_million
+
+log = logging.getLogger(__name__)
+
+# Token and cost quotas per API key. Rate limits count requests; these count
+# what the requests spend upstream. Before a chat completion is sent to a
+# provider, its prompt tokens plus max_tokens (and their cost) are reserved
+# atomically; once the completion has been counted the reservation is settled
+# against the tokens actually used, so the unused part of max_tokens is
+# returned. Redis keys:
+#   quota:tokens:<api key>        hash {level, ts}: a token bucket holding up
+#                                 to tokens_per_minute, refilled continuously
+#                                 (a missing key is a full bucket)
+#   quota:cost:<api key>:<date>   micro-dollars spent (or reserved) on a UTC day
+
+COST_KEY_TTL = 2 * 86400
+
+# KEYS: token bucket, cost counter. ARGV: now ms, tokens per minute, tokens,
+# cost limit, cost (micro-dollars). A limit of 0 is not checked. A request
+# larger than a whole quota is let through once the quota is untouched,
+# leaving the bucket in debt. Returns {allowed, quota (1 tokens, 2 cost),
+# retry after ms}.
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local per_minute = tonumber(ARGV[2])
+local tokens = tonumber(ARGV[3])
+local cost_limit = tonumber(ARGV[4])
+local cost = tonumber(ARGV[5])
+local level = 0
+if per_minute > 0 then
+    local state = redis.call('HMGET', KEYS[1], 'level', 'ts')
+    level = tonumber(state[1]) or per_minute
+    level = math.min(per_minute, level + (now - (tonumber(state[2]) or now)) * per_minute / 60000)
+    local required = math.min(tokens, per_minute)
+    if level < required then
+        return {0, 1, math.ceil((required - level) * 60000 / per_minute)}
+    end
+end
+if cost_limit > 0 then
+    local spent = tonumber(redis.call('GET', KEYS[2]) or '0')
+    if spent + math.min(cost, cost_limit) > cost_limit then
+        return {0, 2, 0}
+    end
+    redis.call('INCRBY', KEYS[2], cost)
+    redis.call('EXPIRE', KEYS[2], ARGV[6])
+end
+if per_minute > 0 then
+    level = level - tokens
+    redis.call('HSET', KEYS[1], 'level', level, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil((per_minute - level) * 60000 / per_minute) + 1000)
+end
+return {1, 0, 0}
+"""
+
+# KEYS: token bucket, cost counter. ARGV: now ms, tokens per minute, tokens
+# used beyond the reservation, cost beyond the reservation (either negative
+# when less was used).
+SETTLE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local per_minute = tonumber(ARGV[2])
+local extra_tokens = tonumber(ARGV[3])
+local extra_cost = tonumber(ARGV[4])
+if per_minute > 0 and extra_tokens ~= 0 then
+    local state = redis.call('HMGET', KEYS[1], 'level', 'ts')
+    local level = tonumber(state[1]) or per_minute
+    level = math.min(per_minute, level + (now - (tonumber(state[2]) or now)) * per_minute / 60000)
+    level = math.min(per_minute, level - extra_tokens)
+    redis.call('HSET', KEYS[1], 'level', level, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil((per_minute - level) * 60000 / per_minute) + 1000)
+end
+if extra_cost ~= 0 and redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('INCRBY', KEYS[2], extra_cost)
+end
+return 1
+"""
+
+def init_quotas(app):
+    """Registers the quota Lua scripts."""
+    with app.app_context():
+        global reserve_script, settle_script
+        reserve_script = redis_client.register_script(RESERVE_SCRIPT)
+        settle_script = redis_client.register_script(SETTLE_SCRIPT)
+
+def quota_policy(api_key):
+    """
+    The quotas of `api_key`: {"tokens_per_minute", "cost_per_day"} (0 when
+    unlimited), from API_KEY_SETTINGS, then the key's tier in
+    RATE_LIMIT_TIERS, then QUOTA_TOKENS_PER_MINUTE / QUOTA_COST_PER_DAY.
+    """
+    policy = {"tokens_per_minute": Config.QUOTA_TOKENS_PER_MINUTE, "cost_per_day": Config.QUOTA_COST_PER_DAY}
+    tier_settings = Config.RATE_LIMIT_TIERS.get(rate_limit_tier(api_key), {})
+    key_settings = get_api_key_settings(api_key)
+    for name in policy:
+        policy[name] = key_settings.get(name, tier_settings.get(name, policy[name])) or 0
+    return policy
+
+def _cost_micros(model_id, tokens):
+    """Cost of `tokens` tokens of a model in micro-dollars, rounded up."""
+    return math.ceil(tokens * model_cost_per_million(model_id))
+
+def _seconds_until_tomorrow(now):
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return math.ceil((tomorrow - now).total_seconds())
+
+def reserve_quota(call):
+    """
+    Reserves the prompt tokens plus max_tokens of a chat completion (see
+    prepare_chat_completion()), and their cost at the price of its first
+    candidate (a group name has no price of its own), against the quotas of
+    its API key. Called right before the provider so
+    an over-quota request spends nothing upstream. Sets call["quota"] to the
+    reservation (None when the key has no quotas), which must be settled
+    with settle_quota() or release_quota().
+
+    Returns None when the request may proceed, otherwise a 429 (body,
+    status, headers) with Retry-After. Fails open.
+    """
+    call["quota"] = None
+    policy = quota_policy(call["api_key"])
+    if not policy["tokens_per_minute"] and not policy["cost_per_day"]:
+        return None
+
+    now = datetime.now(timezone.utc)
+    tokens = call["prompt_tokens"] + (call["max_tokens"] or 0)
+    reservation = {
+        "tokens_key": f"quota:tokens:{call['api_key']}",
+        "cost_key": f"quota:cost:{call['api_key']}:{now.strftime('%Y-%m-%d')}",
+        "tokens_per_minute": int(policy["tokens_per_minute"]),
+        "tokens": tokens,
+        "cost": _cost_micros(call["candidates"][0], tokens) if policy["cost_per_day"] else 0,
+        "cost_enabled": bool(policy["cost_per_day"]),
+        "settled": False,
+        # settle_quota() and release_quota() may race, e.g. a stream's end and its connection closing
+        "lock": threading.Lock(),
+    }
+    try:
+        allowed, quota, retry_after_ms = reserve_script(
+            keys=[reservation["tokens_key"], reservation["cost_key"]],
+            args=[int(time.time() * 1000), reservation["tokens_per_minute"], tokens,
+                  round(policy["cost_per_day"] * 1000000), reservation["cost"], COST_KEY_TTL],
+            client=redis_client
+        )
+    except Exception as e:
+        log.error(f"Quota error: {e}")
+        return None
+
+    if allowed:
+        call["quota"] = reservation
+        return None
+    if quota == 1:
+        increment("quota_rejections", quota="tokens")
+        message = (f"Token quota exceeded - {reservation['tokens_per_minute']} tokens per minute "
+                   f"({tokens} requested: prompt tokens plus max_tokens)")
+        retry_after = max(1, math.ceil(retry_after_ms / 1000))
+    else:
+        increment("quota_rejections", quota="cost")
+        message = f"Daily cost quota of ${policy['cost_per_day']:.2f} exceeded"
+        retry_after = _seconds_until_tomorrow(now)
+    log.warning(f"{message} for API key: {call['api_key']}")
+    return {"error": message, "status_code": 429}, 429, {"Retry-After": str(retry_after)}
+
+def settle_quota(reservation, model_id, prompt_tokens, completion_tokens):
+    """
+    Replaces a reservation with the tokens a completion actually used, priced
+    for the model that served it. Settles a reservation once, whichever of
+    settle_quota() and release_quota() comes first; never raises.
+    """
+    if not reservation:
+        return
+    with reservation["lock"]:
+        if reservation["settled"]:
+            return
+        reservation["settled"] = True
+    used = prompt_tokens + completion_tokens
+    extra_cost = (_cost_micros(model_id, used) if reservation["cost_enabled"] and used else 0) - reservation["cost"]
+    try:
+        settle_script(
+            keys=[reservation["tokens_key"], reservation["cost_key"]],
+            args=[int(time.time() * 1000), reservation["tokens_per_minute"], used - reservation["tokens"], extra_cost],
+            client=redis_client
+        )
+    except Exception as e:
+        log.debug(f"Failed to settle a quota reservation: {e}")
+
+def release_quota(reservation):
+    """Returns a whole reservation, for a request that spent nothing upstream."""
+    if reservation:
+        settle_quota(reservation, None, 0, 0)
@@ -1,68 +1,201 @@
 # app/services/rate_limit_service.py
 
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, make_response
 from functools import wraps
+import math
 import time
+import uuid
 import logging
-from .api_key_service import get_api_key_from_request
+from .api_key_service import get_api_key_settings
+from ..config import Config
 from ..extensions import redis_client
 
 log = logging.getLogger(__name__)
 
-# Lua script for atomic rate limiting
+# Each algorithm is one atomic Lua script returning
+# {allowed (1/0), remaining, reset_ms, retry_after_ms}: the requests left in
+# the current window, the time until the limit is fully restored and, for a
+# rejection, the time until the next request would be allowed.
+
+# Fixed window: a counter per window. KEYS: counter. ARGV: window ms, limit.
+# Allows up to twice the limit across a window boundary.
 RATE_LIMIT_SCRIPT = """
 local current = redis.call('INCR', KEYS[1])
 if current == 1 then
-    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+end
+local ttl = math.max(0, redis.call('PTTL', KEYS[1]))
+local limit = tonumber(ARGV[2])
+if current > limit then
+    return {0, 0, ttl, ttl}
+end
+return {1, limit - current, ttl, 0}
+"""
+
+# Sliding log: the times of the allowed requests of the last window.
+# KEYS: sorted set. ARGV: now ms, window ms, limit, unique member.
+SLIDING_LOG_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if count < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return {1, limit - count - 1, window, 0}
+end
+local oldest = tonumber(redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')[2])
+local newest = tonumber(redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')[2])
+return {0, 0, math.max(0, newest + window - now), math.max(0, oldest + window - now)}
+"""
+
+# GCRA (a token bucket holding `burst` requests, refilled at limit per
+# window), stored as the theoretical arrival time of the next request.
+# KEYS: TAT. ARGV: now ms, window ms, limit, burst.
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2]) / tonumber(ARGV[3])
+local burst = tonumber(ARGV[4])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+local new_tat = tat + interval
+local allow_at = new_tat - burst * interval
+if now < allow_at then
+    return {0, 0, math.ceil(tat - now), math.ceil(allow_at - now)}
 end
-return current
+redis.call('SET', KEYS[1], new_tat, 'PX', math.ceil(new_tat - now))
+return {1, math.floor((now - allow_at) / interval), math.ceil(new_tat - now), 0}
 """
 
+ALGORITHMS = ("fixed", "sliding", "gcra")
+
 def init_rate_limiter(app):
-    """Initializes the rate limiter (loads the Lua script)."""
+    """Initializes the rate limiter (loads the Lua scripts)."""
     with app.app_context():
-        global rate_limiter
+        global rate_limiter, sliding_log_limiter, gcra_limiter
         rate_limiter = redis_client.register_script(RATE_LIMIT_SCRIPT)
+        sliding_log_limiter = redis_client.register_script(SLIDING_LOG_SCRIPT)
+        gcra_limiter = redis_client.register_script(GCRA_SCRIPT)
+
+def _bearer_token(request):
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header.split(' ')[1]
+    return None
+
+def rate_limit_tier(api_key):
+    """The tier of `api_key` ("rate_limit_tier" in API_KEY_SETTINGS, defaulting to RATE_LIMIT_DEFAULT_TIER)."""
+    return get_api_key_settings(api_key).get("rate_limit_tier", Config.RATE_LIMIT_DEFAULT_TIER)
+
+def rate_limit_policy(api_key, limit_type="text"):
+    """
+    The limit applied to `api_key` for `limit_type` ("text" or "image"): a
+    dict with "algorithm", "limit", "window" (seconds) and "burst" (GCRA).
+
+    Comes from the key's tier ("rate_limit_tier" in API_KEY_SETTINGS) in
+    RATE_LIMIT_TIERS, falling back for missing values to REQUEST_LIMIT /
+    IMAGE_REQUEST_LIMIT and RATE_LIMIT_ALGORITHM.
+    """
+    if limit_type == "image":
+        policy = {
+            "limit": current_app.config.get("IMAGE_REQUEST_LIMIT", 5),  # Default 5 requests per minute for images
+            "window": current_app.config.get("IMAGE_RATE_LIMIT_WINDOW", 60),
+        }
+    else:  # Default to text
+        policy = {
+            "limit": current_app.config.get("REQUEST_LIMIT", 10),
+            "window": current_app.config.get("RATE_LIMIT_WINDOW", 60),
+        }
+    policy["algorithm"] = Config.RATE_LIMIT_ALGORITHM
+    tier = rate_limit_tier(api_key)
+    tier_settings = Config.RATE_LIMIT_TIERS.get(tier, {})
+    if "algorithm" in tier_settings:
+        policy["algorithm"] = tier_settings["algorithm"]
+    policy.update(tier_settings.get(limit_type, {}))
+    policy.setdefault("burst", policy["limit"])
+    policy["tier"] = tier
+    return policy
+
+def _run_limiter(policy, key_suffix):
+    """
+    Runs the policy's script; returns (allowed, remaining, reset ms, retry
+    after ms). A limit of 0 or less rejects every request without a script.
+    """
+    now_ms = int(time.time() * 1000)
+    window_ms = int(policy["window"] * 1000)
+    if policy["limit"] <= 0:
+        return 0, 0, window_ms, window_ms
+    algorithm = policy["algorithm"] if policy["algorithm"] in ALGORITHMS else "fixed"
+    if algorithm == "sliding":
+        result = sliding_log_limiter(keys=[f"rate_limit:sliding:{key_suffix}"],
+                                     args=[now_ms, window_ms, policy["limit"], f"{now_ms}-{uuid.uuid4().hex[:8]}"],
+                                     client=redis_client)
+    elif algorithm == "gcra":
+        result = gcra_limiter(keys=[f"rate_limit:gcra:{key_suffix}"],
+                              args=[now_ms, window_ms, policy["limit"], policy["burst"]], client=redis_client)
+    else:
+        result = rate_limiter(keys=[f"rate_limit:{key_suffix}"], args=[window_ms, policy["limit"]], client=redis_client)
+    return tuple(int(value) for value in result)
+
+def check_rate_limit(request, limit_type="text"):
+    """
+    Applies the rate limit for the API key of `request`, in one Redis round
+    trip. The key is taken from the Authorization header as is: the routes
+    check it against the database before the rate limit runs.
+
+    Returns (rejection, headers): rejection is None when the request is
+    allowed, otherwise a (body, status) tuple; headers are the
+    X-RateLimit-* headers (and Retry-After on a rejection) for the
+    response. Shared by the rate_limit decorator and the ASGI handlers.
+
+    Args:
+        limit_type (str): The type of rate limit to apply. Can be "text" or "image".
+    """
+    api_key = _bearer_token(request)
+    if not api_key:
+        return ({"error": "Invalid API Key", "status": 401}, 401), {}
+
+    policy = rate_limit_policy(api_key, limit_type)
+    try:
+        allowed, remaining, reset_ms, retry_after_ms = _run_limiter(policy, f"{limit_type}:{api_key}")
+    except Exception as e:
+        log.error(f"Rate limiting error: {e}")
+        # Fail open if an error occurs with rate limiting
+        return None, {}
+
+    headers = {
+        "X-RateLimit-Limit": str(policy["limit"]),
+        "X-RateLimit-Remaining": str(max(0, remaining)),
+        "X-RateLimit-Reset": str(math.ceil(reset_ms / 1000)),
+    }
+    if not allowed:
+        log.warning(f"Rate limit exceeded for API key: {api_key} (type: {limit_type})")
+        headers["Retry-After"] = str(max(1, math.ceil(retry_after_ms / 1000)))
+        return ({
+            "error": f"Rate limit exceeded - {policy['limit']} {limit_type} request(s) per {policy['window']} seconds",
+            "status": 429
+        }, 429), headers
+
+    return None, headers
 
 def rate_limit(limit_type="text"):
     """
-    Decorator to apply rate limiting to a route.
-    Uses different rate limits based on the limit_type.
-    
+    Decorator to apply rate limiting to a route, adding the X-RateLimit-*
+    headers to its response. Uses different rate limits based on the limit_type.
+
     Args:
         limit_type (str): The type of rate limit to apply. Can be "text" or "image".
     """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            api_key_record = get_api_key_from_request(request)
-            if not api_key_record:
-                return jsonify({"error": "Invalid API Key", "status": 401}), 401
-
-            api_key = api_key_record.api_key
-            rate_limit_key = f"rate_limit:{limit_type}:{api_key}"
-
-            # Get the limit and window from config based on limit_type
-            if limit_type == "image":
-                limit = current_app.config.get("IMAGE_REQUEST_LIMIT", 5)  # Default 5 requests per minute for images
-                window = current_app.config.get("IMAGE_RATE_LIMIT_WINDOW", 60)
-            else:  # Default to text
-                limit = current_app.config.get("REQUEST_LIMIT", 10)
-                window = current_app.config.get("RATE_LIMIT_WINDOW", 60)
-
-            try:
-                current = rate_limiter(keys=[rate_limit_key], args=[window], client=redis_client)
-                if int(current) > limit:
-                    log.warning(f"Rate limit exceeded for API key: {api_key} (type: {limit_type})")
-                    return jsonify({
-                        "error": f"Rate limit exceeded - {limit} {limit_type} request(s) per {window} seconds",
-                        "status": 429
-                    }), 429
-            except Exception as e:
-                log.error(f"Rate limiting error: {e}")
-                # Fail open if an error occurs with rate limiting
-                return f(*args, **kwargs)
-
-            return f(*args, **kwargs)
+            rejection, headers = check_rate_limit(request, limit_type)
+            if rejection:
+                body, status = rejection
+                return jsonify(body), status, headers
+            response = make_response(f(*args, **kwargs))
+            for name, value in headers.items():
+                response.headers[name] = value
+            return response
         return decorated_function
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,220 @@
+# app/services/response_cache_service.py
+
+import hashlib
+import json
+import logging
+import time
+import uuid
+from ..config import Config
+from ..extensions import redis_client
+from .api_key_service import get_api_key_settings
+from .metrics_service import increment
+
+log = logging.getLogger(__name__)
+
+# Exact-match cache of deterministic chat completions, shared by all workers
+# through Redis. An entry ("response_cache:<sha256>") holds the assistant
+# text, the model that produced it and, for non-streamed calls, the original
+# response body; it is served to identical requests either as that body or
+# replayed as a stream of SSE chunks. Entries expire after RESPONSE_CACHE_TTL
+# and the least recently used ones are evicted once the cache holds more than
+# RESPONSE_CACHE_MAX_BYTES:
+#   response_cache:lru    sorted set of entry keys by last use
+#   response_cache:sizes  hash of entry key -> stored bytes
+#   response_cache:bytes  total stored bytes
+
+LRU_KEY = "response_cache:lru"
+SIZES_KEY = "response_cache:sizes"
+BYTES_KEY = "response_cache:bytes"
+
+# KEYS: entry, lru, sizes, bytes. ARGV: value, ttl, now, max bytes.
+# Index entries older than the TTL are dropped first, then the least
+# recently used entries until the total fits.
+PUT_SCRIPT = """
+local function drop(key)
+    local size = tonumber(redis.call('HGET', KEYS[3], key) or '0')
+    redis.call('DEL', key)
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('HDEL', KEYS[3], key)
+    return redis.call('INCRBY', KEYS[4], -size)
+end
+local now = tonumber(ARGV[3])
+local old = tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or '0')
+local size = string.len(ARGV[1])
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('HSET', KEYS[3], KEYS[1], size)
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+local total = redis.call('INCRBY', KEYS[4], size - old)
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[2]), 'LIMIT', 0, 100)) do
+    total = drop(key)
+end
+while total > tonumber(ARGV[4]) do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if #oldest == 0 then
+        break
+    end
+    total = drop(oldest[1])
+end
+return total
+"""
+
+# KEYS: entry, lru. ARGV: now. Returns the entry and marks it as recently used.
+GET_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('ZADD', KEYS[2], 'XX', ARGV[1], KEYS[1])
+end
+return value
+"""
+
+def init_response_cache(app):
+    """Registers the response cache Lua scripts."""
+    with app.app_context():
+        global put_script, get_script
+        put_script = redis_client.register_script(PUT_SCRIPT)
+        get_script = redis_client.register_script(GET_SCRIPT)
+
+def request_digest(validated_data, api_key=None, ignore=()):
+    """
+    sha256 of the canonical JSON of a validated request without the `ignore`d
+    parameters, scoped to `api_key` when one is given.
+    """
+    canonical = {k: v for k, v in validated_data.items() if k not in ignore}
+    if api_key is not None:
+        canonical["api_key"] = api_key
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def cache_policy(validated_data, api_key, request_headers):
+    """
+    How a validated chat completion request may use the cache: a dict with
+    the entry "key" and whether to "read" and "write" it, or None when it
+    must not be cached: caching is off for this API key ("response_cache" in
+    API_KEY_SETTINGS, defaulting to RESPONSE_CACHE_ENABLED), or the request
+    is not deterministic (temperature other than 0) or asks for audio.
+    Cache-Control: no-cache skips the lookup, no-store skips the write.
+
+    The key hashes the canonical JSON of every parameter except "stream", so
+    a streamed and a non-streamed request share an entry. Unless
+    RESPONSE_CACHE_SHARED is set, entries are private to the API key.
+    """
+    if not get_api_key_settings(api_key).get("response_cache", Config.RESPONSE_CACHE_ENABLED):
+        return None
+    if validated_data.get("temperature") != 0 or "audio" in validated_data or "audio" in validated_data.get("modalities", []):
+        return None
+    digest = request_digest(validated_data, None if Config.RESPONSE_CACHE_SHARED else api_key, ignore=("stream",))
+    cache_control = (request_headers.get("Cache-Control") or "").lower()
+    return {
+        "key": f"response_cache:{digest}",
+        "read": "no-cache" not in cache_control,
+        "write": "no-store" not in cache_control,
+    }
+
+def get_cached_completion(policy):
+    """
+    Returns the cached entry for a request ({"model_id", "content",
+    "finish_reason", "completion_tokens", "response"}) or None.
+    """
+    if not policy or not policy["read"]:
+        return None
+    try:
+        value = get_script(keys=[policy["key"], LRU_KEY], args=[time.time()], client=redis_client)
+    except Exception as e:
+        log.debug(f"Failed to read the response cache: {e}")
+        return None
+    if value is None:
+        increment("response_cache_misses")
+        return None
+    entry = json.loads(value)
+    increment("response_cache_hits", model=entry["model_id"])
+    return entry
+
+def _store(policy, entry):
+    if not policy or not policy["write"]:
+        return
+    value = json.dumps(entry, separators=(",", ":"))
+    if len(value) > Config.RESPONSE_CACHE_MAX_ENTRY_BYTES:
+        return
+    try:
+        put_script(
+            keys=[policy["key"], LRU_KEY, SIZES_KEY, BYTES_KEY],
+            args=[value, Config.RESPONSE_CACHE_TTL, time.time(), Config.RESPONSE_CACHE_MAX_BYTES],
+            client=redis_client
+        )
+        increment("response_cache_stores", model=entry["model_id"])
+    except Exception as e:
+        log.debug(f"Failed to write the response cache: {e}")
+
+def store_completion(policy, model_id, response, completion_tokens):
+    """Caches a successful non-streamed response."""
+    try:
+        choice = response["choices"][0]
+        content = choice["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return
+    if not isinstance(content, str) or choice.get("finish_reason") not in (None, "stop", "length"):
+        return
+    _store(policy, {
+        "model_id": model_id,
+        "content": content,
+        "finish_reason": choice.get("finish_reason") or "stop",
+        "completion_tokens": completion_tokens,
+        "response": response,
+    })
+
+def store_stream(policy, model_id, content, completion_tokens):
+    """Caches the text of a stream that completed normally."""
+    if not content:
+        return
+    _store(policy, {
+        "model_id": model_id,
+        "content": content,
+        "finish_reason": "stop",
+        "completion_tokens": completion_tokens,
+        "response": None,
+    })
+
+def cached_response_body(entry, prompt_tokens):
+    """The non-streamed response for a cache hit: the stored body, or one built from a cached stream."""
+    if entry.get("response"):
+        return entry["response"]
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": entry["model_id"],
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": entry["content"]},
+            "finish_reason": entry["finish_reason"],
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": entry["completion_tokens"],
+            "total_tokens": prompt_tokens + entry["completion_tokens"],
+        },
+    }
+
+def replay_stream(entry):
+    """
+    Yields a cached completion as the SSE frames of a chat.completion.chunk
+    stream: a role chunk, the text in RESPONSE_CACHE_REPLAY_CHUNK_CHARS
+    pieces, a finish chunk and [DONE].
+    """
+    base = {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": entry["model_id"],
+    }
+
+    def frame(delta, finish_reason=None):
+        chunk = dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    yield frame({"role": "assistant", "content": ""})
+    content = entry["content"]
+    size = Config.RESPONSE_CACHE_REPLAY_CHUNK_CHARS
+    for start in range(0, len(content), size):
+        yield frame({"content": content[start:start + size]})
+    yield frame({}, entry["finish_reason"])
+    yield "data: [DONE]\n\n"
@@ -0,0 +1,573 @@
+# app/services/single_flight_service.py
+
+import asyncio
+import copy
+import inspect
+import json
+import logging
+import math
+import threading
+import uuid
+from ..config import Config
+from ..extensions import redis_client
+from ..utils.deadline import DeadlineExceeded
+from .api_key_service import get_api_key_settings
+from .metrics_service import increment
+from .response_cache_service import request_digest
+
+log = logging.getLogger(__name__)
+
+# Single-flight coalescing of identical chat completion requests. The first
+# request for a key (the leader) calls the provider; identical requests that
+# arrive while it is in flight (followers) wait for its result instead of
+# opening their own upstream call. A non-streamed response is copied to every
+# follower. A stream is read into a shared chunk buffer by whichever caller
+# needs the next chunk first, and every caller iterates the buffer from the
+# start, so a late follower still gets the whole answer. The upstream is
+# closed when it ends or when its last caller goes away. Each caller records
+# its own usage; failed failover attempts are only recorded by the leader.
+#
+# With SINGLE_FLIGHT_DISTRIBUTED the leader of each worker also takes the
+# Redis lock "single_flight:<digest>:lock". The worker holding it publishes
+# the call's outcome to the Redis stream "single_flight:<digest>:items:<token>"
+# (a "meta" entry with the serving model, the response or every chunk as
+# "item" entries, then "end" or "error"); the other workers follow that
+# stream, and make their own call if the lock holder fails before answering.
+
+# KEYS: lock. ARGV: token. Deletes the lock only if it is still ours.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def init_single_flight(app):
+    """Registers the single-flight Lua script."""
+    with app.app_context():
+        global release_script
+        release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+def flight_key(validated_data, api_key):
+    """
+    Key under which identical requests share a call, or None when coalescing
+    is off for this API key ("single_flight" in API_KEY_SETTINGS, defaulting
+    to SINGLE_FLIGHT_ENABLED). Unless SINGLE_FLIGHT_SHARED is set, only
+    requests from the same key are coalesced.
+    """
+    if not get_api_key_settings(api_key).get("single_flight", Config.SINGLE_FLIGHT_ENABLED):
+        return None
+    return f"single_flight:{request_digest(validated_data, None if Config.SINGLE_FLIGHT_SHARED else api_key)}"
+
+def _served(attempts):
+    """The attempt that served a call, as a one-element attempts list for followers."""
+    return [dict(a) for a in attempts[-1:] if a["error"] is None]
+
+def _plain(item):
+    """A chunk or response in a JSON-serializable form."""
+    if hasattr(item, "model_dump"):
+        return item.model_dump()
+    if isinstance(item, (bytes, bytearray)):
+        return item.decode("utf-8", "replace")
+    return item
+
+def _close(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            log.warning(f"Error closing shared upstream stream: {e}")
+
+async def _aclose(stream):
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if close is not None:
+        try:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            log.warning(f"Error closing shared upstream stream: {e}")
+
+def _deadline_exceeded(deadline):
+    return DeadlineExceeded(f"Request deadline of {deadline.total:.0f}s exceeded")
+
+# --- Cross-worker coordination -------------------------------------------------
+
+class _LeaderFailed(Exception):
+    """The worker leading a flight failed (or went away) before answering."""
+    pass
+
+def _lock_ttl_ms(deadline):
+    # The leader's call cannot outlive its deadline, nor the lock.
+    seconds = deadline.remaining() if deadline is not None else Config.MAX_REQUEST_TIMEOUT
+    return math.ceil((seconds + 1) * 1000)
+
+def _acquire(key, token, ttl_ms):
+    """Token of the worker holding the flight's Redis lock (`token` if we got it), or None if Redis fails."""
+    try:
+        for _ in range(3):
+            if redis_client.set(f"{key}:lock", token, nx=True, px=ttl_ms):
+                return token
+            holder = redis_client.get(f"{key}:lock")
+            if holder:
+                return holder
+    except Exception as e:
+        log.debug(f"Failed to take the single-flight lock: {e}")
+    return None
+
+class _Publisher:
+    """Publishes a leading worker's outcome to the other workers, then releases its lock."""
+
+    def __init__(self, key, token, ttl_ms):
+        self.lock_key = f"{key}:lock"
+        self.items_key = f"{key}:items:{token}"
+        self.token = token
+        self.ttl = math.ceil(ttl_ms / 1000)
+        self.healthy = True
+
+    def _add(self, *entries):
+        if not self.healthy:
+            return
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for kind, data in entries:
+                pipe.xadd(self.items_key, {"kind": kind, "data": json.dumps(data, default=str)})
+            pipe.expire(self.items_key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            log.debug(f"Failed to publish a single-flight result: {e}")
+            self.healthy = False
+
+    def begin(self, attempts, response=None):
+        """Announces the serving model; a non-streamed `response` is published and finished at once."""
+        served = _served(attempts)
+        meta = ("meta", {"model_id": served[0]["model_id"] if served else None})
+        if response is None:
+            self._add(meta)
+        else:
+            self._add(meta, ("item", _plain(response)), ("end", None))
+            self._release()
+
+    def item(self, chunk):
+        self._add(("item", _plain(chunk)))
+
+    def finish(self, error=None):
+        self._add(("error", str(error)) if error is not None else ("end", None))
+        self._release()
+
+    def _release(self):
+        try:
+            release_script(keys=[self.lock_key], args=[self.token], client=redis_client)
+        except Exception as e:
+            log.debug(f"Failed to release the single-flight lock: {e}")
+
+def _entries(key, token, deadline):
+    """Yields the (kind, data) entries a leading worker publishes; never ends by itself."""
+    lock_key = f"{key}:lock"
+    items_key = f"{key}:items:{token}"
+    last_id = "0"
+    while True:
+        block = Config.SINGLE_FLIGHT_POLL_SECONDS
+        if deadline is not None:
+            deadline.check()
+            block = min(block, deadline.remaining())
+        response = redis_client.xread({items_key: last_id}, count=100, block=max(1, int(block * 1000)))
+        if not response:
+            # Nothing new: make sure the leader still holds its lock (and did
+            # not finish between the read and the check).
+            if redis_client.get(lock_key) != token and not redis_client.xread({items_key: last_id}, count=1):
+                raise _LeaderFailed("the leading worker went away")
+            continue
+        for entry_id, fields in response[0][1]:
+            last_id = entry_id
+            yield fields["kind"], json.loads(fields["data"])
+
+def _remote_stream(entries):
+    for kind, data in entries:
+        if kind == "end":
+            return
+        if kind == "error":
+            raise _LeaderFailed(data)
+        yield data
+
+def _follow(key, token, attempts, stream, deadline):
+    """Result of the call another worker is making (a chunk iterator for streams)."""
+    entries = _entries(key, token, deadline)
+    kind, data = next(entries)
+    if kind != "meta":
+        raise _LeaderFailed(data)
+    if not stream:
+        kind, response = next(entries)
+        if kind != "item":
+            raise _LeaderFailed(response)
+    attempts[:] = [{"model_id": data["model_id"], "error": None}]
+    increment("single_flight_followers", scope="redis")
+    return _remote_stream(entries) if stream else response
+
+def _start(key, call, attempts, stream, deadline):
+    """
+    Makes the call of this worker's flight and returns (result, publisher).
+    With SINGLE_FLIGHT_DISTRIBUTED only the worker holding the Redis lock
+    calls the provider; the others follow its published result, or make the
+    call themselves if it fails before answering.
+    """
+    if not Config.SINGLE_FLIGHT_DISTRIBUTED:
+        return call(), None
+    token = uuid.uuid4().hex
+    ttl_ms = _lock_ttl_ms(deadline)
+    holder = _acquire(key, token, ttl_ms)
+    if holder == token:
+        publisher = _Publisher(key, token, ttl_ms)
+        try:
+            result = call()
+        except BaseException as e:
+            publisher.finish(e)
+            raise
+        publisher.begin(attempts, None if stream else result)
+        return result, publisher
+    if holder is not None:
+        try:
+            return _follow(key, holder, attempts, stream, deadline), None
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log.info(f"Not following another worker's call ({e}); calling the provider")
+    return call(), None
+
+async def _astart(key, call, attempts, stream, deadline):
+    """Async variant of _start(); the Redis round trips run in the default thread pool."""
+    if not Config.SINGLE_FLIGHT_DISTRIBUTED:
+        return await call(), None
+    token = uuid.uuid4().hex
+    ttl_ms = _lock_ttl_ms(deadline)
+    holder = await asyncio.to_thread(_acquire, key, token, ttl_ms)
+    if holder == token:
+        publisher = _Publisher(key, token, ttl_ms)
+        try:
+            result = await call()
+        except BaseException as e:
+            await asyncio.to_thread(publisher.finish, e)
+            raise
+        await asyncio.to_thread(publisher.begin, attempts, None if stream else result)
+        return result, publisher
+    if holder is not None:
+        try:
+            result = await asyncio.to_thread(_follow, key, holder, attempts, stream, deadline)
+            return (_aremote_stream(result) if stream else result), None
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log.info(f"Not following another worker's call ({e}); calling the provider")
+    return await call(), None
+
+async def _aremote_stream(chunks):
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+# --- Flights within a worker ---------------------------------------------------
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+class _Flight:
+    """An upstream call made by this worker and the callers sharing it."""
+
+    def __init__(self, key, stream):
+        self.key = key
+        self.stream = stream
+        self.cond = threading.Condition()
+        self.started = False
+        self.finished = False
+        self.pulling = False
+        self.result = None
+        self.served = []
+        self.error = None
+        self.items = []
+        self.subscribers = 1
+        self.publisher = None
+
+    def _retire(self):
+        with _flights_lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+
+    def begin(self, result, attempts, publisher):
+        with self.cond:
+            self.result = result if self.stream else copy.deepcopy(result)
+            self.served = _served(attempts)
+            self.publisher = publisher
+            self.started = True
+            self.finished = not self.stream
+            self.cond.notify_all()
+        if not self.stream:
+            self._retire()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.started = self.finished = True
+            self.cond.notify_all()
+        self._retire()
+
+    def wait_started(self, deadline):
+        with self.cond:
+            while not self.started:
+                self.cond.wait(deadline.remaining() if deadline is not None else None)
+                if deadline is not None and not self.started:
+                    deadline.check()
+
+    def _finish(self, error=None):
+        with self.cond:
+            self.finished = True
+            self.error = error
+        self._retire()
+        _close(self.result)
+        if self.publisher is not None:
+            self.publisher.finish(error)
+
+    def pull(self):
+        """Reads the next upstream chunk into the buffer; one caller at a time."""
+        try:
+            item = next(self.result)
+        except StopIteration:
+            self._finish()
+        except Exception as e:
+            self._finish(e)
+        else:
+            if self.publisher is not None:
+                self.publisher.item(item)
+            with self.cond:
+                self.items.append(item)
+        finally:
+            with self.cond:
+                self.pulling = False
+                self.cond.notify_all()
+
+    def leave(self):
+        """Drops a caller; the last one to go closes an unfinished upstream."""
+        with _flights_lock:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and self.started and not self.finished
+            if abandoned and _flights.get(self.key) is self:
+                del _flights[self.key]
+        if abandoned:
+            self._finish(_LeaderFailed("every caller disconnected"))
+
+class _Subscription:
+    """One caller's iterator over a shared stream; close it like an upstream stream."""
+
+    def __init__(self, flight, deadline):
+        self.flight = flight
+        self.deadline = deadline
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self.flight
+        while True:
+            with flight.cond:
+                while self.index >= len(flight.items) and not flight.finished and flight.pulling:
+                    flight.cond.wait(self.deadline.remaining() if self.deadline is not None else None)
+                    if self.deadline is not None:
+                        self.deadline.check()
+                if self.index < len(flight.items):
+                    self.index += 1
+                    return flight.items[self.index - 1]
+                if flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    raise StopIteration
+                flight.pulling = True
+            flight.pull()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flight.leave()
+
+def run_once(key, call, attempts, stream=False, deadline=None):
+    """
+    Returns the result of `call()` (a provider chat completion filling
+    `attempts`), making the call only once for concurrent callers with the
+    same `key`; None disables coalescing.
+
+    Followers get a copy of the leader's response, or for streams their own
+    iterator over the shared chunks, and `attempts` holding only the attempt
+    that served the call. The leader's error is raised in every caller.
+    """
+    if key is None:
+        return call()
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight(key, stream)
+        else:
+            flight.subscribers += 1
+    if leader:
+        try:
+            result, publisher = _start(key, call, attempts, stream, deadline)
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        flight.begin(result, attempts, publisher)
+    else:
+        increment("single_flight_followers", scope="worker")
+        try:
+            flight.wait_started(deadline)
+        except BaseException:
+            flight.leave()
+            raise
+        if flight.result is None:
+            flight.leave()
+            raise flight.error
+        attempts[:] = [dict(a) for a in flight.served]
+    if stream:
+        return _Subscription(flight, deadline)
+    return result if leader else copy.deepcopy(flight.result)
+
+# --- Flights within an event loop (ASGI) ---------------------------------------
+
+_aflights = {}
+
+class _AsyncFlight:
+    """Async counterpart of _Flight, for callers on one event loop."""
+
+    def __init__(self, key, stream):
+        self.key = key
+        self.stream = stream
+        self.started = asyncio.Event()
+        self.finished = False
+        self.pulling = None
+        self.result = None
+        self.served = []
+        self.error = None
+        self.items = []
+        self.subscribers = 1
+        self.publisher = None
+
+    def _retire(self):
+        if _aflights.get(self.key) is self:
+            del _aflights[self.key]
+
+    def begin(self, result, attempts, publisher):
+        self.result = result if self.stream else copy.deepcopy(result)
+        self.served = _served(attempts)
+        self.publisher = publisher
+        self.finished = not self.stream
+        self.started.set()
+        if not self.stream:
+            self._retire()
+
+    def fail(self, error):
+        self.error = error
+        self.finished = True
+        self.started.set()
+        self._retire()
+
+    async def _finish(self, error=None):
+        self.finished = True
+        self.error = error
+        self._retire()
+        await _aclose(self.result)
+        if self.publisher is not None:
+            await asyncio.to_thread(self.publisher.finish, error)
+
+    async def pull(self):
+        """Reads the next upstream chunk into the buffer. Runs as its own task, so
+        a caller that is cancelled while waiting for it does not interrupt it."""
+        try:
+            item = await self.result.__anext__()
+        except StopAsyncIteration:
+            await self._finish()
+        except Exception as e:
+            await self._finish(e)
+        else:
+            if self.publisher is not None:
+                await asyncio.to_thread(self.publisher.item, item)
+            self.items.append(item)
+        finally:
+            self.pulling = None
+
+    async def leave(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and self.started.is_set() and not self.finished:
+            await self._finish(_LeaderFailed("every caller disconnected"))
+
+async def _within(awaitable, deadline):
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(deadline.remaining(), 0.001))
+    except asyncio.TimeoutError:
+        raise _deadline_exceeded(deadline)
+
+class _AsyncSubscription:
+    """Async counterpart of _Subscription."""
+
+    def __init__(self, flight, deadline):
+        self.flight = flight
+        self.deadline = deadline
+        self.index = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.flight
+        while True:
+            if self.index < len(flight.items):
+                self.index += 1
+                return flight.items[self.index - 1]
+            if flight.finished:
+                if flight.error is not None:
+                    raise flight.error
+                raise StopAsyncIteration
+            if flight.pulling is None:
+                flight.pulling = asyncio.ensure_future(flight.pull())
+            await _within(asyncio.shield(flight.pulling), self.deadline)
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            await self.flight.leave()
+
+async def arun_once(key, call, attempts, stream=False, deadline=None):
+    """Async variant of run_once(); `call` is a coroutine function."""
+    if key is None:
+        return await call()
+    flight = _aflights.get(key)
+    leader = flight is None
+    if leader:
+        flight = _aflights[key] = _AsyncFlight(key, stream)
+    else:
+        flight.subscribers += 1
+    if leader:
+        try:
+            result, publisher = await _astart(key, call, attempts, stream, deadline)
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        flight.begin(result, attempts, publisher)
+    else:
+        await asyncio.to_thread(increment, "single_flight_followers", scope="worker")
+        try:
+            await _within(flight.started.wait(), deadline)
+        except BaseException:
+            await flight.leave()
+            raise
+        if flight.result is None:
+            await flight.leave()
+            raise flight.error
+        attempts[:] = [dict(a) for a in flight.served]
+    if stream:
+        return _AsyncSubscription(flight, deadline)
+    return result if leader else copy.deepcopy(flight.result)
@@ -0,0 +1,317 @@
+# app/services/upstream_budget_service.py
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from ..config import Config
+from ..extensions import redis_client
+from .metrics_service import increment, observe, set_gauge
+
+log = logging.getLogger(__name__)
+
+# Rate-limit budgets announced by the upstreams themselves. OpenAI-compatible
+# APIs (and Azure) report what is left of their limits on every response
+# (x-ratelimit-remaining-requests/tokens with the matching reset), and a 429
+# says how long to back off (retry-after, retry-after-ms). The HTTP layer
+# feeds those headers to observe_response(); the latest budget of every
+# upstream key is shared by all workers through Redis (hash
+# "upstream_budget:<upstream>", one JSON field per key id) and read through a
+# short per-worker cache.
+#
+# Before a call the provider manager asks how long the upstream needs to
+# recover: a short wait is slept off, a longer one rejects the call with
+# UpstreamBudgetExhaustedError so failover moves on to another provider,
+# instead of spending a round trip on a certain 429.
+
+class UpstreamBudgetExhaustedError(Exception):
+    """Raised instead of calling an upstream whose announced rate limit is used up."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Upstream '{name}' has used up its rate limit; retry in {retry_after}s.")
+        self.name = name
+        self.retry_after = retry_after
+
+def key_id(api_key):
+    """Short, non-reversible identifier for an API key, used in Redis keys, metrics and logs."""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+def parse_retry_after(headers):
+    """Seconds from a Retry-After header (delta seconds or an HTTP date), or None."""
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def _parse_reset(value, now):
+    """
+    Absolute reset time from a x-ratelimit-reset-* value: a duration such as
+    "1s", "6m0s" or "20ms" (OpenAI), plain seconds, or an epoch timestamp in
+    seconds or milliseconds (OpenRouter).
+    """
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        parts = _DURATION_PART.findall(value)
+        if not parts or "".join(n + u for n, u in parts) != value:
+            return None
+        return now + sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+    if number > 1e12:
+        return number / 1000
+    if number > 1e9:
+        return number
+    return now + number
+
+def _parse_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def parse_budget(headers, status_code=None, now=None):
+    """
+    Budget announced by a response's headers as a dict with any of
+    remaining_requests, limit_requests, requests_reset_at, remaining_tokens,
+    limit_tokens and tokens_reset_at (reset times are epoch seconds). Empty
+    when the upstream sends no rate-limit headers.
+    """
+    now = now if now is not None else time.time()
+    budget = {}
+    for kind in ("requests", "tokens"):
+        remaining = _parse_int(headers.get(f"x-ratelimit-remaining-{kind}"))
+        if remaining is None:
+            continue
+        budget[f"remaining_{kind}"] = remaining
+        limit = _parse_int(headers.get(f"x-ratelimit-limit-{kind}"))
+        if limit is not None:
+            budget[f"limit_{kind}"] = limit
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        reset_at = _parse_reset(reset, now) if reset else None
+        if reset_at is not None:
+            budget[f"{kind}_reset_at"] = reset_at
+    if "remaining_requests" not in budget and headers.get("x-ratelimit-remaining") is not None:
+        remaining = _parse_int(headers.get("x-ratelimit-remaining"))
+        reset = headers.get("x-ratelimit-reset")
+        reset_at = _parse_reset(reset, now) if reset else None
+        if remaining is not None:
+            budget["remaining_requests"] = remaining
+            if reset_at is not None:
+                budget["requests_reset_at"] = reset_at
+    if status_code == 429:
+        retry_after = None
+        if headers.get("retry-after-ms"):
+            try:
+                retry_after = max(0.0, float(headers["retry-after-ms"]) / 1000)
+            except ValueError:
+                pass
+        if retry_after is None:
+            retry_after = parse_retry_after(headers)
+        if retry_after is None:
+            retry_after = Config.UPSTREAM_BUDGET_DEFAULT_BACKOFF
+        budget["remaining_requests"] = 0
+        budget["requests_reset_at"] = max(budget.get("requests_reset_at", 0), now + retry_after)
+    if budget:
+        budget["updated_at"] = now
+    return budget
+
+def request_key_id(request_headers):
+    """Key id of the API key a request was sent with (Authorization bearer or Azure api-key), or "default"."""
+    if request_headers:
+        auth = request_headers.get("Authorization") or request_headers.get("authorization") or ""
+        if auth.lower().startswith("bearer "):
+            return key_id(auth[7:].strip())
+        api_key = request_headers.get("api-key") or request_headers.get("Api-Key")
+        if api_key:
+            return key_id(api_key)
+    return "default"
+
+class _BudgetTracker:
+    """
+    This worker's view of every upstream's budgets, merged with the copies
+    in Redis (the newest observation of a key wins). The remaining budgets
+    are published every BUDGET_METRICS_INTERVAL seconds by a background
+    thread as the gauge upstream_budget_remaining{upstream,key,kind}.
+    """
+
+    BUDGET_METRICS_INTERVAL = 5
+
+    def __init__(self):
+        self._budgets = {}
+        self._read_at = {}
+        self._lock = threading.Lock()
+        self._publisher_pid = None
+
+    def record(self, upstream, key, budget):
+        with self._lock:
+            self._budgets.setdefault(upstream, {})[key] = budget
+        try:
+            resets = [budget.get("requests_reset_at", 0), budget.get("tokens_reset_at", 0)]
+            ttl = max(Config.UPSTREAM_BUDGET_MIN_TTL, math.ceil(max(resets) - time.time()))
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hset(f"upstream_budget:{upstream}", key, json.dumps(budget))
+            pipe.expire(f"upstream_budget:{upstream}", ttl)
+            pipe.execute()
+        except Exception as e:
+            log.debug(f"Failed to share the rate limit budget of {upstream}: {e}")
+        self._ensure_publisher()
+
+    def budgets(self, upstream):
+        """{key id: budget} of `upstream`, refreshed from Redis at most every UPSTREAM_BUDGET_CACHE_SECONDS."""
+        now = time.monotonic()
+        read_at = self._read_at.get(upstream)
+        if read_at is None or now - read_at >= Config.UPSTREAM_BUDGET_CACHE_SECONDS:
+            try:
+                shared = redis_client.hgetall(f"upstream_budget:{upstream}") or {}
+            except Exception as e:
+                log.debug(f"Failed to read the rate limit budget of {upstream}: {e}")
+                shared = {}
+            with self._lock:
+                local = self._budgets.setdefault(upstream, {})
+                for key, value in shared.items():
+                    try:
+                        budget = json.loads(value)
+                    except ValueError:
+                        continue
+                    if budget.get("updated_at", 0) > local.get(key, {}).get("updated_at", 0):
+                        local[key] = budget
+                self._read_at[upstream] = now
+        with self._lock:
+            return dict(self._budgets.get(upstream, {}))
+
+    def snapshot(self):
+        with self._lock:
+            upstreams = list(self._budgets)
+        return {upstream: self.budgets(upstream) for upstream in upstreams}
+
+    def reset(self):
+        with self._lock:
+            self._budgets = {}
+            self._read_at = {}
+            self._publisher_pid = None
+
+    def _ensure_publisher(self):
+        with self._lock:
+            if self._publisher_pid == os.getpid():
+                return
+            self._publisher_pid = os.getpid()
+        threading.Thread(target=self._publish, daemon=True).start()
+
+    def _publish(self):
+        pid = os.getpid()
+        while self._publisher_pid == pid:
+            time.sleep(self.BUDGET_METRICS_INTERVAL)
+            for upstream, budgets in self.snapshot().items():
+                for key, budget in budgets.items():
+                    for kind in ("requests", "tokens"):
+                        if f"remaining_{kind}" in budget:
+                            set_gauge("upstream_budget_remaining", budget[f"remaining_{kind}"],
+                                      upstream=upstream, key=key, kind=kind)
+
+budget_tracker = _BudgetTracker()
+
+def observe_response(upstream, headers, status_code=None, request_headers=None):
+    """Records the rate-limit budget announced by an upstream response. Never raises."""
+    if not Config.UPSTREAM_BUDGET_ENABLED:
+        return
+    try:
+        budget = parse_budget(headers, status_code)
+        if budget:
+            budget_tracker.record(upstream, request_key_id(request_headers), budget)
+    except Exception as e:
+        log.debug(f"Failed to parse rate limit headers from {upstream}: {e}")
+
+def _key_wait(budget, now):
+    """Seconds until a key's exhausted budget resets, 0 when it has room."""
+    wait = 0.0
+    reserves = {"requests": Config.UPSTREAM_BUDGET_RESERVE_REQUESTS, "tokens": Config.UPSTREAM_BUDGET_RESERVE_TOKENS}
+    for kind, reserve in reserves.items():
+        remaining = budget.get(f"remaining_{kind}")
+        reset_at = budget.get(f"{kind}_reset_at")
+        if remaining is not None and reset_at is not None and remaining <= reserve and reset_at > now:
+            wait = max(wait, reset_at - now)
+    return wait
+
+def key_budget_waits(upstream):
+    """{key id: seconds until the key has budget again} for the keys of `upstream` that are used up."""
+    if not Config.UPSTREAM_BUDGET_ENABLED:
+        return {}
+    now = time.time()
+    waits = {key: _key_wait(budget, now) for key, budget in budget_tracker.budgets(upstream).items()}
+    return {key: wait for key, wait in waits.items() if wait > 0}
+
+def budget_wait(upstream):
+    """
+    Seconds until `upstream` has budget again: 0 while any of its known keys
+    has room (or nothing is known), otherwise the soonest reset.
+    """
+    if not Config.UPSTREAM_BUDGET_ENABLED:
+        return 0.0
+    now = time.time()
+    budgets = budget_tracker.budgets(upstream)
+    if not budgets:
+        return 0.0
+    return min(_key_wait(budget, now) for budget in budgets.values())
+
+def _admit(upstream, deadline):
+    """Returns the seconds to wait before calling `upstream`, or raises UpstreamBudgetExhaustedError."""
+    wait = budget_wait(upstream)
+    if wait <= 0:
+        return 0.0
+    max_delay = Config.UPSTREAM_BUDGET_MAX_DELAY
+    if deadline is not None:
+        max_delay = min(max_delay, deadline.remaining())
+    if wait > max_delay:
+        error = UpstreamBudgetExhaustedError(upstream, math.ceil(wait))
+        log.warning(str(error))
+        increment("upstream_budget_rejections", upstream=upstream)
+        raise error
+    observe("upstream_budget_delay_seconds", wait, upstream=upstream)
+    return wait
+
+def wait_for_budget(upstream, deadline=None):
+    """
+    Holds a call to `upstream` until its announced rate limit resets, if that
+    is at most UPSTREAM_BUDGET_MAX_DELAY away (and within the deadline);
+    raises UpstreamBudgetExhaustedError when it is further.
+    """
+    wait = _admit(upstream, deadline)
+    if wait:
+        time.sleep(wait)
+
+async def await_budget(upstream, deadline=None):
+    """Async variant of wait_for_budget()."""
+    wait = await asyncio.to_thread(_admit, upstream, deadline)
+    if wait:
+        await asyncio.sleep(wait)
+
+def get_budget_stats():
+    """Latest known rate-limit budget of every upstream key, with seconds until reset."""
+    now = time.time()
+    stats = {}
+    for upstream, budgets in budget_tracker.snapshot().items():
+        stats[upstream] = {}
+        for key, budget in budgets.items():
+            entry = {k: v for k, v in budget.items() if not k.endswith("_at")}
+            for kind in ("requests", "tokens"):
+                if f"{kind}_reset_at" in budget:
+                    entry[f"{kind}_reset_in"] = max(0.0, round(budget[f"{kind}_reset_at"] - now, 1))
+            entry["wait"] = round(_key_wait(budget, now), 1)
+            stats[upstream][key] = entry
+    return stats
@@ -0,0 +1,344 @@
+# app/services/uptime_service.py
+
+import json
+import logging
+import math
+import os
+import queue
+import random
+import threading
+import time
+from ..config import Config
+from ..extensions import redis_client
+from ..utils.deadline import Deadline
+from .bulkhead_service import BulkheadFullError
+from .metrics_service import increment, observe
+from .provider_stats_service import get_stats
+from .upstream_budget_service import UpstreamBudgetExhaustedError
+
+log = logging.getLogger(__name__)
+
+# Background uptime prober, so /v1/uptime/<model id> never calls an upstream.
+# Every worker runs a scheduler thread that gives each chat model its own
+# jittered UPTIME_PROBE_INTERVAL; when a model is due, the worker takes its
+# probe slot in Redis ("uptime:<model id>:lock", held for the shortest
+# jittered interval) so one worker in the fleet probes it per interval. A
+# probe is a one-token streamed "ping" through the provider manager (same
+# connection pools, bulkheads and circuit breakers as user traffic), closed
+# as soon as the first chunk arrives. Up to UPTIME_PROBE_CONCURRENCY probes
+# of a worker run at once. Results are shared through Redis:
+#   uptime:<model id>          hash: status ("up"/"down"), ttfb, error,
+#                              checked_at, last_up_at
+#   uptime:<model id>:series   sorted set of every result of the last 7 days
+#                              by time, as JSON {"t", "up", "ttfb", "tps", "b"}
+#                              ("tps" is the model's recent throughput on user
+#                              traffic, "b" the ttfb histogram bin)
+#   uptime:<model id>:<window> hash of running totals over the last 1h, 24h
+#                              and 7d: probes "n", "up", "tps_n", "tps_sum"
+#                              and a count per ttfb bin ("b<i>")
+# The totals are kept incrementally: recording a result adds it to each
+# window and subtracts the results that have just aged out of it (those
+# between the window's "cursor" and now - window), so /v1/status reads a few
+# hashes instead of scanning the series. Keys expire when no probe has
+# refreshed them for their window, so a model that is no longer probed reads
+# as "unknown". Reads go through per-worker copies, refreshed every
+# UPTIME_CACHE_SECONDS.
+
+PROBE_MESSAGES = [{"role": "user", "content": "ping"}]
+TICK_SECONDS = 1.0
+WINDOWS = {"1h": 3600, "24h": 24 * 3600, "7d": 7 * 24 * 3600}
+
+# ttfb histogram: bin 0 holds up to TTFB_BIN_BASE seconds, bin i up to
+# TTFB_BIN_BASE * TTFB_BIN_GROWTH ** i. Percentiles are reported as the
+# geometric middle of their bin, so they are within about 12%.
+TTFB_BIN_BASE = 0.01
+TTFB_BIN_GROWTH = 1.25
+TTFB_BINS = 64
+
+# KEYS: series, then one totals hash per window. ARGV: now, sample JSON,
+# series retention, then the window lengths in seconds.
+RECORD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local function apply(key, sample, sign)
+    local s = cjson.decode(sample)
+    redis.call('HINCRBY', key, 'n', sign)
+    if s.up == 1 then
+        redis.call('HINCRBY', key, 'up', sign)
+    end
+    if s.b then
+        redis.call('HINCRBY', key, 'b' .. s.b, sign)
+    end
+    if s.tps then
+        redis.call('HINCRBY', key, 'tps_n', sign)
+        redis.call('HINCRBYFLOAT', key, 'tps_sum', sign * s.tps)
+    end
+end
+for i = 2, #KEYS do
+    local window = tonumber(ARGV[2 + i])
+    local cutoff = now - window
+    local cursor = redis.call('HGET', KEYS[i], 'cursor')
+    if not cursor then
+        -- New or expired totals: rebuild them from the series
+        redis.call('DEL', KEYS[i])
+        for _, sample in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. cutoff, '+inf')) do
+            apply(KEYS[i], sample, 1)
+        end
+    elseif tonumber(cursor) < cutoff then
+        for _, sample in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. cursor, cutoff)) do
+            apply(KEYS[i], sample, -1)
+        end
+    end
+    redis.call('HSET', KEYS[i], 'cursor', cutoff)
+    apply(KEYS[i], ARGV[2], 1)
+    redis.call('EXPIRE', KEYS[i], window)
+end
+redis.call('ZADD', KEYS[1], now, ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[3]))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+_SKIPPED_TYPES = ("image", "audio")
+_REJECTIONS = (BulkheadFullError, UpstreamBudgetExhaustedError)
+
+_app = None
+_prober_pid = None
+_prober_lock = threading.Lock()
+_cache = {}
+_window_cache = {}
+
+def init_uptime_prober(app):
+    """
+    Registers the history script and starts this worker's prober (when
+    UPTIME_PROBE_ENABLED); needs app.provider_manager.
+    """
+    global _app, record_script
+    _app = app
+    with app.app_context():
+        record_script = redis_client.register_script(RECORD_SCRIPT)
+    ensure_prober()
+
+def ensure_prober():
+    """Starts the prober threads once per process, and again in a forked child."""
+    global _prober_pid
+    if not Config.UPTIME_PROBE_ENABLED or _app is None:
+        return
+    with _prober_lock:
+        if _prober_pid == os.getpid():
+            return
+        _prober_pid = os.getpid()
+    threading.Thread(target=_schedule, daemon=True).start()
+
+def probe_models(provider_manager):
+    """The models to probe: UPTIME_PROBE_MODELS, or every registered chat model."""
+    if Config.UPTIME_PROBE_MODELS:
+        return [m for m in Config.UPTIME_PROBE_MODELS if provider_manager.resolve(m)]
+    models = []
+    for provider in provider_manager.providers.values():
+        models += [m["id"] for m in provider.get_models() if m.get("type") not in _SKIPPED_TYPES]
+    return list(dict.fromkeys(models))
+
+def _jittered(seconds):
+    return seconds * random.uniform(1 - Config.UPTIME_PROBE_JITTER, 1 + Config.UPTIME_PROBE_JITTER)
+
+def _schedule():
+    """Hands each model to the probe workers once per jittered interval."""
+    pid = os.getpid()
+    work = queue.Queue()
+    for _ in range(max(1, Config.UPTIME_PROBE_CONCURRENCY)):
+        threading.Thread(target=_probe_worker, args=(work, pid), daemon=True).start()
+    due = {}
+    while _prober_pid == pid:
+        now = time.time()
+        for model_id in probe_models(_app.provider_manager):
+            if model_id not in due:
+                # Spread the first round over an interval instead of probing everything at startup
+                due[model_id] = now + random.uniform(0, Config.UPTIME_PROBE_INTERVAL)
+            elif due[model_id] <= now:
+                due[model_id] = now + _jittered(Config.UPTIME_PROBE_INTERVAL)
+                if _claim(model_id):
+                    work.put(model_id)
+        time.sleep(TICK_SECONDS)
+
+def _claim(model_id):
+    """Takes the model's probe slot for this interval; False when another worker holds it."""
+    hold = Config.UPTIME_PROBE_INTERVAL * (1 - Config.UPTIME_PROBE_JITTER)
+    try:
+        return bool(redis_client.set(f"uptime:{model_id}:lock", os.getpid(), nx=True, px=max(1, int(hold * 1000))))
+    except Exception as e:
+        log.debug(f"Failed to claim the uptime probe of {model_id}: {e}")
+        return False
+
+def _probe_worker(work, pid):
+    while _prober_pid == pid:
+        try:
+            model_id = work.get(timeout=TICK_SECONDS)
+        except queue.Empty:
+            continue
+        try:
+            probe(model_id)
+        except Exception as e:
+            log.warning(f"Uptime probe of {model_id} failed unexpectedly: {e}")
+
+def probe(model_id):
+    """Probes `model_id` once and records the result."""
+    deadline = Deadline.for_model(model_id, Config.UPTIME_PROBE_TIMEOUT)
+    started = time.monotonic()
+    try:
+        with _app.app_context():
+            stream = _app.provider_manager.chat_completion(
+                model_id, PROBE_MESSAGES, stream=True, candidates=[model_id],
+                deadline=deadline, max_tokens=1, app=_app
+            )
+        # chat_completion() returns streams started: the first chunk is in
+        ttfb = time.monotonic() - started
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    except Exception as e:
+        if isinstance(e, _REJECTIONS):
+            # A full bulkhead or a used-up rate limit says nothing about the upstream
+            log.debug(f"Uptime probe of {model_id} skipped: {e}")
+            return
+        record_probe(model_id, False, error=str(e))
+    else:
+        record_probe(model_id, True, ttfb=ttfb)
+
+def _ttfb_bin(ttfb):
+    if ttfb <= TTFB_BIN_BASE:
+        return 0
+    return min(TTFB_BINS - 1, math.ceil(math.log(ttfb / TTFB_BIN_BASE, TTFB_BIN_GROWTH)))
+
+def record_probe(model_id, up, ttfb=None, error=None):
+    """Stores a probe result and adds it to the model's history and window totals."""
+    now = time.time()
+    key = f"uptime:{model_id}"
+    status = {"status": "up" if up else "down", "ttfb": "" if ttfb is None else round(ttfb, 3),
+              "error": (error or "")[:500], "checked_at": round(now, 3)}
+    if up:
+        status["last_up_at"] = round(now, 3)
+    sample = {"t": round(now, 3), "up": 1 if up else 0}
+    if ttfb is not None:
+        sample.update(ttfb=round(ttfb, 3), b=_ttfb_bin(ttfb))
+    tps = get_stats([model_id])[model_id].get("tps")
+    if tps:
+        sample["tps"] = round(tps, 2)
+    retention = max(WINDOWS.values())
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping=status)
+        pipe.expire(key, max(1, int(Config.UPTIME_PROBE_INTERVAL * 3)))
+        pipe.execute()
+        record_script(
+            keys=[f"{key}:series", *(f"{key}:{name}" for name in WINDOWS)],
+            args=[now, json.dumps(sample, separators=(",", ":")), retention, *WINDOWS.values()],
+            client=redis_client
+        )
+    except Exception as e:
+        log.debug(f"Failed to record the uptime of {model_id}: {e}")
+    increment("uptime_probes", model=model_id, status=status["status"])
+    if ttfb is not None:
+        observe("uptime_probe_ttfb_seconds", ttfb, model=model_id)
+
+def _history_entry(sample):
+    sample = json.loads(sample)
+    return {"t": sample["t"], "up": bool(sample["up"]), "ttfb": sample.get("ttfb")}
+
+def get_uptime(model_ids):
+    """
+    Returns {model id: last probe result} for the given models, cached per
+    worker. A result has "status" ("up", "down" or "unknown" when there is
+    no recent probe), "ttfb", "error", "checked_at", "last_up_at" and
+    "history" (the last UPTIME_HISTORY results, newest first).
+    """
+    ensure_prober()
+    now = time.monotonic()
+    missing = [m for m in model_ids if m not in _cache or now - _cache[m][0] > Config.UPTIME_CACHE_SECONDS]
+    if missing:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for model_id in missing:
+                pipe.hgetall(f"uptime:{model_id}")
+                pipe.zrevrange(f"uptime:{model_id}:series", 0, Config.UPTIME_HISTORY - 1)
+            results = pipe.execute()
+            for model_id, status, history in zip(missing, results[::2], results[1::2]):
+                _cache[model_id] = (now, {
+                    "status": status.get("status", "unknown"),
+                    "ttfb": float(status["ttfb"]) if status.get("ttfb") else None,
+                    "error": status.get("error") or None,
+                    "checked_at": float(status["checked_at"]) if status.get("checked_at") else None,
+                    "last_up_at": float(status["last_up_at"]) if status.get("last_up_at") else None,
+                    "history": [_history_entry(entry) for entry in history],
+                })
+        except Exception as e:
+            log.debug(f"Failed to read uptime: {e}")
+            for model_id in missing:
+                _cache.setdefault(model_id, (now, {"status": "unknown", "history": []}))
+    return {m: _cache[m][1] for m in model_ids}
+
+def _percentile(bins, count, fraction):
+    """ttfb at the given fraction of `count` samples, from the histogram bins."""
+    seen = 0
+    for i in range(TTFB_BINS):
+        seen += bins.get(i, 0)
+        if seen >= fraction * count:
+            return round(TTFB_BIN_BASE * TTFB_BIN_GROWTH ** max(0, i - 0.5), 3)
+    return None
+
+def _summary(totals):
+    """Uptime and latency of one window from its running totals, or None without probes."""
+    probes = int(float(totals.get("n", 0)))
+    if probes <= 0:
+        return None
+    bins = {int(field[1:]): int(float(v)) for field, v in totals.items() if field.startswith("b")}
+    timed = sum(bins.values())
+    tps_n = int(float(totals.get("tps_n", 0)))
+    return {
+        "probes": probes,
+        "uptime": round(100.0 * int(float(totals.get("up", 0))) / probes, 2),
+        "ttfb_p50": _percentile(bins, timed, 0.5) if timed else None,
+        "ttfb_p90": _percentile(bins, timed, 0.9) if timed else None,
+        "ttfb_p99": _percentile(bins, timed, 0.99) if timed else None,
+        "tps": round(float(totals.get("tps_sum", 0)) / tps_n, 2) if tps_n > 0 else None,
+    }
+
+def get_window_stats(model_ids):
+    """
+    Returns {model id: {window name: summary or None}} over the 1h, 24h and
+    7d windows, cached per worker. A summary has "probes", "uptime" (percent
+    of probes that succeeded), "ttfb_p50", "ttfb_p90", "ttfb_p99" (seconds)
+    and "tps" (average recent throughput on user traffic).
+    """
+    now = time.monotonic()
+    missing = [m for m in model_ids if m not in _window_cache or now - _window_cache[m][0] > Config.UPTIME_CACHE_SECONDS]
+    if missing:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for model_id in missing:
+                for name in WINDOWS:
+                    pipe.hgetall(f"uptime:{model_id}:{name}")
+            results = iter(pipe.execute())
+            for model_id in missing:
+                _window_cache[model_id] = (now, {name: _summary(next(results)) for name in WINDOWS})
+        except Exception as e:
+            log.debug(f"Failed to read uptime history: {e}")
+            for model_id in missing:
+                _window_cache.setdefault(model_id, (now, {name: None for name in WINDOWS}))
+    return {m: _window_cache[m][1] for m in model_ids}
+
+def demote_degraded(model_ids):
+    """
+    Moves the models whose uptime over the last hour is below
+    UPTIME_DEMOTE_BELOW percent (with at least UPTIME_DEMOTE_MIN_PROBES
+    probes in it) behind the others, keeping the order otherwise.
+    """
+    if not Config.UPTIME_PROBE_ENABLED or len(model_ids) < 2:
+        return list(model_ids)
+    stats = get_window_stats(model_ids)
+
+    def degraded(model_id):
+        hour = stats[model_id]["1h"]
+        return hour is not None and hour["probes"] >= Config.UPTIME_DEMOTE_MIN_PROBES and hour["uptime"] < Config.UPTIME_DEMOTE_BELOW
+
+    flags = {m: degraded(m) for m in model_ids}
+    return [m for m in model_ids if not flags[m]] + [m for m in model_ids if flags[m]]
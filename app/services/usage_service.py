@@ -8,24 +8,30 @@ from ..config import Config
 
 log = logging.getLogger(__name__)
 
-def record_request(user_id, api_key, model_id, prompt_tokens, completion_tokens, response_data):
+def model_cost_per_million(model_id):
+    """The owner's cost per million tokens of a model (0 when not priced)."""
+    for model in Config.ALLOWED_MODELS:
+        if model['id'] == model_id:
+            return model.get('owner_cost_per_million_tokens') or 0
+    return 0
+
+def record_request(user_id, api_key, model_id, prompt_tokens, completion_tokens, response_data, cached=False):
     """
     Records a successful API request by updating:
       1. API Metrics table (Usage) for (api_key, model)
       2. Global Model Usage table (one row per model)
       3. Total API Usage table (singleton row)
       4. The corresponding user's usage record
+
+    A request answered from the response cache (`cached`) counts as a request
+    with its tokens but costs nothing, since no upstream was called.
     """
     try:
         now = datetime.utcnow()
         total_tokens = prompt_tokens + completion_tokens
 
         # Determine cost per million tokens for the model.
-        cost_per_million = 0
-        for model in Config.ALLOWED_MODELS:
-            if model['id'] == model_id:
-                cost_per_million = model.get('owner_cost_per_million_tokens', 0)
-                break
+        cost_per_million = 0 if cached else model_cost_per_million(model_id)
         cost = (Decimal(total_tokens) / Decimal(1000000)) * Decimal(cost_per_million)
 
         # 1. Update API Metrics table (Usage)
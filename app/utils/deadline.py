@@ -0,0 +1,126 @@
+# app/utils/deadline.py
+
+import socket
+import time
+import httpx
+import openai
+import requests
+from urllib3.exceptions import ConnectTimeoutError, ReadTimeoutError
+from ..config import Config
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of its end-to-end time budget."""
+    pass
+
+# Exception types that mean "the upstream took too long", whichever client raised them.
+TIMEOUT_EXCEPTIONS = (
+    DeadlineExceeded,
+    requests.exceptions.Timeout,
+    ReadTimeoutError,
+    ConnectTimeoutError,
+    socket.timeout,
+    httpx.TimeoutException,
+    openai.APITimeoutError,
+)
+
+def is_timeout_error(exc):
+    """
+    Returns True if `exc` (or anything it wraps) is a timeout.
+
+    Providers often re-raise upstream errors as a plain Exception, so the
+    __cause__/__context__ chain and the exception arguments are inspected too.
+    """
+    seen = set()
+    stack = [exc]
+    while stack:
+        current = stack.pop()
+        if current is None or id(current) in seen:
+            continue
+        seen.add(id(current))
+        if isinstance(current, TIMEOUT_EXCEPTIONS):
+            return True
+        stack.extend([current.__cause__, current.__context__])
+        stack.extend(arg for arg in getattr(current, "args", ()) if isinstance(arg, BaseException))
+    return False
+
+class Deadline:
+    """
+    End-to-end time budget for a single API request.
+
+    Created once per request (defaults come from the model registry, clients
+    may override the total with the X-Request-Timeout header) and passed down
+    to the provider, which derives its connect / first-byte / inter-chunk
+    timeouts from it. Every derived timeout is capped by the time remaining.
+
+    The total bounds a non-streaming request end to end, but a stream only up
+    to its first chunk: every chunk received (see chunk_received()) resets
+    the deadline to the inter-chunk timeout, so a long answer keeps going for
+    as long as the upstream keeps sending.
+    """
+
+    def __init__(self, total, connect_timeout, first_byte_timeout, chunk_timeout):
+        self.total = total
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.chunk_timeout = chunk_timeout
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + total
+
+    @classmethod
+    def for_model(cls, model_id, requested_total=None):
+        """
+        Builds a deadline from the model's configured timeouts.
+
+        `requested_total` (e.g. from the X-Request-Timeout header) overrides the
+        total budget but is clamped to MAX_REQUEST_TIMEOUT so a request can
+        never outlive the gunicorn worker timeout.
+        """
+        timeouts = Config.get_model_timeouts(model_id)
+        total = timeouts["request_timeout"]
+        if requested_total is not None:
+            try:
+                total = float(requested_total)
+            except (TypeError, ValueError):
+                pass
+        total = max(1.0, min(total, Config.MAX_REQUEST_TIMEOUT))
+        return cls(total, timeouts["connect_timeout"], timeouts["first_byte_timeout"], timeouts["chunk_timeout"])
+
+    def chunk_received(self):
+        """Restarts the budget as the inter-chunk timeout once a stream chunk has arrived."""
+        self.expires_at = time.monotonic() + self.chunk_timeout
+
+    def remaining(self):
+        """Seconds left before the deadline (never negative)."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        """Raises DeadlineExceeded if the budget has been used up."""
+        if self.expired():
+            raise DeadlineExceeded(f"Request deadline of {self.total:.0f}s exceeded")
+
+    def _cap(self, seconds):
+        self.check()
+        return min(seconds, self.remaining())
+
+    def timeout(self):
+        """(connect, read) timeout tuple for requests, read covering the first byte."""
+        return (self._cap(self.connect_timeout), self._cap(self.first_byte_timeout))
+
+    def first_byte_read_timeout(self):
+        return self._cap(self.first_byte_timeout)
+
+    def chunk_read_timeout(self):
+        return self._cap(self.chunk_timeout)
+
+    def sdk_timeout(self):
+        """httpx.Timeout for the OpenAI / Azure SDK clients."""
+        return httpx.Timeout(
+            self._cap(self.first_byte_timeout),
+            connect=self._cap(self.connect_timeout)
+        )
@@ -1,106 +1,373 @@
 # app/utils/streaming.py
 
 from flask import Response, current_app
+import anyio
+import asyncio
+import inspect
 import json
 import logging
+import queue
+import threading
+import time
 from ..services.usage_service import record_request
+from ..services.quota_service import settle_quota, release_quota
+from ..services.metrics_service import increment
+from ..services.provider_stats_service import record_throughput
 from ..utils.token_counter import count_tokens
+from ..utils.deadline import is_timeout_error
 
 log = logging.getLogger(__name__)
 
-def generate_stream(response_generator, user_id, api_key, model_id, app, messages):
+# Sentinel placed on the coalescing queue once the frame generator is exhausted.
+_STREAM_END = object()
+
+def close_upstream(response_generator):
+    """
+    Closes an upstream stream so its connection is released immediately.
+
+    Works for provider generators (closing runs their cleanup) and for OpenAI
+    SDK Stream objects (closing shuts the underlying HTTP response).
+    """
+    close = getattr(response_generator, "close", None)
+    if close is None:
+        return
+    try:
+        close()
+    except ValueError:
+        # A generator still being read by the coalescing reader thread (see
+        # coalesce_frames()); the reader closes it once its read returns.
+        log.debug("Upstream stream is being read in another thread; left to the reader to close")
+    except Exception as e:
+        log.warning(f"Error closing upstream stream: {e}")
+
+async def aclose_upstream(response_stream):
+    """Async counterpart of close_upstream() for async upstream iterators."""
+    close = getattr(response_stream, "aclose", None) or getattr(response_stream, "close", None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        log.warning(f"Error closing upstream stream: {e}")
+
+def process_chunk(chunk):
+    """
+    Converts one upstream chunk into the SSE frame sent to the client.
+
+    Chunks may be SDK models, JSON strings/bytes or dicts. Returns a tuple
+    (frame, content, done): the frame to send (None to skip the chunk), the
+    assistant text it carries and whether the stream should end after it.
+    """
+    try:
+        # Determine chunk_data from various possible types.
+        if hasattr(chunk, 'model_dump'):
+            chunk_data = chunk.model_dump()
+        elif isinstance(chunk, (str, bytes, bytearray)):
+            try:
+                chunk_data = json.loads(chunk)
+            except json.JSONDecodeError as e:
+                log.error(f"JSON parsing error in chunk: {e}")
+                return f"data: {json.dumps({'error': 'Invalid JSON in chunk.'})}\n\n", "", True
+        elif isinstance(chunk, dict):
+            chunk_data = chunk
+        else:
+            log.error(f"Unexpected chunk type: {type(chunk)}. Skipping.")
+            return None, "", False
+
+        # Check if chunk_data is a termination signal.
+        if isinstance(chunk_data, str) and chunk_data.strip() == "[DONE]":
+            return None, "", True
+
+        # Remove any 'usage' key to avoid premature usage logging.
+        if isinstance(chunk_data, dict) and "usage" in chunk_data:
+            chunk_data.pop("usage", None)
+
+        # If there is content in the delta field, pass it back for accumulation.
+        content = ""
+        if isinstance(chunk_data, dict) and 'choices' in chunk_data:
+            choices = chunk_data.get('choices', [])
+            if choices and isinstance(choices, list) and len(choices) > 0:
+                delta = choices[0].get("delta", {})
+                if isinstance(delta, dict):
+                    content = delta.get("content", "") or ""
+
+        return f"data: {json.dumps(chunk_data)}\n\n", content, False
+
+    except Exception as e:
+        log.error(f"Error processing chunk: {e}", exc_info=True)
+        return f"data: {json.dumps({'error': 'Error processing chunk.'})}\n\n", "", True
+
+def coalesce_frames(frames, max_bytes, max_delay, upstream=None):
+    """
+    Batches consecutive SSE frames into a single write.
+
+    The frame generator is driven from a reader thread (a greenlet under gevent)
+    so that a pending batch is flushed after `max_delay` seconds even when the
+    upstream goes quiet. A batch is flushed early once it reaches `max_bytes`.
+    The very first frame is always sent on its own to keep time-to-first-token
+    unchanged.
+
+    When the client disconnects `upstream` (the stream the frames are built
+    from) is closed right away from this side, which interrupts a reader
+    blocked on a stalled upstream; the reader then stops and closes the frame
+    generator.
+    """
+    frame_queue = queue.Queue(maxsize=256)
+    stop = threading.Event()
+
+    def put(item):
+        # Never block forever on a full queue once the client has gone away.
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def reader():
+        try:
+            for frame in frames:
+                if stop.is_set():
+                    break
+                put(frame)
+        finally:
+            frames.close()
+            put(_STREAM_END)
+
+    threading.Thread(target=reader, daemon=True).start()
+
+    try:
+        first = frame_queue.get()
+        if first is _STREAM_END:
+            return
+        yield first
+
+        while True:
+            item = frame_queue.get()
+            if item is _STREAM_END:
+                return
+            batch = [item]
+            size = len(item)
+            flush_at = time.monotonic() + max_delay
+            finished = False
+            while size < max_bytes:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = frame_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STREAM_END:
+                    finished = True
+                    break
+                batch.append(item)
+                size += len(item)
+            yield "".join(batch)
+            if finished:
+                return
+    finally:
+        stop.set()
+        if upstream is not None:
+            close_upstream(upstream)
+
+def generate_stream(response_generator, user_id, api_key, model_id, app, messages, coalesce=None, deadline=None,
+                    on_complete=None, quota=None):
     """
     Handles streaming responses with a single application context,
     accumulates the assistant's text to count tokens once after the stream,
     and records usage only at the end.
+
+    If `coalesce` is given (a dict with "max_bytes" and "max_delay" in seconds),
+    frames are batched into fewer socket writes via coalesce_frames().
+
+    If `deadline` is given every chunk restarts it as the inter-chunk timeout
+    (see Deadline.chunk_received()), so the stream is cut off only when the
+    upstream stalls; usage is still recorded for the text delivered up to
+    that point.
+
+    `on_complete(text, completion_tokens)` is called (inside the app context)
+    once a stream has finished normally, e.g. to cache its result.
+
+    A `quota` reservation (see reserve_quota()) is settled with the recorded
+    usage, or released if the connection closes before any upstream chunk
+    was read.
     """
     # Get initial token count for the prompt messages
     prompt_tokens = count_tokens(messages, model_id, app)
+    # Set once an upstream chunk has been read: from then on the stream
+    # settles the reservation itself, possibly after the connection has closed
+    # (with coalescing the frames are read by another thread).
+    upstream_read = threading.Event()
     
     def event_stream():
         accumulated_text = ""
+        usage_recorded = False
+        started = time.monotonic()
+
+        def record_usage():
+            # Records usage for whatever text has been produced so far.
+            completion_tokens = count_tokens(
+                [{"role": "assistant", "content": accumulated_text}],
+                model_id,
+                app
+            )
+            record_request(
+                user_id,
+                api_key,
+                model_id,
+                prompt_tokens,
+                completion_tokens,
+                {"choices": [{"message": {"content": accumulated_text}}]}
+            )
+            settle_quota(quota, model_id, prompt_tokens, completion_tokens)
+            return completion_tokens
+
         try:
             # Open a single app context for the entire stream processing.
             with app.app_context():
                 for chunk in response_generator:
-                    try:
-                        # Determine chunk_data from various possible types.
-                        if hasattr(chunk, 'model_dump'):
-                            chunk_data = chunk.model_dump()
-                        elif isinstance(chunk, (str, bytes, bytearray)):
-                            try:
-                                chunk_data = json.loads(chunk)
-                            except json.JSONDecodeError as e:
-                                log.error(f"JSON parsing error in chunk: {e}")
-                                yield f"data: {json.dumps({'error': 'Invalid JSON in chunk.'})}\n\n"
-                                break
-                        elif isinstance(chunk, dict):
-                            chunk_data = chunk
-                        else:
-                            log.error(f"Unexpected chunk type: {type(chunk)}. Skipping.")
-                            continue
-
-                        # Check if chunk_data is a termination signal.
-                        if isinstance(chunk_data, str) and chunk_data.strip() == "[DONE]":
-                            break
-                        
-                        # Remove any 'usage' key to avoid premature usage logging.
-                        if isinstance(chunk_data, dict) and "usage" in chunk_data:
-                            chunk_data.pop("usage", None)
-
-                        # If there is content in the delta field, accumulate it.
-                        if isinstance(chunk_data, dict) and 'choices' in chunk_data:
-                            choices = chunk_data.get('choices', [])
-                            if choices and isinstance(choices, list) and len(choices) > 0:
-                                delta = choices[0].get("delta", {})
-                                if isinstance(delta, dict):
-                                    content = delta.get("content", "")
-                                    if content:
-                                        accumulated_text += content
-                                        
+                    upstream_read.set()
+                    if deadline is not None:
+                        deadline.chunk_received()
+                    frame, content, done = process_chunk(chunk)
+                    accumulated_text += content
+                    if frame:
                         # Yield the processed chunk to the client.
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                        
-                    except Exception as e:
-                        log.error(f"Error processing chunk: {e}", exc_info=True)
-                        yield f"data: {json.dumps({'error': 'Error processing chunk.'})}\n\n"
+                        yield frame
+                    if done:
                         break
 
-                # Once all chunks are processed, count tokens on the final accumulated text.
-                final_completion_tokens = count_tokens(
-                    [{"role": "assistant", "content": accumulated_text}],
-                    model_id,
-                    app
-                )
-                # Record the complete request usage only once.
-                record_request(
-                    user_id,
-                    api_key,
-                    model_id,
-                    prompt_tokens,
-                    final_completion_tokens,
-                    {"choices": [{"message": {"content": accumulated_text}}]}
-                )
+                # Once all chunks are processed, record the complete request usage only once.
+                completion_tokens = record_usage()
+                usage_recorded = True
+                record_throughput(model_id, completion_tokens, time.monotonic() - started)
+                if on_complete is not None:
+                    on_complete(accumulated_text, completion_tokens)
                 # Signal the end of streaming.
                 yield "data: [DONE]\n\n"
-                
+
+        except GeneratorExit:
+            # The client disconnected mid-stream. The upstream is closed in the
+            # finally block below so it stops generating (and billing); record
+            # usage for what was delivered up to this point. Once usage is
+            # recorded the stream has finished, and only the final [DONE] frame
+            # was left to send.
+            if not usage_recorded:
+                log.info(f"Client disconnected from {model_id} stream after {len(accumulated_text)} characters")
+                increment("stream_client_disconnects", model=model_id)
+                with app.app_context():
+                    record_usage()
+            raise
         except Exception as e:
-            log.error(f"Error in stream generation: {e}", exc_info=True)
             with app.app_context():
                 # In case of error, record usage with what we have so far.
-                current_token_count = count_tokens(
-                    [{"role": "assistant", "content": accumulated_text}],
-                    model_id,
-                    app
-                )
-                record_request(
-                    user_id,
-                    api_key,
-                    model_id,
-                    prompt_tokens,
-                    current_token_count,
-                    {"choices": [{"message": {"content": accumulated_text}}]}
-                )
-            yield f"data: {json.dumps({'error': 'An error occurred during streaming.'})}\n\n"
+                record_usage()
+            if is_timeout_error(e):
+                log.warning(f"Stream for {model_id} timed out: {e}")
+                yield f"data: {json.dumps({'error': 'Upstream provider timed out.', 'status_code': 504})}\n\n"
+            else:
+                log.error(f"Error in stream generation: {e}", exc_info=True)
+                yield f"data: {json.dumps({'error': 'An error occurred during streaming.'})}\n\n"
+        finally:
+            close_upstream(response_generator)
+    
     
-    return Response(event_stream(), mimetype='text/event-stream')
\ No newline at end of file
+    stream = event_stream()
+    if coalesce:
+        stream = coalesce_frames(stream, coalesce["max_bytes"], coalesce["max_delay"], upstream=response_generator)
+    response = Response(stream, mimetype='text/event-stream')
+    # Safety net for clients that disconnect before the first frame is pulled,
+    # in which case the generators above never run their cleanup.
+    response.call_on_close(lambda: close_upstream(response_generator))
+
+    def release_unused_quota():
+        if not upstream_read.is_set():
+            release_quota(quota)
+
+    response.call_on_close(release_unused_quota)
+    return response
+
+async def agenerate_stream(response_stream, user_id, api_key, model_id, app, prompt_tokens, deadline=None,
+                           on_complete=None, quota=None):
+    """
+    Async counterpart of generate_stream() used by the ASGI handlers.
+
+    Yields SSE frames from an async upstream iterator. Token counting and the
+    usage write run in the default thread pool so the event loop keeps serving
+    other streams. A client disconnect arrives as a cancellation; the cleanup
+    (partial usage, closing the upstream) is shielded from it so it still runs.
+    """
+    accumulated_text = ""
+    usage_recorded = False
+    disconnected = False
+    started = time.monotonic()
+
+    def record_usage():
+        # Records usage for whatever text has been produced so far.
+        with app.app_context():
+            completion_tokens = count_tokens(
+                [{"role": "assistant", "content": accumulated_text}],
+                model_id,
+                app
+            )
+            record_request(
+                user_id,
+                api_key,
+                model_id,
+                prompt_tokens,
+                completion_tokens,
+                {"choices": [{"message": {"content": accumulated_text}}]}
+            )
+            settle_quota(quota, model_id, prompt_tokens, completion_tokens)
+            return completion_tokens
+
+    async def record_usage_once(completed=False):
+        # Shielded so a cancellation cannot interrupt (and later repeat) the write.
+        nonlocal usage_recorded
+        if usage_recorded:
+            return
+        usage_recorded = True
+        with anyio.CancelScope(shield=True):
+            completion_tokens = await asyncio.to_thread(record_usage)
+            if completed:
+                await asyncio.to_thread(record_throughput, model_id, completion_tokens, time.monotonic() - started)
+                if on_complete is not None:
+                    await asyncio.to_thread(on_complete, accumulated_text, completion_tokens)
+
+    try:
+        async for chunk in response_stream:
+            if deadline is not None:
+                deadline.chunk_received()
+            frame, content, done = process_chunk(chunk)
+            accumulated_text += content
+            if frame:
+                yield frame
+            if done:
+                break
+
+        await record_usage_once(completed=True)
+        yield "data: [DONE]\n\n"
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # Not a disconnect once usage is recorded: only [DONE] was left to send.
+        if not usage_recorded:
+            log.info(f"Client disconnected from {model_id} stream after {len(accumulated_text)} characters")
+            disconnected = True
+        raise
+    except Exception as e:
+        await record_usage_once()
+        if is_timeout_error(e):
+            log.warning(f"Stream for {model_id} timed out: {e}")
+            yield f"data: {json.dumps({'error': 'Upstream provider timed out.', 'status_code': 504})}\n\n"
+        else:
+            log.error(f"Error in stream generation: {e}", exc_info=True)
+            yield f"data: {json.dumps({'error': 'An error occurred during streaming.'})}\n\n"
+    finally:
+        with anyio.CancelScope(shield=True):
+            await aclose_upstream(response_stream)
+            await record_usage_once()
+            if disconnected:
+                await asyncio.to_thread(increment, "stream_client_disconnects", model=model_id)
@@ -0,0 +1,13 @@
+# asgi.py
+#
+# Alternative ASGI entry point, serving the same routes as run.py:
+#   uvicorn asgi:app --host 0.0.0.0 --port 80 --workers 9
+
+from app.asgi import create_asgi_app
+from app.config import Config
+
+app = create_asgi_app(Config)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=80)
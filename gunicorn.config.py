@@ -4,4 +4,9 @@ threads = 2  # Threads per worker
 bind = "0.0.0.0:80"  # Bind to all interfaces on port 5000
 timeout = 300  # Timeout for worker processes
 max_requests = 1000  # Restart worker after handling 1000 requests
-max_requests_jitter = 50  # Add randomness to max_requests to avoid simultaneous restarts
\ No newline at end of file
+max_requests_jitter = 50  # Add randomness to max_requests to avoid simultaneous restarts
+
+def post_fork(server, worker):
+    # Each worker builds its own SDK clients; drop any inherited from the master.
+    from app.providers.sdk_clients import reset_after_fork
+    reset_after_fork()
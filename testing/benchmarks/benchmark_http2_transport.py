@@ -0,0 +1,196 @@
+"""
+benchmark_http2_transport.py
+
+Compares the HTTP/1.1 and HTTP/2 upstream transports of UpstreamHTTPClient.
+
+Two local stub upstreams stream SSE chunks: an HTTP/1.1 server and an h2c
+(HTTP/2 over plain TCP, prior knowledge) server built on the h2 package.
+The same number of concurrent streams is pushed through each transport, and
+the script reports wall time, time to first chunk, TCP connections opened
+on the upstream, and peak in-flight streams per host.
+
+Usage:
+    python testing/benchmarks/benchmark_http2_transport.py --streams 200 --chunks 20 --delay 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import h2.config
+import h2.connection
+import h2.events
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from testing.utils.test_helpers import print_section_header, print_test_case, print_separator
+from app.config import Config
+from app.providers import http_client
+
+def sse_chunk(i):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': f'token{i} '}}]})}\n\n".encode()
+
+class H2StubProtocol(asyncio.Protocol):
+    """h2c server answering every request with a slow SSE stream."""
+
+    def __init__(self, stats, chunks, delay):
+        self.stats = stats
+        self.chunks = chunks
+        self.delay = delay
+        self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        self.in_flight = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats["connections"] += 1
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id))
+            elif isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        self.transport.write(self.conn.data_to_send())
+
+    async def send(self, stream_id, data, end_stream=False):
+        # Respect flow control: wait for the client to open the window.
+        while self.conn.local_flow_control_window(stream_id) < len(data):
+            await asyncio.sleep(0.001)
+        self.conn.send_data(stream_id, data, end_stream=end_stream)
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id):
+        self.in_flight += 1
+        self.stats["peak_streams_per_connection"] = max(self.stats["peak_streams_per_connection"], self.in_flight)
+        try:
+            self.conn.send_headers(stream_id, [(":status", "200"), ("content-type", "text/event-stream")])
+            self.transport.write(self.conn.data_to_send())
+            for i in range(self.chunks):
+                await asyncio.sleep(self.delay)
+                await self.send(stream_id, sse_chunk(i))
+            await self.send(stream_id, b"data: [DONE]\n\n", end_stream=True)
+        finally:
+            self.in_flight -= 1
+
+def start_h2_stub(chunks, delay):
+    stats = {"connections": 0, "peak_streams_per_connection": 0}
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(lambda: H2StubProtocol(stats, chunks, delay), "127.0.0.1", 0)
+    )
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1], stats
+
+def start_http1_stub(chunks, delay):
+    stats = {"connections": 0, "peak_streams_per_connection": 1}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            stats["connections"] += 1
+            super().setup()
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(chunks + 1):
+                time.sleep(delay if i < chunks else 0)
+                data = sse_chunk(i) if i < chunks else b"data: [DONE]\n\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1], stats
+
+def run_streams(client, url, streams):
+    """Runs `streams` concurrent streaming requests; returns timings and peak in-flight counts."""
+    payload = {"model": "stub", "stream": True, "messages": [{"role": "user", "content": "ping"}]}
+    peak = {}
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            for host, versions in http_client.get_stream_counts().items():
+                for version, count in versions.items():
+                    peak[(host, version)] = max(peak.get((host, version), 0), count)
+            time.sleep(0.01)
+
+    def one():
+        started = time.perf_counter()
+        first_chunk = None
+        lines = 0
+        with client.request("POST", url, json=payload, stream=True, timeout=(5, 60)) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    lines += 1
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - started
+        return first_chunk, lines
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        results = list(pool.map(lambda _: one(), range(streams)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    return elapsed, results, peak
+
+def report(name, elapsed, results, peak, stats):
+    first_chunks = sorted(r[0] for r in results if r[0] is not None)
+    print_test_case(name)
+    print(f"Wall time:              {elapsed:.2f}s")
+    print(f"Completed streams:      {len(first_chunks)}/{len(results)} ({results[0][1]} lines each)")
+    print(f"First chunk p50 / p95:  {statistics.median(first_chunks) * 1000:.0f}ms / "
+          f"{first_chunks[int(len(first_chunks) * 0.95) - 1] * 1000:.0f}ms")
+    print(f"Upstream connections:   {stats['connections']}")
+    print(f"Peak streams/connection: {stats['peak_streams_per_connection']}")
+    for (host, version), count in peak.items():
+        print(f"Peak in-flight ({host}, {version}): {count}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200, help="concurrent streams per run")
+    parser.add_argument("--chunks", type=int, default=20, help="SSE chunks per stream")
+    parser.add_argument("--delay", type=float, default=0.05, help="seconds between chunks")
+    args = parser.parse_args()
+
+    print_section_header(f"HTTP/1.1 vs HTTP/2 upstream transport: {args.streams} streams x {args.chunks} chunks")
+
+    # Pool sizes large enough that HTTP/1.1 is not artificially queued.
+    Config.UPSTREAM_POOL_MAXSIZE = args.streams
+    Config.UPSTREAM_HTTP2_PRIOR_KNOWLEDGE = True  # the stub speaks h2c
+
+    http1_port, http1_stats = start_http1_stub(args.chunks, args.delay)
+    client = http_client.UpstreamHTTPClient("benchmark-http1")
+    client.http2 = False
+    report("HTTP/1.1 (requests)", *run_streams(client, f"http://127.0.0.1:{http1_port}/chat/completions", args.streams), http1_stats)
+
+    h2_port, h2_stats = start_h2_stub(args.chunks, args.delay)
+    client = http_client.UpstreamHTTPClient("benchmark-http2")
+    client.http2 = True
+    report("HTTP/2 (httpx, h2c)", *run_streams(client, f"http://127.0.0.1:{h2_port}/chat/completions", args.streams), h2_stats)
+
+    print_separator()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import pytest
+from app.config import Config
+from app.services.bulkhead_service import AdaptiveLimit, BulkheadPermit, _Bulkhead, bulkhead_registry
+
+@pytest.fixture
+def adaptive(monkeypatch):
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_INITIAL", 10)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_MIN", 2)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_BACKOFF", 0.5)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_LATENCY_TOLERANCE", 2.0)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_SMOOTHING", 1.0)
+    yield
+    bulkhead_registry.reset()
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+def test_initial_limit_is_capped_by_the_maximum(adaptive):
+    assert AdaptiveLimit("test", 4).current() == 4
+    assert AdaptiveLimit("test", 50).current() == 10
+
+def test_drops_cut_the_limit_multiplicatively_down_to_the_minimum(adaptive):
+    limit = AdaptiveLimit("test", 50)
+    limit.sample(None, 10, dropped=True)
+    assert limit.current() == 5
+    for _ in range(5):
+        limit.sample(None, 10, dropped=True)
+    assert limit.current() == 2
+
+def test_steady_latency_grows_the_limit_up_to_the_maximum(adaptive):
+    limit = AdaptiveLimit("test", 20)
+    limit.sample(1.0, 10, dropped=False)
+    assert limit.limit == pytest.approx(10 + 10 ** 0.5)
+    for _ in range(10):
+        limit.sample(1.0, 20, dropped=False)
+    assert limit.current() == 20
+
+def test_limit_only_grows_while_half_of_it_is_in_use(adaptive):
+    limit = AdaptiveLimit("test", 50)
+    limit.sample(1.0, 4, dropped=False)
+    assert limit.current() == 10
+
+def test_rising_latency_pulls_the_limit_down(adaptive):
+    limit = AdaptiveLimit("test", 50)
+    for _ in range(20):
+        limit.sample(0.1, 1, dropped=False)
+    for _ in range(5):
+        limit.sample(5.0, 10, dropped=False)
+    assert limit.current() < 10
+
+def test_success_without_a_timing_changes_nothing(adaptive):
+    limit = AdaptiveLimit("test", 50)
+    limit.sample(None, 10, dropped=False)
+    assert limit.limit == 10
+
+def test_permit_feeds_upstream_faults_but_not_request_errors(adaptive):
+    bulkhead = _Bulkhead("stub", 50, 10)
+    BulkheadPermit([bulkhead]).record(0, UpstreamError(400))
+    assert bulkhead.limit() == 10
+    permit = BulkheadPermit([bulkhead])
+    permit.record(0, UpstreamError(503))
+    permit.record(0, UpstreamError(503))
+    assert bulkhead.limit() == 5
@@ -0,0 +1,48 @@
+import pytest
+from starlette.testclient import TestClient
+from app import asgi
+from app.config import Config
+
+@pytest.fixture
+def client(app, redis, api_key, usage, monkeypatch):
+    monkeypatch.setattr(asgi, "create_app", lambda config_class: app)
+    with TestClient(asgi.create_asgi_app(Config), headers={"Authorization": "Bearer test-key"}) as client:
+        yield client
+
+def messages(text="hi"):
+    return [{"role": "user", "content": text}]
+
+def test_chat_completion(client, providers, usage):
+    providers("Stub/a", text="hello from asgi")
+    response = client.post("/v1/chat/completions", json={"model": "Stub/a", "messages": messages()})
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["message"]["content"] == "hello from asgi"
+    assert response.headers["X-RateLimit-Limit"]
+    assert usage == [{"model": "Stub/a", "prompt_tokens": 1, "completion_tokens": 3, "cached": False}]
+
+def test_streamed_chat_completion(client, providers, usage):
+    providers("Stub/a", text="one two three")
+    response = client.post("/v1/chat/completions", json={"model": "Stub/a", "messages": messages(), "stream": True})
+    assert response.status_code == 200
+    frames = [line for line in response.text.split("\n\n") if line]
+    assert len(frames) == 4 and frames[-1] == "data: [DONE]"
+    assert usage[0]["completion_tokens"] == 3
+
+def test_invalid_json_is_rejected(client):
+    response = client.post("/v1/chat/completions", content=b"{not json", headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+
+def test_unknown_model_is_rejected(client, providers):
+    response = client.post("/v1/chat/completions", json={"model": "Nobody/none", "messages": messages()})
+    assert response.status_code == 400
+
+def test_provider_error_is_reported(client, providers, usage):
+    providers("Stub/a", error=RuntimeError("upstream broke"))
+    response = client.post("/v1/chat/completions", json={"model": "Stub/a", "messages": messages()})
+    assert response.status_code == 500
+    assert usage == [{"failed": "Stub/a"}]
+
+def test_other_routes_are_served_by_the_flask_app(client, monkeypatch):
+    monkeypatch.setattr(Config, "SYSTEM_SECRET", "s3cret")
+    assert client.get("/health").json() == {"status": "OK"}
+    assert client.get("/v1/metrics", headers={"X-System-Secret": "s3cret"}).status_code == 200
@@ -0,0 +1,130 @@
+import base64
+import json
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+import pytest
+from app.config import Config
+from app.services.blob_store_service import (
+    Base64Blob, blob_id_from_url, blob_path, collect_garbage, iter_json, json_response, put_blob, put_blob_stream,
+    signed_url, verify
+)
+from .conftest import png
+
+def link(url):
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    return parts.path, query["expires"][0], query["signature"][0]
+
+def test_identical_bytes_are_stored_once(blob_store):
+    blob_id = put_blob(png(b"cat"))
+    assert put_blob(png(b"cat")) == blob_id and blob_id.endswith(".png")
+    assert open(blob_path(blob_id), "rb").read() == png(b"cat")
+    assert put_blob(png(b"dog")) != blob_id
+
+def test_only_well_formed_ids_have_a_path(blob_store):
+    assert blob_path("../../etc/passwd") is None
+    assert blob_path("0" * 32 + ".png").startswith(str(blob_store))
+
+def test_signed_url_verifies_until_it_expires(blob_store, monkeypatch):
+    monkeypatch.setattr(Config, "PUBLIC_BASE_URL", "https://api.example.com")
+    blob_id = put_blob(png(b"cat"))
+    url = signed_url(blob_id)
+    path, expires, signature = link(url)
+    assert url.startswith("https://api.example.com/v1/files/") and path.endswith(blob_id)
+    assert verify(blob_id, expires, signature)
+    assert blob_id_from_url(url) == blob_id
+    assert not verify(blob_id, str(int(time.time()) - 1), signature)
+
+def test_tampered_links_are_rejected(blob_store):
+    blob_id = put_blob(png(b"cat"))
+    _, expires, signature = link(signed_url(blob_id))
+    assert not verify(blob_id, str(int(expires) + 3600), signature)
+    assert not verify(put_blob(png(b"dog")), expires, signature)
+    assert not verify(blob_id, expires, "0" * 32)
+    assert not verify(blob_id, "never", signature)
+    assert blob_id_from_url("https://cdn.example.com/cat.png") is None
+
+def test_links_signed_with_another_secret_are_rejected(blob_store, monkeypatch):
+    blob_id = put_blob(png(b"cat"))
+    _, expires, signature = link(signed_url(blob_id))
+    monkeypatch.setattr(Config, "BLOB_SIGNING_SECRET", "rotated")
+    assert not verify(blob_id, expires, signature)
+
+def test_nothing_is_signed_or_verified_without_a_secret(blob_store, monkeypatch):
+    blob_id = put_blob(png(b"cat"))
+    _, expires, signature = link(signed_url(blob_id))
+    monkeypatch.setattr(Config, "BLOB_SIGNING_SECRET", "")
+    with pytest.raises(RuntimeError):
+        signed_url(blob_id)
+    assert not verify(blob_id, expires, signature)
+
+def test_expired_blobs_are_collected(blob_store):
+    old, fresh = put_blob(png(b"old")), put_blob(png(b"fresh"))
+    past = time.time() - Config.BLOB_URL_TTL - 60
+    os.utime(blob_path(old), (past, past))
+    collect_garbage()
+    assert not os.path.exists(blob_path(old)) and os.path.exists(blob_path(fresh))
+
+def test_files_endpoint_serves_signed_links_only(app, blob_store):
+    client = app.test_client()
+    blob_id = put_blob(png(b"cat"))
+    path, expires, signature = link(signed_url(blob_id))
+    response = client.get(f"{path}?expires={expires}&signature={signature}")
+    assert response.status_code == 200 and response.data == png(b"cat")
+    assert response.mimetype == "image/png"
+    partial = client.get(f"{path}?expires={expires}&signature={signature}", headers={"Range": "bytes=0-3"})
+    assert partial.status_code == 206 and partial.data == png(b"cat")[:4]
+    assert client.get(f"{path}?expires={expires}&signature=forged").status_code == 403
+
+def test_url_images_are_refused_without_a_secret(app, blob_store, image_provider, api_key, monkeypatch):
+    monkeypatch.setattr(Config, "BLOB_SIGNING_SECRET", "")
+    response = app.test_client().post("/v1/images/generations",
+                                      json={"model": "Provider-6/flux-schnell", "prompt": "cat"},
+                                      headers={"Authorization": f"Bearer {api_key}"})
+    assert response.status_code == 400 and "BLOB_SIGNING_SECRET" in response.get_json()["error"]
+    assert image_provider == []
+
+def test_streamed_download_is_stored_chunk_by_chunk(blob_store):
+    data = png(os.urandom(10000))
+    blob_id = put_blob_stream(data[i:i + 1000] for i in range(0, len(data), 1000))
+    assert blob_id == put_blob(data) and blob_id.endswith(".png")
+    assert put_blob_stream([b"RIFF....WEBPVP8 "]).endswith(".webp")
+
+def test_failed_download_leaves_no_file(blob_store):
+    def chunks():
+        yield png(b"partial")
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        put_blob_stream(chunks())
+    assert os.listdir(blob_store / "blobs" / "tmp") == []
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 4096, 4097, 10000])
+def test_base64_is_encoded_in_bounded_chunks(blob_store, monkeypatch, size):
+    monkeypatch.setattr(Config, "BLOB_CHUNK_BYTES", 1000)
+    data = png(os.urandom(size))
+    chunks = list(Base64Blob(put_blob(data)).chunks())
+    assert base64.b64decode("".join(chunks)) == data
+    assert all(len(chunk) <= 1332 for chunk in chunks)
+
+def test_json_text_matches_json_dumps(blob_store, monkeypatch):
+    monkeypatch.setattr(Config, "BLOB_CHUNK_BYTES", 100)
+    first, second = png(os.urandom(500)), png(b"second")
+    body = {"created": 1, "data": [{"b64_json": Base64Blob(put_blob(first))},
+                                   {"b64_json": Base64Blob(put_blob(second)), "revised_prompt": "a \"cat\""}]}
+    parts = list(iter_json(body))
+    assert len(parts) > 5
+    decoded = json.loads("".join(parts))
+    assert [base64.b64decode(item["b64_json"]) for item in decoded["data"]] == [first, second]
+    assert decoded["data"][1]["revised_prompt"] == 'a "cat"'
+
+def test_other_values_are_still_not_serializable():
+    with pytest.raises(TypeError):
+        list(iter_json({"value": object()}))
+
+def test_json_response_is_streamed(app, blob_store):
+    response = json_response({"data": [{"b64_json": Base64Blob(put_blob(png(b"cat")))}]}, headers={"X-Cache": "HIT"})
+    assert response.is_streamed and response.mimetype == "application/json"
+    assert response.headers["X-Cache"] == "HIT"
+    assert base64.b64decode(json.loads(response.get_data())["data"][0]["b64_json"]) == png(b"cat")
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+import pytest
+from app.config import Config
+from app.services.bulkhead_service import (
+    BulkheadFullError, aacquire_bulkheads, acquire_bulkheads, bulkhead_names, bulkhead_registry, get_bulkhead_stats
+)
+
+@pytest.fixture
+def bulkheads(monkeypatch):
+    monkeypatch.setattr(Config, "BULKHEAD_ENABLED", True)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(Config, "BULKHEAD_MAX_CONCURRENT", 1)
+    monkeypatch.setattr(Config, "BULKHEAD_MAX_QUEUE", 1)
+    monkeypatch.setattr(Config, "BULKHEAD_QUEUE_TIMEOUT", 0.1)
+    monkeypatch.setattr(Config, "BULKHEAD_LIMITS", {})
+    bulkhead_registry.reset()
+    yield
+    bulkhead_registry.reset()
+
+def test_disabled_bulkheads_hand_out_empty_permits(monkeypatch):
+    monkeypatch.setattr(Config, "BULKHEAD_ENABLED", False)
+    permit = acquire_bulkheads("stub", "Stub/a")
+    permit.release()
+    assert get_bulkhead_stats() == {}
+
+def test_models_listed_in_the_limits_get_their_own_bulkhead(bulkheads, monkeypatch):
+    assert bulkhead_names("stub", "Stub/a") == ["stub"]
+    monkeypatch.setattr(Config, "BULKHEAD_LIMITS", {"Stub/a": {"max_concurrent": 5}})
+    assert bulkhead_names("stub", "Stub/a") == ["Stub/a", "stub"]
+    acquire_bulkheads("stub", "Stub/a")
+    assert get_bulkhead_stats()["Stub/a"]["max_concurrent"] == 5
+
+def test_call_over_the_limit_times_out_in_the_queue(bulkheads):
+    acquire_bulkheads("stub", "Stub/a")
+    started = time.monotonic()
+    with pytest.raises(BulkheadFullError) as error:
+        acquire_bulkheads("stub", "Stub/a")
+    assert error.value.reason == "queue_timeout"
+    assert time.monotonic() - started >= 0.1
+
+def test_full_queue_rejects_straight_away(bulkheads):
+    acquire_bulkheads("stub", "Stub/a")
+    waiter = threading.Thread(target=lambda: pytest.raises(BulkheadFullError, acquire_bulkheads, "stub", "Stub/a"))
+    waiter.start()
+    time.sleep(0.02)
+    with pytest.raises(BulkheadFullError) as error:
+        acquire_bulkheads("stub", "Stub/a")
+    assert error.value.reason == "queue_full"
+    waiter.join()
+
+def test_released_slot_goes_to_the_queued_call(bulkheads):
+    permit = acquire_bulkheads("stub", "Stub/a")
+    threading.Timer(0.03, permit.release).start()
+    acquire_bulkheads("stub", "Stub/a").release()
+    permit.release()
+    assert get_bulkhead_stats()["stub"]["in_flight"] == 0
+
+def test_deadline_shortens_the_wait(bulkheads, monkeypatch):
+    monkeypatch.setattr(Config, "BULKHEAD_QUEUE_TIMEOUT", 5)
+    acquire_bulkheads("stub", "Stub/a")
+    deadline = type("Deadline", (), {"remaining": lambda self: 0.05})()
+    started = time.monotonic()
+    with pytest.raises(BulkheadFullError):
+        acquire_bulkheads("stub", "Stub/a", deadline)
+    assert time.monotonic() - started < 1
+
+def test_rejection_releases_the_slots_already_taken(bulkheads, monkeypatch):
+    monkeypatch.setattr(Config, "BULKHEAD_LIMITS", {"Stub/a": {"max_concurrent": 5}})
+    acquire_bulkheads("stub", "Stub/b")
+    with pytest.raises(BulkheadFullError):
+        acquire_bulkheads("stub", "Stub/a")
+    assert get_bulkhead_stats()["Stub/a"]["in_flight"] == 0
+
+def test_async_bulkhead_queues_and_rejects(bulkheads):
+    async def run():
+        permit = await aacquire_bulkheads("stub", "Stub/a")
+        with pytest.raises(BulkheadFullError):
+            await aacquire_bulkheads("stub", "Stub/a")
+        asyncio.get_running_loop().call_later(0.03, permit.release)
+        (await aacquire_bulkheads("stub", "Stub/a")).release()
+
+    asyncio.run(run())
+    assert get_bulkhead_stats()["stub"]["in_flight"] == 0
+
+def test_stream_holds_its_slot_until_closed(app, redis, providers, bulkheads):
+    providers("Stub/a", text="one two")
+    stream = app.provider_manager.chat_completion("Stub/a", [{"role": "user", "content": "hi"}], stream=True)
+    assert list(get_bulkhead_stats().values())[0]["in_flight"] == 1
+    list(stream)
+    assert list(get_bulkhead_stats().values())[0]["in_flight"] == 0
+
+def test_full_bulkhead_answers_503_with_retry_after(app, redis, providers, bulkheads, api_key, usage):
+    providers("Stub/a", delay=0.3)
+    client = app.test_client()
+    body = {"model": "Stub/a", "messages": [{"role": "user", "content": "hi"}]}
+    headers = {"Authorization": f"Bearer {api_key}"}
+    threads = [threading.Thread(target=client.post, args=("/v1/chat/completions",),
+                                kwargs={"json": body, "headers": headers}) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    response = client.post("/v1/chat/completions", json=body, headers=headers)
+    for thread in threads:
+        thread.join()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
@@ -0,0 +1,131 @@
+import time
+from contextlib import contextmanager
+import pytest
+from app.config import Config
+from app.providers.base_provider import UpstreamHTTPError
+from app.services.circuit_breaker_service import (
+    CircuitOpenError, allow_call, breaker_names, is_breaker_failure, record_result, release_probes
+)
+
+@pytest.fixture
+def breakers(monkeypatch, redis):
+    monkeypatch.setattr(Config, "CIRCUIT_BREAKER_ENABLED", True)
+    monkeypatch.setattr(Config, "CIRCUIT_MIN_REQUESTS", 4)
+    monkeypatch.setattr(Config, "CIRCUIT_ERROR_RATE", 0.5)
+    monkeypatch.setattr(Config, "CIRCUIT_OPEN_SECONDS", 30)
+    monkeypatch.setattr(Config, "CIRCUIT_HALF_OPEN_PROBES", 1)
+    return redis
+
+def open_breaker(redis, name, opened_at):
+    redis.hset(f"circuit:{name}", mapping={"state": "open", "opened_at": opened_at})
+
+def test_closed_breaker_lets_calls_through(breakers):
+    assert allow_call(["stub"]) == []
+
+def test_breaker_opens_once_the_error_rate_is_reached(breakers):
+    for failed in (False, True, False):
+        record_result(["stub"], failed, 0.1)
+    assert allow_call(["stub"]) == []
+    record_result(["stub"], True, 0.1)
+    with pytest.raises(CircuitOpenError) as error:
+        allow_call(["stub"])
+    assert error.value.name == "stub"
+    assert 0 < error.value.retry_after <= 30
+
+def test_too_few_calls_never_open_the_breaker(breakers):
+    for _ in range(3):
+        record_result(["stub"], True, 0.1)
+    assert allow_call(["stub"]) == []
+
+def test_slow_calls_open_the_breaker(breakers, monkeypatch):
+    monkeypatch.setattr(Config, "CIRCUIT_SLOW_CALL_SECONDS", 1)
+    for _ in range(4):
+        record_result(["stub"], False, 2)
+    with pytest.raises(CircuitOpenError):
+        allow_call(["stub"])
+
+def test_expired_open_breaker_lets_a_single_probe_through(breakers):
+    open_breaker(breakers, "stub", time.time() - 31)
+    assert allow_call(["stub"]) == ["stub"]
+    assert breakers.hget("circuit:stub", "state") == "half_open"
+    with pytest.raises(CircuitOpenError):
+        allow_call(["stub"])
+
+def test_successful_probe_closes_the_breaker(breakers):
+    open_breaker(breakers, "stub", time.time() - 31)
+    probes = allow_call(["stub"])
+    record_result(["stub"], False, 0.1, probes)
+    assert breakers.hget("circuit:stub", "state") == "closed"
+    assert allow_call(["stub"]) == []
+
+def test_failed_probe_reopens_the_breaker(breakers):
+    open_breaker(breakers, "stub", time.time() - 31)
+    probes = allow_call(["stub"])
+    record_result(["stub"], True, 0.1, probes)
+    assert breakers.hget("circuit:stub", "state") == "open"
+    with pytest.raises(CircuitOpenError):
+        allow_call(["stub"])
+
+def test_calls_that_are_not_probes_do_not_decide_a_half_open_breaker(breakers):
+    open_breaker(breakers, "stub", time.time() - 31)
+    allow_call(["stub"])
+    record_result(["stub"], True, 0.1)
+    assert breakers.hget("circuit:stub", "state") == "half_open"
+
+def test_released_probe_frees_its_slot(breakers):
+    open_breaker(breakers, "stub", time.time() - 31)
+    release_probes(allow_call(["stub"]))
+    assert allow_call(["stub"]) == ["stub"]
+
+def test_open_model_breaker_releases_the_provider_probe(breakers):
+    names = breaker_names("stub", "model")
+    open_breaker(breakers, "stub", time.time() - 31)
+    open_breaker(breakers, "stub:model", time.time())
+    with pytest.raises(CircuitOpenError) as error:
+        allow_call(names)
+    assert error.value.name == "stub:model"
+    assert int(breakers.get("circuit:stub:probes") or 0) == 0
+    assert allow_call(["stub"]) == ["stub"]
+
+def test_disabled_breakers_allow_everything(breakers, monkeypatch):
+    open_breaker(breakers, "stub", time.time())
+    monkeypatch.setattr(Config, "CIRCUIT_BREAKER_ENABLED", False)
+    assert allow_call(["stub"]) == []
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+@pytest.mark.parametrize("status, failure", [(500, True), (503, True), (429, True), (408, True),
+                                             (400, False), (404, False)])
+def test_only_upstream_faults_count_against_the_breaker(status, failure):
+    assert is_breaker_failure(UpstreamError(status)) is failure
+
+def test_status_is_found_on_the_cause_chain():
+    try:
+        try:
+            raise UpstreamError(400)
+        except UpstreamError as e:
+            raise Exception("Provider failed") from e
+    except Exception as e:
+        assert is_breaker_failure(e) is False
+
+class Rejected:
+    status_code = 400
+    text = "invalid request"
+
+def test_provider_400_does_not_trip_the_breaker(app, breakers, monkeypatch):
+    provider = app.provider_manager.providers["provider-1"]
+    model_id = provider.get_models()[0]["id"]
+
+    @contextmanager
+    def request(method, url, **kwargs):
+        yield Rejected()
+
+    monkeypatch.setattr(provider.http, "request", request)
+    for _ in range(6):
+        with pytest.raises(UpstreamHTTPError) as error:
+            app.provider_manager.chat_completion(model_id, [{"role": "user", "content": "hi"}])
+        assert error.value.status_code == 400
+    assert allow_call(breaker_names("provider-1", model_id)) == []
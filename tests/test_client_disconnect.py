@@ -0,0 +1,94 @@
+import threading
+from app.utils.streaming import generate_stream
+
+class Upstream:
+    """An upstream stream that records whether it was closed."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+def chunk(text):
+    return {"choices": [{"delta": {"content": text}}]}
+
+def disconnects(redis):
+    return float(redis.hget("metrics:counters", "stream_client_disconnects{model=Provider-5/deepseek-v3}") or 0)
+
+def test_client_disconnect_closes_upstream_and_records_partial_usage(app, redis, usage):
+    upstream = Upstream([chunk("hello "), chunk("world"), chunk("!")])
+    response = generate_stream(upstream, 1, "test-key", "Provider-5/deepseek-v3", app,
+                               [{"role": "user", "content": "hi"}])
+    body = response.response
+    assert "hello" in next(body)
+    body.close()
+    assert upstream.closed
+    assert len(usage) == 1 and usage[0]["completion_tokens"] > 0
+    assert disconnects(redis) == 1
+
+def test_finished_stream_closes_upstream_once_usage_is_recorded(app, redis, usage):
+    upstream = Upstream([chunk("hello")])
+    response = generate_stream(upstream, 1, "test-key", "Provider-5/deepseek-v3", app,
+                               [{"role": "user", "content": "hi"}])
+    frames = list(response.response)
+    assert frames[-1] == "data: [DONE]\n\n"
+    assert upstream.closed
+    assert len(usage) == 1
+
+def test_closing_at_the_done_frame_is_not_a_disconnect(app, redis, usage):
+    upstream = Upstream([chunk("hello")])
+    response = generate_stream(upstream, 1, "test-key", "Provider-5/deepseek-v3", app,
+                               [{"role": "user", "content": "hi"}])
+    body = response.response
+    assert "hello" in next(body)
+    assert next(body) == "data: [DONE]\n\n"
+    body.close()
+    assert len(usage) == 1
+    assert disconnects(redis) == 0
+
+def test_response_closed_before_the_first_frame_closes_upstream(app, redis, usage):
+    upstream = Upstream([chunk("hello")])
+    response = generate_stream(upstream, 1, "test-key", "Provider-5/deepseek-v3", app,
+                               [{"role": "user", "content": "hi"}])
+    response.close()
+    assert upstream.closed
+
+class StalledUpstream:
+    """An upstream that sends one chunk and then stalls until it is closed, like a socket shut down."""
+
+    def __init__(self):
+        self.sent = False
+        self.closed = threading.Event()
+        self.unblocked = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.sent:
+            self.sent = True
+            return chunk("hello")
+        self.closed.wait(5)
+        self.unblocked.set()
+        raise ConnectionError("connection shut down")
+
+    def close(self):
+        self.closed.set()
+
+def test_disconnect_from_a_coalesced_stream_closes_a_stalled_upstream(app, redis, usage):
+    upstream = StalledUpstream()
+    response = generate_stream(upstream, 1, "test-key", "Provider-5/deepseek-v3", app,
+                               [{"role": "user", "content": "hi"}], coalesce={"max_bytes": 1024, "max_delay": 0.01})
+    body = response.response
+    assert "hello" in next(body)
+    body.close()
+    assert upstream.closed.is_set()
+    assert upstream.unblocked.wait(1)
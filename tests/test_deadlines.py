@@ -0,0 +1,81 @@
+import json
+import socket
+import time
+from contextlib import contextmanager
+import pytest
+from app.config import Config
+from app.providers.http_client import UpstreamStream
+from app.providers.provider_1 import Provider1
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.streaming import generate_stream
+
+class FakeResponse:
+    raw = None
+
+    def __init__(self, lines=()):
+        self.status_code = 200
+        self.lines = lines
+
+    def iter_lines(self, decode_unicode=False):
+        for delay, line in self.lines:
+            time.sleep(delay)
+            yield line
+
+    def close(self):
+        pass
+
+def test_check_raises_once_the_total_is_used_up():
+    deadline = Deadline(0.05, 1, 1, 1)
+    deadline.check()
+    time.sleep(0.06)
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+
+def test_chunk_received_restarts_the_budget_as_the_chunk_timeout():
+    deadline = Deadline(0.05, 1, 1, 0.5)
+    time.sleep(0.06)
+    deadline.chunk_received()
+    deadline.check()
+    assert 0.4 < deadline.chunk_read_timeout() <= 0.5
+
+def test_requested_total_is_clamped_to_the_maximum(monkeypatch):
+    monkeypatch.setattr(Config, "MAX_REQUEST_TIMEOUT", 50)
+    assert Deadline.for_model("Provider-5/deepseek-v3", "1000").total == 50
+    assert Deadline.for_model("Provider-5/deepseek-v3", "not a number").total <= 50
+
+def test_stream_outlives_the_total_while_chunks_keep_arriving(app, redis, usage):
+    deadline = Deadline(0.2, 1, 1, 0.3)
+
+    def chunks():
+        for i in range(6):
+            time.sleep(0.1)
+            yield {"choices": [{"delta": {"content": f"word{i} "}}]}
+
+    response = generate_stream(chunks(), 1, "test-key", "Provider-5/deepseek-v3", app,
+                               [{"role": "user", "content": "hi"}], deadline=deadline)
+    frames = list(response.response)
+    assert frames[-1] == "data: [DONE]\n\n"
+    assert usage[0]["completion_tokens"] == 6
+
+def test_stalled_upstream_stream_raises_deadline_exceeded():
+    def chunks():
+        yield "first"
+        raise socket.timeout("timed out")
+
+    stream = UpstreamStream(FakeResponse(), chunks(), Deadline(10, 1, 1, 1))
+    assert next(stream) == "first"
+    with pytest.raises(DeadlineExceeded):
+        next(stream)
+
+def test_provider_1_non_stream_read_is_bounded_by_the_total(monkeypatch):
+    provider = Provider1()
+    line = "data: " + json.dumps({"choices": [{"delta": {"content": "x"}}]})
+
+    @contextmanager
+    def request(method, url, **kwargs):
+        yield FakeResponse([(0.05, line)] * 10)
+
+    monkeypatch.setattr(provider.http, "request", request)
+    with pytest.raises(DeadlineExceeded):
+        provider.chat_completion("Provider-1/DeepSeek-R1", [{"role": "user", "content": "hi"}],
+                                 deadline=Deadline(0.2, 1, 1, 1))
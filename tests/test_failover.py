@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+from app.config import Config
+from app.providers.base_provider import UpstreamHTTPError
+from app.utils.deadline import Deadline
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+def messages():
+    return [{"role": "user", "content": "hi"}]
+
+@pytest.fixture
+def failover(monkeypatch, redis):
+    monkeypatch.setattr(Config, "MODEL_FAILOVER_ENABLED", True)
+    monkeypatch.setattr(Config, "MODEL_FAILOVER_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(Config, "LOAD_BALANCING_ENABLED", False)
+
+def test_alias_is_tried_first_then_the_rest_of_its_group(app, providers, groups, failover):
+    providers("Stub/a", "Stub/b", "Stub/c")
+    groups({"stub": ["Stub/b", "Stub/a", "Stub/c"]})
+    assert app.provider_manager.candidates("Stub/a") == ["Stub/a", "Stub/b", "Stub/c"]
+    assert app.provider_manager.candidates("stub") == ["Stub/b", "Stub/a", "Stub/c"]
+
+def test_candidates_skip_unregistered_members_and_stop_at_max_attempts(app, providers, groups, failover, monkeypatch):
+    providers("Stub/a", "Stub/b", "Stub/c")
+    groups({"stub": ["Stub/a", "Missing/x", "Stub/b", "Stub/c"]})
+    monkeypatch.setattr(Config, "MODEL_FAILOVER_MAX_ATTEMPTS", 2)
+    assert app.provider_manager.candidates("stub") == ["Stub/a", "Stub/b"]
+    assert app.provider_manager.candidates("Nobody/none") == []
+
+def test_disabled_failover_keeps_an_alias_on_its_provider(app, providers, groups, failover, monkeypatch):
+    providers("Stub/a", "Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    monkeypatch.setattr(Config, "MODEL_FAILOVER_ENABLED", False)
+    assert app.provider_manager.candidates("Stub/a") == ["Stub/a"]
+
+def test_failed_call_moves_on_to_the_next_member(app, providers, groups, failover):
+    broken = providers("Stub/a", error=RuntimeError("upstream down"))
+    healthy = providers("Stub/b", text="from b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    attempts = []
+    result = app.provider_manager.chat_completion("Stub/a", messages(), attempts=attempts)
+    assert result["choices"][0]["message"]["content"] == "from b"
+    assert broken.calls == ["Stub/a"] and healthy.calls == ["Stub/b"]
+    assert [a["model_id"] for a in attempts] == ["Stub/a", "Stub/b"]
+    assert attempts[0]["error"] and attempts[1]["error"] is None
+
+def test_stream_failing_before_its_first_chunk_fails_over(app, providers, groups, failover):
+    providers("Stub/a", error=RuntimeError("upstream down"))
+    providers("Stub/b", text="one two")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    stream = app.provider_manager.chat_completion("stub", messages(), stream=True)
+    assert "".join(c["choices"][0]["delta"]["content"] for c in stream) == "one two"
+
+def test_request_errors_are_not_retried_elsewhere(app, providers, groups, failover):
+    providers("Stub/a", error=UpstreamError(400))
+    other = providers("Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    with pytest.raises(UpstreamError):
+        app.provider_manager.chat_completion("stub", messages())
+    assert other.calls == []
+
+def test_provider_400_is_not_retried_elsewhere(app, providers, groups, failover):
+    providers("Stub/a", error=UpstreamHTTPError("Stub API error: Status 400", 400))
+    other = providers("Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    with pytest.raises(UpstreamHTTPError):
+        app.provider_manager.chat_completion("stub", messages())
+    with pytest.raises(UpstreamHTTPError):
+        asyncio.run(app.provider_manager.achat_completion("stub", messages()))
+    assert other.calls == []
+
+def test_no_new_attempt_without_time_left_on_the_deadline(app, providers, groups, failover, monkeypatch):
+    providers("Stub/a", error=RuntimeError("upstream down"))
+    other = providers("Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    monkeypatch.setattr(Config, "MODEL_FAILOVER_MIN_REMAINING", 5)
+    with pytest.raises(RuntimeError):
+        app.provider_manager.chat_completion("stub", messages(), deadline=Deadline(2, 1, 1, 1))
+    assert other.calls == []
+
+def test_last_error_is_raised_when_every_member_fails(app, providers, groups, failover):
+    providers("Stub/a", error=RuntimeError("first"))
+    providers("Stub/b", error=RuntimeError("second"))
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    with pytest.raises(RuntimeError, match="second"):
+        app.provider_manager.chat_completion("stub", messages())
+
+def test_group_name_is_served_over_http(app, providers, groups, failover, api_key, usage):
+    providers("Stub/a", error=RuntimeError("upstream down"))
+    providers("Stub/b", text="from b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    response = app.test_client().post("/v1/chat/completions", json={"model": "stub", "messages": messages()},
+                                      headers={"Authorization": f"Bearer {api_key}"})
+    assert response.status_code == 200
+    assert response.get_json()["choices"][0]["message"]["content"] == "from b"
+    assert usage[-1]["model"] == "Stub/b"
+
+def ask(app, api_key, **body):
+    return app.test_client().post("/v1/chat/completions", json={"model": "stub", "messages": messages(), **body},
+                                  headers={"Authorization": f"Bearer {api_key}"})
+
+def test_members_whose_limits_the_request_exceeds_are_skipped(app, providers, groups, failover, api_key, usage,
+                                                               monkeypatch):
+    small = providers("Stub/a")
+    providers("Stub/b", text="from b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    monkeypatch.setitem(Config.MODEL_SPECIFIC_CONFIG, "Stub/a", {"max_input_tokens": 100, "max_output_tokens": 10})
+    response = ask(app, api_key, max_tokens=50)
+    assert response.status_code == 200
+    assert response.get_json()["choices"][0]["message"]["content"] == "from b"
+    assert small.calls == []
+
+def test_request_exceeding_every_member_is_rejected(app, providers, groups, failover, api_key, usage, monkeypatch):
+    providers("Stub/a", "Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    for model in ("Stub/a", "Stub/b"):
+        monkeypatch.setitem(Config.MODEL_SPECIFIC_CONFIG, model, {"max_input_tokens": 100, "max_output_tokens": 10})
+    response = ask(app, api_key, max_tokens=50)
+    assert response.status_code == 400 and "allowed limit of 10" in response.get_json()["error"]
@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+from app.config import Config
+from app.services import hedge_service, provider_stats_service
+from app.services.hedge_service import HedgeBudget, hedge_delay
+from app.services.provider_stats_service import record_call
+
+def messages():
+    return [{"role": "user", "content": "hi"}]
+
+def text(stream):
+    return "".join(chunk["choices"][0]["delta"]["content"] for chunk in stream)
+
+async def atext(stream):
+    return "".join([chunk["choices"][0]["delta"]["content"] async for chunk in stream])
+
+@pytest.fixture
+def hedging(app, redis, providers, groups, monkeypatch):
+    """Stub/slow and Stub/fast in group "stub", with enough ttfb samples to hedge Stub/slow after 0.05s."""
+    monkeypatch.setattr(provider_stats_service, "_cache", {})
+    monkeypatch.setattr(Config, "LOAD_BALANCING_ENABLED", False)
+    monkeypatch.setattr(Config, "HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(Config, "HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(Config, "PROVIDER_STATS_CACHE_SECONDS", 60)
+    budget = HedgeBudget()
+    budget._tokens = 1
+    monkeypatch.setattr(hedge_service, "hedge_budget", budget)
+    record_call("Stub/slow", False, ttfb=0.01)
+    groups({"stub": ["Stub/slow", "Stub/fast"]})
+
+    def register(slow_delay):
+        slow = providers("Stub/slow", text="from slow", delay=slow_delay)
+        fast = providers("Stub/fast", text="from fast")
+        return slow, fast
+    register.budget = budget
+    return register
+
+def test_budget_grows_by_a_percentage_per_request_up_to_the_burst(monkeypatch):
+    monkeypatch.setattr(Config, "HEDGE_BUDGET_PERCENT", 50)
+    monkeypatch.setattr(Config, "HEDGE_BUDGET_BURST", 1)
+    budget = HedgeBudget()
+    budget.deposit()
+    assert not budget.try_spend()
+    for _ in range(5):
+        budget.deposit()
+    assert budget.try_spend()
+    assert not budget.try_spend()
+
+def test_no_hedge_delay_until_enough_samples(redis, monkeypatch):
+    monkeypatch.setattr(provider_stats_service, "_cache", {})
+    monkeypatch.setattr(Config, "HEDGE_MIN_SAMPLES", 2)
+    monkeypatch.setattr(Config, "HEDGE_MIN_DELAY", 0.25)
+    record_call("Stub/a", False, ttfb=1.5)
+    assert hedge_delay("Stub/a") is None
+    monkeypatch.setattr(provider_stats_service, "_cache", {})
+    record_call("Stub/a", False, ttfb=0.1)
+    assert hedge_delay("Stub/a") == 1.5
+    monkeypatch.setattr(Config, "HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(provider_stats_service, "_cache", {})
+    redis.delete("provider_stats:Stub/a:ttfb")
+    record_call("Stub/a", False, ttfb=0.1)
+    assert hedge_delay("Stub/a") == 0.25
+
+def test_overdue_stream_is_hedged_and_the_first_to_answer_wins(app, hedging):
+    slow, fast = hedging(slow_delay=0.5)
+    attempts = []
+    stream = app.provider_manager.chat_completion("stub", messages(), stream=True, hedge=True, attempts=attempts)
+    assert text(stream) == "from fast"
+    assert slow.calls == ["Stub/slow"] and fast.calls == ["Stub/fast"]
+    assert attempts[-1] == {"model_id": "Stub/fast", "error": None}
+
+def test_stream_answering_in_time_is_not_hedged(app, hedging):
+    slow, fast = hedging(slow_delay=0)
+    stream = app.provider_manager.chat_completion("stub", messages(), stream=True, hedge=True)
+    assert text(stream) == "from slow"
+    assert fast.calls == []
+
+def test_no_hedge_without_budget(app, hedging):
+    slow, fast = hedging(slow_delay=0.2)
+    hedging.budget._tokens = 0
+    stream = app.provider_manager.chat_completion("stub", messages(), stream=True, hedge=True)
+    assert text(stream) == "from slow"
+    assert fast.calls == []
+
+def test_hedge_covers_a_failing_primary(app, hedging, providers):
+    providers("Stub/slow", delay=0.2, error=RuntimeError("upstream down"))
+    providers("Stub/fast", text="from fast", delay=0.3)
+    stream = app.provider_manager.chat_completion("stub", messages(), stream=True, hedge=True)
+    assert text(stream) == "from fast"
+
+def test_async_hedge_wins_over_an_overdue_primary(app, hedging):
+    slow, fast = hedging(slow_delay=0.5)
+
+    async def run():
+        stream = await app.provider_manager.achat_completion("stub", messages(), stream=True, hedge=True)
+        return await atext(stream)
+
+    assert asyncio.run(run()) == "from fast"
+    assert fast.calls == ["Stub/fast"]
@@ -0,0 +1,78 @@
+import httpx
+import pytest
+import requests
+from app.config import Config
+from app.providers import http_client
+from app.providers.http_client import (
+    HTTP2Response, UpstreamHTTPClient, _HTTP2ClientPool, _as_requests_errors, _httpx_timeout
+)
+
+class FakeClient:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+def test_streams_go_to_the_least_loaded_client(monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_HTTP2_CONNECTIONS_PER_HOST", 2)
+    pool = _HTTP2ClientPool(FakeClient)
+    first, release_first = pool.acquire("a.test")
+    second, _ = pool.acquire("a.test")
+    assert first is not second
+    release_first()
+    release_first()  # idempotent
+    third, _ = pool.acquire("a.test")
+    assert third is first
+    # Load is counted per host.
+    other, _ = pool.acquire("b.test")
+    assert other is first
+
+def test_clients_negotiate_http1_unless_prior_knowledge(monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_HTTP2_PRIOR_KNOWLEDGE", True)
+    client, _ = _HTTP2ClientPool(FakeClient).acquire("a.test")
+    assert client.kwargs == {"http2": True, "http1": False}
+
+def test_requests_style_timeouts_are_converted():
+    timeout = _httpx_timeout((3, 20))
+    assert (timeout.connect, timeout.read) == (3, 20)
+    assert _httpx_timeout(7).read == 7
+
+@pytest.mark.parametrize("error, expected", [
+    (httpx.ConnectTimeout("connect"), requests.exceptions.ConnectTimeout),
+    (httpx.ReadTimeout("read"), requests.exceptions.ReadTimeout),
+    (httpx.ConnectError("refused"), requests.exceptions.ConnectionError),
+])
+def test_httpx_errors_surface_as_requests_errors(error, expected):
+    with pytest.raises(expected):
+        with _as_requests_errors():
+            raise error
+
+def mock_client(handler):
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+def test_http2_response_reads_like_a_requests_response():
+    client = mock_client(lambda request: httpx.Response(200, text='data: {"a": 1}\n\ndata: [DONE]\n'))
+    released = []
+    response = HTTP2Response(client.send(client.build_request("POST", "http://up.test/"), stream=True),
+                             lambda: released.append(True))
+    assert response.status_code == 200
+    assert list(response.iter_lines(decode_unicode=True)) == ['data: {"a": 1}', "", "data: [DONE]"]
+    response.close()
+    assert released == [True]
+
+def test_http2_response_raises_for_error_status():
+    client = mock_client(lambda request: httpx.Response(429, json={"error": "slow down"}))
+    response = HTTP2Response(client.send(client.build_request("GET", "http://up.test/")), lambda: None)
+    assert response.json() == {"error": "slow down"}
+    with pytest.raises(requests.exceptions.HTTPError):
+        response.raise_for_status()
+
+def test_opted_in_provider_sends_through_the_http2_pool(redis, monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_HTTP2_PROVIDERS", ["provider-test"])
+    monkeypatch.setattr(http_client, "HTTP2_AVAILABLE", True)
+    pool = _HTTP2ClientPool(lambda **kwargs: mock_client(lambda request: httpx.Response(200, json={"ok": True})))
+    monkeypatch.setattr(http_client, "http2_pool", pool)
+    client = UpstreamHTTPClient("provider-test")
+    assert client.http2
+    with client.request("POST", "http://up.test/v1/chat", json={}, timeout=(1, 5)) as response:
+        assert isinstance(response, HTTP2Response)
+        assert response.json() == {"ok": True}
+    assert all(load == 0 for load in pool._load.values())
@@ -0,0 +1,79 @@
+import base64
+import os
+import pytest
+from app.config import Config
+from app.services.blob_store_service import blob_path, put_blob
+from app.services.image_cache_service import (
+    BYTES_KEY, LRU_KEY, SIZES_KEY, _path, get_cached_images, image_cache_policy, store_images
+)
+from .conftest import png
+
+MODEL = "Provider-6/flux-schnell"
+
+@pytest.fixture
+def image_cache(redis, blob_store, monkeypatch):
+    monkeypatch.setattr(Config, "IMAGE_CACHE_ENABLED", True)
+    monkeypatch.setattr(Config, "IMAGE_CACHE_MAX_BYTES", 10000)
+    return redis
+
+def policy(prompt, seed=None, headers=None):
+    return image_cache_policy(MODEL, prompt, "1024x1024", seed, "k", headers or {})
+
+def response(*payloads):
+    return {"data": [{"b64_json": base64.b64encode(png(p)).decode()} for p in payloads]}
+
+def test_policy_keys_on_model_prompt_size_and_seed(image_cache, monkeypatch):
+    assert policy("cat")["key"] == policy("cat")["key"]
+    assert policy("cat", seed=1)["key"] != policy("cat", seed=2)["key"]
+    assert policy("cat", headers={"Cache-Control": "no-cache"})["read"] is False
+    assert policy("cat", headers={"Cache-Control": "no-store"})["write"] is False
+    monkeypatch.setattr(Config, "IMAGE_CACHE_ENABLED", False)
+    assert policy("cat") is None
+
+def test_stored_images_are_served_from_the_cache(image_cache):
+    store_images(policy("cat"), response(b"one", b"two"))
+    images = get_cached_images(policy("cat"), 2)
+    assert len(images) == 2 and all(os.path.exists(blob_path(i)) for i in images)
+    assert get_cached_images(policy("cat"), 3) is None
+    assert get_cached_images(policy("dog"), 1) is None
+
+def test_identical_images_are_stored_and_counted_once(image_cache):
+    store_images(policy("cat"), response(b"same"))
+    store_images(policy("kitten"), response(b"same"))
+    assert image_cache.zcard(LRU_KEY) == 1
+    assert int(image_cache.get(BYTES_KEY)) == len(png(b"same"))
+
+def test_least_recently_used_images_are_evicted_with_their_files(image_cache):
+    store_images(policy("a"), response(b"a" * 4000))
+    store_images(policy("b"), response(b"b" * 4000))
+    get_cached_images(policy("a"), 1)
+    store_images(policy("c"), response(b"c" * 4000))
+    evicted = put_blob(png(b"b" * 4000))
+    assert not os.path.exists(_path(evicted))
+    os.unlink(blob_path(evicted))
+    assert get_cached_images(policy("b"), 1) is None
+    assert get_cached_images(policy("a"), 1) and get_cached_images(policy("c"), 1)
+    assert int(image_cache.get(BYTES_KEY)) == sum(int(v) for v in image_cache.hvals(SIZES_KEY)) <= 10000
+
+def test_images_larger_than_the_cache_are_not_stored(image_cache, monkeypatch):
+    monkeypatch.setattr(Config, "IMAGE_CACHE_MAX_BYTES", 100)
+    store_images(policy("big"), response(b"x" * 200))
+    assert get_cached_images(policy("big"), 1) is None
+
+def test_remote_urls_are_not_cached(image_cache):
+    store_images(policy("cat"), {"data": [{"url": "https://cdn.example.com/cat.png"}]})
+    assert not image_cache.exists(policy("cat")["key"])
+
+def generate(app, api_key, **body):
+    return app.test_client().post("/v1/images/generations",
+                                  json={"model": MODEL, "prompt": "cat", "response_format": "b64_json", **body},
+                                  headers={"Authorization": f"Bearer {api_key}"})
+
+def test_repeated_generation_is_answered_from_the_cache(app, image_cache, image_provider, api_key):
+    first = generate(app, api_key, seed=7)
+    second = generate(app, api_key, seed=7)
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.get_json()["data"] == first.get_json()["data"]
+    assert len(image_provider) == 1
+    generate(app, api_key, seed=8)
+    assert len(image_provider) == 2
@@ -0,0 +1,146 @@
+import base64
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+import pytest
+from app.config import Config
+from app.providers.base_provider import fan_out
+from app.utils.deadline import Deadline, DeadlineExceeded
+from .conftest import png
+
+def deadline(seconds):
+    return Deadline(seconds, seconds, seconds, seconds)
+
+class Calls:
+    """make_call for fan_out(): sleeps `delay` (or delays[i]), fails the indices in `failing`, tracks concurrency."""
+
+    def __init__(self, delay=0.05, delays=None, failing=()):
+        self.delay = delay
+        self.delays = delays or {}
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.started = []
+
+    def __call__(self, i):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.started.append(i)
+        try:
+            time.sleep(self.delays.get(i, self.delay))
+            if i in self.failing:
+                raise RuntimeError(f"call {i} failed")
+            return f"image {i}"
+        finally:
+            with self.lock:
+                self.running -= 1
+
+def test_calls_run_concurrently_up_to_the_limit(monkeypatch):
+    monkeypatch.setattr(Config, "IMAGE_FANOUT_CONCURRENCY", 3)
+    calls = Calls()
+    started = time.monotonic()
+    assert fan_out(calls, 6) == [f"image {i}" for i in range(6)]
+    assert calls.peak == 3
+    assert time.monotonic() - started < 6 * calls.delay
+
+def test_explicit_concurrency_overrides_the_setting():
+    calls = Calls()
+    fan_out(calls, 4, concurrency=1)
+    assert calls.peak == 1 and calls.started == [0, 1, 2, 3]
+
+def test_single_call_runs_inline():
+    calls = Calls(failing={0})
+    with pytest.raises(RuntimeError):
+        fan_out(calls, 1)
+
+def test_failed_calls_are_left_out():
+    assert fan_out(Calls(failing={1}), 3) == ["image 0", "image 2"]
+
+def test_first_error_is_raised_when_every_call_failed():
+    with pytest.raises(RuntimeError, match="failed"):
+        fan_out(Calls(failing={0, 1, 2}), 3)
+
+def test_deadline_returns_the_calls_finished_in_time():
+    calls = Calls(delays={2: 1.0})
+    started = time.monotonic()
+    assert fan_out(calls, 3, deadline(0.3)) == ["image 0", "image 1"]
+    assert time.monotonic() - started < 0.6
+
+def test_calls_not_started_by_the_deadline_are_skipped():
+    calls = Calls(delay=0.15)
+    assert fan_out(calls, 4, deadline(0.2), concurrency=1) == ["image 0"]
+    time.sleep(0.3)
+    assert calls.started == [0, 1]
+
+def test_deadline_without_any_result_raises():
+    with pytest.raises(DeadlineExceeded):
+        fan_out(Calls(delay=1.0), 2, deadline(0.1))
+
+class Response:
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+def test_provider_6_requests_the_images_concurrently(app, monkeypatch):
+    provider = app.provider_manager.providers["provider-6"]
+    monkeypatch.setattr(Config, "IMAGE_FANOUT_CONCURRENCY", 4)
+    calls = Calls(delay=0.1)
+
+    @contextmanager
+    def request(method, url, **kwargs):
+        i = len(calls.started)
+        calls(i)
+        yield Response({"result": "data:image/png;base64," + base64.b64encode(png(str(i).encode())).decode()})
+
+    monkeypatch.setattr(provider.http, "request", request)
+    started = time.monotonic()
+    result = provider.image_generation("cat", n=4, response_format="b64_json", deadline=deadline(5))
+    assert len(result["data"]) == 4 and calls.peak > 1
+    assert time.monotonic() - started < 0.3
+
+def test_provider_5_gives_every_image_its_own_seed(app, blob_store, monkeypatch):
+    provider = app.provider_manager.providers["provider-5"]
+    monkeypatch.setenv("PROVIDER_5_IMG_BASE_URL", "https://images.example.com/prompt")
+    seeds = []
+
+    @contextmanager
+    def request(method, url, **kwargs):
+        seed = parse_qs(urlparse(url).query)["seed"][0]
+        seeds.append(int(seed))
+        yield Response(png(seed.encode()))
+
+    monkeypatch.setattr(provider.http, "request", request)
+    result = provider.image_generation("cat", n=3, response_format="b64_json", seed=10, deadline=deadline(5))
+    assert sorted(seeds) == [10, 11, 12] and len(result["data"]) == 3
+    seeds.clear()
+    provider.image_generation("cat", n=3, response_format="b64_json", deadline=deadline(5))
+    assert len(set(seeds)) == 3
+
+@pytest.mark.parametrize("name", ["provider-3", "provider-5", "provider-6"])
+def test_url_images_without_a_secret_fail_before_any_upstream_call(app, blob_store, monkeypatch, name):
+    provider = app.provider_manager.providers[name]
+    monkeypatch.setattr(Config, "BLOB_SIGNING_SECRET", "")
+    monkeypatch.setenv("PROVIDER_5_IMG_BASE_URL", "https://images.example.com/prompt")
+    calls = []
+
+    @contextmanager
+    def request(method, url, **kwargs):
+        calls.append(url)
+        yield Response({})
+
+    monkeypatch.setattr(provider.http, "request", request)
+    with pytest.raises(RuntimeError, match="BLOB_SIGNING_SECRET"):
+        provider.image_generation("cat", n=2, response_format="url", deadline=deadline(5))
+    assert calls == []
@@ -0,0 +1,131 @@
+from types import SimpleNamespace
+import pytest
+from app.config import Config
+from app.providers.key_pool import APIKeyPool, NoAvailableKeyError
+from app.providers.provider_7 import MaxAPIKeyRotationsError, Provider7
+
+@pytest.fixture
+def pool(redis, monkeypatch):
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_ENABLED", False)
+    monkeypatch.setattr(Config, "KEY_POOL_HEALTH_CACHE_SECONDS", 0)
+    return APIKeyPool("provider-test", ["key-a", "key-b", "key-a", "key-c"])
+
+def test_duplicate_keys_are_pooled_once(pool):
+    assert len(pool) == 3
+
+def test_keys_are_handed_out_in_turn_when_equally_busy(pool):
+    keys = []
+    for _ in range(4):
+        api_key, release = pool.acquire()
+        release()
+        keys.append(api_key)
+    assert keys == ["key-a", "key-b", "key-c", "key-a"]
+
+def test_least_busy_key_is_preferred(pool):
+    pool.acquire()
+    pool.acquire()
+    _, release_c = pool.acquire()
+    release_c()
+    assert pool.acquire()[0] == "key-c"
+
+def test_release_runs_once(pool):
+    api_key, release = pool.acquire()
+    release()
+    release()
+    assert pool.snapshot()[pool._ids[api_key]]["in_flight"] == 0
+
+def test_excluded_keys_are_skipped_until_none_is_left(pool):
+    assert pool.acquire(exclude={"key-a", "key-b"})[0] == "key-c"
+    with pytest.raises(NoAvailableKeyError) as error:
+        pool.acquire(exclude={"key-a", "key-b", "key-c"})
+    assert error.value.retry_after is None and not error.value.saturated
+
+def test_cooldown_is_shared_with_other_workers(pool, redis):
+    pool.cooldown("key-a", 30, "status 429")
+    other = APIKeyPool("provider-test", ["key-a", "key-b"])
+    assert redis.ttl(other._redis_key("key-a")) == 30
+    assert other.acquire()[0] == "key-b"
+    with pytest.raises(NoAvailableKeyError) as error:
+        other.acquire(exclude={"key-b"})
+    assert error.value.retry_after == 30
+
+def test_cooldown_is_clamped(pool, redis, monkeypatch):
+    monkeypatch.setattr(Config, "KEY_POOL_MAX_COOLDOWN", 60)
+    pool.cooldown("key-a", 3600)
+    assert redis.ttl(pool._redis_key("key-a")) == 60
+
+def test_keys_at_their_adaptive_limit_saturate_the_pool(redis, monkeypatch):
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_ENABLED", False)
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_INITIAL", 1)
+    pool = APIKeyPool("provider-test", ["key-a"])
+    _, release = pool.acquire()
+    with pytest.raises(NoAvailableKeyError) as error:
+        pool.acquire()
+    assert error.value.saturated
+    release()
+    assert pool.acquire()[0] == "key-a"
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body or {}
+        self.text = str(self.body)
+        self.request = SimpleNamespace(headers={})
+
+    def json(self):
+        return self.body
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def provider_7(redis, monkeypatch):
+    monkeypatch.setenv("PROVIDER_7_API_KEYS", '["key-a", "key-b"]')
+    monkeypatch.setenv("PROVIDER_7_ERROR_CODES", "[429, 401]")
+    monkeypatch.setattr(Config, "ADAPTIVE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_ENABLED", False)
+    monkeypatch.setattr(Config, "KEY_POOL_HEALTH_CACHE_SECONDS", 0)
+    provider = Provider7()
+    provider.sent = []
+
+    def answer(*statuses):
+        responses = [FakeResponse(*status) if isinstance(status, tuple) else FakeResponse(status) for status in statuses]
+
+        def request(method, url, headers=None, **kwargs):
+            provider.sent.append(headers["Authorization"])
+            return responses.pop(0)
+
+        monkeypatch.setattr(provider.http.session, "request", request)
+
+    provider.answer = answer
+    return provider
+
+def completion():
+    return {"choices": [{"message": {"content": "hi"}}], "usage": {"prompt_tokens": 1, "completion_tokens": 1}}
+
+def test_rate_limited_key_is_cooled_down_and_the_next_key_used(provider_7, redis):
+    provider_7.answer((429, {"Retry-After": "20"}), (200, {}, completion()))
+    result = provider_7.chat_completion("Provider-7/gpt-4o", [{"role": "user", "content": "hi"}])
+    assert result["choices"][0]["message"]["content"] == "hi"
+    assert provider_7.sent == ["Bearer key-a", "Bearer key-b"]
+    assert redis.ttl(provider_7.key_pool._redis_key("key-a")) == 20
+
+def test_other_rotation_codes_move_on_without_a_cooldown(provider_7, redis):
+    provider_7.answer(401, (200, {}, completion()))
+    provider_7.chat_completion("Provider-7/gpt-4o", [{"role": "user", "content": "hi"}])
+    assert not redis.exists(provider_7.key_pool._redis_key("key-a"))
+
+def test_every_key_failing_raises(provider_7):
+    provider_7.answer(429, 429)
+    with pytest.raises(MaxAPIKeyRotationsError):
+        provider_7.chat_completion("Provider-7/gpt-4o", [{"role": "user", "content": "hi"}])
+    assert provider_7.key_pool.snapshot()[provider_7.key_pool._ids["key-a"]]["in_flight"] == 0
+
+def test_errors_not_listed_are_raised_without_rotating(provider_7):
+    provider_7.answer(500)
+    with pytest.raises(Exception, match="Status 500"):
+        provider_7.chat_completion("Provider-7/gpt-4o", [{"role": "user", "content": "hi"}])
+    assert provider_7.sent == ["Bearer key-a"]
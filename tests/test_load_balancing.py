@@ -0,0 +1,75 @@
+import pytest
+from app.config import Config
+from app.services import provider_stats_service
+from app.services.provider_stats_service import get_stats, rank, record_call, record_throughput, score
+
+@pytest.fixture
+def stats(monkeypatch, redis):
+    monkeypatch.setattr(provider_stats_service, "_cache", {})
+    monkeypatch.setattr(Config, "PROVIDER_STATS_ALPHA", 0.5)
+    monkeypatch.setattr(Config, "PROVIDER_STATS_TTFB_HISTORY", 3)
+    return redis
+
+def test_first_sample_seeds_the_average_and_later_ones_are_blended(stats):
+    record_call("Stub/a", False, ttfb=1.0)
+    record_call("Stub/a", False, ttfb=3.0)
+    assert float(stats.hget("provider_stats:Stub/a", "ttfb")) == 2.0
+    assert stats.hget("provider_stats:Stub/a", "samples") == "2"
+
+def test_failures_raise_the_error_rate_without_a_ttfb_sample(stats):
+    record_call("Stub/a", False, ttfb=1.0)
+    record_call("Stub/a", True)
+    assert float(stats.hget("provider_stats:Stub/a", "error_rate")) == 0.5
+    assert [float(v) for v in stats.lrange("provider_stats:Stub/a:ttfb", 0, -1)] == [1.0]
+
+def test_ttfb_history_is_trimmed_and_gives_the_p90(stats):
+    for ttfb in (1, 2, 3, 4):
+        record_call("Stub/a", False, ttfb=ttfb)
+    result = get_stats(["Stub/a"])["Stub/a"]
+    assert result["ttfb_history"] == 3
+    assert result["ttfb_p90"] == 4.0
+
+def test_stats_are_cached_per_worker(stats, monkeypatch):
+    monkeypatch.setattr(Config, "PROVIDER_STATS_CACHE_SECONDS", 60)
+    assert get_stats(["Stub/a"]) == {"Stub/a": {}}
+    record_call("Stub/a", False, ttfb=1.0)
+    assert get_stats(["Stub/a"]) == {"Stub/a": {}}
+
+def test_throughput_is_recorded_for_finished_streams_only(stats):
+    record_throughput("Stub/a", 0, 1)
+    assert not stats.exists("provider_stats:Stub/a")
+    record_throughput("Stub/a", 100, 2)
+    assert float(stats.hget("provider_stats:Stub/a", "tps")) == 50.0
+
+def test_score_adds_ttfb_generation_time_and_error_penalty(monkeypatch):
+    monkeypatch.setattr(Config, "PROVIDER_SCORE_REFERENCE_TOKENS", 100)
+    monkeypatch.setattr(Config, "PROVIDER_SCORE_ERROR_PENALTY", 10)
+    assert score({}) == 0
+    assert score({"ttfb": 1.0, "tps": 50.0, "error_rate": 0.5}) == pytest.approx(1.0 + 2.0 + 5.0)
+
+def test_better_of_two_goes_first_and_the_rest_follow_by_score(stats):
+    for model, ttfb in (("Stub/a", 3.0), ("Stub/b", 1.0), ("Stub/c", 2.0)):
+        record_call(model, False, ttfb=ttfb)
+    assert rank(["Stub/a", "Stub/b"]) == ["Stub/b", "Stub/a"]
+    for _ in range(20):
+        ranked = rank(["Stub/a", "Stub/b", "Stub/c"])
+        assert ranked[0] != "Stub/a"
+        assert ranked[1:] == sorted(ranked[1:], key=lambda m: {"Stub/a": 3, "Stub/b": 1, "Stub/c": 2}[m])
+
+def test_group_members_are_ranked_only_when_load_balancing_is_on(app, stats, providers, groups, monkeypatch):
+    providers("Stub/a", "Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    record_call("Stub/a", True)
+    record_call("Stub/b", False, ttfb=0.1)
+    monkeypatch.setattr(Config, "LOAD_BALANCING_ENABLED", True)
+    assert app.provider_manager.candidates("stub") == ["Stub/b", "Stub/a"]
+    monkeypatch.setattr(Config, "LOAD_BALANCING_ENABLED", False)
+    assert app.provider_manager.candidates("stub") == ["Stub/a", "Stub/b"]
+
+def test_served_calls_feed_the_stats(app, stats, providers, api_key, usage):
+    providers("Stub/a", text="one two three")
+    response = app.test_client().post("/v1/chat/completions",
+                                      json={"model": "Stub/a", "messages": [{"role": "user", "content": "hi"}]},
+                                      headers={"Authorization": f"Bearer {api_key}"})
+    assert response.status_code == 200
+    assert float(stats.hget("provider_stats:Stub/a", "error_rate")) == 0
@@ -0,0 +1,165 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from app.config import Config
+from app.services import quota_service
+from app.services.quota_service import quota_policy, release_quota, reserve_quota, settle_quota
+from app.utils.streaming import generate_stream
+
+@pytest.fixture
+def quotas(redis, monkeypatch):
+    """Prices Stub/a at 10 and Stub/b at 20 micro-dollars a token; quotas(tokens_per_minute, cost_per_day) sets them."""
+    now = [time.time()]
+    monkeypatch.setattr(quota_service, "time", SimpleNamespace(time=lambda: now[0]))
+    monkeypatch.setattr(Config, "ALLOWED_MODELS", Config.ALLOWED_MODELS + [
+        {"id": "Stub/a", "owner_cost_per_million_tokens": 10},
+        {"id": "Stub/b", "owner_cost_per_million_tokens": 20},
+        {"id": "Stub/free"},
+    ])
+
+    def configure(tokens_per_minute=0, cost_per_day=0):
+        monkeypatch.setattr(Config, "QUOTA_TOKENS_PER_MINUTE", tokens_per_minute)
+        monkeypatch.setattr(Config, "QUOTA_COST_PER_DAY", cost_per_day)
+
+    def advance(seconds):
+        now[0] += seconds
+
+    def spent():
+        keys = redis.keys("quota:cost:k:*")
+        return int(redis.get(keys[0])) if keys else 0
+
+    return SimpleNamespace(configure=configure, advance=advance, spent=spent, redis=redis)
+
+def call(prompt_tokens=10, max_tokens=90, model_id="Stub/a", candidates=None):
+    return {"api_key": "k", "prompt_tokens": prompt_tokens, "max_tokens": max_tokens, "model_id": model_id,
+            "candidates": candidates or [model_id]}
+
+def test_key_settings_override_the_tier_and_the_defaults(monkeypatch):
+    monkeypatch.setattr(Config, "QUOTA_TOKENS_PER_MINUTE", 1000)
+    monkeypatch.setattr(Config, "QUOTA_COST_PER_DAY", 5)
+    monkeypatch.setattr(Config, "RATE_LIMIT_TIERS", {"pro": {"tokens_per_minute": 5000}})
+    monkeypatch.setattr(Config, "API_KEY_SETTINGS", {"k": {"rate_limit_tier": "pro", "cost_per_day": 0}})
+    assert quota_policy("k") == {"tokens_per_minute": 5000, "cost_per_day": 0}
+    assert quota_policy("other") == {"tokens_per_minute": 1000, "cost_per_day": 5}
+
+def test_keys_without_quotas_reserve_nothing(quotas):
+    request = call()
+    assert reserve_quota(request) is None and request["quota"] is None
+    assert quotas.redis.keys("quota:*") == []
+
+def test_token_quota_rejects_until_the_bucket_refills(quotas):
+    quotas.configure(tokens_per_minute=150)
+    assert reserve_quota(call()) is None
+    body, status, headers = reserve_quota(call())
+    assert status == 429 and "Token quota" in body["error"]
+    assert headers["Retry-After"] == "20"
+    quotas.advance(20)
+    assert reserve_quota(call()) is None
+
+def test_unused_tokens_are_returned_on_settlement(quotas):
+    quotas.configure(tokens_per_minute=150)
+    first = call()
+    reserve_quota(first)
+    settle_quota(first["quota"], "Stub/a", 10, 5)
+    assert reserve_quota(call()) is None
+
+def test_request_larger_than_the_quota_passes_once_it_is_untouched(quotas):
+    quotas.configure(tokens_per_minute=50)
+    assert reserve_quota(call()) is None
+    assert reserve_quota(call())[1] == 429
+
+def test_group_requests_are_priced_at_their_first_candidate(quotas):
+    quotas.configure(cost_per_day=1)
+    request = call(model_id="stub", candidates=["Stub/b", "Stub/a"])
+    reserve_quota(request)
+    assert request["quota"]["cost"] == 100 * 20 and quotas.spent() == 2000
+
+def test_settlement_charges_the_serving_model(quotas):
+    quotas.configure(cost_per_day=1)
+    request = call()
+    reserve_quota(request)
+    settle_quota(request["quota"], "Stub/b", 10, 20)
+    assert quotas.spent() == 30 * 20
+
+def test_unpriced_reservation_is_charged_at_the_actual_cost(quotas):
+    quotas.configure(cost_per_day=1)
+    request = call(model_id="Stub/free")
+    reserve_quota(request)
+    assert request["quota"]["cost"] == 0
+    settle_quota(request["quota"], "Stub/a", 10, 20)
+    assert quotas.spent() == 30 * 10
+
+def test_cost_quota_rejects_until_tomorrow(quotas):
+    quotas.configure(cost_per_day=0.002)
+    assert reserve_quota(call()) is None
+    assert reserve_quota(call()) is None
+    body, status, headers = reserve_quota(call())
+    assert status == 429 and "cost quota" in body["error"]
+    assert 0 < int(headers["Retry-After"]) <= 86400
+
+def test_released_reservation_is_returned_whole(quotas):
+    quotas.configure(tokens_per_minute=150, cost_per_day=1)
+    request = call()
+    reserve_quota(request)
+    release_quota(request["quota"])
+    assert quotas.spent() == 0
+    assert reserve_quota(call()) is None
+
+def test_only_the_first_of_settle_and_release_applies(quotas):
+    quotas.configure(cost_per_day=1)
+    for _ in range(20):
+        quotas.redis.flushall()
+        request = call()
+        reserve_quota(request)
+        barrier = threading.Barrier(2)
+
+        def settle():
+            barrier.wait()
+            settle_quota(request["quota"], "Stub/a", 10, 20)
+
+        def release():
+            barrier.wait()
+            release_quota(request["quota"])
+
+        threads = [threading.Thread(target=settle), threading.Thread(target=release)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert quotas.spent() in (0, 300)
+    request = call()
+    reserve_quota(request)
+    settle_quota(request["quota"], "Stub/a", 10, 20)
+    release_quota(request["quota"])
+    settle_quota(request["quota"], "Stub/a", 10, 90)
+    assert quotas.spent() == 300
+
+def chunks(words, delay=0.0):
+    for i, word in enumerate(words):
+        if i:
+            time.sleep(delay)
+        yield {"id": "chatcmpl-stub", "model": "Stub/a", "choices": [{"index": 0, "delta": {"content": word + " "}}]}
+
+@pytest.mark.parametrize("coalesce", [None, {"max_bytes": 1 << 20, "max_delay": 0.05}])
+def test_disconnected_stream_is_charged_for_what_it_produced(app, quotas, usage, coalesce):
+    quotas.configure(cost_per_day=1)
+    request = call(prompt_tokens=1)
+    reserve_quota(request)
+    response = generate_stream(chunks(["one", "two", "three"], delay=0.1), 1, "k", "Stub/a", app,
+                               [{"role": "user", "content": "hi"}], coalesce=coalesce, quota=request["quota"])
+    frames = iter(response.response)
+    next(frames)
+    response.close()
+    time.sleep(0.5)
+    assert request["quota"]["settled"] and usage
+    assert quotas.spent() == (1 + usage[-1]["completion_tokens"]) * 10 > 0
+
+def test_stream_closed_before_reading_upstream_is_released(app, quotas, usage):
+    quotas.configure(cost_per_day=1)
+    request = call(prompt_tokens=1)
+    reserve_quota(request)
+    response = generate_stream(chunks(["one"]), 1, "k", "Stub/a", app,
+                               [{"role": "user", "content": "hi"}], quota=request["quota"])
+    response.close()
+    assert quotas.spent() == 0 and usage == []
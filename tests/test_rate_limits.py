@@ -0,0 +1,109 @@
+import time
+from types import SimpleNamespace
+import pytest
+from app.config import Config
+from app.services import rate_limit_service
+from app.services.rate_limit_service import check_rate_limit, rate_limit_policy
+
+@pytest.fixture
+def limits(app, redis, monkeypatch):
+    """Puts the key "k" in a tier "t": limits(algorithm, limit=3, window=60, burst=None), clock set by limits.at(ms)."""
+    now = [time.time()]
+    monkeypatch.setattr(rate_limit_service, "time", SimpleNamespace(time=lambda: now[0]))
+    monkeypatch.setattr(Config, "API_KEY_SETTINGS", {"k": {"rate_limit_tier": "t"}})
+
+    def configure(algorithm, limit=3, window=60, burst=None):
+        text = {"limit": limit, "window": window}
+        if burst is not None:
+            text["burst"] = burst
+        monkeypatch.setattr(Config, "RATE_LIMIT_TIERS", {"t": {"algorithm": algorithm, "text": text}})
+
+    def check():
+        with app.test_request_context(headers={"Authorization": "Bearer k"}):
+            rejection, headers = check_rate_limit(rate_limit_service.request)
+        return rejection is None, headers
+
+    def advance(seconds):
+        now[0] += seconds
+
+    return SimpleNamespace(configure=configure, check=check, advance=advance, redis=redis)
+
+def test_fixed_window_is_the_default():
+    assert Config.RATE_LIMIT_ALGORITHM == "fixed"
+
+def test_tier_overrides_the_defaults(app, monkeypatch):
+    monkeypatch.setattr(Config, "API_KEY_SETTINGS", {"k": {"rate_limit_tier": "pro"}})
+    monkeypatch.setattr(Config, "RATE_LIMIT_TIERS", {"pro": {"algorithm": "gcra", "text": {"limit": 120, "burst": 20}}})
+    with app.app_context():
+        assert rate_limit_policy("k") == {"algorithm": "gcra", "limit": 120, "window": 60, "burst": 20, "tier": "pro"}
+        other = rate_limit_policy("other", "image")
+    assert other["algorithm"] == Config.RATE_LIMIT_ALGORITHM and other["limit"] == other["burst"]
+    assert other["tier"] == Config.RATE_LIMIT_DEFAULT_TIER
+
+@pytest.mark.parametrize("algorithm", ["fixed", "sliding", "gcra"])
+def test_requests_over_the_limit_are_rejected(limits, algorithm):
+    limits.configure(algorithm, limit=3)
+    results = [limits.check() for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert [headers["X-RateLimit-Remaining"] for _, headers in results] == ["2", "1", "0", "0"]
+    assert all(headers["X-RateLimit-Limit"] == "3" for _, headers in results)
+    assert 1 <= int(results[-1][1]["Retry-After"]) <= 60
+
+def test_fixed_window_resets_when_it_expires(limits):
+    limits.configure("fixed", limit=1, window=0.2)
+    assert limits.check()[0] and not limits.check()[0]
+    time.sleep(0.25)
+    assert limits.check()[0]
+
+def test_sliding_log_frees_the_oldest_request_first(limits):
+    limits.configure("sliding", limit=2, window=60)
+    limits.check()
+    limits.advance(20)
+    limits.check()
+    allowed, headers = limits.check()
+    assert not allowed and headers["Retry-After"] == "40"
+    limits.advance(40)
+    assert limits.check()[0] and not limits.check()[0]
+
+def test_gcra_refills_at_the_limit_rate_after_a_burst(limits):
+    limits.configure("gcra", limit=6, window=60, burst=3)
+    assert [limits.check()[0] for _ in range(4)] == [True, True, True, False]
+    allowed, headers = limits.check()
+    assert headers["Retry-After"] == "10"
+    limits.advance(10)
+    assert limits.check()[0] and not limits.check()[0]
+    limits.advance(60)
+    assert [limits.check()[0] for _ in range(4)] == [True, True, True, False]
+
+@pytest.mark.parametrize("algorithm", ["fixed", "sliding", "gcra"])
+@pytest.mark.parametrize("limit", [0, -1])
+def test_a_limit_of_zero_rejects_every_request(limits, algorithm, limit):
+    limits.configure(algorithm, limit=limit, window=30)
+    allowed, headers = limits.check()
+    assert not allowed
+    assert headers["Retry-After"] == "30" and headers["X-RateLimit-Remaining"] == "0"
+    assert limits.redis.keys("rate_limit:*") == []
+
+def test_redis_errors_fail_open(limits, monkeypatch):
+    limits.configure("fixed", limit=1)
+
+    def broken(policy, key_suffix):
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(rate_limit_service, "_run_limiter", broken)
+    assert limits.check() == (True, {})
+
+def test_rejected_request_gets_429_with_retry_after(app, limits, api_key, providers, usage, monkeypatch):
+    providers("Stub/a")
+    monkeypatch.setattr(Config, "API_KEY_SETTINGS", {api_key: {"rate_limit_tier": "t"}})
+    limits.configure("fixed", limit=1)
+    client = app.test_client()
+
+    def post():
+        return client.post("/v1/chat/completions", json={"model": "Stub/a", "messages": [{"role": "user", "content": "hi"}]},
+                           headers={"Authorization": f"Bearer {api_key}"})
+
+    first = post()
+    assert first.status_code == 200 and first.headers["X-RateLimit-Remaining"] == "0"
+    second = post()
+    assert second.status_code == 429 and "Retry-After" in second.headers
@@ -0,0 +1,112 @@
+import json
+import pytest
+from app.config import Config
+from app.services.response_cache_service import (
+    BYTES_KEY, LRU_KEY, SIZES_KEY, cache_policy, get_cached_completion, replay_stream, store_completion, store_stream
+)
+
+@pytest.fixture
+def cache(redis, monkeypatch):
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_SHARED", False)
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_TTL", 3600)
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_MAX_BYTES", 10000)
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_MAX_ENTRY_BYTES", 10000)
+    return redis
+
+def request(**overrides):
+    data = {"model": "Stub/a", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+    data.update(overrides)
+    return data
+
+def policy(key):
+    return {"key": f"response_cache:{key}", "read": True, "write": True}
+
+def test_only_deterministic_requests_are_cached(cache):
+    assert cache_policy(request(), "k", {}) is not None
+    assert cache_policy(request(temperature=0.7), "k", {}) is None
+    assert cache_policy(request(modalities=["text", "audio"]), "k", {}) is None
+
+def test_streamed_and_plain_requests_share_an_entry_private_to_the_key(cache, monkeypatch):
+    key = cache_policy(request(), "k", {})["key"]
+    assert cache_policy(request(stream=True), "k", {})["key"] == key
+    assert cache_policy(request(), "other", {})["key"] != key
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_SHARED", True)
+    assert cache_policy(request(), "k", {})["key"] == cache_policy(request(), "other", {})["key"]
+
+def test_cache_control_skips_the_read_or_the_write(cache):
+    assert cache_policy(request(), "k", {"Cache-Control": "no-cache"})["read"] is False
+    assert cache_policy(request(), "k", {"Cache-Control": "no-store"})["write"] is False
+
+def test_per_key_setting_overrides_the_default(cache, monkeypatch):
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_ENABLED", False)
+    monkeypatch.setattr(Config, "API_KEY_SETTINGS", {"k": {"response_cache": True}})
+    assert cache_policy(request(), "k", {}) is not None
+    assert cache_policy(request(), "other", {}) is None
+
+def test_entries_are_sized_and_least_recently_used_evicted(cache, monkeypatch):
+    store_stream(policy("a"), "Stub/a", "x" * 3000, 1)
+    store_stream(policy("b"), "Stub/a", "x" * 3000, 1)
+    assert int(cache.get(BYTES_KEY)) == sum(int(v) for v in cache.hvals(SIZES_KEY))
+    get_cached_completion(policy("a"))
+    store_stream(policy("c"), "Stub/a", "x" * 5000, 1)
+    assert cache.exists("response_cache:a") and not cache.exists("response_cache:b")
+    assert cache.zrange(LRU_KEY, 0, -1) == ["response_cache:a", "response_cache:c"]
+    assert int(cache.get(BYTES_KEY)) <= 10000
+
+def test_rewriting_an_entry_replaces_its_size(cache):
+    store_stream(policy("a"), "Stub/a", "x" * 3000, 1)
+    store_stream(policy("a"), "Stub/a", "x" * 10, 1)
+    assert int(cache.get(BYTES_KEY)) == int(cache.hget(SIZES_KEY, "response_cache:a")) < 200
+
+def test_expired_entries_are_dropped_from_the_index(cache, monkeypatch):
+    store_stream(policy("a"), "Stub/a", "old", 1)
+    cache.zadd(LRU_KEY, {"response_cache:a": 0})
+    store_stream(policy("b"), "Stub/a", "new", 1)
+    assert cache.zrange(LRU_KEY, 0, -1) == ["response_cache:b"]
+    assert not cache.hexists(SIZES_KEY, "response_cache:a")
+
+def test_oversized_and_unfinished_responses_are_not_stored(cache, monkeypatch):
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_MAX_ENTRY_BYTES", 100)
+    store_stream(policy("a"), "Stub/a", "x" * 200, 1)
+    store_completion(policy("b"), "Stub/a", {"choices": [{"message": {"content": "hi"}, "finish_reason": "tool_calls"}]}, 1)
+    assert not cache.exists("response_cache:a") and not cache.exists("response_cache:b")
+
+def test_replay_frames_the_text_as_chunks(monkeypatch):
+    monkeypatch.setattr(Config, "RESPONSE_CACHE_REPLAY_CHUNK_CHARS", 4)
+    frames = list(replay_stream({"model_id": "Stub/a", "content": "hello world", "finish_reason": "stop"}))
+    assert frames[-1] == "data: [DONE]\n\n"
+    chunks = [json.loads(f[6:]) for f in frames[:-1]]
+    assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks) == "hello world"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+def post(app, api_key, headers=None, **body):
+    return app.test_client().post("/v1/chat/completions", json=request(**body),
+                                  headers={"Authorization": f"Bearer {api_key}", **(headers or {})})
+
+def test_repeated_request_is_answered_from_the_cache(app, cache, providers, api_key, usage):
+    provider = providers("Stub/a", text="cached words")
+    first = post(app, api_key)
+    second = post(app, api_key)
+    assert "X-Cache" not in first.headers and second.headers["X-Cache"] == "HIT"
+    assert second.get_json()["choices"][0]["message"]["content"] == "cached words"
+    assert provider.calls == ["Stub/a"]
+    assert usage[-1]["cached"] is True
+
+def test_stream_is_cached_and_replayed(app, cache, providers, api_key, usage):
+    provider = providers("Stub/a", text="one two three")
+    post(app, api_key, stream=True).get_data()
+    replay = post(app, api_key, stream=True)
+    assert replay.headers["X-Cache"] == "HIT"
+    assert "one two three" in "".join(
+        json.loads(line[6:])["choices"][0]["delta"].get("content", "")
+        for line in replay.get_data(as_text=True).splitlines() if line.startswith("data: {")
+    )
+    assert post(app, api_key).headers["X-Cache"] == "HIT"
+    assert provider.calls == ["Stub/a"]
+
+def test_no_cache_request_goes_upstream(app, cache, providers, api_key, usage):
+    provider = providers("Stub/a")
+    post(app, api_key)
+    assert "X-Cache" not in post(app, api_key, headers={"Cache-Control": "no-cache"}).headers
+    assert provider.calls == ["Stub/a", "Stub/a"]
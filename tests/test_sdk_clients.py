@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+import httpx
+import pytest
+from app.config import Config
+from app.providers import sdk_clients
+from app.providers.sdk_clients import ProcessLocalClient, reset_after_fork, sdk_client_kwargs, sdk_client_settings
+
+def test_per_provider_settings_override_the_defaults(monkeypatch):
+    monkeypatch.setattr(Config, "SDK_POOL_MAX_CONNECTIONS", 50)
+    monkeypatch.setattr(Config, "SDK_CLIENT_SETTINGS", {"provider-9": {"max_connections": 5, "max_retries": 2}})
+    assert sdk_client_settings("provider-2")["max_connections"] == 50
+    settings = sdk_client_settings("provider-9")
+    assert (settings["max_connections"], settings["max_retries"]) == (5, 2)
+
+def test_client_kwargs_carry_the_pool_limits_retries_and_timeout(monkeypatch):
+    monkeypatch.setattr(Config, "SDK_CLIENT_SETTINGS", {"provider-test": {"timeout": 42, "max_retries": 0}})
+    kwargs = sdk_client_kwargs("provider-test")
+    assert kwargs["max_retries"] == 0
+    assert kwargs["timeout"].read == 42
+    assert isinstance(kwargs["http_client"], httpx.Client)
+    assert isinstance(sdk_client_kwargs("provider-test", is_async=True)["http_client"], httpx.AsyncClient)
+
+def test_requests_are_counted_until_their_response_is_closed(monkeypatch):
+    observed = []
+    monkeypatch.setattr(sdk_clients, "observe_response", lambda *args: observed.append(args[:3]))
+    monkeypatch.setattr(httpx.HTTPTransport, "handle_request",
+                        lambda self, request: httpx.Response(200, headers={"x-ratelimit-remaining-requests": "9"},
+                                                             stream=httpx.ByteStream(b"{}")))
+    client = sdk_client_kwargs("provider-count")["http_client"]
+    stats = sdk_clients.pool_registry._stats["provider-count"]
+    with client.stream("POST", "http://up.test/v1/chat/completions") as response:
+        assert stats.requests == 1
+        response.read()
+    assert stats.requests == 0
+    assert observed[0][0] == "provider-count" and observed[0][2] == 200
+    assert sdk_clients.get_sdk_pool_stats()["provider-count"] == {"in_use": 0, "idle": 0, "waiters": 0}
+
+def test_failed_requests_are_not_left_counted(monkeypatch):
+    def fail(self, request):
+        raise httpx.ConnectError("refused")
+
+    monkeypatch.setattr(httpx.HTTPTransport, "handle_request", fail)
+    client = sdk_client_kwargs("provider-fail")["http_client"]
+    with pytest.raises(httpx.ConnectError):
+        client.get("http://up.test/")
+    assert sdk_clients.pool_registry._stats["provider-fail"].requests == 0
+
+def test_process_local_client_is_rebuilt_after_a_fork(monkeypatch):
+    built = []
+    client = ProcessLocalClient(lambda: built.append(object()) or built[-1])
+    first = client.get()
+    assert client.get() is first
+    monkeypatch.setattr(sdk_clients, "os", SimpleNamespace(getpid=lambda: -1))
+    assert client.get() is not first
+    reset_after_fork()
+    assert client._client is None
+    assert len(built) == 2
@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+import pytest
+from app.config import Config
+from app.services import single_flight_service
+from app.services.single_flight_service import _start, arun_once, flight_key, run_once
+
+@pytest.fixture
+def flights(redis, monkeypatch):
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_DISTRIBUTED", False)
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_POLL_SECONDS", 0.05)
+    yield
+    assert single_flight_service._flights == {}
+
+class Upstream:
+    """A provider call: counts calls and answers after `delay`, streaming `words` with `chunk_delay` between them."""
+
+    def __init__(self, words=("a", "b", "c"), delay=0.1, chunk_delay=0.0, error=None):
+        self.words = list(words)
+        self.delay = delay
+        self.chunk_delay = chunk_delay
+        self.error = error
+        self.calls = 0
+        self.closed = 0
+
+    def call(self, attempts, stream):
+        def make():
+            self.calls += 1
+            time.sleep(self.delay)
+            attempts.append({"model_id": "Stub/b", "error": "failed"})
+            if self.error is not None:
+                raise self.error
+            attempts.append({"model_id": "Stub/a", "error": None})
+            return self._chunks() if stream else {"choices": [{"message": {"content": " ".join(self.words)}}]}
+        return make
+
+    def _chunks(self):
+        try:
+            for word in self.words:
+                time.sleep(self.chunk_delay)
+                yield word
+        finally:
+            self.closed += 1
+
+def concurrently(count, target):
+    results = [None] * count
+    errors = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target(i)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+def test_flight_key_is_per_api_key_unless_shared(flights, monkeypatch):
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_ENABLED", True)
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_SHARED", False)
+    data = {"model": "Stub/a", "messages": []}
+    assert flight_key(data, "k") != flight_key(data, "other")
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_SHARED", True)
+    assert flight_key(data, "k") == flight_key(data, "other")
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_ENABLED", False)
+    assert flight_key(data, "k") is None
+
+def test_concurrent_identical_calls_share_one_upstream_call(flights):
+    upstream = Upstream()
+    attempts = [[] for _ in range(4)]
+    results, errors = concurrently(4, lambda i: run_once("k", upstream.call(attempts[i], False), attempts[i]))
+    assert errors == [None] * 4 and upstream.calls == 1
+    assert all(r == results[0] for r in results) and len({id(r) for r in results}) == 4
+    assert [a["model_id"] for a in attempts[0]] == ["Stub/b", "Stub/a"]
+    assert all(a == [{"model_id": "Stub/a", "error": None}] for a in attempts[1:])
+
+def test_calls_after_the_flight_landed_go_upstream_again(flights):
+    upstream = Upstream(delay=0)
+    run_once("k", upstream.call([], False), [])
+    run_once("k", upstream.call([], False), [])
+    assert upstream.calls == 2
+
+def test_no_key_means_no_coalescing(flights):
+    upstream = Upstream()
+    concurrently(3, lambda i: run_once(None, upstream.call([], False), []))
+    assert upstream.calls == 3
+
+def test_leader_error_is_raised_in_every_caller(flights):
+    upstream = Upstream(error=RuntimeError("upstream down"))
+    results, errors = concurrently(3, lambda i: run_once("k", upstream.call([], False), []))
+    assert upstream.calls == 1
+    assert all(isinstance(e, RuntimeError) for e in errors)
+
+def test_every_caller_reads_the_whole_shared_stream(flights):
+    upstream = Upstream(words=[str(i) for i in range(20)], chunk_delay=0.01)
+
+    def read(i):
+        subscription = run_once("k", upstream.call([], True), [], stream=True)
+        try:
+            return list(subscription)
+        finally:
+            subscription.close()
+
+    results, errors = concurrently(4, read)
+    assert errors == [None] * 4 and upstream.calls == 1
+    assert all(r == [str(i) for i in range(20)] for r in results)
+    assert upstream.closed == 1
+
+def test_upstream_stays_open_until_its_last_caller_leaves(flights):
+    upstream = Upstream(words=["a", "b", "c"], delay=0)
+    first = run_once("k", upstream.call([], True), [], stream=True)
+    second = run_once("k", upstream.call([], True), [], stream=True)
+    assert next(first) == "a" and next(second) == "a"
+    first.close()
+    assert upstream.closed == 0
+    assert next(second) == "b"
+    second.close()
+    assert upstream.closed == 1
+
+def test_stream_error_reaches_every_caller(flights):
+    def chunks():
+        yield "a"
+        raise ConnectionError("reset")
+
+    first = run_once("k", lambda: chunks(), [], stream=True)
+    second = run_once("k", lambda: None, [], stream=True)
+    assert next(first) == "a"
+    with pytest.raises(ConnectionError):
+        next(first)
+    assert next(second) == "a"
+    with pytest.raises(ConnectionError):
+        next(second)
+    first.close()
+    second.close()
+
+def test_async_callers_share_one_call(flights):
+    upstream = Upstream(delay=0)
+
+    async def call():
+        upstream.calls += 1
+        await asyncio.sleep(0.05)
+        return {"choices": []}
+
+    async def run():
+        return await asyncio.gather(*(arun_once("k", call, []) for _ in range(3)))
+
+    results = asyncio.run(run())
+    assert upstream.calls == 1 and results == [{"choices": []}] * 3
+
+def test_async_stream_is_shared(flights):
+    async def chunks():
+        for word in ("a", "b"):
+            await asyncio.sleep(0.01)
+            yield word
+
+    async def call():
+        return chunks()
+
+    async def read():
+        subscription = await arun_once("k", call, [], stream=True)
+        try:
+            return [chunk async for chunk in subscription]
+        finally:
+            await subscription.aclose()
+
+    async def run():
+        return await asyncio.gather(read(), read())
+
+    assert asyncio.run(run()) == [["a", "b"], ["a", "b"]]
+
+@pytest.fixture
+def distributed(flights, monkeypatch):
+    monkeypatch.setattr(Config, "SINGLE_FLIGHT_DISTRIBUTED", True)
+
+def test_other_workers_follow_the_lock_holder(distributed):
+    upstream = Upstream(words=["a", "b"], delay=0.2)
+    leader_attempts = []
+    leader = threading.Thread(target=lambda: list(run_once("k", upstream.call(leader_attempts, True), leader_attempts,
+                                                           stream=True)))
+    leader.start()
+    time.sleep(0.05)
+    attempts = []
+    result, publisher = _start("k", upstream.call(attempts, True), attempts, True, None)
+    assert list(result) == ["a", "b"] and publisher is None
+    assert attempts == [{"model_id": "Stub/a", "error": None}]
+    leader.join()
+    assert upstream.calls == 1
+
+def test_followers_call_themselves_when_the_lock_holder_fails(distributed):
+    failing = Upstream(delay=0.2, error=RuntimeError("upstream down"))
+    leader = threading.Thread(target=lambda: pytest.raises(RuntimeError, run_once, "k", failing.call([], False), []))
+    leader.start()
+    time.sleep(0.05)
+    healthy = Upstream(delay=0)
+    result, _ = _start("k", healthy.call([], False), [], False, None)
+    leader.join()
+    assert result["choices"][0]["message"]["content"] == "a b c"
+    assert healthy.calls == 1
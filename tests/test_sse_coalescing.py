@@ -0,0 +1,49 @@
+import time
+from app.utils.streaming import coalesce_frames
+
+def frames_with_delays(items):
+    for delay, frame in items:
+        time.sleep(delay)
+        yield frame
+
+def test_first_frame_is_sent_alone_then_frames_are_batched():
+    frames = frames_with_delays([(0, "a"), (0, "b"), (0, "c"), (0, "d")])
+    out = list(coalesce_frames(frames, max_bytes=1024, max_delay=0.2))
+    assert out[0] == "a"
+    assert "".join(out) == "abcd"
+    assert len(out) < 4
+
+def test_batch_is_flushed_at_max_bytes():
+    frames = frames_with_delays([(0, "x" * 10)] + [(0, "y" * 10)] * 6)
+    out = list(coalesce_frames(frames, max_bytes=20, max_delay=5))
+    assert out[0] == "x" * 10
+    assert all(len(batch) <= 20 for batch in out)
+    assert "".join(out) == "x" * 10 + "y" * 60
+
+def test_pending_batch_is_flushed_after_max_delay_when_upstream_is_quiet():
+    frames = frames_with_delays([(0, "a"), (0, "b"), (0.5, "c")])
+    stream = coalesce_frames(frames, max_bytes=1024, max_delay=0.05)
+    assert next(stream) == "a"
+    started = time.monotonic()
+    assert next(stream) == "b"
+    assert time.monotonic() - started < 0.4
+    assert next(stream) == "c"
+
+def test_closing_the_output_closes_the_frame_generator():
+    closed = []
+
+    def frames():
+        try:
+            while True:
+                yield "frame"
+                time.sleep(0.01)
+        finally:
+            closed.append(True)
+
+    stream = coalesce_frames(frames(), max_bytes=1024, max_delay=0.01)
+    next(stream)
+    stream.close()
+    deadline = time.monotonic() + 2
+    while not closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert closed
@@ -0,0 +1,12 @@
+from app.config import Config
+
+def test_admin_routes_take_the_system_secret_from_the_header_only(app, redis, monkeypatch):
+    monkeypatch.setattr(Config, "SYSTEM_SECRET", "s3cret")
+    client = app.test_client()
+    assert client.get("/v1/metrics", headers={"X-System-Secret": "s3cret"}).status_code == 200
+    assert client.get("/v1/metrics", headers={"X-System-Secret": "wrong"}).status_code == 401
+    assert client.get("/v1/metrics?secret=s3cret").status_code == 401
+
+def test_admin_routes_are_closed_without_a_system_secret(app, redis, monkeypatch):
+    monkeypatch.setattr(Config, "SYSTEM_SECRET", None)
+    assert app.test_client().get("/v1/metrics", headers={"X-System-Secret": ""}).status_code == 401
@@ -0,0 +1,115 @@
+import time
+import pytest
+from app.config import Config
+from app.services.upstream_budget_service import (
+    UpstreamBudgetExhaustedError, budget_tracker, budget_wait, get_budget_stats, key_budget_waits, key_id,
+    observe_response, parse_budget, parse_retry_after, request_key_id, wait_for_budget
+)
+
+NOW = 1_700_000_000.0
+
+@pytest.fixture
+def budgets(redis, monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_ENABLED", True)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_RESERVE_REQUESTS", 0)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_RESERVE_TOKENS", 100)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_MAX_DELAY", 2)
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_CACHE_SECONDS", 0)
+    budget_tracker.reset()
+    yield redis
+    budget_tracker.reset()
+
+def exhausted(seconds):
+    return {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": f"{seconds}s"}
+
+@pytest.mark.parametrize("reset, expected", [("1s", NOW + 1), ("6m0s", NOW + 360), ("20ms", NOW + 0.02),
+                                             ("30", NOW + 30), (str(NOW + 5), NOW + 5),
+                                             (str(int((NOW + 5) * 1000)), NOW + 5), ("soon", None)])
+def test_reset_formats(reset, expected):
+    budget = parse_budget({"x-ratelimit-remaining-tokens": "10", "x-ratelimit-reset-tokens": reset}, now=NOW)
+    assert budget.get("tokens_reset_at") == (pytest.approx(expected) if expected else None)
+
+def test_openai_headers_are_parsed():
+    budget = parse_budget({
+        "x-ratelimit-remaining-requests": "59", "x-ratelimit-limit-requests": "60", "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-remaining-tokens": "149000", "x-ratelimit-limit-tokens": "150000",
+    }, now=NOW)
+    assert budget == {"remaining_requests": 59, "limit_requests": 60, "requests_reset_at": NOW + 1,
+                      "remaining_tokens": 149000, "limit_tokens": 150000, "updated_at": NOW}
+
+def test_unprefixed_headers_count_as_requests():
+    budget = parse_budget({"x-ratelimit-remaining": "3", "x-ratelimit-reset": "10"}, now=NOW)
+    assert budget["remaining_requests"] == 3 and budget["requests_reset_at"] == NOW + 10
+
+def test_no_headers_no_budget():
+    assert parse_budget({}, 200, now=NOW) == {}
+
+@pytest.mark.parametrize("headers, backoff", [({"retry-after-ms": "1500"}, 1.5), ({"Retry-After": "7"}, 7), ({}, 5)])
+def test_429_blocks_for_its_retry_after(headers, backoff, monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_DEFAULT_BACKOFF", 5)
+    budget = parse_budget(headers, 429, now=NOW)
+    assert budget["remaining_requests"] == 0
+    assert budget["requests_reset_at"] == pytest.approx(NOW + backoff)
+
+def test_default_backoff_is_waited_out_not_rerouted(budgets):
+    assert Config.UPSTREAM_BUDGET_DEFAULT_BACKOFF <= Config.UPSTREAM_BUDGET_MAX_DELAY
+    observe_response("stub", {}, 429)
+    assert 0 < budget_wait("stub") <= Config.UPSTREAM_BUDGET_DEFAULT_BACKOFF
+
+def test_retry_after_accepts_http_dates():
+    assert parse_retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert parse_retry_after({"Retry-After": "garbage"}) is None
+
+def test_request_key_id_comes_from_the_credentials():
+    assert request_key_id({"Authorization": "Bearer sk-1"}) == key_id("sk-1")
+    assert request_key_id({"api-key": "azure-1"}) == key_id("azure-1")
+    assert request_key_id({}) == "default"
+
+def test_upstream_waits_only_once_every_key_is_used_up(budgets):
+    observe_response("stub", exhausted(30), 200, {"Authorization": "Bearer a"})
+    assert key_budget_waits("stub").keys() == {key_id("a")}
+    assert budget_wait("stub") > 0
+    observe_response("stub", {"x-ratelimit-remaining-requests": "5"}, 200, {"Authorization": "Bearer b"})
+    assert budget_wait("stub") == 0
+
+def test_tokens_within_the_reserve_count_as_used_up(budgets):
+    observe_response("stub", {"x-ratelimit-remaining-tokens": "100", "x-ratelimit-reset-tokens": "30s"})
+    assert 29 < budget_wait("stub") <= 30
+
+def test_budgets_are_shared_through_redis(budgets):
+    observe_response("stub", exhausted(30))
+    assert budgets.ttl("upstream_budget:stub") == 60
+    budget_tracker.reset()
+    assert budget_wait("stub") > 0
+
+def test_short_wait_is_slept_off_and_a_long_one_rejected(budgets):
+    observe_response("stub", exhausted(0.2))
+    started = time.monotonic()
+    wait_for_budget("stub")
+    assert time.monotonic() - started >= 0.1
+    observe_response("stub", exhausted(30))
+    with pytest.raises(UpstreamBudgetExhaustedError) as error:
+        wait_for_budget("stub")
+    assert error.value.retry_after == 30
+
+def test_disabled_budgets_are_neither_recorded_nor_enforced(budgets, monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_BUDGET_ENABLED", False)
+    observe_response("stub", exhausted(30))
+    assert not budgets.exists("upstream_budget:stub")
+    wait_for_budget("stub")
+
+def test_stats_list_the_wait_per_key(budgets):
+    observe_response("stub", exhausted(30))
+    entry = get_budget_stats()["stub"]["default"]
+    assert entry["remaining_requests"] == 0
+    assert 29 <= entry["requests_reset_in"] <= 30 and entry["wait"] == entry["requests_reset_in"]
+
+def test_exhausted_member_is_skipped_for_the_next(app, budgets, providers, groups, monkeypatch):
+    monkeypatch.setattr(Config, "LOAD_BALANCING_ENABLED", False)
+    tired = providers("Stub/a")
+    fresh = providers("Stub/b", text="from b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    observe_response(app.provider_manager.resolve("Stub/a")[0], exhausted(30))
+    result = app.provider_manager.chat_completion("stub", [{"role": "user", "content": "hi"}])
+    assert result["choices"][0]["message"]["content"] == "from b"
+    assert tired.calls == [] and fresh.calls == ["Stub/b"]
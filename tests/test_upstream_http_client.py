@@ -0,0 +1,107 @@
+import threading
+from types import SimpleNamespace
+import pytest
+from app.providers import http_client
+from app.providers.http_client import UpstreamHTTPClient, _LeakTracker, get_stream_counts
+
+class FakeResponse:
+    raw = None
+
+    def __init__(self):
+        self.status_code = 200
+        self.headers = {}
+        self.url = "http://upstream.test/v1/chat/completions"
+        self.request = SimpleNamespace(method="POST", headers={})
+        self.closes = 0
+
+    def close(self):
+        self.closes += 1
+
+@pytest.fixture
+def client(redis, monkeypatch):
+    client = UpstreamHTTPClient("Provider-test")
+    responses = []
+
+    def request(method, url, **kwargs):
+        responses.append(FakeResponse())
+        return responses[-1]
+
+    monkeypatch.setattr(client.session, "request", request)
+    client.responses = responses
+    return client
+
+def in_flight():
+    return get_stream_counts().get("upstream.test", {}).get("HTTP/1.1", 0)
+
+def test_response_is_closed_when_the_block_exits(client):
+    with client.request("POST", "http://upstream.test/v1/chat/completions") as response:
+        assert in_flight() == 1
+    assert response.closes == 1
+    assert in_flight() == 0
+
+def test_response_is_closed_when_the_block_raises(client):
+    with pytest.raises(RuntimeError):
+        with client.request("POST", "http://upstream.test/v1/chat/completions"):
+            raise RuntimeError("bad status")
+    assert client.responses[0].closes == 1
+    assert in_flight() == 0
+
+def test_stream_owns_the_response_until_it_is_exhausted(client):
+    with client.request("POST", "http://upstream.test/v1/chat/completions") as response:
+        stream = client.stream_chunks(response, (chunk for chunk in ["a", "b"]))
+    assert response.closes == 0
+    assert list(stream) == ["a", "b"]
+    assert response.closes == 1
+    assert in_flight() == 0
+
+def test_stream_closed_before_iteration_releases_the_response(client):
+    with client.request("POST", "http://upstream.test/v1/chat/completions") as response:
+        stream = client.stream_chunks(response, (chunk for chunk in ["a"]))
+    stream.close()
+    assert response.closes == 1
+
+def test_stream_failure_releases_the_response(client):
+    def chunks():
+        yield "a"
+        raise ConnectionError("reset")
+
+    with client.request("POST", "http://upstream.test/v1/chat/completions") as response:
+        stream = client.stream_chunks(response, chunks())
+    assert next(stream) == "a"
+    with pytest.raises(ConnectionError):
+        next(stream)
+    assert response.closes == 1
+
+def test_stream_read_in_another_thread_is_shut_down_on_close(client):
+    shut_down = threading.Event()
+
+    def chunks():
+        yield "a"
+        shut_down.wait(5)
+        raise ConnectionError("connection shut down")
+
+    with client.request("POST", "http://upstream.test/v1/chat/completions") as response:
+        stream = client.stream_chunks(response, chunks())
+    response.raw = SimpleNamespace(shutdown=shut_down.set)
+    assert next(stream) == "a"
+
+    def read():
+        with pytest.raises(ConnectionError):
+            next(stream)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    reader.join(0.1)
+    stream.close()
+    reader.join(1)
+    assert shut_down.is_set() and not reader.is_alive()
+
+def test_leak_tracker_lists_open_responses_until_they_are_closed(monkeypatch):
+    monkeypatch.setattr(http_client.threading, "Thread", lambda **kwargs: SimpleNamespace(start=lambda: None))
+    tracker = _LeakTracker(threshold=60)
+    response = FakeResponse()
+    tracker.track("Provider-test", response)
+    assert [entry[0] for entry in tracker.open_responses()] == ["Provider-test"]
+    response.close()
+    assert tracker.open_responses() == []
+    assert response.closes == 1
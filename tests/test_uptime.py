@@ -0,0 +1,223 @@
+import json
+import os
+import time
+from types import SimpleNamespace
+import pytest
+from app.config import Config
+from app.services import uptime_service
+from app.services.bulkhead_service import BulkheadFullError
+from app.services.uptime_service import (
+    WINDOWS, _claim, demote_degraded, ensure_prober, get_uptime, get_window_stats, probe, probe_models, record_probe
+)
+
+@pytest.fixture
+def uptime(redis, monkeypatch):
+    monkeypatch.setattr(Config, "UPTIME_CACHE_SECONDS", 0)
+    monkeypatch.setattr(Config, "UPTIME_PROBE_MODELS", [])
+    monkeypatch.setattr(uptime_service, "_cache", {})
+    monkeypatch.setattr(uptime_service, "_window_cache", {})
+    return redis
+
+@pytest.fixture
+def prober(monkeypatch):
+    """Records prober starts instead of running the scheduler."""
+    started = []
+    monkeypatch.setattr(uptime_service, "_prober_pid", None)
+    monkeypatch.setattr(uptime_service, "_schedule", lambda: started.append(os.getpid()))
+    return started
+
+def test_no_probes_run_unless_enabled(app, prober, monkeypatch):
+    monkeypatch.setattr(Config, "UPTIME_PROBE_ENABLED", False)
+    ensure_prober()
+    assert uptime_service._prober_pid is None and prober == []
+
+def test_prober_starts_once_per_process(app, prober, monkeypatch):
+    monkeypatch.setattr(Config, "UPTIME_PROBE_ENABLED", True)
+    ensure_prober()
+    ensure_prober()
+    time.sleep(0.05)
+    assert uptime_service._prober_pid == os.getpid() and prober == [os.getpid()]
+
+def test_unprobed_models_are_unknown(uptime):
+    assert get_uptime(["Stub/a"])["Stub/a"]["status"] == "unknown"
+
+def test_successful_probe_is_recorded_as_up(app, uptime, providers):
+    providers("Stub/a")
+    probe("Stub/a")
+    result = get_uptime(["Stub/a"])["Stub/a"]
+    assert result["status"] == "up" and result["ttfb"] is not None and result["error"] is None
+    assert result["last_up_at"] == result["checked_at"]
+    assert [entry["up"] for entry in result["history"]] == [True]
+
+def test_failed_probe_is_recorded_as_down(app, uptime, providers):
+    providers("Stub/a", error=ConnectionError("refused"))
+    probe("Stub/a")
+    result = get_uptime(["Stub/a"])["Stub/a"]
+    assert result["status"] == "down" and "refused" in result["error"]
+    assert result["last_up_at"] is None
+
+def test_probe_turned_away_locally_records_nothing(app, uptime, providers):
+    providers("Stub/a", error=BulkheadFullError("stub", "queue_full"))
+    probe("Stub/a")
+    assert get_uptime(["Stub/a"])["Stub/a"]["status"] == "unknown"
+
+def test_history_is_newest_first_and_bounded(uptime, monkeypatch):
+    monkeypatch.setattr(Config, "UPTIME_HISTORY", 3)
+    for up in (True, True, False, True, False):
+        record_probe("Stub/a", up, ttfb=0.1 if up else None)
+    history = get_uptime(["Stub/a"])["Stub/a"]["history"]
+    assert [entry["up"] for entry in history] == [False, True, False]
+
+def test_one_worker_probes_a_model_per_interval(uptime, monkeypatch):
+    monkeypatch.setattr(Config, "UPTIME_PROBE_INTERVAL", 60)
+    assert _claim("Stub/a") is True
+    assert _claim("Stub/a") is False
+    assert _claim("Stub/b") is True
+    assert 0 < uptime.pttl("uptime:Stub/a:lock") <= 60 * (1 - Config.UPTIME_PROBE_JITTER) * 1000
+
+def test_probed_models_skip_image_and_audio_models(app, providers, monkeypatch):
+    providers("Stub/a")
+    models = probe_models(app.provider_manager)
+    assert "Stub/a" in models and "Provider-6/flux-schnell" not in models
+    monkeypatch.setattr(Config, "UPTIME_PROBE_MODELS", ["Stub/a", "Unknown/model"])
+    assert probe_models(app.provider_manager) == ["Stub/a"]
+
+def test_uptime_endpoint_reports_the_last_probe(app, uptime, providers, groups):
+    providers("Stub/a", "Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    client = app.test_client()
+    assert client.get("/v1/uptime/Stub/a").status_code == 503
+    assert client.get("/v1/uptime/Unknown/model").status_code == 404
+    record_probe("Stub/a", False, error="refused")
+    record_probe("Stub/b", True, ttfb=0.2)
+    down = client.get("/v1/uptime/Stub/a")
+    assert down.status_code == 503 and down.get_json()["status"] == "down"
+    group = client.get("/v1/uptime/stub")
+    assert group.status_code == 200
+    assert [m["status"] for m in group.get_json()["members"]] == ["down", "up"]
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+@pytest.fixture
+def clock(uptime, monkeypatch):
+    """Records probes at chosen times: clock.record(model, up, ttfb=None, at=seconds from the start)."""
+    start = time.time()
+    now = [start]
+    monkeypatch.setattr(uptime_service, "time", SimpleNamespace(time=lambda: now[0], monotonic=time.monotonic))
+
+    def record(model_id, up, ttfb=None, at=0):
+        now[0] = start + at
+        record_probe(model_id, up, ttfb=ttfb)
+
+    return SimpleNamespace(record=record, start=start)
+
+def recount(redis, model_id, now):
+    """Window totals counted from the series, for comparison with the running ones."""
+    samples = [json.loads(s) for s in redis.zrange(f"uptime:{model_id}:series", 0, -1)]
+    counts = {}
+    for name, window in WINDOWS.items():
+        inside = [s for s in samples if s["t"] > now - window]
+        counts[name] = (len(inside), sum(s["up"] for s in inside))
+    return counts
+
+def totals(redis, model_id):
+    counts = {}
+    for name in WINDOWS:
+        entry = redis.hgetall(f"uptime:{model_id}:{name}")
+        counts[name] = (int(float(entry.get("n", 0))), int(float(entry.get("up", 0))))
+    return counts
+
+def test_each_window_counts_its_own_probes(clock):
+    clock.record("Stub/a", True, ttfb=0.2, at=0)
+    clock.record("Stub/a", False, at=2 * DAY - 2 * HOUR)
+    clock.record("Stub/a", True, ttfb=0.4, at=2 * DAY)
+    stats = get_window_stats(["Stub/a"])["Stub/a"]
+    assert (stats["1h"]["probes"], stats["1h"]["uptime"]) == (1, 100.0)
+    assert (stats["24h"]["probes"], stats["24h"]["uptime"]) == (2, 50.0)
+    assert (stats["7d"]["probes"], stats["7d"]["uptime"]) == (3, pytest.approx(66.67))
+
+def test_running_totals_match_a_recount(clock, uptime):
+    at = 0
+    for i in range(60):
+        at += (i % 7 + 1) * 20 * 60
+        clock.record("Stub/a", i % 3 != 0, ttfb=0.1 if i % 3 else None, at=at)
+    assert totals(uptime, "Stub/a") == recount(uptime, "Stub/a", clock.start + at)
+
+def test_expired_totals_are_rebuilt_from_the_series(clock, uptime):
+    for at in (0, 10 * 60, 20 * 60):
+        clock.record("Stub/a", True, ttfb=0.1, at=at)
+    uptime.delete("uptime:Stub/a:1h", "uptime:Stub/a:24h")
+    clock.record("Stub/a", False, at=30 * 60)
+    assert totals(uptime, "Stub/a") == recount(uptime, "Stub/a", clock.start + 30 * 60)
+    assert totals(uptime, "Stub/a")["1h"] == (4, 3)
+
+def test_series_keeps_a_week(clock, uptime):
+    clock.record("Stub/a", True, ttfb=0.1, at=0)
+    clock.record("Stub/a", True, ttfb=0.1, at=8 * DAY)
+    assert uptime.zcard("uptime:Stub/a:series") == 1
+
+def test_ttfb_percentiles_come_from_the_histogram(clock):
+    for i in range(99):
+        clock.record("Stub/a", True, ttfb=0.1, at=i)
+    clock.record("Stub/a", True, ttfb=2.0, at=100)
+    hour = get_window_stats(["Stub/a"])["Stub/a"]["1h"]
+    assert hour["ttfb_p50"] == pytest.approx(0.1, rel=0.12)
+    assert hour["ttfb_p90"] == pytest.approx(0.1, rel=0.12)
+    assert hour["ttfb_p99"] == pytest.approx(0.1, rel=0.12)
+    clock.record("Stub/a", True, ttfb=2.0, at=101)
+    assert get_window_stats(["Stub/a"])["Stub/a"]["1h"]["ttfb_p99"] == pytest.approx(2.0, rel=0.12)
+
+def test_throughput_is_averaged_over_the_window(clock, monkeypatch):
+    rates = iter([40.0, 60.0])
+    monkeypatch.setattr(uptime_service, "get_stats", lambda model_ids: {m: {"tps": next(rates)} for m in model_ids})
+    clock.record("Stub/a", True, ttfb=0.1, at=0)
+    clock.record("Stub/a", True, ttfb=0.1, at=60)
+    assert get_window_stats(["Stub/a"])["Stub/a"]["1h"]["tps"] == 50.0
+
+def test_models_without_probes_have_no_windows(uptime):
+    assert get_window_stats(["Stub/a"])["Stub/a"] == {name: None for name in WINDOWS}
+
+@pytest.fixture
+def demotion(clock, monkeypatch):
+    monkeypatch.setattr(Config, "UPTIME_PROBE_ENABLED", True)
+    monkeypatch.setattr(Config, "UPTIME_DEMOTE_BELOW", 90)
+    monkeypatch.setattr(Config, "UPTIME_DEMOTE_MIN_PROBES", 3)
+    monkeypatch.setattr(uptime_service, "ensure_prober", lambda: None)
+    return clock
+
+def test_degraded_members_are_tried_last(demotion):
+    for i, up in enumerate((True, False, False, True)):
+        demotion.record("Stub/a", up, ttfb=0.1 if up else None, at=i)
+    for i in range(4):
+        demotion.record("Stub/b", True, ttfb=0.1, at=i)
+    assert demote_degraded(["Stub/a", "Stub/b", "Stub/c"]) == ["Stub/b", "Stub/c", "Stub/a"]
+
+def test_too_few_probes_do_not_demote(demotion):
+    demotion.record("Stub/a", False, at=0)
+    assert demote_degraded(["Stub/a", "Stub/b"]) == ["Stub/a", "Stub/b"]
+
+def test_nothing_is_demoted_without_probes(demotion, monkeypatch):
+    for i in range(4):
+        demotion.record("Stub/a", False, at=i)
+    monkeypatch.setattr(Config, "UPTIME_PROBE_ENABLED", False)
+    assert demote_degraded(["Stub/a", "Stub/b"]) == ["Stub/a", "Stub/b"]
+
+def test_group_candidates_put_degraded_members_last(app, demotion, providers, groups, monkeypatch):
+    monkeypatch.setattr(Config, "LOAD_BALANCING_ENABLED", False)
+    providers("Stub/a", "Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    for i in range(4):
+        demotion.record("Stub/a", False, at=i)
+    assert app.provider_manager.candidates("stub") == ["Stub/b", "Stub/a"]
+
+def test_status_page_reports_models_and_groups(app, clock, providers, groups, monkeypatch):
+    providers("Stub/a", "Stub/b")
+    groups({"stub": ["Stub/a", "Stub/b"]})
+    monkeypatch.setattr(Config, "UPTIME_PROBE_MODELS", ["Stub/a", "Stub/b"])
+    clock.record("Stub/a", False, at=0)
+    clock.record("Stub/b", True, ttfb=0.3, at=0)
+    body = app.test_client().get("/v1/status").get_json()
+    assert body["models"]["Stub/a"]["status"] == "down"
+    assert body["models"]["Stub/b"]["windows"]["1h"]["uptime"] == 100.0
+    assert body["groups"]["stub"] == {"status": "up", "members": ["Stub/a", "Stub/b"]}